@@ -28,6 +28,14 @@ django_application = get_asgi_application()
 # Import websocket application here, so apps from django_application are loaded first
 from config.websocket import websocket_application  # noqa: E402
 
+# Build the process-wide KM source registry once per worker, without blocking startup
+from django.conf import settings  # noqa: E402
+
+if getattr(settings, "KM_WARM_ON_START", True):
+    from maya_sawa_v2.ai_processing.km_sources.registry import warm_km_manager  # noqa: E402
+
+    warm_km_manager(background=True)
+
 
 async def application(scope, receive, send):
     if scope["type"] == "http":
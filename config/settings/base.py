@@ -391,6 +391,13 @@ CELERY_TASK_DEFAULT_QUEUE = 'maya_v2'
 CELERY_TASK_ROUTES = {
     'maya_sawa_v2.ai_processing.tasks.*': {'queue': 'maya_v2'},
 }
+CELERY_BEAT_SCHEDULE = {
+    'backfill-article-embeddings': {
+        'task': 'maya_sawa_v2.ai_processing.tasks.backfill_article_embeddings',
+        'schedule': env.float('EMBED_BACKFILL_INTERVAL_SECONDS', default=300.0),
+        'options': {'queue': 'maya_v2'},
+    },
+}
 
 # Windows compatibility settings
 import sys
@@ -418,6 +425,16 @@ SPECTACULAR_SETTINGS = {
     'SCHEMA_PATH_PREFIX': '/maya-v2/',
 }
 
+# Knowledge Base (KM) Sources
+# ------------------------------------------------------------------------------
+# 程序內共用的知識庫源組成（worker 啟動時讀取；修改後重新啟動 worker，或呼叫 registry.reload_km_manager()）
+KM_SOURCES = [
+    {'class': 'maya_sawa_v2.ai_processing.km_sources.programming.ProgrammingKMSource', 'config': {}},
+    {'class': 'maya_sawa_v2.ai_processing.km_sources.general.GeneralKMSource', 'config': {}},
+]
+# 是否在 worker 啟動時預熱知識庫源（連線池、Paprika 文章快取）
+KM_WARM_ON_START = env.bool('KM_WARM_ON_START', default=True)
+
 # API Security Configuration
 # ------------------------------------------------------------------------------
 # 控制API是否需要認證
@@ -1,13 +1,6 @@
-async def websocket_application(scope, receive, send):
-    while True:
-        event = await receive()
-
-        if event["type"] == "websocket.connect":
-            await send({"type": "websocket.accept"})
+from maya_sawa_v2.api.chat_socket import ChatSocket
 
-        if event["type"] == "websocket.disconnect":
-            break
 
-        if event["type"] == "websocket.receive":
-            if event["text"] == "ping":
-                await send({"type": "websocket.send", "text": "pong!"})
+async def websocket_application(scope, receive, send):
+    # 聊天協定見 maya_sawa_v2/api/chat_socket.py（純文字 "ping" 仍回覆 "pong!"）
+    await ChatSocket(scope, receive, send).run()
@@ -2,7 +2,7 @@ import logging
 from typing import Dict, Any
 from maya_sawa_v2.agent.models import AgentState
 from maya_sawa_v2.ai_processing.chain.service import conversation_type_service
-from maya_sawa_v2.ai_processing.km_sources.manager import KMSourceManager
+from maya_sawa_v2.ai_processing.km_sources.registry import get_km_manager
 from maya_sawa_v2.ai_processing.services.ai_response_service import AIResponseService
 from maya_sawa_v2.conversations.models import Conversation, Message
 from maya_sawa_v2.ai_processing.models import AIModel
@@ -45,8 +45,8 @@ def retrieve_knowledge_node(state: AgentState) -> AgentState:
     try:
         logger.info("Retrieving knowledge context...")
         
-        # 使用現有的 KMSourceManager
-        km_manager = KMSourceManager()
+        # 使用程序內共用的 KMSourceManager
+        km_manager = get_km_manager()
         from maya_sawa_v2.ai_processing.km_sources.base import KMQuery
         
         # 創建查詢對象
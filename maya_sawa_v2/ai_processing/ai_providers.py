@@ -1,10 +1,227 @@
 import os
+import json
+import asyncio
 import logging
+import threading
+import weakref
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional
+from collections import Counter
+from typing import Dict, Any, AsyncIterator, Iterator, List, Optional, Tuple
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_OPENAI_API_BASE = 'https://api.openai.com/v1'
+DEFAULT_DASHSCOPE_API_BASE = 'https://dashscope.aliyuncs.com/api/v1'
+
+
+class ProviderClientRegistry:
+    """程序內共用的 AI 提供者客戶端
+
+    每組 (provider, api_base, organization, api_key) 只建立一個客戶端，全部共用同一個
+    keep-alive 的 httpx 連線池，聊天回合不必再付出客戶端建構與冷 TCP/TLS 連線的成本。
+    代理設定由 AI_HTTP_TRUST_ENV 決定，不修改 os.environ（多執行緒下不安全）。
+    fork 之後（gunicorn / Celery prefork）子程序會重新建立連線池。
+
+    非同步客戶端（AsyncOpenAI、httpx.AsyncClient）的連線綁定建立時的 event loop，
+    因此依 event loop 各自快取；ASGI worker 只有一個 event loop，等同程序內共用。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._clients: Dict[Tuple[str, str, str, str], Any] = {}
+        self._http_client = None
+        self._http_options: Dict[str, Any] = {}
+        self._async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._async_http: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self.created = 0
+        self.reused = 0
+
+    @staticmethod
+    def http_options() -> Dict[str, Any]:
+        return {
+            'max_connections': int(os.getenv('AI_HTTP_MAX_CONNECTIONS', '50')),
+            'max_keepalive_connections': int(os.getenv('AI_HTTP_MAX_KEEPALIVE', '20')),
+            'keepalive_expiry': float(os.getenv('AI_HTTP_KEEPALIVE_EXPIRY', '30')),
+            'timeout': float(os.getenv('AI_HTTP_TIMEOUT', '60')),
+            'connect_timeout': float(os.getenv('AI_HTTP_CONNECT_TIMEOUT', '5')),
+            'trust_env': os.getenv('AI_HTTP_TRUST_ENV', 'false').lower() in ('1', 'true', 'yes'),
+        }
+
+    def _check_fork(self) -> None:
+        """fork 後不可沿用父程序的連線（需持有 _lock）"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._clients = {}
+            self._http_client = None
+            self._async_clients = weakref.WeakKeyDictionary()
+            self._async_http = weakref.WeakKeyDictionary()
+
+    def _httpx_options(self) -> Dict[str, Any]:
+        """httpx.Client / AsyncClient 共用的連線池參數（需持有 _lock）"""
+        options = self._http_options = self.http_options()
+        return {
+            'limits': httpx.Limits(
+                max_connections=options['max_connections'],
+                max_keepalive_connections=options['max_keepalive_connections'],
+                keepalive_expiry=options['keepalive_expiry'],
+            ),
+            'timeout': httpx.Timeout(options['timeout'], connect=options['connect_timeout']),
+            'trust_env': options['trust_env'],
+        }
+
+    def _shared_http_client(self):
+        """共用的 httpx.Client（需持有 _lock）；未安裝 httpx 時回傳 None，由 SDK 自行建立"""
+        if self._http_client is None and httpx is not None:
+            self._http_client = httpx.Client(**self._httpx_options())
+        return self._http_client
+
+    def _loop_http_client(self, loop):
+        """event loop 共用的 httpx.AsyncClient（需持有 _lock）；未安裝 httpx 時回傳 None"""
+        client = self._async_http.get(loop)
+        if client is None and httpx is not None:
+            client = self._async_http[loop] = httpx.AsyncClient(**self._httpx_options())
+        return client
+
+    def async_http_client(self):
+        """目前 event loop 共用的 httpx.AsyncClient（需在 event loop 內呼叫）"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._check_fork()
+            return self._loop_http_client(loop)
+
+    def get(self, provider: str, api_key: str, factory, api_base: str = '', organization: str = ''):
+        """取得 (或以 factory(http_client) 建立) 對應的客戶端"""
+        key = (provider, api_base or '', organization or '', api_key or '')
+        client = self._clients.get(key)
+        if client is not None and self._pid == os.getpid():
+            self.reused += 1
+            return client
+        with self._lock:
+            self._check_fork()
+            client = self._clients.get(key)
+            if client is None:
+                client = factory(self._shared_http_client())
+                self._clients[key] = client
+                self.created += 1
+                logger.info("建立 %s 客戶端（api_base=%s）", provider, api_base or 'default')
+            else:
+                self.reused += 1
+        return client
+
+    def get_async(self, provider: str, api_key: str, factory, api_base: str = '', organization: str = ''):
+        """取得 (或以 factory(async_http_client) 建立) 目前 event loop 的非同步客戶端"""
+        loop = asyncio.get_running_loop()
+        key = (provider, api_base or '', organization or '', api_key or '')
+        with self._lock:
+            self._check_fork()
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(key)
+            if client is None:
+                client = clients[key] = factory(self._loop_http_client(loop))
+                self.created += 1
+                logger.info("建立 %s 非同步客戶端（api_base=%s）", provider, api_base or 'default')
+            else:
+                self.reused += 1
+        return client
+
+    @staticmethod
+    def _openai_factory(client_class, api_key: str, base_url: Optional[str], organization: Optional[str]):
+        def factory(http_client):
+            kwargs: Dict[str, Any] = {'api_key': api_key}
+            if base_url:
+                kwargs['base_url'] = base_url
+            if organization:
+                kwargs['organization'] = organization
+            if http_client is not None:
+                kwargs['http_client'] = http_client
+            return client_class(**kwargs)
+        return factory
+
+    def openai(self, api_key: str, api_base: Optional[str] = None, organization: Optional[str] = None):
+        """OpenAI（或相容 API）的共用客戶端；非預設 api_base 時才指定 base_url"""
+        from openai import OpenAI
+
+        base_url = api_base if api_base and api_base != DEFAULT_OPENAI_API_BASE else None
+        factory = self._openai_factory(OpenAI, api_key, base_url, organization)
+        return self.get('openai', api_key, factory, base_url or '', organization or '')
+
+    def async_openai(self, api_key: str, api_base: Optional[str] = None, organization: Optional[str] = None):
+        """目前 event loop 共用的 AsyncOpenAI 客戶端"""
+        from openai import AsyncOpenAI
+
+        base_url = api_base if api_base and api_base != DEFAULT_OPENAI_API_BASE else None
+        factory = self._openai_factory(AsyncOpenAI, api_key, base_url, organization)
+        return self.get_async('openai', api_key, factory, base_url or '', organization or '')
+
+    def stats(self) -> Dict[str, Any]:
+        """客戶端數量、重用次數與共用連線池的連線狀態"""
+        with self._lock:
+            clients = Counter(key[0] for key in self._clients)
+            async_clients = Counter(key[0] for loop_clients in self._async_clients.values() for key in loop_clients)
+            http_client, options = self._http_client, self._http_options
+        http: Dict[str, Any] = {}
+        if http_client is not None:
+            http = {'max_connections': options['max_connections'],
+                    'max_keepalive_connections': options['max_keepalive_connections']}
+            try:
+                # httpcore 連線池的目前連線（httpx 未公開 transport，取不到時略過）
+                connections = list(http_client._transport._pool.connections)
+                http['connections'] = len(connections)
+                http['idle'] = sum(1 for c in connections if c.is_idle())
+            except Exception:
+                pass
+        return {'clients': dict(clients), 'async_clients': dict(async_clients), 'created': self.created, 'reused': self.reused, 'http': http}
+
+    def clear(self) -> None:
+        """關閉共用連線池並清除所有客戶端（測試、設定變更時使用）"""
+        with self._lock:
+            http_client, self._http_client = self._http_client, None
+            self._clients = {}
+            # 非同步連線需在所屬 event loop 內 aclose，這裡只放掉參照
+            self._async_clients = weakref.WeakKeyDictionary()
+            self._async_http = weakref.WeakKeyDictionary()
+            self.created = self.reused = 0
+        if http_client is not None:
+            http_client.close()
+
+
+provider_clients = ProviderClientRegistry()
+
+
+def provider_client_stats() -> Dict[str, Any]:
+    """目前程序內 AI 提供者客戶端與連線池的統計"""
+    return provider_clients.stats()
+
+
+def _system_content(context: Optional[Dict[str, Any]]) -> Optional[str]:
+    """系統提示詞與知識庫上下文合併為系統指令"""
+    if not context:
+        return None
+    parts = []
+    if context.get('system_prompt'):
+        parts.append(str(context['system_prompt']))
+    if context.get('knowledge_context'):
+        parts.append("以下是與用戶問題相關的知識庫內容，請作為主要依據回答：\n" + str(context['knowledge_context']))
+    return "\n\n".join(parts) if parts else None
+
+
+def _prior_history(message: str, context: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """conversation_history 中本回合之前的訊息
+
+    build_conversation_history 會包含剛保存的本回合用戶訊息；提供者另外送出 message，
+    結尾相同的 user 訊息需去掉，否則問題會送兩次。
+    """
+    history = list((context or {}).get('conversation_history') or [])
+    if history and history[-1].get('role') == 'user' and history[-1].get('content') == message:
+        history.pop()
+    return history
+
 
 class AIProvider(ABC):
     """AI 提供者抽象基類"""
@@ -13,6 +230,18 @@ class AIProvider(ABC):
     def generate_response(self, message: str, context: Optional[Dict[str, Any]] = None) -> str:
         pass
 
+    def generate_stream(self, message: str, context: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        """逐段產生回應文字（token delta）；未支援串流的提供者一次回傳完整回應"""
+        yield self.generate_response(message, context)
+
+    async def agenerate_response(self, message: str, context: Optional[Dict[str, Any]] = None) -> str:
+        """非同步生成回應；沒有原生非同步客戶端的提供者改在執行緒中呼叫 generate_response"""
+        return await asyncio.to_thread(self.generate_response, message, context)
+
+    async def agenerate_stream(self, message: str, context: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """非同步逐段產生回應文字；未支援非同步串流的提供者一次回傳完整回應"""
+        yield await self.agenerate_response(message, context)
+
 
 class OpenAIProvider(AIProvider):
     """OpenAI API 提供者"""
@@ -21,88 +250,56 @@ class OpenAIProvider(AIProvider):
         self.api_key = api_key or os.getenv('OPENAI_API_KEY')
         self.model = model
         self.organization = organization or os.getenv('OPENAI_ORGANIZATION')
-        self.api_base = api_base or os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
+        self.api_base = api_base or os.getenv('OPENAI_API_BASE', DEFAULT_OPENAI_API_BASE)
 
-    def generate_response(self, message: str, context: Optional[Dict[str, Any]] = None) -> str:
-        """使用 OpenAI API 生成回應"""
-        try:
-            from openai import OpenAI
+    def _client(self):
+        if not self.api_key:
+            raise ValueError("OpenAI API key not found")
+        # 共用客戶端與連線池（import openai 失敗時由呼叫端的 ImportError 處理）
+        return provider_clients.openai(self.api_key, self.api_base, self.organization)
 
-            if not self.api_key:
-                raise ValueError("OpenAI API key not found")
+    def _async_client(self):
+        if not self.api_key:
+            raise ValueError("OpenAI API key not found")
+        return provider_clients.async_openai(self.api_key, self.api_base, self.organization)
 
-            # 配置 OpenAI 客戶端 - 只傳遞支援的參數
-            client_kwargs = {
-                'api_key': self.api_key
-            }
+    @staticmethod
+    def _build_messages(message: str, context: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """構建對話歷史與知識庫上下文"""
+        messages = _prior_history(message, context)
 
-            # 只有在非預設 URL 時才添加 base_url
-            if self.api_base and self.api_base != 'https://api.openai.com/v1':
-                client_kwargs['base_url'] = self.api_base
+        system_content = _system_content(context)
+        if system_content:
+            messages.insert(0, {"role": "system", "content": system_content})
 
-            # 只有在有組織 ID 時才添加
-            if self.organization:
-                client_kwargs['organization'] = self.organization
+        messages.append({"role": "user", "content": message})
+        return messages
 
-            # 調試資訊
-            logger.info(f"Creating OpenAI client with kwargs: {client_kwargs}")
+    def generate_response(self, message: str, context: Optional[Dict[str, Any]] = None) -> str:
+        """使用 OpenAI API 生成回應"""
+        try:
+            response = self._client().chat.completions.create(
+                model=self.model,
+                messages=self._build_messages(message, context),
+                max_tokens=1000,
+                temperature=0.7
+            )
 
-            # 確保沒有傳遞不支援的參數，並明確排除 proxy 相關參數
-            supported_params = {'api_key', 'base_url', 'organization', 'timeout', 'max_retries'}
-            excluded_params = {'proxies', 'http_proxy', 'https_proxy', 'no_proxy'}
-            filtered_kwargs = {k: v for k, v in client_kwargs.items()
-                             if k in supported_params and k not in excluded_params}
+            return response.choices[0].message.content
 
-            # 臨時清除環境變數中的 proxy 設定
-            original_proxy_vars = {}
-            for var in ['HTTP_PROXY', 'HTTPS_PROXY', 'NO_PROXY', 'http_proxy', 'https_proxy', 'no_proxy']:
-                if var in os.environ:
-                    original_proxy_vars[var] = os.environ[var]
-                    del os.environ[var]
+        except ImportError:
+            logger.error("OpenAI library not installed")
+            return "抱歉，OpenAI 函式庫未安裝，請先安裝 openai 套件。"
+        except Exception as e:
+            logger.error(f"OpenAI API error: {str(e)}")
+            return f"抱歉，AI 服務暫時無法使用。錯誤：{str(e)}"
 
-            try:
-                # 使用最簡單的初始化方式，只傳遞必要的參數
-                client = OpenAI(api_key=self.api_key)
-
-                # 如果需要設置其他參數，在初始化後單獨設置
-                if self.organization:
-                    client.organization = self.organization
-
-            except Exception as e:
-                logger.error(f"OpenAI client initialization error: {str(e)}")
-                # 如果還是有問題，嘗試不傳遞任何參數
-                client = OpenAI()
-                client.api_key = self.api_key
-                if self.organization:
-                    client.organization = self.organization
-            finally:
-                # 恢復原始環境變數
-                for var, value in original_proxy_vars.items():
-                    os.environ[var] = value
-
-            # 構建對話歷史與知識庫上下文
-            messages = []
-            if context and 'conversation_history' in context:
-                messages.extend(context['conversation_history'])
-
-            system_content = None
-            if context:
-                parts = []
-                if context.get('system_prompt'):
-                    parts.append(str(context['system_prompt']))
-                if context.get('knowledge_context'):
-                    parts.append("以下是與用戶問題相關的知識庫內容，請作為主要依據回答：\n" + str(context['knowledge_context']))
-                if parts:
-                    system_content = "\n\n".join(parts)
-
-            if system_content:
-                messages.insert(0, {"role": "system", "content": system_content})
-
-            messages.append({"role": "user", "content": message})
-
-            response = client.chat.completions.create(
+    async def agenerate_response(self, message: str, context: Optional[Dict[str, Any]] = None) -> str:
+        """使用 AsyncOpenAI 生成回應（等待期間不佔用執行緒）"""
+        try:
+            response = await self._async_client().chat.completions.create(
                 model=self.model,
-                messages=messages,
+                messages=self._build_messages(message, context),
                 max_tokens=1000,
                 temperature=0.7
             )
@@ -116,6 +313,44 @@ class OpenAIProvider(AIProvider):
             logger.error(f"OpenAI API error: {str(e)}")
             return f"抱歉，AI 服務暫時無法使用。錯誤：{str(e)}"
 
+    def generate_stream(self, message: str, context: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        """使用 OpenAI 串流 API 逐段回傳回應；失敗時拋出例外（由呼叫端送出 error 事件，不當作回應內容）"""
+        try:
+            stream = self._client().chat.completions.create(
+                model=self.model,
+                messages=self._build_messages(message, context),
+                max_tokens=1000,
+                temperature=0.7,
+                stream=True
+            )
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+
+        except Exception as e:
+            logger.error(f"OpenAI API error: {str(e)}")
+            raise
+
+    async def agenerate_stream(self, message: str, context: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """使用 AsyncOpenAI 串流逐段回傳回應；失敗時拋出例外"""
+        try:
+            stream = await self._async_client().chat.completions.create(
+                model=self.model,
+                messages=self._build_messages(message, context),
+                max_tokens=1000,
+                temperature=0.7,
+                stream=True
+            )
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+
+        except Exception as e:
+            logger.error(f"OpenAI API error: {str(e)}")
+            raise
+
 
 _UNSET = object()
 
@@ -131,28 +366,46 @@ class GeminiProvider(AIProvider):
             self.api_key = api_key  # could be None
         self.model = model
 
+    @staticmethod
+    def _build_history(message: str, context: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """本回合之前的 conversation_history 轉為 Gemini 原生 history（assistant 對應 model 角色）"""
+        history = []
+        for msg in _prior_history(message, context):
+            role = {'user': 'user', 'assistant': 'model'}.get(msg.get('role'))
+            if role and msg.get('content'):
+                history.append({'role': role, 'parts': [{'text': msg['content']}]})
+        return history
+
+    def _start_chat(self, message: str, context: Optional[Dict[str, Any]]):
+        """以完整歷史與系統指令建立對話（不呼叫 API；之後每回合只送一次 send_message）"""
+        import google.generativeai as genai
+
+        genai.configure(api_key=self.api_key)
+        model = genai.GenerativeModel(self.model, system_instruction=_system_content(context))
+        return model.start_chat(history=self._build_history(message, context))
+
     def generate_response(self, message: str, context: Optional[Dict[str, Any]] = None) -> str:
         """使用 Gemini API 生成回應"""
         # 明確在無 API key 時回覆固定錯誤字串，確保測試穩定
         if not self.api_key:
             return "Google API key not found"
         try:
-            import google.generativeai as genai
-
-            genai.configure(api_key=self.api_key)
-            model = genai.GenerativeModel(self.model)
-
-            # 構建對話歷史
-            chat = model.start_chat(history=[])
-            if context and 'conversation_history' in context:
-                for msg in context['conversation_history']:
-                    if msg['role'] == 'user':
-                        chat.send_message(msg['content'])
-                    elif msg['role'] == 'assistant':
-                        # Gemini 會自動處理助手回應
-                        pass
-
-            response = chat.send_message(message)
+            response = self._start_chat(message, context).send_message(message)
+            return response.text
+
+        except ImportError:
+            logger.error("Google Generative AI library not installed")
+            return "抱歉，Google Generative AI 函式庫未安裝，請先安裝 google-generativeai 套件。"
+        except Exception as e:
+            logger.error(f"Gemini API error: {str(e)}")
+            return f"抱歉，AI 服務暫時無法使用。錯誤：{str(e)}"
+
+    async def agenerate_response(self, message: str, context: Optional[Dict[str, Any]] = None) -> str:
+        """使用 Gemini 的非同步（grpc.aio）客戶端生成回應"""
+        if not self.api_key:
+            return "Google API key not found"
+        try:
+            response = await self._start_chat(message, context).send_message_async(message)
             return response.text
 
         except ImportError:
@@ -162,6 +415,33 @@ class GeminiProvider(AIProvider):
             logger.error(f"Gemini API error: {str(e)}")
             return f"抱歉，AI 服務暫時無法使用。錯誤：{str(e)}"
 
+    def generate_stream(self, message: str, context: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        """使用 Gemini 串流回應逐段回傳；失敗時拋出例外"""
+        if not self.api_key:
+            raise ValueError("Google API key not found")
+        try:
+            for chunk in self._start_chat(message, context).send_message(message, stream=True):
+                if chunk.text:
+                    yield chunk.text
+
+        except Exception as e:
+            logger.error(f"Gemini API error: {str(e)}")
+            raise
+
+    async def agenerate_stream(self, message: str, context: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """使用 Gemini 非同步串流逐段回傳；失敗時拋出例外"""
+        if not self.api_key:
+            raise ValueError("Google API key not found")
+        try:
+            response = await self._start_chat(message, context).send_message_async(message, stream=True)
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+
+        except Exception as e:
+            logger.error(f"Gemini API error: {str(e)}")
+            raise
+
 
 class QwenProvider(AIProvider):
     """Qwen API 提供者"""
@@ -174,6 +454,38 @@ class QwenProvider(AIProvider):
             self.api_key = api_key  # could be None
         self.model = model
 
+    @staticmethod
+    def _build_messages(message: str, context: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # 構建對話歷史
+        messages = _prior_history(message, context)
+
+        messages.append({"role": "user", "content": message})
+        return messages
+
+    @staticmethod
+    def _text(content: Any) -> str:
+        """MultiModalConversation 的內容可能是字串或 [{'text': ...}] 列表"""
+        if isinstance(content, list):
+            return ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+        return content or ''
+
+    def _http_request(self, message: str, context: Optional[Dict[str, Any]],
+                      stream: bool = False) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+        """DashScope HTTP API 的 (url, headers, payload)；stream=True 時為 SSE 增量輸出"""
+        base_url = os.getenv('DASHSCOPE_HTTP_BASE_URL', DEFAULT_DASHSCOPE_API_BASE).rstrip('/')
+        messages = [
+            {'role': msg['role'],
+             'content': [{'text': msg['content']}] if isinstance(msg['content'], str) else msg['content']}
+            for msg in self._build_messages(message, context)
+        ]
+        headers = {'Authorization': f'Bearer {self.api_key}'}
+        parameters: Dict[str, Any] = {'max_tokens': 1000, 'temperature': 0.7}
+        if stream:
+            headers['X-DashScope-SSE'] = 'enable'
+            parameters['incremental_output'] = True
+        payload = {'model': self.model, 'input': {'messages': messages}, 'parameters': parameters}
+        return f"{base_url}/services/aigc/multimodal-generation/generation", headers, payload
+
     def generate_response(self, message: str, context: Optional[Dict[str, Any]] = None) -> str:
         """使用 Qwen API 生成回應"""
         # 明確在無 API key 時回覆固定錯誤字串，確保測試穩定
@@ -184,16 +496,9 @@ class QwenProvider(AIProvider):
 
             dashscope.api_key = self.api_key
 
-            # 構建對話歷史
-            messages = []
-            if context and 'conversation_history' in context:
-                messages.extend(context['conversation_history'])
-
-            messages.append({"role": "user", "content": message})
-
             response = dashscope.MultiModalConversation.call(
                 model=self.model,
-                messages=messages,
+                messages=self._build_messages(message, context),
                 max_tokens=1000,
                 temperature=0.7
             )
@@ -210,6 +515,86 @@ class QwenProvider(AIProvider):
             logger.error(f"Qwen API error: {str(e)}")
             return f"抱歉，AI 服務暫時無法使用。錯誤：{str(e)}"
 
+    async def agenerate_response(self, message: str, context: Optional[Dict[str, Any]] = None) -> str:
+        """直接以共用的 httpx.AsyncClient 呼叫 DashScope HTTP API（dashscope SDK 沒有非同步介面）"""
+        if not self.api_key:
+            return "Qwen API key not found"
+        try:
+            client = provider_clients.async_http_client()
+            if client is None:
+                raise ImportError("httpx")
+
+            url, headers, payload = self._http_request(message, context)
+            response = await client.post(url, headers=headers, json=payload)
+
+            data = response.json()
+            if response.status_code == 200:
+                return self._text(data['output']['choices'][0]['message']['content'])
+            else:
+                raise Exception(f"Qwen API error: {data.get('message')}")
+
+        except ImportError:
+            logger.error("httpx library not installed")
+            return "抱歉，httpx 函式庫未安裝，請先安裝 httpx 套件。"
+        except Exception as e:
+            logger.error(f"Qwen API error: {str(e)}")
+            return f"抱歉，AI 服務暫時無法使用。錯誤：{str(e)}"
+
+    def generate_stream(self, message: str, context: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        """使用 DashScope 增量串流（incremental_output）逐段回傳；失敗時拋出例外"""
+        if not self.api_key:
+            raise ValueError("Qwen API key not found")
+        try:
+            import dashscope
+
+            responses = dashscope.MultiModalConversation.call(
+                model=self.model,
+                messages=self._build_messages(message, context),
+                max_tokens=1000,
+                temperature=0.7,
+                api_key=self.api_key,
+                stream=True,
+                incremental_output=True
+            )
+            for response in responses:
+                if response.status_code != 200:
+                    raise Exception(f"Qwen API error: {response.message}")
+                delta = self._text(response.output.choices[0].message.content)
+                if delta:
+                    yield delta
+
+        except Exception as e:
+            logger.error(f"Qwen API error: {str(e)}")
+            raise
+
+    async def agenerate_stream(self, message: str, context: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """以共用的 httpx.AsyncClient 讀取 DashScope SSE 增量串流；失敗時拋出例外"""
+        if not self.api_key:
+            raise ValueError("Qwen API key not found")
+        try:
+            client = provider_clients.async_http_client()
+            if client is None:
+                raise ImportError("httpx")
+
+            url, headers, payload = self._http_request(message, context, stream=True)
+            async with client.stream('POST', url, headers=headers, json=payload) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise Exception(f"Qwen API error: {response.json().get('message')}")
+                async for line in response.aiter_lines():
+                    if not line.startswith('data:'):
+                        continue
+                    data = json.loads(line[len('data:'):])
+                    if data.get('code'):
+                        raise Exception(f"Qwen API error: {data.get('message')}")
+                    delta = self._text(data['output']['choices'][0]['message']['content'])
+                    if delta:
+                        yield delta
+
+        except Exception as e:
+            logger.error(f"Qwen API error: {str(e)}")
+            raise
+
 
 class MockProvider(AIProvider):
     """模擬 AI 提供者 - 用於測試"""
@@ -218,6 +603,21 @@ class MockProvider(AIProvider):
         """生成模擬回應"""
         return f"這是一個模擬回應。你問的是：{message}"
 
+    async def agenerate_response(self, message: str, context: Optional[Dict[str, Any]] = None) -> str:
+        """非同步生成模擬回應（不需要執行緒）"""
+        return self.generate_response(message, context)
+
+    def generate_stream(self, message: str, context: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        """以固定長度的片段模擬串流回應"""
+        response = self.generate_response(message, context)
+        for i in range(0, len(response), 4):
+            yield response[i:i + 4]
+
+    async def agenerate_stream(self, message: str, context: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """非同步版本的模擬串流，片段與 generate_stream 相同"""
+        for delta in self.generate_stream(message, context):
+            yield delta
+
 
 def get_ai_provider(provider_name: str, config: Dict[str, Any] = None) -> AIProvider:
     """根據提供者名稱獲取 AI 提供者實例"""
@@ -1,3 +1,5 @@
+import contextlib
+
 from django.apps import AppConfig
 
 
@@ -6,3 +8,7 @@ class AiProcessingConfig(AppConfig):
     name = "maya_sawa_v2.ai_processing"
     label = "maya_sawa_v2_ai_processing"
     verbose_name = "AI Processing"
+
+    def ready(self):
+        with contextlib.suppress(ImportError):
+            import maya_sawa_v2.ai_processing.signals  # noqa: F401, PLC0415
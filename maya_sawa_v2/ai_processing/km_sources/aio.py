@@ -0,0 +1,68 @@
+"""
+KM 非同步執行輔助 - 程序內共用的背景事件迴圈與每個事件迴圈一份的資源
+
+同步呼叫端（Django 同步 view、Celery、LangGraph 節點）透過 run_sync() 把協程
+交給同一個常駐事件迴圈執行，不需每次建立執行緒或巢狀事件迴圈；
+httpx.AsyncClient、AsyncOpenAI、psycopg 非同步連線池等綁定事件迴圈的資源
+以 LoopLocal 依迴圈保存，ASGI 事件迴圈與背景迴圈各自沿用自己的一份。
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar('T')
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """取得（必要時啟動）常駐於 daemon 執行緒的事件迴圈"""
+    global _loop
+    if _loop is not None:
+        return _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='km-event-loop', daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def run_sync(coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+    """在背景事件迴圈上執行協程並等待結果（供同步程式碼呼叫）
+
+    逾時時取消背景迴圈上的協程並拋出 concurrent.futures.TimeoutError。
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_background_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
+class LoopLocal:
+    """每個事件迴圈各自持有一份的物件（事件迴圈被回收時一併釋放）"""
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._values: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+
+    def get(self) -> Any:
+        loop = asyncio.get_running_loop()
+        value = self._values.get(loop)
+        if value is None:
+            value = self._factory()
+            self._values[loop] = value
+        return value
+
+    def values(self):
+        return list(self._values.values())
+
+    def items(self):
+        """[(事件迴圈, 物件)]"""
+        return list(self._values.items())
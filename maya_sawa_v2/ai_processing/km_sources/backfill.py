@@ -0,0 +1,370 @@
+"""
+文章 embedding 補齊 - 由排程任務執行，不在檢索路徑上
+
+EmbeddingBackfill 以 id keyset 分頁讀取待處理列，同時送出多個 embedding 批次
+（數量由 concurrency 限制，總量由每分鐘 token 配額節流），完成的批次依 id 順序
+以 COPY 寫入暫存表，再用單一 UPDATE ... FROM 寫回。整份語料重算（更換模型）時，
+進度與寫回在同一交易記錄於 km_backfill_checkpoints，中斷後從上次的 id 繼續。
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Iterator, List, Optional, Sequence, Tuple
+
+import psycopg
+
+from . import db as km_db
+from .chunking import estimate_tokens
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# pg advisory lock 的固定鍵值，確保同一時間只有一個補齊任務在跑
+BACKFILL_LOCK_KEY = 0x6B6D6266  # "kmbf"
+
+ProgressCallback = Callable[[int, int], None]
+
+# 可補齊 embedding 的表 -> 產生 embedding 的輸入運算式
+# 段落以「標題路徑 + 內容」產生 embedding，讓段落向量保有所屬章節的語境（見 chunking.Chunk.embedding_text）
+EMBEDDING_TABLES = {
+    'articles': "content",
+    'article_chunks': "CASE WHEN heading <> '' THEN heading || E'\\n\\n' || content ELSE content END",
+}
+
+CHECKPOINT_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS km_backfill_checkpoints (
+  job VARCHAR(200) PRIMARY KEY,
+  table_name VARCHAR(100) NOT NULL,
+  model VARCHAR(200) NOT NULL,
+  last_id BIGINT NOT NULL DEFAULT 0,
+  processed BIGINT NOT NULL DEFAULT 0,
+  started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  finished_at TIMESTAMP NULL
+)
+"""
+
+# 寫回用的暫存表：每條連線一份，交易提交後清空
+STAGING_TABLE_SQL = (
+    "CREATE TEMP TABLE IF NOT EXISTS km_embedding_staging (id BIGINT, embedding vector) ON COMMIT DELETE ROWS"
+)
+
+
+@contextmanager
+def advisory_lock(key: int = BACKFILL_LOCK_KEY) -> Iterator[bool]:
+    """嘗試取得 session 層級的 advisory lock，yield 是否成功取得。
+
+    鎖綁定在一條獨立的 autocommit 連線上（不占用連線池，也不會讓連線在交易中閒置），
+    區塊結束（含例外）時解鎖並關閉連線；程序異常結束時連線中斷，鎖也隨之釋放。
+    """
+    conn_str = km_db.build_conn_str()
+    if not conn_str:
+        raise RuntimeError("KM database is not configured")
+    with psycopg.connect(conn_str, autocommit=True) as conn:
+        acquired = bool(conn.execute("SELECT pg_try_advisory_lock(%s)", (key,)).fetchone()[0])
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    conn.execute("SELECT pg_advisory_unlock(%s)", (key,))
+                except psycopg.Error as e:
+                    # 連線已中斷時鎖已隨 session 釋放
+                    logger.warning("釋放 advisory lock 失敗: %s", str(e))
+
+
+class TokenRateLimiter:
+    """每分鐘 token 配額的 token bucket；容量為一分鐘的配額，依時間連續補充"""
+
+    def __init__(self, tokens_per_minute: int, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.capacity = max(1, int(tokens_per_minute))
+        self.rate = self.capacity / 60.0
+        self._clock = clock
+        self._sleep = sleep
+        self._available = float(self.capacity)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int) -> float:
+        """取得 tokens 的配額（超過容量時以容量計），回傳等待秒數"""
+        tokens = min(max(tokens, 0), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._available >= tokens:
+                    self._available -= tokens
+                    return waited
+                delay = (tokens - self._available) / self.rate
+            self._sleep(delay)
+            waited += delay
+
+
+def format_vector(values: Sequence[float]) -> str:
+    """pgvector 的文字格式"""
+    return '[' + ','.join(map(str, values)) + ']'
+
+
+class EmbeddingBackfill:
+    """並行產生 embedding 並批次寫回 articles / article_chunks"""
+
+    def __init__(self, table: str = 'articles', client: Any = None, model: Optional[str] = None,
+                 batch_size: int = 50, concurrency: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None, flush_rows: Optional[int] = None,
+                 page_size: int = 1000, where: str = '', limiter: Optional[TokenRateLimiter] = None):
+        if table not in EMBEDDING_TABLES:
+            raise ValueError(f"unsupported table: {table}")
+        self.table = table
+        self.client = client
+        self.model = model or os.getenv('OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small')
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency or int(os.getenv('EMBED_BACKFILL_CONCURRENCY', '4')))
+        self.limiter = limiter or TokenRateLimiter(
+            tokens_per_minute or int(os.getenv('EMBED_BACKFILL_TPM', '1000000')))
+        self.flush_rows = max(1, flush_rows or int(os.getenv('EMBED_BACKFILL_FLUSH_ROWS', '500')))
+        self.page_size = max(self.batch_size, page_size)
+        self.where = where
+        self.tokens_sent = 0
+        self.throttled_seconds = 0.0
+
+    def job_name(self) -> str:
+        return f"reembed:{self.table}:{self.model}"
+
+    # ========== 讀取 ==========
+
+    def _where_sql(self, reembed: bool) -> str:
+        conditions = ["id > %s", "content IS NOT NULL AND length(content) > 0"]
+        if not reembed:
+            conditions.append("embedding IS NULL")
+        if self.where:
+            conditions.append(f"({self.where})")
+        return ' AND '.join(conditions)
+
+    def _fetch_page(self, cur, after_id: int, count: int, reembed: bool) -> List[Tuple[int, str]]:
+        cur.execute(
+            f"SELECT id, {EMBEDDING_TABLES[self.table]} FROM {self.table} "
+            f"WHERE {self._where_sql(reembed)} ORDER BY id LIMIT %s",
+            (after_id, count),
+        )
+        return [(row[0], row[1]) for row in cur.fetchall()]
+
+    def pending_count(self, reembed: bool = False) -> int:
+        """待處理筆數（dry run 用；重算模式從 checkpoint 之後起算）"""
+        with km_db.connection() as conn:
+            with conn.cursor() as cur:
+                after_id = self._checkpoint(cur)[0] if reembed else 0
+                cur.execute(f"SELECT count(*) FROM {self.table} WHERE {self._where_sql(reembed)}", (after_id,))
+                return int(cur.fetchone()[0])
+
+    # ========== checkpoint ==========
+
+    @staticmethod
+    def _checkpoint_table_exists(cur) -> bool:
+        cur.execute("SELECT to_regclass('km_backfill_checkpoints') IS NOT NULL")
+        return bool(cur.fetchone()[0])
+
+    def _checkpoint(self, cur, create: bool = False) -> Tuple[int, bool]:
+        """回傳 (last_id, 是否已完成)；沒有紀錄時為 (0, False)。
+
+        只有實際重算（create=True）才建立 checkpoint 表；dry run 與統計不執行 DDL。
+        """
+        if create:
+            cur.execute(CHECKPOINT_TABLE_SQL)
+        elif not self._checkpoint_table_exists(cur):
+            return 0, False
+        cur.execute("SELECT last_id, finished_at IS NOT NULL FROM km_backfill_checkpoints WHERE job = %s",
+                    (self.job_name(),))
+        row = cur.fetchone()
+        return (int(row[0]), bool(row[1])) if row else (0, False)
+
+    def reset_checkpoint(self) -> None:
+        with km_db.connection() as conn:
+            with conn.cursor() as cur:
+                if self._checkpoint_table_exists(cur):
+                    cur.execute("DELETE FROM km_backfill_checkpoints WHERE job = %s", (self.job_name(),))
+            conn.commit()
+
+    def _save_checkpoint(self, cur, last_id: int, processed: int, finished: bool = False) -> None:
+        cur.execute(
+            """
+            INSERT INTO km_backfill_checkpoints (job, table_name, model, last_id, processed, finished_at)
+            VALUES (%s, %s, %s, %s, %s, CASE WHEN %s THEN NOW() END)
+            ON CONFLICT (job) DO UPDATE SET
+                last_id = EXCLUDED.last_id,
+                processed = km_backfill_checkpoints.processed + EXCLUDED.processed,
+                updated_at = NOW(),
+                finished_at = EXCLUDED.finished_at
+            """,
+            (self.job_name(), self.table, self.model, last_id, processed, finished),
+        )
+
+    # ========== 產生與寫回 ==========
+
+    def _embed(self, batch: List[Tuple[int, str]]) -> List[Tuple[int, List[float]]]:
+        resp = self.client.embeddings.create(model=self.model, input=[text for _, text in batch])
+        return [(row_id, item.embedding) for (row_id, _), item in zip(batch, resp.data)]
+
+    def _submit(self, executor: ThreadPoolExecutor, batch: List[Tuple[int, str]]) -> Future:
+        tokens = sum(estimate_tokens(text) for _, text in batch)
+        self.throttled_seconds += self.limiter.acquire(tokens)
+        self.tokens_sent += tokens
+        return executor.submit(self._embed, batch)
+
+    def _flush(self, conn, cur, rows: List[Tuple[int, List[float]]], reembed: bool) -> None:
+        """COPY 進暫存表後以單一 UPDATE ... FROM 寫回；重算模式在同一交易推進 checkpoint。
+
+        連線已註冊 pgvector adapter 時以二進位 COPY 傳送 float32 陣列，否則退回文字格式。
+        """
+        cur.execute(STAGING_TABLE_SQL)
+        if np is not None and km_db.has_vector_adapter(conn):
+            with cur.copy("COPY km_embedding_staging (id, embedding) FROM STDIN (FORMAT BINARY)") as copy:
+                copy.set_types(['int8', 'vector'])
+                for row_id, embedding in rows:
+                    copy.write_row((row_id, np.asarray(embedding, dtype=np.float32)))
+        else:
+            with cur.copy("COPY km_embedding_staging (id, embedding) FROM STDIN") as copy:
+                for row_id, embedding in rows:
+                    copy.write_row((row_id, format_vector(embedding)))
+        cur.execute(
+            f"UPDATE {self.table} t SET embedding = s.embedding, updated_at = NOW() "
+            "FROM km_embedding_staging s WHERE t.id = s.id"
+        )
+        if reembed:
+            self._save_checkpoint(cur, max(row_id for row_id, _ in rows), len(rows))
+        conn.commit()
+
+    def run(self, limit: Optional[int] = None, reembed: bool = False,
+            progress: Optional[ProgressCallback] = None) -> int:
+        """補齊（或 reembed=True 時全部重算）embedding，回傳寫回筆數。
+
+        批次依 id 順序送出、依送出順序收回寫入，因此 checkpoint 之前的列必定都已寫回；
+        任一批次失敗即停止送出，已完成的批次仍會寫回。
+        """
+        processed = 0
+        with km_db.connection() as conn:
+            with conn.cursor() as cur:
+                after_id = 0
+                if reembed:
+                    after_id, finished = self._checkpoint(cur, create=True)
+                    conn.commit()
+                    if finished:
+                        logger.info("%s 已完成，如需重新執行請先重設 checkpoint", self.job_name())
+                        return 0
+                    if after_id:
+                        logger.info("%s 從 id > %d 繼續", self.job_name(), after_id)
+
+                total = limit if limit is not None else 0
+                remaining = limit
+                inflight: Deque[Future] = deque()
+                ready: List[Tuple[int, List[float]]] = []
+                failed = False
+                exhausted = False
+
+                def collect(future: Future) -> None:
+                    nonlocal failed
+                    try:
+                        ready.extend(future.result())
+                    except Exception as e:
+                        if not failed:
+                            logger.warning("產生 embedding 失敗，停止補齊: %s", str(e))
+                        failed = True
+
+                with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    while not failed and not exhausted:
+                        count = self.page_size if remaining is None else min(self.page_size, remaining)
+                        page = self._fetch_page(cur, after_id, count, reembed) if count > 0 else []
+                        conn.commit()
+                        if not page:
+                            break
+                        after_id = page[-1][0]
+                        if remaining is not None:
+                            remaining -= len(page)
+                        else:
+                            total += len(page)
+                        exhausted = len(page) < count
+
+                        for i in range(0, len(page), self.batch_size):
+                            if failed:
+                                break
+                            if len(inflight) >= self.concurrency:
+                                # 依送出順序收回，寫回的 id 保持連續
+                                collect(inflight.popleft())
+                            inflight.append(self._submit(executor, page[i:i + self.batch_size]))
+                            if len(ready) >= self.flush_rows and not failed:
+                                self._flush(conn, cur, ready, reembed)
+                                processed += len(ready)
+                                ready = []
+                                if progress:
+                                    progress(processed, max(total, processed))
+
+                    while inflight:
+                        future = inflight.popleft()
+                        if failed:
+                            # 失敗之後的批次不寫回，避免 checkpoint 跳過失敗批次
+                            future.cancel()
+                            continue
+                        collect(future)
+
+                if ready:
+                    # 失敗時 ready 只含失敗批次之前依序完成的部分，仍可寫回
+                    self._flush(conn, cur, ready, reembed)
+                    processed += len(ready)
+                if progress and processed:
+                    progress(processed, max(total, processed))
+                if reembed and not failed and (limit is None or exhausted):
+                    self._save_checkpoint(cur, after_id, 0, finished=True)
+                    conn.commit()
+
+        logger.info("補齊 %s embedding 完成，共更新 %d 筆（%d tokens，節流 %.1f 秒）",
+                    self.table, processed, self.tokens_sent, self.throttled_seconds)
+        if processed:
+            from .result_cache import bump_corpus_version
+            bump_corpus_version(f'backfill:{self.table}')
+        return processed
+
+
+def openai_client() -> Optional[Any]:
+    """建立 OpenAI client；沒有金鑰或未安裝套件時回傳 None"""
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        return None
+    try:
+        from openai import OpenAI
+    except Exception:
+        return None
+    return OpenAI(api_key=api_key)
+
+
+def backfill_missing_embeddings(limit: int = 200, batch_size: int = 50,
+                                progress: Optional[ProgressCallback] = None, table: str = 'articles') -> int:
+    """為 articles（或 article_chunks）表補齊缺少的 embedding，回傳更新筆數。
+
+    僅處理 content 不為空且 embedding 為 NULL 的列；若沒有 OpenAI 金鑰或資料庫連線則略過。
+    """
+    if not km_db.is_configured():
+        return 0  # 無法連線資料庫則略過
+
+    client = openai_client()
+    if client is None:
+        return 0  # 沒有金鑰則略過
+
+    if table != 'articles':
+        with km_db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+                if not cur.fetchone()[0]:
+                    return 0  # 尚未建立段落表
+
+    return EmbeddingBackfill(table, client=client, batch_size=batch_size).run(limit=limit, progress=progress)
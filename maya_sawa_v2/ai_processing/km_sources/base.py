@@ -2,6 +2,8 @@
 知識庫源基類 - 獨立的基礎模組
 """
 
+import asyncio
+import os
 from abc import ABC, abstractmethod
 from typing import Dict, Any, List, Optional
 from dataclasses import dataclass
@@ -48,15 +50,31 @@ class BaseKMSource(ABC):
         """搜索知識庫"""
         pass
 
+    async def asearch(self, query: KMQuery) -> List[KMResult]:
+        """非同步搜索知識庫；預設在執行緒中呼叫 search，有原生非同步 I/O 的源應覆寫"""
+        return await asyncio.to_thread(self.search, query)
+
     @abstractmethod
     def is_suitable_for(self, query: KMQuery) -> bool:
         """判斷是否適合處理此查詢"""
         pass
 
+    def warm(self) -> None:
+        """預熱連線與快取（程序啟動時呼叫一次），預設不做事"""
+        pass
+
     def get_priority(self) -> int:
         """獲取優先級，數字越小優先級越高"""
         return 100
 
+    def cache_params(self) -> Dict[str, Any]:
+        """影響檢索結果的參數，納入結果快取的鍵值；結果不可快取的源回傳 None"""
+        return dict(self.config)
+
+    def get_timeout(self) -> float:
+        """單一源的檢索時間預算（秒），超過則放棄此源的結果"""
+        return float(self.config.get('timeout', os.getenv('KM_SOURCE_TIMEOUT_SECONDS', '5')))
+
     def get_source_type(self) -> str:
         """獲取源類型"""
         return self.__class__.__name__.lower()
@@ -0,0 +1,316 @@
+"""
+離線檢索基準測試 - ProgrammingKMSource 的延遲與品質量測
+
+以固定語料（benchmark_corpus.json：文章 + 標註相關文章的中 / 英 / 中英夾雜查詢）與
+決定性的假 embedding（token 雜湊）執行檢索，逐階段記錄延遲並計算 recall@k 與 MRR。
+結果為 key 排序的 JSON，可存檔後跨 commit 比較。
+
+兩種後端：
+- postgres：在目前的 KM 資料庫建立暫存表（含 is_test 產生欄位與相同條件的部分 HNSW / trigram 索引），
+  以 ProgrammingKMSource.build_hybrid_query 產生的正式檢索 SQL（表名換成暫存表）計時，
+  階段為 embed / bm25 / query（向量、trigram 與融合在同一個查詢內）；不會寫入正式的 articles 表
+- local：沒有資料庫時使用程序內 NumpyVectorIndex 與 Python 版 pg_trgm similarity，
+  階段為 embed / bm25 / vector / trigram / merge；融合公式與權重取自 ProgrammingKMSource 的設定
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from . import db as km_db
+from . import pg_index
+from .index_sync import is_test_path
+from .text_index import BM25Index, normalize_scores, tokenize
+from .vector_index import NumpyVectorIndex, np
+
+logger = logging.getLogger(__name__)
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_corpus.json')
+STAGES = ('embed', 'bm25')
+BENCH_TABLE = 'km_bench_articles'
+
+# pg_trgm 以英數（含 CJK）連續字元為詞
+_TRGM_WORD_RE = re.compile(r"[^\W_]+")
+
+
+def load_corpus(path: Optional[str] = None) -> Dict[str, Any]:
+    """讀取基準語料；回傳 {'articles': [...], 'queries': [...], 'sha1': 語料雜湊}"""
+    with open(path or CORPUS_PATH, 'rb') as f:
+        raw = f.read()
+    corpus = json.loads(raw)
+    corpus['sha1'] = hashlib.sha1(raw).hexdigest()
+    return corpus
+
+
+class HashEmbedder:
+    """決定性的假 embedding：token（英數詞 / CJK bigram）雜湊到固定維度並正規化，詞彙重疊即相似"""
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def embed(self, text: str) -> List[float]:
+        vec = [0.0] * self.dim
+        for token in tokenize(text):
+            h = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'big')
+            vec[h % self.dim] += 1.0 if (h >> 63) & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+        return [v / norm for v in vec]
+
+
+def trigrams(text: str) -> Set[str]:
+    """與 pg_trgm 相同的 trigram 集合：小寫、每個詞前補兩個空白、後補一個空白"""
+    grams: Set[str] = set()
+    for word in _TRGM_WORD_RE.findall((text or '').lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def trigram_similarity(a: Set[str], b: Set[str]) -> float:
+    """pg_trgm similarity()：共同 trigram 數 / 聯集 trigram 數"""
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+def fuse(source: Any, vec: Sequence[Tuple[Any, float]], trgm: Sequence[Tuple[Any, float]],
+         bm25: Sequence[Tuple[Any, float]], k: int) -> List[Tuple[Any, float]]:
+    """以 ProgrammingKMSource 的融合設定合併三路候選（與資料庫內融合 SQL 相同公式），回傳 top-k"""
+    scores: Dict[Any, float] = {}
+    for weight, candidates in ((source.vector_weight, vec), (source.text_weight, trgm), (source.bm25_weight, bm25)):
+        for rank, (item_id, score) in enumerate(candidates, start=1):
+            contribution = 1.0 / (source.rrf_k + rank) if source.fusion == 'rrf' else score
+            scores[item_id] = scores.get(item_id, 0.0) + weight * contribution
+    return sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:k]
+
+
+def recall_at_k(ranked: Sequence[str], relevant: Sequence[str], k: int) -> float:
+    if not relevant:
+        return 0.0
+    return len(set(ranked[:k]) & set(relevant)) / len(set(relevant))
+
+
+def reciprocal_rank(ranked: Sequence[str], relevant: Sequence[str]) -> float:
+    for rank, path in enumerate(ranked, start=1):
+        if path in relevant:
+            return 1.0 / rank
+    return 0.0
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    """線性內插的百分位數"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * pct / 100.0
+    low = int(math.floor(pos))
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+class LocalBackend:
+    """程序內後端：NumpyVectorIndex + Python trigram（只索引正式文章，等同部分索引）"""
+
+    name = 'local'
+    stages = ('vector', 'trigram', 'merge')
+
+    def __init__(self, articles: List[Dict[str, Any]], vectors: Dict[Any, List[float]]):
+        visible = [a for a in articles if not is_test_path(a['file_path'])]
+        self.vector_index = NumpyVectorIndex.from_items((a['id'], vectors[a['id']]) for a in visible)
+        self.trigram_sets = {a['id']: trigrams(a['content']) for a in visible}
+
+    def vector(self, query_vec: List[float], k: int) -> List[Tuple[Any, float]]:
+        return self.vector_index.search(query_vec, k)
+
+    def trigram(self, query_text: str, k: int, min_sim: float) -> List[Tuple[Any, float]]:
+        query = trigrams(query_text)
+        scored = ((item_id, trigram_similarity(grams, query)) for item_id, grams in self.trigram_sets.items())
+        return sorted((s for s in scored if s[1] >= min_sim), key=lambda x: (-x[1], x[0]))[:k]
+
+    def retrieve(self, source: Any, text: str, query_vec: List[float], bm25: List[Tuple[Any, float]],
+                 k: int, measure: Callable[[str, Callable[[], Any]], Any]) -> List[Any]:
+        vec = measure('vector', lambda: self.vector(query_vec, source.vector_candidates))
+        trgm = measure('trigram', lambda: self.trigram(text, source.trigram_candidates, source.min_text_similarity))
+        return [item_id for item_id, _ in measure('merge', lambda: fuse(source, vec, trgm, bm25, k))]
+
+    def close(self) -> None:
+        pass
+
+
+class PostgresBackend:
+    """資料庫後端：語料載入暫存表（連線結束即消失），欄位與索引條件與正式 articles 表相同"""
+
+    name = 'postgres'
+    stages = ('query',)
+
+    def __init__(self, conn: Any, articles: List[Dict[str, Any]], vectors: Dict[Any, List[float]], dim: int):
+        self.conn = conn
+        vtype = pg_index.vector_type()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS pg_temp.{BENCH_TABLE}")
+            cur.execute(
+                f"CREATE TEMP TABLE {BENCH_TABLE} ("
+                "id BIGINT PRIMARY KEY, file_path TEXT NOT NULL, content TEXT NOT NULL, file_date TIMESTAMP NULL, "
+                f"embedding vector({int(dim)}), "
+                "is_test BOOLEAN GENERATED ALWAYS AS (lower(file_path) LIKE '%test%') STORED)"
+            )
+            with cur.copy(f"COPY {BENCH_TABLE} (id, file_path, content, embedding) FROM STDIN") as copy:
+                for a in articles:
+                    copy.write_row((a['id'], a['file_path'], a['content'],
+                                    '[' + ','.join(repr(float(v)) for v in vectors[a['id']]) + ']'))
+            # 與正式索引相同的運算式（halfvec 時為 embedding::halfvec(dim)），檢索 SQL 才會使用索引
+            cur.execute(f"CREATE INDEX ON {BENCH_TABLE} USING hnsw "
+                        f"({pg_index.embedding_expr(vtype)} {vtype}_cosine_ops) WHERE {pg_index.VISIBLE_SQL}")
+            cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+            if cur.fetchone()[0]:
+                cur.execute(f"CREATE INDEX ON {BENCH_TABLE} USING GIN (content gin_trgm_ops) "
+                            f"WHERE {pg_index.VISIBLE_SQL}")
+            cur.execute(f"ANALYZE {BENCH_TABLE}")
+        conn.commit()
+
+    def query(self, source: Any, text: str, query_vec: List[float],
+              bm25: List[Tuple[Any, float]]) -> List[Dict[str, Any]]:
+        """以正式的混合檢索 SQL 查詢暫存表（交易範圍設定與 _arun_hybrid_query 相同）"""
+        sql, params = source.build_hybrid_query(text, query_vec, source._extract_query_terms(text),
+                                                table=BENCH_TABLE, bm25=bm25)
+        params['qvec'] = km_db.vector_param(self.conn, query_vec)
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)",
+                        (str(source.min_text_similarity),))
+            pg_index.apply_search_settings(cur)
+            cur.execute(sql, params)
+            rows = source.parse_hybrid_rows(cur.fetchall())
+        self.conn.rollback()
+        return rows
+
+    def retrieve(self, source: Any, text: str, query_vec: List[float], bm25: List[Tuple[Any, float]],
+                 k: int, measure: Callable[[str, Callable[[], Any]], Any]) -> List[Any]:
+        rows = measure('query', lambda: self.query(source, text, query_vec, bm25))
+        return [row['id'] for row in rows[:k]]
+
+    def close(self) -> None:
+        self.conn.rollback()
+        with self.conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS pg_temp.{BENCH_TABLE}")
+        self.conn.commit()
+
+
+def _measure(backend: Any, corpus: Dict[str, Any], embedder: HashEmbedder, source: Any,
+             k: int, repeat: int) -> Dict[str, Any]:
+    articles = corpus['articles']
+    paths = {a['id']: a['file_path'] for a in articles}
+    text_index = BM25Index.from_items(
+        (a['id'], a['content']) for a in articles if not is_test_path(a['file_path']))
+    timings: Dict[str, List[float]] = {stage: [] for stage in STAGES + backend.stages}
+
+    def timed(stage: str, fn: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        result = fn()
+        timings[stage].append((time.perf_counter() - start) * 1000.0)
+        return result
+
+    per_query = []
+    for query in corpus['queries']:
+        text = query['query']
+        # 第 0 次為暖身（不計時），之後每次都完整走過所有階段
+        for attempt in range(repeat + 1):
+            measure = timed if attempt else (lambda stage, fn: fn())
+            query_vec = measure('embed', lambda: embedder.embed(text))
+            bm25 = measure('bm25', lambda: normalize_scores(text_index.search(text, source.bm25_candidates)))
+            ids = backend.retrieve(source, text, query_vec, bm25, k, measure)
+        ranked = [paths[item_id] for item_id in ids]
+        per_query.append({
+            'id': query['id'],
+            'lang': query.get('lang', ''),
+            'ranked': ranked,
+            'recall': round(recall_at_k(ranked, query['relevant'], k), 4),
+            'rr': round(reciprocal_rank(ranked, query['relevant']), 4),
+        })
+
+    def quality(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+        n = len(rows) or 1
+        return {
+            'queries': len(rows),
+            f'recall@{k}': round(sum(r['recall'] for r in rows) / n, 4),
+            'mrr': round(sum(r['rr'] for r in rows) / n, 4),
+        }
+
+    langs = sorted({r['lang'] for r in per_query if r['lang']})
+    return {
+        'backend': backend.name,
+        'k': k,
+        'repeat': repeat,
+        'corpus': {'articles': len(articles), 'queries': len(corpus['queries']), 'sha1': corpus.get('sha1', '')},
+        'config': source.cache_params(),
+        'latency_ms': {
+            stage: {
+                'p50': round(percentile(values, 50), 4),
+                'p95': round(percentile(values, 95), 4),
+                'mean': round(sum(values) / len(values), 4) if values else 0.0,
+            }
+            for stage, values in timings.items()
+        },
+        'quality': dict(quality(per_query), by_lang={lang: quality([r for r in per_query if r['lang'] == lang])
+                                                     for lang in langs}),
+        'per_query': per_query,
+    }
+
+
+def run_benchmark(corpus: Optional[Dict[str, Any]] = None, backend: str = 'auto', k: Optional[int] = None,
+                  repeat: int = 5, source: Any = None, embedder: Optional[HashEmbedder] = None) -> Dict[str, Any]:
+    """執行基準測試並回傳結果 dict（可直接 json.dumps(sort_keys=True) 存檔比較）
+
+    backend='auto' 時有 KM 資料庫設定就用 postgres，否則用 local。
+    """
+    if np is None:
+        raise RuntimeError("numpy is required for the retrieval benchmark")
+    from .programming import ProgrammingKMSource
+
+    corpus = corpus or load_corpus()
+    source = source or ProgrammingKMSource()
+    k = k or source.top_k
+    if backend == 'auto':
+        backend = 'postgres' if km_db.is_configured() else 'local'
+    # postgres 後端執行正式 SQL，halfvec 轉型使用 KM_EMBEDDING_DIM，向量維度須一致
+    embedder = embedder or HashEmbedder(pg_index.embedding_dim() if backend == 'postgres' else 256)
+    vectors = {a['id']: embedder.embed(a['content']) for a in corpus['articles']}
+    if backend == 'local':
+        return _measure(LocalBackend(corpus['articles'], vectors), corpus, embedder, source, k, repeat)
+    if backend != 'postgres':
+        raise ValueError(f"unknown benchmark backend: {backend}")
+    with km_db.connection() as conn:
+        runner = PostgresBackend(conn, corpus['articles'], vectors, embedder.dim)
+        try:
+            return _measure(runner, corpus, embedder, source, k, repeat)
+        finally:
+            runner.close()
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+    """與先前的結果比較：品質指標與各階段 p50 / p95 的差值（current - baseline）"""
+    def delta(a: Any, b: Any) -> Optional[float]:
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+            return round(b - a, 4)
+        return None
+
+    quality = {name: delta(baseline.get('quality', {}).get(name), value)
+               for name, value in current.get('quality', {}).items() if name not in ('queries', 'by_lang')}
+    latency = {}
+    for stage, values in current.get('latency_ms', {}).items():
+        before = baseline.get('latency_ms', {}).get(stage, {})
+        latency[stage] = {pct: delta(before.get(pct), values.get(pct)) for pct in ('p50', 'p95')}
+    before_ranked = {q['id']: q['ranked'] for q in baseline.get('per_query', [])}
+    changed = sorted(q['id'] for q in current.get('per_query', []) if before_ranked.get(q['id']) != q['ranked'])
+    return {
+        'comparable': baseline.get('corpus', {}).get('sha1') == current.get('corpus', {}).get('sha1')
+        and baseline.get('k') == current.get('k'),
+        'quality': quality,
+        'latency_ms': latency,
+        'changed_queries': changed,
+    }
@@ -0,0 +1,300 @@
+"""
+文章段落切分 - 依標題 / 段落切成有 token 上限、前後重疊的段落，寫入 article_chunks 表
+
+整篇文章只有一個 embedding 時，長文的向量被平均稀釋（且可能被 embedding 模型截斷），
+檢索結果也只能注入整篇或開頭片段。段落各自有 embedding 與 trigram 索引後，
+ProgrammingKMSource 可以回傳最相關的段落並附上所屬文章作為引用。
+段落的 embedding 由排程任務 backfill_article_embeddings 補齊，不在檢索路徑上。
+"""
+
+import hashlib
+import logging
+import math
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from . import db as km_db
+from .text_index import _CJK
+
+logger = logging.getLogger(__name__)
+
+_CJK_RE = re.compile(f"[{_CJK}]")
+_SPACE_RE = re.compile(r"\s+")
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+_SENTENCE_RE = re.compile(r"[^。！？!?；;\n]*(?:[。！？!?；;]+|\.(?=\s)|\n|$)")
+
+
+def estimate_tokens(text: str) -> int:
+    """估算 token 數：CJK 每字約 1 token，其餘非空白字元約 4 字元 1 token（不依賴 tokenizer 套件）"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    rest = len(_SPACE_RE.sub('', _CJK_RE.sub('', text)))
+    return cjk + math.ceil(rest / 4)
+
+
+@dataclass
+class Chunk:
+    """文章中的一個段落；start / end 為在原文中的字元位移"""
+    index: int
+    heading: str
+    content: str
+    start: int
+    end: int
+    token_count: int
+
+    @property
+    def content_hash(self) -> str:
+        """標題或內容變更才需要重算 embedding"""
+        return hashlib.sha1(f"{self.heading}\0{self.content}".encode('utf-8')).hexdigest()
+
+    def embedding_text(self) -> str:
+        """產生 embedding 的輸入：帶上標題路徑，讓段落向量保有所屬章節的語境"""
+        return f"{self.heading}\n\n{self.content}" if self.heading else self.content
+
+
+def _iter_blocks(text: str) -> Iterator[Tuple[str, int, int]]:
+    """依行掃描 markdown，產出 (標題路徑, start, end) 的段落區塊。
+
+    空行分隔段落；圍欄程式碼區塊（``` / ~~~）內的空行不分段；標題行本身不進入區塊，
+    而是更新之後區塊的標題路徑（如「Spring Boot > 自動配置」）。
+    """
+    headings: List[Tuple[int, str]] = []
+    block_start: Optional[int] = None
+    block_end = 0
+    fence: Optional[str] = None
+    pos = 0
+    for line in text.splitlines(keepends=True):
+        line_start, pos = pos, pos + len(line)
+        stripped = line.strip()
+        if fence is None:
+            heading = _HEADING_RE.match(stripped)
+            if heading:
+                if block_start is not None:
+                    yield ' > '.join(h for _, h in headings), block_start, block_end
+                    block_start = None
+                level = len(heading.group(1))
+                headings = [h for h in headings if h[0] < level] + [(level, heading.group(2))]
+                continue
+            if not stripped:
+                if block_start is not None:
+                    yield ' > '.join(h for _, h in headings), block_start, block_end
+                    block_start = None
+                continue
+        fence_match = _FENCE_RE.match(line)
+        if fence_match:
+            marker = fence_match.group(1)
+            fence = marker if fence is None else (None if marker == fence else fence)
+        if block_start is None:
+            block_start = line_start
+        block_end = line_start + len(line.rstrip('\r\n'))
+    if block_start is not None:
+        yield ' > '.join(h for _, h in headings), block_start, block_end
+
+
+def _split_oversized(text: str, start: int, end: int, max_tokens: int) -> List[Tuple[int, int]]:
+    """把超過上限的區塊依行、句子切開，最後才硬切字元；回傳 (start, end) 片段"""
+    if estimate_tokens(text[start:end]) <= max_tokens:
+        return [(start, end)]
+    pieces: List[Tuple[int, int]] = []
+    for unit in (r"[^\n]*\n?", _SENTENCE_RE.pattern):
+        units = [(start + m.start(), start + m.end()) for m in re.finditer(unit, text[start:end]) if m.group().strip()]
+        if len(units) > 1:
+            break
+    else:
+        units = [(start, end)]
+
+    for unit_start, unit_end in units:
+        if estimate_tokens(text[unit_start:unit_end]) <= max_tokens:
+            pieces.append((unit_start, unit_end))
+            continue
+        # 單一句子仍過長：逐字累計估算值（CJK 1、空白 0、其餘 1/4）到上限為止
+        piece_start, cost = unit_start, 0.0
+        for i in range(unit_start, unit_end):
+            char = text[i]
+            char_cost = 1.0 if _CJK_RE.match(char) else (0.0 if char.isspace() else 0.25)
+            if cost + char_cost > max_tokens and i > piece_start:
+                pieces.append((piece_start, i))
+                piece_start, cost = i, 0.0
+            cost += char_cost
+        pieces.append((piece_start, unit_end))
+    # 片段保持行 / 句子的粒度，由 chunk_markdown 合併到上限並以句子為單位重疊
+    return pieces
+
+
+def chunk_markdown(text: str, max_tokens: int = 300, overlap_tokens: int = 50) -> List[Chunk]:
+    """將 markdown 切成段落：同一標題下的段落依序合併到 max_tokens 為止，
+    新段落開頭重疊前一段落結尾 overlap_tokens 以內的區塊；段落不跨越標題。"""
+    if max_tokens <= 0:
+        raise ValueError("max_tokens must be positive")
+    overlap_tokens = max(0, min(overlap_tokens, max_tokens // 2))
+    text = text or ''
+
+    # 先展開成不超過上限的區塊，依標題分組
+    sections: List[Tuple[str, List[Tuple[int, int, int]]]] = []
+    for heading, start, end in _iter_blocks(text):
+        if not sections or sections[-1][0] != heading:
+            sections.append((heading, []))
+        for piece_start, piece_end in _split_oversized(text, start, end, max_tokens):
+            sections[-1][1].append((piece_start, piece_end, estimate_tokens(text[piece_start:piece_end])))
+    if not sections and text.strip():
+        # 只有標題沒有內文：以整段文字作為區塊
+        stripped_start = len(text) - len(text.lstrip())
+        sections = [('', [(s, e, estimate_tokens(text[s:e]))
+                          for s, e in _split_oversized(text, stripped_start, len(text.rstrip()), max_tokens)])]
+
+    chunks: List[Chunk] = []
+
+    def emit(heading: str, blocks: List[Tuple[int, int, int]]) -> None:
+        start, end = blocks[0][0], blocks[-1][1]
+        content = text[start:end]
+        chunks.append(Chunk(len(chunks), heading, content, start, end, estimate_tokens(content)))
+
+    for heading, blocks in sections:
+        current: List[Tuple[int, int, int]] = []
+        tokens = 0
+        fresh = 0  # current 中不屬於重疊部分的區塊數
+        for block in blocks:
+            if current and tokens + block[2] > max_tokens:
+                emit(heading, current)
+                # 由前一段落結尾往回取重疊區塊（總量不超過 overlap_tokens，且留空間給新區塊）
+                overlap: List[Tuple[int, int, int]] = []
+                budget = min(overlap_tokens, max_tokens - block[2])
+                for prev in reversed(current):
+                    if prev[2] > budget:
+                        break
+                    overlap.insert(0, prev)
+                    budget -= prev[2]
+                current, tokens, fresh = overlap, sum(b[2] for b in overlap), 0
+            current.append(block)
+            tokens += block[2]
+            fresh += 1
+        if current and fresh:
+            emit(heading, current)
+    return chunks
+
+
+# ========== article_chunks 同步 ==========
+
+def enabled() -> bool:
+    return os.getenv('KM_CHUNKING', 'true').lower() in ('1', 'true', 'yes')
+
+
+def chunk_options() -> Dict[str, int]:
+    """段落切分參數，可由環境變數調整"""
+    return {
+        'max_tokens': int(os.getenv('KM_CHUNK_MAX_TOKENS', '300')),
+        'overlap_tokens': int(os.getenv('KM_CHUNK_OVERLAP_TOKENS', '50')),
+    }
+
+
+def chunk_table_exists(cur) -> bool:
+    cur.execute("SELECT to_regclass('article_chunks') IS NOT NULL")
+    return bool(cur.fetchone()[0])
+
+
+def _apply_chunks(cur, article_id: Any, chunks: List[Chunk]) -> Tuple[int, int, int]:
+    """以 content_hash 對齊既有段落：內容不變的段落保留 embedding 只更新位置，其餘新增或刪除。
+    回傳 (inserted, kept, deleted)。"""
+    cur.execute("SELECT id, content_hash FROM article_chunks WHERE article_id = %s", (article_id,))
+    existing: Dict[str, List[Any]] = {}
+    for chunk_id, content_hash in cur.fetchall():
+        existing.setdefault(content_hash, []).append(chunk_id)
+
+    kept: List[Tuple[Any, ...]] = []
+    inserted: List[Tuple[Any, ...]] = []
+    for chunk in chunks:
+        matches = existing.get(chunk.content_hash)
+        if matches:
+            kept.append((chunk.index, chunk.start, chunk.token_count, matches.pop()))
+        else:
+            inserted.append((article_id, chunk.index, chunk.heading, chunk.content, chunk.content_hash,
+                             chunk.start, chunk.token_count))
+    stale = [chunk_id for ids in existing.values() for chunk_id in ids]
+
+    if stale:
+        cur.execute("DELETE FROM article_chunks WHERE id = ANY(%s)", (stale,))
+    if kept:
+        cur.executemany(
+            "UPDATE article_chunks SET chunk_index = %s, start_offset = %s, token_count = %s, updated_at = NOW() "
+            "WHERE id = %s",
+            kept,
+        )
+    if inserted:
+        cur.executemany(
+            """
+            INSERT INTO article_chunks
+                (article_id, chunk_index, heading, content, content_hash, start_offset, token_count,
+                 created_at, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
+            """,
+            inserted,
+        )
+    return len(inserted), len(kept), len(stale)
+
+
+def sync_article_chunks(limit: int = 200, max_tokens: Optional[int] = None,
+                        overlap_tokens: Optional[int] = None) -> Dict[str, int]:
+    """為內容在上次切分後有變更的文章重新切段落，並清除已刪除 / 測試文章的段落（測試文章不切段落）。
+
+    回傳 {'articles', 'inserted', 'kept', 'deleted'}；新增的段落 embedding 為 NULL，
+    由 backfill_missing_embeddings(table='article_chunks') 補齊。
+    """
+    stats = {'articles': 0, 'inserted': 0, 'kept': 0, 'deleted': 0}
+    if not km_db.is_configured():
+        return stats
+    options = chunk_options()
+    max_tokens = max_tokens or options['max_tokens']
+    overlap_tokens = options['overlap_tokens'] if overlap_tokens is None else overlap_tokens
+
+    with km_db.connection() as conn:
+        with conn.cursor() as cur:
+            if not chunk_table_exists(cur):
+                logger.info("article_chunks 表不存在，略過段落切分")
+                return stats
+            cur.execute(
+                """
+                DELETE FROM article_chunks c
+                USING articles a
+                WHERE a.id = c.article_id
+                  AND (a.deleted_at IS NOT NULL OR a.is_test)
+                """
+            )
+            stats['deleted'] += max(cur.rowcount, 0)
+            # 段落最後更新時間早於文章變更時間（或尚未切分）即需重新切分
+            cur.execute(
+                """
+                SELECT a.id, a.content
+                FROM articles a
+                LEFT JOIN LATERAL (
+                    SELECT max(c.updated_at) AS chunked_at FROM article_chunks c WHERE c.article_id = a.id
+                ) ch ON true
+                WHERE a.deleted_at IS NULL
+                  AND a.content IS NOT NULL AND btrim(a.content) <> ''
+                  AND NOT a.is_test
+                  AND (ch.chunked_at IS NULL OR ch.chunked_at < COALESCE(a.updated_at, a.created_at, a.file_date))
+                ORDER BY a.id
+                LIMIT %s
+                """,
+                (limit,)
+            )
+            rows = cur.fetchall()
+            conn.commit()
+
+            for article_id, content in rows:
+                inserted, kept, deleted = _apply_chunks(
+                    cur, article_id, chunk_markdown(content, max_tokens, overlap_tokens))
+                conn.commit()
+                stats['articles'] += 1
+                stats['inserted'] += inserted
+                stats['kept'] += kept
+                stats['deleted'] += deleted
+
+    logger.info("段落切分完成：%s", stats)
+    if stats['inserted'] or stats['deleted']:
+        from .result_cache import bump_corpus_version
+        bump_corpus_version('chunks')
+    return stats
@@ -0,0 +1,239 @@
+"""
+知識庫資料庫連線 - 程序內共享的 psycopg 連線池
+
+所有 KM 檢索與 embedding 補齊都透過這裡借用連線，避免每次查詢重新
+組裝連線字串並重做 TLS 握手與認證。新連線會註冊 pgvector 的二進位 adapter，
+查詢向量與補齊的 embedding 以 float32 二進位傳送，不必組成數十 KB 的十進位字串再由資料庫解析。
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Union
+
+import psycopg
+from psycopg.types import TypeInfo
+
+from .aio import LoopLocal
+
+try:
+    from psycopg_pool import AsyncConnectionPool, ConnectionPool
+except ImportError:
+    AsyncConnectionPool = None
+    ConnectionPool = None
+
+try:
+    import numpy as np
+    from pgvector.psycopg import register_vector, register_vector_async
+except ImportError:
+    np = None
+    register_vector = None
+    register_vector_async = None
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional["ConnectionPool"] = None
+_async_pools = LoopLocal(lambda: {'pool': None, 'lock': asyncio.Lock()})
+_lock = threading.Lock()
+
+
+def build_conn_str() -> str:
+    """從環境變數組裝資料庫連線字串，找不到則回傳空字串。"""
+    conn_str = os.getenv('POSTGRES_CONNECTION_STRING') or os.getenv('DATABASE_URL')
+    if conn_str:
+        return conn_str
+    # 允許以拆分的 DB_* 變數組裝連線字串
+    db_host = os.getenv('DB_HOST')
+    db_port = os.getenv('DB_PORT')
+    db_name = os.getenv('DB_DATABASE')
+    db_user = os.getenv('DB_USERNAME')
+    db_pass = os.getenv('DB_PASSWORD')
+    db_sslmode = os.getenv('DB_SSLMODE')
+    if not all([db_host, db_port, db_name, db_user, db_pass]):
+        return ""
+    conn_str = f"postgres://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
+    if db_sslmode:
+        conn_str = f"{conn_str}?sslmode={db_sslmode}"
+    return conn_str
+
+
+def is_configured() -> bool:
+    """是否有可用的資料庫連線資訊"""
+    return bool(build_conn_str())
+
+
+def _pool_options() -> Dict[str, Any]:
+    """連線池參數，可由環境變數調整"""
+    return {
+        'min_size': int(os.getenv('KM_DB_POOL_MIN_SIZE', '1')),
+        'max_size': int(os.getenv('KM_DB_POOL_MAX_SIZE', '5')),
+        'timeout': float(os.getenv('KM_DB_POOL_TIMEOUT', '10')),
+        'max_idle': float(os.getenv('KM_DB_POOL_MAX_IDLE', '300')),
+        'max_lifetime': float(os.getenv('KM_DB_POOL_MAX_LIFETIME', '1800')),
+    }
+
+
+def _configure(conn: psycopg.Connection) -> None:
+    """新連線註冊 pgvector adapter；資料庫未安裝 vector 擴充時略過（改以文字格式傳送向量）"""
+    if register_vector is None:
+        return
+    try:
+        register_vector(conn)
+    except Exception as e:
+        logger.info("未註冊 pgvector adapter，向量改以文字格式傳送: %s", str(e))
+    # 連線池要求 configure 後連線回到 idle 狀態
+    conn.rollback()
+
+
+async def _aconfigure(conn: psycopg.AsyncConnection) -> None:
+    """_configure 的非同步版本"""
+    if register_vector_async is None:
+        return
+    try:
+        await register_vector_async(conn)
+    except Exception as e:
+        logger.info("未註冊 pgvector adapter，向量改以文字格式傳送: %s", str(e))
+    await conn.rollback()
+
+
+def has_vector_adapter(conn: Any) -> bool:
+    """連線是否已註冊 pgvector 的 vector 型別（可用二進位傳送 numpy 陣列）"""
+    adapters = getattr(conn, 'adapters', None)
+    return adapters is not None and isinstance(adapters.types.get('vector'), TypeInfo)
+
+
+def vector_param(conn: Any, values: Sequence[float]) -> Union["np.ndarray", str]:
+    """向量查詢參數：已註冊 adapter 的連線傳 float32 陣列（二進位），否則退回 pgvector 文字格式"""
+    if np is not None and has_vector_adapter(conn):
+        return np.asarray(values, dtype=np.float32)
+    return '[' + ','.join(map(str, values)) + ']'
+
+
+def get_pool() -> Optional["ConnectionPool"]:
+    """取得（必要時建立）同步連線池；未安裝 psycopg_pool 或無連線資訊時回傳 None。"""
+    global _pool
+    if _pool is not None:
+        return _pool
+    if ConnectionPool is None:
+        return None
+    conn_str = build_conn_str()
+    if not conn_str:
+        return None
+    with _lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                conn_str,
+                name='km_db',
+                check=ConnectionPool.check_connection,
+                configure=_configure,
+                open=True,
+                **_pool_options(),
+            )
+            logger.info("KM 資料庫連線池已建立: %s", conn_str.split('@')[-1])
+    return _pool
+
+
+@contextmanager
+def connection() -> Iterator[psycopg.Connection]:
+    """借用一條資料庫連線。
+
+    區塊正常結束時 commit，發生例外時 rollback；未安裝 psycopg_pool 時
+    退回一次性的 psycopg.connect()，語意相同。
+    """
+    pool = get_pool()
+    if pool is not None:
+        with pool.connection() as conn:
+            yield conn
+        return
+    conn_str = build_conn_str()
+    if not conn_str:
+        raise RuntimeError("KM database is not configured")
+    with psycopg.connect(conn_str) as conn:
+        _configure(conn)
+        yield conn
+
+
+async def get_async_pool() -> Optional["AsyncConnectionPool"]:
+    """取得當前事件迴圈的非同步連線池（每個事件迴圈一份，建立後長期沿用）。"""
+    if AsyncConnectionPool is None:
+        return None
+    conn_str = build_conn_str()
+    if not conn_str:
+        return None
+    state = _async_pools.get()
+    if state['pool'] is not None:
+        return state['pool']
+    async with state['lock']:
+        if state['pool'] is None:
+            pool = AsyncConnectionPool(
+                conn_str,
+                name='km_db_async',
+                check=AsyncConnectionPool.check_connection,
+                configure=_aconfigure,
+                open=False,
+                **_pool_options(),
+            )
+            await pool.open()
+            state['pool'] = pool
+    return state['pool']
+
+
+@asynccontextmanager
+async def aconnection() -> AsyncIterator[psycopg.AsyncConnection]:
+    """借用一條非同步資料庫連線，語意同 connection()。"""
+    pool = await get_async_pool()
+    if pool is not None:
+        async with pool.connection() as conn:
+            yield conn
+        return
+    conn_str = build_conn_str()
+    if not conn_str:
+        raise RuntimeError("KM database is not configured")
+    async with await psycopg.AsyncConnection.connect(conn_str) as conn:
+        await _aconfigure(conn)
+        yield conn
+
+
+def pool_stats() -> Dict[str, Any]:
+    """回傳連線池統計資訊（pool_size、requests_waiting 等）"""
+    stats: Dict[str, Any] = {'configured': is_configured(), 'pool_available': ConnectionPool is not None}
+    if _pool is not None:
+        stats['sync'] = _pool.get_stats()
+    async_pools = [state['pool'] for state in _async_pools.values() if state['pool'] is not None]
+    if async_pools:
+        stats['async'] = [pool.get_stats() for pool in async_pools]
+    return stats
+
+
+def close_pools() -> None:
+    """關閉同步連線池與各事件迴圈的非同步連線池
+
+    非同步連線池須在建立它的事件迴圈上關閉：仍在執行的迴圈（背景迴圈、ASGI 迴圈）交給該迴圈執行並等待，
+    在該迴圈內呼叫時改排入 task；迴圈已停止的連線池無法再關閉，只能捨棄。
+    """
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+    try:
+        current = asyncio.get_running_loop()
+    except RuntimeError:
+        current = None
+    for loop, state in _async_pools.items():
+        pool, state['pool'] = state['pool'], None
+        if pool is None:
+            continue
+        if loop.is_closed() or not loop.is_running():
+            logger.warning("事件迴圈已停止，捨棄其非同步連線池")
+            continue
+        if loop is current:
+            loop.create_task(pool.close())
+            continue
+        try:
+            asyncio.run_coroutine_threadsafe(pool.close(), loop).result(_pool_options()['timeout'])
+        except Exception as e:
+            logger.warning("關閉非同步連線池失敗: %s", str(e))
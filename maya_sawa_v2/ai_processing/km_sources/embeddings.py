@@ -0,0 +1,252 @@
+"""
+查詢向量快取 - 程序內 LRU + Redis 兩層快取
+
+以正規化後的查詢文字與 OPENAI_EMBEDDING_MODEL 為鍵（送去產生向量的也是正規化後的文字，
+同一個鍵不論先由哪種寫法寫入都對應同一個向量），Redis 中以 float32
+二進位格式儲存（1536 維約 6 KB），命中時可省去一次 OpenAI embeddings 往返。
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from .aio import LoopLocal
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT = "?？!！。.,，;；:：~～ "
+
+
+def normalize_query(text: str) -> str:
+    """正規化查詢文字：全半形統一、小寫、合併空白並去除句尾標點"""
+    s = unicodedata.normalize('NFKC', text or '').lower()
+    s = _WHITESPACE_RE.sub(' ', s).strip()
+    return s.rstrip(_TRAILING_PUNCT)
+
+
+def encode_vector(vec: List[float]) -> bytes:
+    """以 float32 緊湊編碼向量"""
+    return array('f', vec).tobytes()
+
+
+def decode_vector(raw: bytes) -> List[float]:
+    """解碼 float32 二進位向量"""
+    arr = array('f')
+    arr.frombytes(raw)
+    return arr.tolist()
+
+
+class EmbeddingCache:
+    """查詢向量兩層快取（程序內 LRU + Redis TTL）"""
+
+    KEY_PREFIX = 'km:qemb'
+
+    def __init__(self, max_size: Optional[int] = None, ttl_seconds: Optional[int] = None,
+                 redis_url: Optional[str] = None):
+        self.max_size = max_size or int(os.getenv('KM_EMBED_CACHE_SIZE', '1024'))
+        self.ttl_seconds = ttl_seconds or int(os.getenv('KM_EMBED_CACHE_TTL', '86400'))
+        self.redis_url = redis_url if redis_url is not None else os.getenv('REDIS_URL', '')
+        self._local: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+        self._redis_retry_at = 0.0
+        self.hits_local = 0
+        self.hits_redis = 0
+        self.misses = 0
+
+    def make_key(self, text: str, model: str) -> str:
+        digest = hashlib.sha1(f"{model}\0{normalize_query(text)}".encode('utf-8')).hexdigest()
+        return f"{self.KEY_PREFIX}:{model}:{digest}"
+
+    def _get_redis(self):
+        """延遲建立 Redis 連線；失敗後 60 秒內不再嘗試，避免拖慢檢索"""
+        if not self.redis_url or time.monotonic() < self._redis_retry_at:
+            return None
+        if self._redis is None:
+            try:
+                import redis
+                self._redis = redis.Redis.from_url(self.redis_url, socket_timeout=0.2,
+                                                   socket_connect_timeout=0.2)
+            except Exception as e:
+                self._mark_redis_down(e)
+                return None
+        return self._redis
+
+    def _mark_redis_down(self, error: Exception) -> None:
+        logger.warning("查詢向量 Redis 快取不可用，暫停使用 60 秒: %s", str(error))
+        self._redis = None
+        self._redis_retry_at = time.monotonic() + 60
+
+    def _count(self, counter: str) -> None:
+        # 計數會在多個執行緒（to_thread、同步檢索的執行緒池）同時更新
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _remember(self, key: str, vec: List[float]) -> None:
+        with self._lock:
+            self._local[key] = vec
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def _get_local(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            vec = self._local.get(key)
+            if vec is not None:
+                self._local.move_to_end(key)
+                self.hits_local += 1
+            return vec
+
+    def _get_remote(self, key: str) -> Optional[List[float]]:
+        """（阻塞）查詢 Redis；命中時一併寫入程序內快取"""
+        client = self._get_redis()
+        if client is None:
+            return None
+        try:
+            raw = client.get(key)
+        except Exception as e:
+            self._mark_redis_down(e)
+            return None
+        if not raw:
+            return None
+        vec = decode_vector(raw)
+        self._remember(key, vec)
+        self._count('hits_redis')
+        return vec
+
+    def _store_remote(self, key: str, vec: List[float]) -> None:
+        client = self._get_redis()
+        if client is not None:
+            try:
+                client.set(key, encode_vector(vec), ex=self.ttl_seconds)
+            except Exception as e:
+                self._mark_redis_down(e)
+
+    def get(self, text: str, model: str) -> Optional[List[float]]:
+        key = self.make_key(text, model)
+        vec = self._get_local(key)
+        if vec is None:
+            vec = self._get_remote(key)
+        if vec is None:
+            self._count('misses')
+        return vec
+
+    async def aget(self, text: str, model: str) -> Optional[List[float]]:
+        """get 的非同步版本：Redis 往返在執行緒中進行，不阻塞共用的事件迴圈"""
+        key = self.make_key(text, model)
+        vec = self._get_local(key)
+        if vec is None and self._get_redis() is not None:
+            vec = await asyncio.to_thread(self._get_remote, key)
+        if vec is None:
+            self._count('misses')
+        return vec
+
+    def set(self, text: str, model: str, vec: List[float]) -> None:
+        key = self.make_key(text, model)
+        self._remember(key, vec)
+        self._store_remote(key, vec)
+
+    async def aset(self, text: str, model: str, vec: List[float]) -> None:
+        """set 的非同步版本（Redis 寫入在執行緒中進行）"""
+        key = self.make_key(text, model)
+        self._remember(key, vec)
+        if self._get_redis() is not None:
+            await asyncio.to_thread(self._store_remote, key, vec)
+
+    def clear(self) -> None:
+        """清除程序內快取與計數（Redis 中的條目依 TTL 自然過期）"""
+        with self._lock:
+            self._local.clear()
+            self.hits_local = self.hits_redis = self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits_local + self.hits_redis + self.misses
+        return {
+            'size': len(self._local),
+            'max_size': self.max_size,
+            'hits_local': self.hits_local,
+            'hits_redis': self.hits_redis,
+            'misses': self.misses,
+            'hit_rate': (self.hits_local + self.hits_redis) / lookups if lookups else 0.0,
+        }
+
+
+embedding_cache = EmbeddingCache()
+
+def get_openai_client(api_key: str):
+    """取得共用的 OpenAI 客戶端（與聊天共用 ai_providers 的客戶端與 keep-alive 連線池）"""
+    from maya_sawa_v2.ai_processing.ai_providers import provider_clients
+    return provider_clients.openai(api_key)
+
+
+_async_clients = LoopLocal(dict)
+
+
+def get_async_openai_client(api_key: str):
+    """取得當前事件迴圈共用的 AsyncOpenAI 客戶端"""
+    clients = _async_clients.get()
+    client = clients.get(api_key)
+    if client is None:
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(api_key=api_key)
+        clients[api_key] = client
+    return client
+
+
+def get_query_embedding(text: str) -> Optional[List[float]]:
+    """取得查詢向量（先查快取），失敗則回傳 None。"""
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        return None
+    model = os.getenv('OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small')
+
+    cached = embedding_cache.get(text, model)
+    if cached is not None:
+        return cached
+
+    try:
+        client = get_openai_client(api_key)
+        resp = client.embeddings.create(model=model, input=normalize_query(text))
+        vec = resp.data[0].embedding
+    except Exception as e:
+        logger.warning("產生查詢向量失敗: %s", str(e))
+        return None
+    if not isinstance(vec, list) or not vec:
+        return None
+    vec = [float(x) for x in vec]
+    embedding_cache.set(text, model, vec)
+    return vec
+
+
+async def aget_query_embedding(text: str) -> Optional[List[float]]:
+    """get_query_embedding 的非同步版本（快取語意相同）"""
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        return None
+    model = os.getenv('OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small')
+
+    cached = await embedding_cache.aget(text, model)
+    if cached is not None:
+        return cached
+
+    try:
+        client = get_async_openai_client(api_key)
+        resp = await client.embeddings.create(model=model, input=normalize_query(text))
+        vec = resp.data[0].embedding
+    except Exception as e:
+        logger.warning("產生查詢向量失敗: %s", str(e))
+        return None
+    if not isinstance(vec, list) or not vec:
+        return None
+    vec = [float(x) for x in vec]
+    await embedding_cache.aset(text, model, vec)
+    return vec
@@ -0,0 +1,397 @@
+"""
+文章索引增量同步 - 以 updated_at / deleted_at watermark 只拉取變更的文章
+
+每次同步從 (changed_at, id) watermark 之後以伺服器端游標分批讀取變更列，
+整理成 upsert 與 tombstone 後一次套用到各個程序內索引（向量索引等），
+再發布新的索引版本。成本與變更量成正比，而非語料大小。
+完整重建時不暫存整份語料：各索引逐批累積自己需要的資料（BM25 postings、float32 向量），
+最後一次發布；只有啟用中的索引需要時才讀取 embedding 欄位。
+目前的索引：向量索引（vector_index）與 BM25 全文索引（text_index）。
+"""
+
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from . import db as km_db
+
+logger = logging.getLogger(__name__)
+
+Watermark = Tuple[datetime, int]
+
+# 變更時間：最後更新（無則建立 / 檔案日期）與刪除時間取較晚者
+CHANGED_AT_SQL = ("GREATEST(COALESCE(updated_at, created_at, file_date), "
+                  "COALESCE(deleted_at, '-infinity'::timestamp))")
+
+
+def is_test_path(file_path: str) -> bool:
+    """測試文章判斷（與 articles.is_test 產生欄位的規則一致；資料庫內的文章直接讀該欄位）"""
+    return (file_path or '').startswith('test/') or 'test' in (file_path or '').lower()
+
+
+def encode_watermark(watermark: Optional[Watermark]) -> Optional[List[Any]]:
+    if watermark is None:
+        return None
+    return [watermark[0].isoformat(), watermark[1]]
+
+
+def decode_watermark(value: Any) -> Optional[Watermark]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value[0]), int(value[1])
+
+
+class IndexTarget(ABC):
+    """可增量同步的程序內索引"""
+
+    name = ''
+    # 是否需要 embedding 欄位（沒有啟用中的索引需要時不讀取向量）
+    needs_embedding = False
+
+    def enabled(self) -> bool:
+        """停用的索引不參與 watermark 計算與同步"""
+        return True
+
+    def watermark(self) -> Optional[Watermark]:
+        """目前已載入資料對應的 watermark；未知時回傳 None（需完整重建）"""
+        return None
+
+    @abstractmethod
+    def apply(self, upserts: List[Dict[str, Any]], deletes: List[int], full: bool,
+              watermark: Optional[Watermark]) -> None:
+        """套用變更並發布新版本；full=True 表示以 upserts 完整取代既有內容"""
+        pass
+
+    def begin_full(self) -> Any:
+        """開始完整重建，回傳逐批累積用的狀態"""
+        return []
+
+    def add_batch(self, state: Any, rows: List[Dict[str, Any]]) -> Any:
+        """累積完整重建的一批文章，回傳更新後的狀態（預設保留原始列，索引可覆寫以只保留需要的資料）"""
+        state.extend(rows)
+        return state
+
+    def finish_full(self, state: Any, watermark: Optional[Watermark]) -> None:
+        """以累積的狀態完整取代既有內容並發布"""
+        self.apply(state, [], True, watermark)
+
+
+class VectorIndexTarget(IndexTarget):
+    """程序內 NumPy 向量索引"""
+
+    name = 'vector'
+    needs_embedding = True
+
+    def enabled(self) -> bool:
+        # 只在使用程序內向量索引時同步（KM_VECTOR_BACKEND=local，或已載入快照作為 pgvector 的備援）；
+        # 純 pgvector 部署不在每個 worker 建立整份向量索引
+        from .vector_index import get_vector_index, np
+        if np is None:
+            return False
+        return os.getenv('KM_VECTOR_BACKEND', 'pgvector') == 'local' or get_vector_index() is not None
+
+    def watermark(self) -> Optional[Watermark]:
+        from .vector_index import get_vector_index
+        index = get_vector_index()
+        meta = getattr(index, 'meta', None) or {}
+        return decode_watermark(meta.get('watermark'))
+
+    def apply(self, upserts, deletes, full, watermark):
+        from .vector_index import (NumpyVectorIndex, get_vector_index, index_options, np, parse_vector,
+                                   set_vector_index)
+        if np is None:
+            return
+        current = get_vector_index()
+        if current is None or not hasattr(current, 'with_changes'):
+            current = NumpyVectorIndex.from_items([], **index_options())
+        elif full:
+            # 完整重建沿用目前索引的格式（float32 / 量化、是否保留 float32）
+            current = current.with_changes([], current.ids.tolist())
+        vectors = [(row['id'], parse_vector(row.get('embedding'))) for row in upserts]
+        # 沒有 embedding 的文章也要移出向量索引
+        missing = [item_id for item_id, vec in vectors if not vec]
+        index = current.with_changes(vectors, list(deletes) + missing)
+        index.meta['watermark'] = encode_watermark(watermark)
+        set_vector_index(index)
+
+    def begin_full(self):
+        return {'ids': [], 'vectors': []}
+
+    def add_batch(self, state, rows):
+        from .vector_index import np, parse_vector
+        batch = [(row['id'], parse_vector(row.get('embedding'))) for row in rows]
+        batch = [(item_id, vec) for item_id, vec in batch if vec]
+        if batch and np is not None:
+            # 每批轉成 float32 陣列，不保留 Python float 串列
+            state['ids'].extend(item_id for item_id, _ in batch)
+            state['vectors'].append(np.asarray([vec for _, vec in batch], dtype=np.float32))
+        return state
+
+    def finish_full(self, state, watermark):
+        from .vector_index import NumpyVectorIndex, get_vector_index, index_options, np, set_vector_index
+        if np is None:
+            return
+        current = get_vector_index()
+        if current is None or not hasattr(current, 'with_changes'):
+            base = NumpyVectorIndex.from_items([], **index_options())
+        else:
+            # 完整重建沿用目前索引的格式（float32 / 量化、是否保留 float32）
+            base = current.with_changes([], current.ids.tolist())
+        rows = (row for matrix in state['vectors'] for row in matrix)
+        index = base.with_changes(zip(state['ids'], rows))
+        index.meta['watermark'] = encode_watermark(watermark)
+        set_vector_index(index)
+
+
+class TextIndexTarget(IndexTarget):
+    """程序內 BM25 全文索引（檔案路徑 + 內文）"""
+
+    name = 'text'
+
+    def enabled(self) -> bool:
+        from .text_index import enabled, np
+        return np is not None and enabled()
+
+    def watermark(self) -> Optional[Watermark]:
+        from .text_index import get_text_index
+        index = get_text_index()
+        return decode_watermark(index.meta.get('watermark')) if index is not None else None
+
+    def apply(self, upserts, deletes, full, watermark):
+        from .text_index import BM25Index, get_text_index, set_text_index
+        current = None if full else get_text_index()
+        items = [(row['id'], f"{row.get('file_path') or ''}\n{row.get('content') or ''}") for row in upserts]
+        if current is None:
+            index = BM25Index.from_items(items)
+        else:
+            index = current.with_changes(items, deletes)
+        index.meta['watermark'] = encode_watermark(watermark)
+        set_text_index(index)
+
+    def begin_full(self):
+        return {'ids': [], 'vocab': {}, 'term_ids': [], 'doc_idx': [], 'tfs': [], 'doc_len': []}
+
+    def add_batch(self, state, rows):
+        from .text_index import BM25Index, tokenize
+        # 每批直接切詞成 postings，不保留文章內文
+        items = [(row['id'], f"{row.get('file_path') or ''}\n{row.get('content') or ''}") for row in rows]
+        items = [(item_id, text) for item_id, text in items if tokenize(text)]
+        term_ids, doc_idx, tfs, doc_len = BM25Index._postings((text for _, text in items), state['vocab'],
+                                                              first_doc=len(state['ids']))
+        state['ids'].extend(item_id for item_id, _ in items)
+        state['term_ids'].extend(term_ids)
+        state['doc_idx'].extend(doc_idx)
+        state['tfs'].extend(tfs)
+        state['doc_len'].extend(doc_len)
+        return state
+
+    def finish_full(self, state, watermark):
+        from .text_index import BM25Index, np, set_text_index
+        index = BM25Index._from_postings(
+            BM25Index._ids_array(state['ids']), state['vocab'],
+            np.asarray(state['term_ids'], dtype=np.int64), np.asarray(state['doc_idx'], dtype=np.int64),
+            np.asarray(state['tfs'], dtype=np.int64), np.asarray(state['doc_len'], dtype=np.float32),
+            1.2, 0.75,
+        )
+        index.meta['watermark'] = encode_watermark(watermark)
+        set_text_index(index)
+
+
+class IndexSyncEngine:
+    """增量同步引擎：追蹤 watermark 與已發布的索引版本"""
+
+    def __init__(self):
+        self.targets: Dict[str, IndexTarget] = {}
+        self.watermark: Optional[Watermark] = None
+        self.version = 0
+        self.last_stats: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def register(self, target: IndexTarget) -> None:
+        self.targets[target.name] = target
+
+    def _initial_watermark(self) -> Optional[Watermark]:
+        """以各索引已載入資料中最舊的 watermark 為起點；任一索引未知則需完整同步"""
+        marks = [target.watermark() for target in self.targets.values() if target.enabled()]
+        if not marks or any(m is None for m in marks):
+            return None
+        return min(marks)
+
+    def _scan(self, watermark: Optional[Watermark], batch_size: int, with_embedding: bool
+              ) -> Iterator[List[Tuple[Any, ...]]]:
+        """以伺服器端游標逐批讀取 watermark 之後的變更列；不需要向量時不讀取 embedding 欄位"""
+        where = "" if watermark is None else "WHERE (changed_at, id) > (%(changed_at)s, %(id)s)"
+        params = {} if watermark is None else {'changed_at': watermark[0], 'id': watermark[1]}
+        embedding = "embedding" if with_embedding else "NULL"
+        with km_db.connection() as conn:
+            # 已註冊 pgvector adapter 時以二進位格式讀取，embedding 直接載入為陣列
+            binary = with_embedding and km_db.has_vector_adapter(conn)
+            with conn.cursor(name='km_index_sync', binary=binary) as cur:
+                cur.itersize = batch_size
+                cur.execute(
+                    f"""
+                    SELECT id, file_path, content, {embedding}, deleted_at IS NOT NULL OR is_test, changed_at
+                    FROM (
+                        SELECT id, file_path, content, embedding, deleted_at, is_test, {CHANGED_AT_SQL} AS changed_at
+                        FROM articles
+                    ) a
+                    {where}
+                    ORDER BY changed_at, id
+                    """,
+                    params,
+                )
+                while True:
+                    batch = cur.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    yield batch
+
+    @staticmethod
+    def _row(article_id, file_path, content, embedding) -> Dict[str, Any]:
+        return {'id': int(article_id), 'file_path': file_path, 'content': content, 'embedding': embedding}
+
+    def _fetch_changes(self, watermark: Watermark, batch_size: int, with_embedding: bool
+                       ) -> Tuple[Dict[int, Dict[str, Any]], List[int], Optional[Watermark], int]:
+        """增量同步：整理 watermark 之後的變更（量與變更數成正比）"""
+        upserts: Dict[int, Dict[str, Any]] = {}
+        deletes: Dict[int, None] = {}
+        last: Optional[Watermark] = watermark
+        scanned = 0
+        for batch in self._scan(watermark, batch_size, with_embedding):
+            for article_id, file_path, content, embedding, hidden, changed_at in batch:
+                scanned += 1
+                last = (changed_at, int(article_id))
+                # 已刪除或測試文章：不進入索引（增量同步時視為刪除）
+                if hidden:
+                    upserts.pop(article_id, None)
+                    deletes[article_id] = None
+                    continue
+                deletes.pop(article_id, None)
+                upserts[article_id] = self._row(article_id, file_path, content, embedding)
+        return upserts, list(deletes), last, scanned
+
+    def _sync_full(self, targets: List[IndexTarget], batch_size: int, with_embedding: bool, failed: List[str]
+                   ) -> Tuple[int, Optional[Watermark], int]:
+        """完整重建：每批交給各索引累積後即丟棄，全部讀完才發布；回傳 (文章數, watermark, 掃描數)"""
+        states: Dict[str, Any] = {}
+        for target in targets:
+            states[target.name] = target.begin_full()
+        count = 0
+        last: Optional[Watermark] = None
+        scanned = 0
+        for batch in self._scan(None, batch_size, with_embedding):
+            rows = []
+            for article_id, file_path, content, embedding, hidden, changed_at in batch:
+                scanned += 1
+                last = (changed_at, int(article_id))
+                if not hidden:
+                    rows.append(self._row(article_id, file_path, content, embedding))
+            count += len(rows)
+            for target in targets:
+                if target.name in failed:
+                    continue
+                try:
+                    states[target.name] = target.add_batch(states[target.name], rows)
+                except Exception as e:
+                    failed.append(target.name)
+                    logger.error("套用索引變更失敗（%s）: %s", target.name, str(e))
+        for target in targets:
+            if target.name in failed:
+                continue
+            try:
+                target.finish_full(states.pop(target.name), last)
+            except Exception as e:
+                failed.append(target.name)
+                logger.error("套用索引變更失敗（%s）: %s", target.name, str(e))
+        return count, last, scanned
+
+    def sync(self, full: bool = False, batch_size: int = 500) -> Dict[str, Any]:
+        """執行一次同步並回傳統計；沒有變更時不發布新版本"""
+        if not km_db.is_configured():
+            return {'status': 'skipped', 'version': self.version}
+        with self._lock:
+            started = time.perf_counter()
+            if not full and self.watermark is None:
+                self.watermark = self._initial_watermark()
+                full = self.watermark is None
+            targets = [target for target in self.targets.values() if target.enabled()]
+            with_embedding = any(target.needs_embedding for target in targets)
+
+            failed: List[str] = []
+            deletes: List[int] = []
+            if full:
+                upserted, last, scanned = self._sync_full(targets, batch_size, with_embedding, failed)
+            else:
+                upserts, deletes, last, scanned = self._fetch_changes(self.watermark, batch_size, with_embedding)
+                upserted = len(upserts)
+                if upserts or deletes:
+                    rows = list(upserts.values())
+                    for target in targets:
+                        try:
+                            target.apply(rows, deletes, False, last)
+                        except Exception as e:
+                            failed.append(target.name)
+                            logger.error("套用索引變更失敗（%s）: %s", target.name, str(e))
+            if full or upserted or deletes:
+                self.version += 1
+                self._publish(upserted, len(deletes), full)
+            if failed:
+                # 任一索引未套用時不推進 watermark，下次同步重新拉取同一批變更（套用為冪等）
+                logger.warning("索引 %s 套用失敗，watermark 維持不變", ', '.join(failed))
+            else:
+                self.watermark = last
+
+            self.last_stats = {
+                'status': 'full' if full else 'incremental',
+                'version': self.version,
+                'scanned': scanned,
+                'upserts': upserted,
+                'deletes': len(deletes),
+                'failed': failed,
+                'watermark': encode_watermark(self.watermark),
+                'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+            }
+        logger.info("文章索引同步完成: %s", self.last_stats)
+        return self.last_stats
+
+    def _publish(self, upserts: int, deletes: int, full: bool = False) -> None:
+        try:
+            from maya_sawa_v2.ai_processing.signals import km_index_published
+            km_index_published.send(sender=self.__class__, version=self.version, upserts=upserts, deletes=deletes,
+                                    full=full)
+        except Exception as e:
+            logger.warning("發布索引版本通知失敗: %s", str(e))
+
+    def start_periodic(self, interval: float) -> None:
+        """在背景執行緒中定期同步（每個 worker 各自更新自己的程序內索引）"""
+        if interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.sync()
+                except Exception as e:
+                    logger.warning("定期索引同步失敗: %s", str(e))
+
+        self._thread = threading.Thread(target=run, name='km-index-sync', daemon=True)
+        self._thread.start()
+
+    def stop_periodic(self) -> None:
+        self._stop.set()
+
+
+sync_engine = IndexSyncEngine()
+sync_engine.register(VectorIndexTarget())
+sync_engine.register(TextIndexTarget())
+
+
+def sync_interval() -> float:
+    return float(os.getenv('KM_INDEX_SYNC_INTERVAL_SECONDS', '0'))
@@ -2,9 +2,15 @@
 知識庫源管理器 - 負責管理所有知識庫源
 """
 
+import asyncio
+import concurrent.futures
 import logging
-from typing import Dict, List, Optional, Any
+import os
+import time
+from typing import Dict, List, Optional, Any, Tuple
+from . import aio
 from .base import BaseKMSource, KMQuery, KMResult
+from .result_cache import search_cache
 
 logger = logging.getLogger(__name__)
 
@@ -12,11 +18,26 @@ logger = logging.getLogger(__name__)
 class KMSourceManager:
     """知識庫源管理器"""
 
-    def __init__(self):
+    def __init__(self, source_specs: Optional[List[Dict[str, Any]]] = None):
         self.sources: List[BaseKMSource] = []
         self._sources_by_name: Dict[str, BaseKMSource] = {}
         self._sources_by_type: Dict[str, BaseKMSource] = {}
-        self._setup_default_sources()
+        # 整體檢索 deadline（秒），逾時的源回傳部分結果
+        self.deadline = float(os.getenv('KM_SEARCH_DEADLINE_SECONDS', '8'))
+        if source_specs is None:
+            self._setup_default_sources()
+        else:
+            self._setup_sources_from_specs(source_specs)
+
+    def _setup_sources_from_specs(self, source_specs: List[Dict[str, Any]]):
+        """依設定建立知識庫源，格式: [{'class': 'dotted.path.Source', 'config': {...}}, ...]"""
+        from django.utils.module_loading import import_string
+        for spec in source_specs:
+            try:
+                source_cls = import_string(spec['class'])
+                self.add_source(source_cls(spec.get('config') or {}))
+            except Exception as e:
+                logger.error(f"設置知識庫源 {spec.get('class')} 失敗: {e}")
 
     def _setup_default_sources(self):
         """設置預設的知識庫源"""
@@ -86,22 +107,123 @@ class KMSourceManager:
         return []
 
     def search_all_suitable(self, query: KMQuery) -> List[KMResult]:
-        """搜索所有適合的知識庫源"""
-        suitable_sources = self.get_suitable_sources(query)
-        all_results = []
+        """搜索所有適合的知識庫源（同步介面，於共用事件迴圈上並行執行）
 
-        for source in suitable_sources:
-            try:
-                results = source.search(query)
-                all_results.extend(results)
-            except Exception as e:
-                logger.error(f"Error searching source {source.name}: {e}")
-                continue
+        整體超過 deadline（快取或排序等源以外的步驟卡住）時放棄本次檢索，回傳空結果。
+        """
+        try:
+            return aio.run_sync(self.asearch_all_suitable(query), timeout=self.deadline + 1)
+        except concurrent.futures.TimeoutError:
+            logger.warning(f"KM search exceeded deadline ({self.deadline + 1}s), returning no results")
+            return []
+
+    async def _timed_search(self, source: BaseKMSource, query: KMQuery) -> Tuple[List[KMResult], str]:
+        """在單一源的時間預算內搜索，回傳結果與狀態（ok / timeout / error）"""
+        try:
+            results = await asyncio.wait_for(source.asearch(query), timeout=min(source.get_timeout(), self.deadline))
+            return results, 'ok'
+        except asyncio.TimeoutError:
+            logger.warning(f"KM source {source.name} timed out")
+            return [], 'timeout'
+        except Exception as e:
+            logger.error(f"Error searching source {source.name}: {e}")
+            return [], 'error'
+
+    async def _cache_key(self, query: KMQuery, sources: List[BaseKMSource]) -> Optional[str]:
+        """結果快取鍵；停用快取或有源不可快取時回傳 None"""
+        if not search_cache.enabled or any(source.cache_params() is None for source in sources):
+            return None
+        try:
+            return await search_cache.amake_key(query.query, sources)
+        except Exception as e:
+            logger.warning(f"計算檢索快取鍵失敗: {e}")
+            return None
+
+    @staticmethod
+    def _retime_cached(results: List[KMResult], started: float) -> List[KMResult]:
+        """快取命中時以本次查詢的耗時取代原本的 km_search 延遲，並標示 cached"""
+        total_ms = round((time.perf_counter() - started) * 1000, 1)
+        original = (results[0].metadata.get('km_search') or {}) if results else {}
+        summary = {
+            'sources': {name: dict(report, latency_ms=total_ms)
+                        for name, report in (original.get('sources') or {}).items()},
+            'partial': False,
+            'total_ms': total_ms,
+            'cached': True,
+        }
+        for result in results:
+            result.metadata['latency_ms'] = total_ms
+            result.metadata['km_search'] = summary
+        return results
+
+    async def asearch_all_suitable(self, query: KMQuery) -> List[KMResult]:
+        """並行搜索所有適合的知識庫源。
+
+        每個源有各自的時間預算，整體另有 deadline；逾時的源直接略過，回傳其餘源的部分結果。
+        各源耗時與狀態記錄在每筆結果的 metadata['km_search'] 中。
+        相同查詢與源組合的完整結果（非部分結果）會依語料版本快取，命中時標示 metadata['km_cache']，
+        km_search 改為本次（快取查詢）的耗時並標示 cached。
+        """
+        suitable_sources = self.get_suitable_sources(query)
+        if not suitable_sources:
+            return []
+
+        started = time.perf_counter()
+        cache_key = await self._cache_key(query, suitable_sources)
+        if cache_key is not None:
+            cached = await search_cache.aget(cache_key)
+            if cached is not None:
+                return self._retime_cached(cached, started)
+
+        latencies: Dict[str, float] = {}
+
+        async def run(source: BaseKMSource):
+            results, status = await self._timed_search(source, query)
+            latencies[source.name] = round((time.perf_counter() - started) * 1000, 1)
+            return results, status
+
+        tasks = {asyncio.ensure_future(run(source)): source for source in suitable_sources}
+        done, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        for task in pending:
+            task.cancel()
+
+        report: Dict[str, Dict[str, Any]] = {}
+        all_results: List[KMResult] = []
+        for task, source in tasks.items():
+            if task in done:
+                results, status = task.result()
+            else:
+                results, status = [], 'deadline'
+                logger.warning(f"KM source {source.name} missed the search deadline")
+            latency_ms = latencies.get(source.name, round(self.deadline * 1000, 1))
+            report[source.name] = {'status': status, 'latency_ms': latency_ms, 'results': len(results)}
+            for result in results:
+                result.metadata['latency_ms'] = latency_ms
+            all_results.extend(results)
+
+        summary = {
+            'sources': report,
+            'partial': any(r['status'] != 'ok' for r in report.values()),
+            'total_ms': round((time.perf_counter() - started) * 1000, 1),
+            'cached': False,
+        }
+        for result in all_results:
+            result.metadata['km_search'] = summary
 
         # 按相關性排序
         all_results.sort(key=lambda r: r.relevance_score, reverse=True)
+        if cache_key is not None and not summary['partial']:
+            await search_cache.aset(cache_key, all_results)
         return all_results
 
+    def warm(self) -> None:
+        """預熱所有知識庫源（建立連線池、載入快取）"""
+        for source in self.sources:
+            try:
+                source.warm()
+            except Exception as e:
+                logger.warning(f"預熱知識庫源 {source.name} 失敗: {e}")
+
     def list_sources(self) -> List[Dict[str, Any]]:
         """列出所有知識庫源資訊"""
         return [
@@ -0,0 +1,307 @@
+"""
+Paprika 文章快取 - 程序內共享（可選 Redis 共享）的文章列表快取
+
+- 以 ETag / Last-Modified 做條件式請求，內容未變時只需一次 304 往返
+- 過期但仍在 stale 視窗內時立即回傳舊資料，並在背景更新（stale-while-revalidate）
+- single-flight：同一時間只有一個執行緒（與一個 worker，若啟用 Redis）下載列表
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .aio import LoopLocal
+
+logger = logging.getLogger(__name__)
+
+# 長期沿用的非同步 HTTP 客戶端（每個事件迴圈一份），保留 keep-alive 連線
+_async_clients = LoopLocal(lambda: httpx.AsyncClient(timeout=10.0))
+
+
+class PaprikaCorpusCache:
+    """Paprika 文章列表快取"""
+
+    def __init__(self, url: str, ttl_seconds: int = 3600, stale_seconds: Optional[int] = None,
+                 timeout: float = 10.0, redis_url: Optional[str] = None):
+        self.url = url
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds if stale_seconds is not None else int(
+            os.getenv('KM_PAPRIKA_STALE_SECONDS', '86400'))
+        self.timeout = timeout
+        self.redis_url = redis_url if redis_url is not None else (
+            os.getenv('REDIS_URL', '') if os.getenv('KM_PAPRIKA_REDIS_CACHE', 'false').lower() == 'true' else '')
+
+        self._articles: Optional[List[Dict[str, Any]]] = None
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._async_locks = LoopLocal(asyncio.Lock)
+        self._refreshing = False
+        self._redis = None
+        self.counters: Dict[str, int] = {'hits': 0, 'stale_hits': 0, 'fetches': 0, 'not_modified': 0, 'errors': 0}
+
+    @property
+    def _redis_key(self) -> str:
+        return f"km:paprika:{hashlib.sha1(self.url.encode('utf-8')).hexdigest()}"
+
+    def _get_redis(self):
+        if not self.redis_url:
+            return None
+        if self._redis is None:
+            try:
+                import redis
+                self._redis = redis.Redis.from_url(self.redis_url, socket_timeout=1, socket_connect_timeout=1)
+            except Exception as e:
+                logger.warning("Paprika Redis 快取不可用: %s", str(e))
+                self.redis_url = ''
+                return None
+        return self._redis
+
+    def _age(self) -> float:
+        return time.time() - self._fetched_at
+
+    def get_articles(self) -> List[Dict[str, Any]]:
+        """取得文章列表；新鮮時直接回傳，過期時依情況背景或同步更新"""
+        if self._articles is not None:
+            age = self._age()
+            if age <= self.ttl_seconds:
+                self.counters['hits'] += 1
+                return self._articles
+            if age <= self.ttl_seconds + self.stale_seconds:
+                self.counters['stale_hits'] += 1
+                self._refresh_in_background()
+                return self._articles
+
+        # 冷啟動或資料太舊：同步更新，其他執行緒等待同一次下載結果
+        with self._lock:
+            if self._articles is None or self._age() > self.ttl_seconds + self.stale_seconds:
+                self._load_from_redis()
+            if self._articles is None or self._age() > self.ttl_seconds:
+                self._refresh()
+        return self._articles or []
+
+    async def aget_articles(self) -> List[Dict[str, Any]]:
+        """get_articles 的非同步版本：冷啟動時以共用的 httpx.AsyncClient 下載，不阻塞事件迴圈"""
+        if self._articles is not None and self._age() <= self.ttl_seconds + self.stale_seconds:
+            return self.get_articles()
+
+        async with self._async_locks.get():
+            # Redis 為同步客戶端，往返放到執行緒中，避免一次慢速往返卡住共用事件迴圈上的所有檢索
+            redis_enabled = self._get_redis() is not None
+            if redis_enabled and (self._articles is None or self._age() > self.ttl_seconds + self.stale_seconds):
+                await asyncio.to_thread(self._load_from_redis)
+            if self._articles is None or self._age() > self.ttl_seconds:
+                locked = await asyncio.to_thread(self._try_lock) if redis_enabled else None
+                if locked is False:
+                    await asyncio.to_thread(self._load_from_redis)
+                if locked is not False or self._articles is None:
+                    try:
+                        self._apply(await self._afetch(), store=False)
+                        if redis_enabled:
+                            await asyncio.to_thread(self._store_to_redis)
+                    finally:
+                        # 下載失敗或檢索逾時被取消時也要釋放，否則其他 worker 要等鎖過期
+                        if locked:
+                            await asyncio.to_thread(self._release_lock)
+        return self._articles or []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            'articles': len(self._articles or []),
+            'age_seconds': self._age() if self._fetched_at else None,
+            'etag': self._etag,
+        }
+
+    def invalidate(self) -> None:
+        """強制下次讀取時重新驗證"""
+        self._fetched_at = 0.0
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                with self._lock:
+                    if self._age() > self.ttl_seconds:
+                        self._refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='paprika-cache-refresh', daemon=True).start()
+
+    def _try_lock(self) -> Optional[bool]:
+        """跨 worker single-flight 的 Redis 鎖：True 已取得、False 其他 worker 正在更新、None 未使用 Redis 或失敗"""
+        client = self._get_redis()
+        if client is None:
+            return None
+        try:
+            return bool(client.set(f"{self._redis_key}:lock", "1", nx=True, ex=int(self.timeout) + 5))
+        except Exception as e:
+            logger.warning("Paprika Redis 鎖失敗: %s", str(e))
+            return None
+
+    def _release_lock(self) -> None:
+        client = self._get_redis()
+        if client is None:
+            return
+        try:
+            client.delete(f"{self._redis_key}:lock")
+        except Exception as e:
+            logger.warning("釋放 Paprika Redis 鎖失敗: %s", str(e))
+
+    def _refresh(self) -> None:
+        """（持有 _lock 時呼叫）以條件式 GET 更新快取；其他 worker 正在更新時先沿用 Redis 中的資料"""
+        locked = self._try_lock()
+        if locked is False:
+            self._load_from_redis()
+            if self._articles is not None:
+                return
+        try:
+            self._apply(self._fetch())
+        finally:
+            if locked:
+                self._release_lock()
+
+    def _request_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self._articles is not None:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+        return headers
+
+    def _parse_response(self, response):
+        """回傳新的文章列表；304 時回傳 True；失敗回傳 None"""
+        if response.status_code == 304:
+            self.counters['not_modified'] += 1
+            return True
+        response.raise_for_status()
+        data = response.json()
+        if not data.get("success"):
+            logger.error("Paprika API 返回錯誤")
+            self.counters['errors'] += 1
+            return None
+        self._etag = response.headers.get('ETag')
+        self._last_modified = response.headers.get('Last-Modified')
+        articles = data.get("data", [])
+        logger.info("從paprika API獲取了 %d 篇文章", len(articles))
+        return articles
+
+    def _fetch(self):
+        if not httpx:
+            logger.error("httpx 未安裝，無法獲取paprika文章")
+            return None
+        try:
+            self.counters['fetches'] += 1
+            response = httpx.get(self.url, headers=self._request_headers(), timeout=self.timeout)
+            return self._parse_response(response)
+        except Exception as e:
+            self.counters['errors'] += 1
+            logger.error("獲取paprika文章時發生錯誤: %s", str(e))
+            return None
+
+    async def _afetch(self):
+        if not httpx:
+            logger.error("httpx 未安裝，無法獲取paprika文章")
+            return None
+        try:
+            self.counters['fetches'] += 1
+            response = await _async_clients.get().get(self.url, headers=self._request_headers(),
+                                                      timeout=self.timeout)
+            return self._parse_response(response)
+        except Exception as e:
+            self.counters['errors'] += 1
+            logger.error("獲取paprika文章時發生錯誤: %s", str(e))
+            return None
+
+    def _apply(self, fetched, store: bool = True) -> None:
+        if fetched is None:
+            if self._articles is None:
+                self._articles = []
+            # 失敗時沿用既有資料並在 60 秒後再重試，避免每個請求都打 API
+            self._fetched_at = max(self._fetched_at, time.time() - self.ttl_seconds + 60)
+            return
+        self._fetched_at = time.time()
+        if fetched is not True:
+            changed = self._articles is not None and fetched != self._articles
+            self._articles = fetched
+            if changed:
+                # Paprika 文章也是檢索語料，內容變更時讓檢索結果快取失效
+                from .result_cache import bump_corpus_version
+                bump_corpus_version('paprika')
+        if store:
+            self._store_to_redis()
+
+    def _load_from_redis(self) -> None:
+        client = self._get_redis()
+        if client is None:
+            return
+        try:
+            raw = client.get(self._redis_key)
+        except Exception as e:
+            logger.warning("讀取 Paprika Redis 快取失敗: %s", str(e))
+            return
+        if not raw:
+            return
+        try:
+            payload = json.loads(raw)
+        except ValueError as e:
+            # 內容損毀（例如被截斷）視為未命中，之後由下載結果覆寫
+            logger.warning("Paprika Redis 快取內容無法解析: %s", str(e))
+            return
+        if not isinstance(payload, dict):
+            return
+        if payload.get('fetched_at', 0) > self._fetched_at:
+            self._articles = payload.get('articles') or []
+            self._etag = payload.get('etag')
+            self._last_modified = payload.get('last_modified')
+            self._fetched_at = payload['fetched_at']
+
+    def _store_to_redis(self) -> None:
+        client = self._get_redis()
+        if client is None:
+            return
+        payload = {
+            'articles': self._articles or [],
+            'etag': self._etag,
+            'last_modified': self._last_modified,
+            'fetched_at': self._fetched_at,
+        }
+        try:
+            client.set(self._redis_key, json.dumps(payload, ensure_ascii=False),
+                       ex=self.ttl_seconds + self.stale_seconds)
+        except Exception as e:
+            logger.warning("寫入 Paprika Redis 快取失敗: %s", str(e))
+
+
+_caches: Dict[Tuple[str, int], PaprikaCorpusCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_paprika_cache(url: str, ttl_seconds: int = 3600) -> PaprikaCorpusCache:
+    """取得指定 URL 與 TTL 的程序內共享快取"""
+    key = (url, ttl_seconds)
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = PaprikaCorpusCache(url, ttl_seconds=ttl_seconds)
+                _caches[key] = cache
+    return cache
@@ -0,0 +1,178 @@
+"""
+pgvector ANN 索引管理 - 建立 / 重建 HNSW 或 IVFFlat 索引與查詢時參數
+
+KM_PG_VECTOR_TYPE=halfvec 時索引建在 embedding::halfvec(dim) 運算式上（pgvector >= 0.7.0），
+索引大小與檢索 I/O 約減半；embedding 欄位本身仍是 float32，可用來重排候選。
+索引只涵蓋正式文章（WHERE NOT is_test 的部分索引，見 migration 0006），檢索須帶相同條件才會使用。
+"""
+
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional
+
+import psycopg
+
+from . import db as km_db
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAMES = {
+    'hnsw': 'articles_embedding_hnsw',
+    'ivfflat': 'articles_embedding_ivfflat',
+}
+
+VECTOR_TYPES = ('vector', 'halfvec')
+
+# 正式文章的過濾條件（articles.is_test 為產生欄位）；檢索 SQL 與部分索引共用
+VISIBLE_SQL = "NOT is_test"
+
+
+def vector_type() -> str:
+    """ANN 索引與檢索使用的向量型別：vector（float32）或 halfvec（float16）"""
+    return os.getenv('KM_PG_VECTOR_TYPE', 'vector')
+
+
+def embedding_dim() -> int:
+    return int(os.getenv('KM_EMBEDDING_DIM', '1536'))
+
+
+def index_name(method: str, vtype: str = 'vector') -> str:
+    return INDEX_NAMES[method] + ('_halfvec' if vtype == 'halfvec' else '')
+
+
+def embedding_expr(vtype: str = 'vector') -> str:
+    """檢索與索引的 embedding 運算式；查詢必須與索引運算式完全一致才會使用索引"""
+    if vtype == 'halfvec':
+        return f"(embedding::halfvec({embedding_dim()}))"
+    return "embedding"
+
+
+def query_cast(vtype: str = 'vector') -> str:
+    """查詢向量（已為 vector 型別）在 vtype 索引上比較時需要的型別轉換"""
+    if vtype == 'halfvec':
+        return f"::halfvec({embedding_dim()})"
+    return ""
+
+
+def recommended_ivfflat_lists(row_count: int) -> int:
+    """依 pgvector 建議推算 lists：100 萬筆以下取 rows/1000，以上取 sqrt(rows)"""
+    if row_count <= 1_000_000:
+        return max(1, row_count // 1000)
+    return int(math.sqrt(row_count))
+
+
+def search_settings() -> Dict[str, str]:
+    """每次查詢套用的 ANN 召回參數（交易範圍）"""
+    return {
+        'hnsw.ef_search': os.getenv('KM_HNSW_EF_SEARCH', '40'),
+        'ivfflat.probes': os.getenv('KM_IVFFLAT_PROBES', '10'),
+    }
+
+
+def apply_search_settings(cur: psycopg.Cursor) -> None:
+    """在目前交易內設定 hnsw.ef_search / ivfflat.probes，不影響歸還連線池的連線"""
+    for name, value in search_settings().items():
+        cur.execute("SELECT set_config(%s, %s, true)", (name, str(value)))
+
+
+async def aapply_search_settings(cur: psycopg.AsyncCursor) -> None:
+    """apply_search_settings 的非同步版本"""
+    for name, value in search_settings().items():
+        await cur.execute("SELECT set_config(%s, %s, true)", (name, str(value)))
+
+
+def _index_sql(method: str, name: str, m: int, ef_construction: int, lists: int, vtype: str = 'vector') -> str:
+    column = f"{embedding_expr(vtype)} {vtype}_cosine_ops"
+    if method == 'hnsw':
+        return (f"CREATE INDEX CONCURRENTLY {name} ON articles "
+                f"USING hnsw ({column}) WITH (m = {int(m)}, ef_construction = {int(ef_construction)}) "
+                f"WHERE {VISIBLE_SQL}")
+    return (f"CREATE INDEX CONCURRENTLY {name} ON articles "
+            f"USING ivfflat ({column}) WITH (lists = {int(lists)}) WHERE {VISIBLE_SQL}")
+
+
+def _maintenance_connection() -> psycopg.Connection:
+    """CREATE/DROP INDEX CONCURRENTLY 不能在交易中執行，使用獨立的 autocommit 連線"""
+    conn_str = km_db.build_conn_str()
+    if not conn_str:
+        raise RuntimeError("KM database is not configured")
+    return psycopg.connect(conn_str, autocommit=True)
+
+
+def list_indexes() -> List[Dict[str, Any]]:
+    """列出 articles.embedding 相關索引與大小"""
+    with _maintenance_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT i.indexname, i.indexdef, pg_size_pretty(pg_relation_size(c.oid)), idx.indisvalid
+                FROM pg_indexes i
+                JOIN pg_class c ON c.relname = i.indexname
+                JOIN pg_index idx ON idx.indexrelid = c.oid
+                WHERE i.tablename = 'articles' AND i.indexdef ILIKE '%(embedding%'
+                ORDER BY i.indexname
+                """
+            )
+            return [
+                {'name': r[0], 'definition': r[1], 'size': r[2], 'valid': r[3]}
+                for r in cur.fetchall()
+            ]
+
+
+def build_index(method: str = 'hnsw', rebuild: bool = False, m: int = 16, ef_construction: int = 64,
+                lists: Optional[int] = None, vtype: Optional[str] = None) -> Dict[str, Any]:
+    """以 CONCURRENTLY 建立（或重建）向量索引，不阻塞檢索與寫入。
+
+    重建時先建新索引再替換舊索引，過程中查詢仍可使用舊索引。
+    切換 method 或向量型別時會移除其他索引，避免寫入時維護兩份 ANN 索引。
+    """
+    vtype = vtype or vector_type()
+    if method not in INDEX_NAMES:
+        raise ValueError(f"Unsupported vector index method: {method}")
+    if vtype not in VECTOR_TYPES:
+        raise ValueError(f"Unsupported vector type: {vtype}")
+    name = index_name(method, vtype)
+
+    with _maintenance_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM articles WHERE embedding IS NOT NULL")
+            row_count = int(cur.fetchone()[0])
+            if method == 'ivfflat' and not lists:
+                lists = recommended_ivfflat_lists(row_count)
+
+            cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+            existing = cur.fetchone()
+            # 先前中斷的 CONCURRENTLY 建立會留下 invalid 索引，直接重建
+            if existing is not None and existing[0] and not rebuild:
+                return {'name': name, 'action': 'exists', 'rows': row_count}
+
+            if existing is None:
+                cur.execute(_index_sql(method, name, m, ef_construction, lists or 1, vtype))
+                action = 'created'
+            else:
+                tmp_name = f"{name}_new"
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {tmp_name}")
+                cur.execute(_index_sql(method, tmp_name, m, ef_construction, lists or 1, vtype))
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                cur.execute(f"ALTER INDEX {tmp_name} RENAME TO {name}")
+                action = 'rebuilt'
+
+            for other_method in INDEX_NAMES:
+                for other_type in VECTOR_TYPES:
+                    other_name = index_name(other_method, other_type)
+                    if other_name != name:
+                        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {other_name}")
+
+            cur.execute("ANALYZE articles")
+
+    logger.info("向量索引 %s 已%s（rows=%d, method=%s, type=%s）", name, action, row_count, method, vtype)
+    return {'name': name, 'action': action, 'rows': row_count, 'lists': lists if method == 'ivfflat' else None,
+            'type': vtype}
+
+
+def drop_index(method: str, vtype: Optional[str] = None) -> None:
+    """移除指定方法（與向量型別）的向量索引"""
+    with _maintenance_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name(method, vtype or vector_type())}")
@@ -3,20 +3,22 @@
 專門處理程式設計相關問題，從paprika API獲取真實資料
 """
 
+import concurrent.futures
 import logging
-import asyncio
-import re
 import json
-import math
 import os
+import time
 from typing import Dict, Any, List, Tuple, Optional
-import psycopg
+from . import aio
+from . import db as km_db
+from . import pg_index
 from .base import BaseKMSource, KMQuery, KMResult
-
-try:
-    import httpx
-except ImportError:
-    httpx = None
+from .chunking import chunk_markdown
+from .embeddings import aget_query_embedding
+from .index_sync import is_test_path
+from .paprika import get_paprika_cache
+from .text_index import BM25Index, get_text_index, normalize_scores, tokenize
+from .vector_index import NumpyVectorIndex, get_vector_index, np
 
 logger = logging.getLogger(__name__)
 
@@ -24,90 +26,86 @@ logger = logging.getLogger(__name__)
 class ProgrammingKMSource(BaseKMSource):
     """程式設計知識庫源 - 整合所有程式設計相關資料"""
 
+    CHUNKS_RETRY_SECONDS = 300
+    # 查詢向量在 SQL 中的引用（InitPlan 只計算一次，ANN 索引仍可用於 ORDER BY）
+    QVEC_SQL = "(SELECT v FROM query_vec)"
+
     def __init__(self, config: Dict[str, Any] = None):
         super().__init__("programming_km", config)
 
         # Paprika API 配置
         self.paprika_api_url = self.config.get('paprika_api_url', 'https://peoplesystem.tatdvsonorth.com/paprika/articles')
         self.cache_timeout = self.config.get('cache_timeout', 3600)  # 快取1小時
-        self._articles_cache = None
-        self._cache_timestamp = 0
-
-        # 移除硬編碼關鍵詞 - 讓AI處理相關性判斷
-
-    async def _fetch_articles_from_paprika(self) -> List[Dict[str, Any]]:
-        """從paprika API獲取文章資料"""
-        if not httpx:
-            logger.error("httpx 未安裝，無法獲取paprika文章")
-            return []
-
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(self.paprika_api_url)
-                response.raise_for_status()
-                data = response.json()
 
-                if not data.get("success"):
-                    logger.error("Paprika API 返回錯誤")
-                    return []
+        # 混合檢索配置：fusion 可為 weighted（分數加權）或 rrf（reciprocal rank fusion）
+        self.fusion = self.config.get('fusion', os.getenv('KM_HYBRID_FUSION', 'weighted'))
+        self.text_weight = float(self.config.get('text_weight', os.getenv('KM_HYBRID_TEXT_WEIGHT', '0.6')))
+        self.vector_weight = float(self.config.get('vector_weight', os.getenv('KM_HYBRID_VECTOR_WEIGHT', '0.4')))
+        self.rrf_k = int(self.config.get('rrf_k', os.getenv('KM_HYBRID_RRF_K', '60')))
+        self.top_k = int(self.config.get('top_k', os.getenv('KM_HYBRID_TOP_K', '5')))
+        self.vector_candidates = int(self.config.get('vector_candidates', 8))
+        self.trigram_candidates = int(self.config.get('trigram_candidates', 12))
+        self.min_text_similarity = float(self.config.get('min_text_similarity', 0.1))
+        # 第三路訊號：程序內 BM25 全文索引（CJK bigram），由增量同步引擎維護
+        self.bm25_weight = float(self.config.get('bm25_weight', os.getenv('KM_HYBRID_BM25_WEIGHT', '0.3')))
+        self.bm25_candidates = int(self.config.get('bm25_candidates', 12))
+        # 向量候選來源：pgvector（資料庫 ANN）或 local（程序內 NumPy 索引）；
+        # pgvector 查詢失敗或超過 statement timeout 時自動改用程序內索引
+        self.vector_backend = self.config.get('vector_backend', os.getenv('KM_VECTOR_BACKEND', 'pgvector'))
+        self.db_statement_timeout_ms = int(self.config.get(
+            'db_statement_timeout_ms', os.getenv('KM_DB_STATEMENT_TIMEOUT_MS', '0')))
+        # 向量以 halfvec 檢索時，先取 vector_rerank 筆候選再以 float32 欄位重新計算距離（0 表示不重排）
+        self.pg_vector_type = self.config.get('pg_vector_type', pg_index.vector_type())
+        self.vector_rerank = int(self.config.get('vector_rerank', os.getenv('KM_VECTOR_RERANK_CANDIDATES', '0')))
+        self._paprika_index = None
+        self._paprika_index_source = None
+        self._paprika_text_index = None
+        self._paprika_text_index_source = None
+        self._paprika_visible = []
+        self._paprika_visible_source = None
+
+        # 檢索結果投影：passage 回傳文章中最相關的段落（article_chunks），尚未切分的文章退回 snippet；
+        # snippet 僅回傳命中位置附近的片段（完整內文改由 fetch_full 取得），full 回傳整篇
+        self.retrieval_mode = self.config.get('retrieval_mode', os.getenv('KM_RETRIEVAL_MODE', 'passage'))
+        self.snippet_chars = int(self.config.get('snippet_chars', os.getenv('KM_SNIPPET_CHARS', '400')))
+        self.snippet_lead = int(self.config.get('snippet_lead', 80))
+        # passage 模式下，段落向量的 ANN 候選也併入文章召回（長文的整篇向量會被稀釋）
+        self.chunk_candidates = int(self.config.get('chunk_candidates', os.getenv('KM_CHUNK_VECTOR_CANDIDATES', '16')))
+        self._chunks_retry_at = 0.0
 
-                articles = data.get("data", [])
-                logger.info("從paprika API獲取了 %d 篇文章", len(articles))
-                return articles
-
-        except Exception as e:
-            logger.error("獲取paprika文章時發生錯誤: %s", str(e))
-            return []
+        # 移除硬編碼關鍵詞 - 讓AI處理相關性判斷
 
     def _get_cached_articles(self) -> List[Dict[str, Any]]:
-        """獲取快取的文章資料"""
-        import time
-        current_time = time.time()
-
-        # 如果快取過期或不存在，重新獲取
-        if (self._articles_cache is None or
-            current_time - self._cache_timestamp > self.cache_timeout):
-
-            logger.info("開始從 Paprika API 獲取文章...")
-            try:
-                # 優先使用當前執行緒的 running loop 檢測
-                try:
-                    _ = asyncio.get_running_loop()
-                    # 有 running loop：改用執行緒中執行 asyncio.run，避免 RuntimeError
-                    import concurrent.futures
-                    logger.info("使用 ThreadPoolExecutor 執行異步請求...")
-                    with concurrent.futures.ThreadPoolExecutor() as executor:
-                        future = executor.submit(lambda: asyncio.run(self._fetch_articles_from_paprika()))
-                        # 添加超時處理
-                        self._articles_cache = future.result(timeout=10)  # 10秒超時
-                except RuntimeError:
-                    # 無 running loop：可直接 asyncio.run
-                    logger.info("直接使用 asyncio.run...")
-                    self._articles_cache = asyncio.run(self._fetch_articles_from_paprika())
-                except concurrent.futures.TimeoutError:
-                    logger.warning("Paprika API 請求超時，使用空快取")
-                    self._articles_cache = []
-
-                self._cache_timestamp = current_time
-                logger.info(f"成功獲取 {len(self._articles_cache)} 篇文章")
-
-            except Exception as e:
-                # 最後回退：手動建立事件迴圈
-                logger.warning(f"主要獲取方式失敗，嘗試回退方式: {str(e)}")
-                try:
-                    loop = asyncio.new_event_loop()
-                    try:
-                        asyncio.set_event_loop(loop)
-                        self._articles_cache = loop.run_until_complete(self._fetch_articles_from_paprika())
-                    finally:
-                        loop.close()
-                    self._cache_timestamp = current_time
-                except Exception as e2:
-                    logger.error("獲取文章快取失敗: %s / %s", str(e), str(e2))
-                    if self._articles_cache is None:
-                        self._articles_cache = []
-
-        return self._articles_cache or []
+        """獲取快取的文章資料（程序內共享，過期時背景以條件式請求更新）"""
+        return get_paprika_cache(self.paprika_api_url, self.cache_timeout).get_articles()
+
+    async def _aget_cached_articles(self) -> List[Dict[str, Any]]:
+        """_get_cached_articles 的非同步版本"""
+        return await get_paprika_cache(self.paprika_api_url, self.cache_timeout).aget_articles()
+
+    def warm(self) -> None:
+        """在共用事件迴圈上建立非同步連線池並預先載入 Paprika 文章快取"""
+        aio.run_sync(km_db.get_async_pool())
+        self._get_cached_articles()
+
+    def cache_params(self) -> Dict[str, Any]:
+        """檢索參數（含環境變數的預設值），任一變更即對應到不同的結果快取鍵"""
+        return {
+            'paprika_api_url': self.paprika_api_url,
+            'fusion': self.fusion,
+            'weights': [self.text_weight, self.vector_weight, self.bm25_weight],
+            'rrf_k': self.rrf_k,
+            'top_k': self.top_k,
+            'candidates': [self.vector_candidates, self.trigram_candidates, self.bm25_candidates],
+            'min_text_similarity': self.min_text_similarity,
+            'vector_backend': self.vector_backend,
+            'pg_vector_type': self.pg_vector_type,
+            'vector_rerank': self.vector_rerank,
+            'retrieval_mode': self.retrieval_mode,
+            'chunk_candidates': self.chunk_candidates,
+            'snippet': [self.snippet_chars, self.snippet_lead],
+            'embedding_model': os.getenv('OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small'),
+        }
 
     def get_priority(self) -> int:
         """程式設計知識庫優先級 - 高優先級"""
@@ -121,51 +119,35 @@ class ProgrammingKMSource(BaseKMSource):
                 query.metadata.get('km_source') == 'programming_km')
 
     def search(self, query: KMQuery) -> List[KMResult]:
+        """同步介面：交給程序內共用的事件迴圈執行 asearch（逾時回傳空結果）"""
+        try:
+            return aio.run_sync(self.asearch(query), timeout=self.get_timeout())
+        except concurrent.futures.TimeoutError:
+            logger.warning(f"程式設計知識庫搜索逾時（{self.get_timeout()} 秒）")
+            return []
+
+    async def asearch(self, query: KMQuery) -> List[KMResult]:
         """搜索程式設計知識庫，支援中英文與回退策略，並回傳引用資訊"""
         results: List[KMResult] = []
 
         try:
-            # 0) 若資料庫存在缺少 embedding 的文章，先嘗試自動補齊（僅處理 content 不為空者）
-            try:
-                self._backfill_missing_embeddings(limit=int(os.getenv('EMBED_BACKFILL_LIMIT', '200')),
-                                                  batch_size=int(os.getenv('EMBED_BACKFILL_BATCH', '50')))
-            except Exception as _e:
-                logger.warning("自動補齊 embedding 失敗或已略過: %s", str(_e))
+            # 0) 純讀取路徑：缺少的 embedding 由排程任務 backfill_article_embeddings 補齊
 
             # 1) 先嘗試直接用資料庫的語義/全文進行檢索
-            all_articles: List[Dict[str, Any]] = []
-
             # 2) 優先使用向量相似度（若可計算查詢向量）與 trigram 全文檢索（pg_trgm）
-            query_vec = self._compute_query_embedding_safe(query.query)
+            query_vec = await self._acompute_query_embedding_safe(query.query)
 
-            # 3) 嘗試從資料庫檢索（過濾測試文章）
-            if query_vec is not None:
-                db_semantic = self._search_db_by_embedding(query_vec, k=8, threshold=0.0)
-            else:
-                db_semantic = []
-
-            db_trgm = self._search_db_by_trigram(query.query or "", k=12, min_sim=0.1)
-
-            # 合併候選（以 file_path 為 key 去重），並保留各自分數
-            merged: Dict[str, Dict[str, Any]] = {}
-            for art in db_semantic:
-                key = art.get('file_path') or f"id:{art.get('id')}"
-                merged[key] = {**art, 'emb_score': float(art.get('_match_score') or 0.0), 'text_score': 0.0}
-            for art in db_trgm:
-                key = art.get('file_path') or f"id:{art.get('id')}"
-                existing = merged.get(key, {**art, 'emb_score': 0.0})
-                existing.update(art)
-                existing['text_score'] = float(art.get('_text_score') or 0.0)
-                merged[key] = existing
-
-            merged_list = list(merged.values())
-            all_articles = self._filter_test_articles(merged_list)
-            logger.info(f"DB 候選文章：semantic={len(db_semantic)}，trigram={len(db_trgm)}，合併後={len(all_articles)}")
+            # 萃取查詢關鍵字（支援中文句子中夾英數，如 Java, Python, .NET, C#），用於片段定位與關鍵詞回退
+            query_terms = self._extract_query_terms(query.query or '')
+
+            # 3) 單次往返的混合檢索：向量與 trigram 候選在資料庫內融合排序，只回傳 top-k
+            all_articles: List[Dict[str, Any]] = await self._asearch_db_hybrid(query.query or "", query_vec, query_terms)
+            logger.info(f"DB 混合檢索候選文章：{len(all_articles)}（fusion={self.fusion}）")
 
             # 如果資料庫沒有足夠的文章，回退到 Paprika API
             if len(all_articles) < 3:
-                paprika_articles = self._get_cached_articles()
-                paprika_filtered = self._filter_test_articles(paprika_articles)
+                paprika_articles = await self._aget_cached_articles()
+                paprika_filtered = self._visible_paprika_articles(paprika_articles)
                 logger.info(f"從 Paprika API 檢索到 {len(paprika_articles)} 篇文章，過濾後剩 {len(paprika_filtered)} 篇")
                 # 合併結果，優先使用資料庫的結果
                 all_articles.extend(paprika_filtered)
@@ -181,37 +163,31 @@ class ProgrammingKMSource(BaseKMSource):
 
             # 如果還是沒有文章，使用原始的 Paprika 結果（但過濾測試）
             if not all_articles:
-                all_articles = self._filter_test_articles(self._get_cached_articles())
-
-            # 4) 萃取查詢關鍵字（支援中文句子中夾英數，如 Java, Python, .NET, C#）
-            query_text = (query.query or '').lower()
-            alpha_num_terms = re.findall(r"[a-z0-9\+\#\.\-]+", query_text)
-            split_terms = [w.strip() for w in query_text.split() if len(w.strip()) > 1]
-            query_terms = list({t for t in (alpha_num_terms + split_terms) if t})
+                all_articles = self._visible_paprika_articles(await self._aget_cached_articles())
 
             # 5) 構建相似度/關聯度分數
-            #    優先使用混合分數：text(0.6) + embedding(0.4)；若皆無則關鍵詞匹配回退
+            #    優先使用資料庫融合分數；其次 Paprika 文章的向量相似度；若無則關鍵詞匹配回退
+            vector_scores: Dict[Any, float] = {}
+            if query_vec is not None and any(not a.get('_hybrid_score') for a in all_articles):
+                vector_scores = self._paprika_vector_scores(await self._aget_cached_articles(), query_vec)
+            text_scores: Dict[Any, float] = {}
+            if any(not a.get('_hybrid_score') and not vector_scores.get(a.get('id')) for a in all_articles):
+                text_scores = self._paprika_text_scores(await self._aget_cached_articles(), query.query or '')
             scored: List[Tuple[Dict[str, Any], float]] = []
             for article in all_articles:
-                content_l = (article.get('content') or '').lower()
-                path_l = (article.get('file_path') or '').lower()
-
                 sim_score: float = 0.0
                 matched_terms: List[str] = []
 
                 # 先取混合分數（若存在）
-                text_score = float(article.get('text_score') or 0.0)
-                emb_score = float(article.get('emb_score') or 0.0)
-                if text_score > 0.0 or emb_score > 0.0:
-                    sim_score = 0.6 * text_score + 0.4 * emb_score
-                else:
-                    # 關鍵詞匹配作為回退
-                    term_score = 0
-                    for t in query_terms:
-                        if t and (t in content_l or t in path_l):
-                            term_score += 1
-                            matched_terms.append(t)
-                    sim_score = float(term_score)
+                hybrid_score = float(article.get('_hybrid_score') or 0.0)
+                if hybrid_score > 0.0:
+                    sim_score = hybrid_score
+                elif vector_scores.get(article.get('id'), 0.0) > 0.0:
+                    sim_score = vector_scores[article.get('id')]
+                elif text_scores.get(article.get('id'), 0.0) > 0.0:
+                    # BM25 全文分數作為回退（已正規化到 0~1）
+                    sim_score = text_scores[article.get('id')]
+                    matched_terms = self._paprika_text_index.matched_terms(article.get('id'), query.query or '')
 
                 article['_match_score'] = sim_score
                 article['_matched_terms'] = matched_terms
@@ -224,7 +200,7 @@ class ProgrammingKMSource(BaseKMSource):
                 fallback_used = False
             else:
                 # 回退策略：若 DB 取不到或無匹配，改用 Paprika API 快取
-                paprika_articles = self._get_cached_articles()
+                paprika_articles = await self._aget_cached_articles()
                 if paprika_articles:
                     # 簡單取前三篇保證有引用
                     relevant_articles = paprika_articles[:3]
@@ -242,7 +218,7 @@ class ProgrammingKMSource(BaseKMSource):
                 work_url = f"https://peoplesystem.tatdvsonorth.com/work/{file_path}" if file_path else self.paprika_api_url
 
                 results.append(KMResult(
-                    content=article.get('content', ''),
+                    content=self._result_content(article, query_terms),
                     source=f"paprika_{article.get('id', 'unknown')}",
                     confidence=confidence,
                     relevance_score=relevance_score,
@@ -251,7 +227,9 @@ class ProgrammingKMSource(BaseKMSource):
                         'file_path': file_path,
                         'file_date': article.get('file_date'),
                         'source_type': 'paprika_api',
-                        'title': self._extract_title_from_content(article.get('content', '')),
+                        'title': self._extract_title_from_content(article.get('head') or article.get('content', '')),
+                        'snippet': self.retrieval_mode != 'full',
+                        'passage': article.get('passage'),
                         'source_url': work_url,
                         'provider': 'Paprika',
                         'matched_terms': article.get('_matched_terms', []),
@@ -270,109 +248,10 @@ class ProgrammingKMSource(BaseKMSource):
         return results
 
     # ========== Embedding helpers ==========
-    def _backfill_missing_embeddings(self, limit: int = 200, batch_size: int = 50) -> None:
-        """為 articles 表補齊缺少的 embedding。若無需要則不動作。
-
-        僅處理 content 不為空且 embedding 為 NULL 的文章；若沒有 OpenAI 金鑰或資料庫連線則略過。
-        """
-        conn_str = os.getenv('POSTGRES_CONNECTION_STRING') or os.getenv('DATABASE_URL')
-        if not conn_str:
-            # 試著組裝拆分環境變數
-            db_host = os.getenv('DB_HOST')
-            db_port = os.getenv('DB_PORT')
-            db_name = os.getenv('DB_DATABASE')
-            db_user = os.getenv('DB_USERNAME')
-            db_pass = os.getenv('DB_PASSWORD')
-            db_sslmode = os.getenv('DB_SSLMODE')
-            if all([db_host, db_port, db_name, db_user, db_pass]):
-                conn_str = f"postgres://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
-                if db_sslmode:
-                    conn_str = f"{conn_str}?sslmode={db_sslmode}"
-        if not conn_str:
-            return  # 無法連線資料庫則略過
-
-        api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
-            return  # 沒有金鑰則略過
-
+    async def _acompute_query_embedding_safe(self, text: str) -> Optional[List[float]]:
+        """嘗試用 OpenAI 產生查詢向量（經兩層快取），失敗則回傳 None。"""
         try:
-            import psycopg
-        except Exception:
-            return
-        try:
-            from openai import OpenAI
-        except Exception:
-            return
-
-        # 抓取需要補齊的文章
-        rows: List[Tuple[Any, Any, Any]] = []
-        with psycopg.connect(conn_str) as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT id, file_path, content
-                    FROM articles
-                    WHERE embedding IS NULL
-                      AND content IS NOT NULL AND length(content) > 0
-                    ORDER BY file_date DESC
-                    LIMIT %s
-                    """,
-                    (limit,)
-                )
-                rows = cur.fetchall()
-
-        if not rows:
-            return  # 無待處理
-
-        client = OpenAI(api_key=api_key)
-
-        processed = 0
-        with psycopg.connect(conn_str) as conn:
-            with conn.cursor() as cur:
-                for i in range(0, len(rows), batch_size):
-                    batch = rows[i:i + batch_size]
-                    inputs = [r[2] for r in batch if r[2]]
-                    if not inputs:
-                        continue
-                    try:
-                        resp = client.embeddings.create(model=os.getenv('OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small'),
-                                                        input=inputs)
-                    except Exception as e:
-                        logger.warning("產生 embedding 失敗，停止自動補齊: %s", str(e))
-                        return
-
-                    # 寫回資料庫
-                    idx = 0
-                    for row in batch:
-                        art_id = row[0]
-                        content_val = row[2]
-                        if not content_val:
-                            continue
-                        vec = resp.data[idx].embedding
-                        idx += 1
-                        emb_str = '[' + ','.join(map(str, vec)) + ']'
-                        cur.execute(
-                            "UPDATE articles SET embedding = %s::vector, updated_at = NOW() WHERE id = %s",
-                            (emb_str, art_id)
-                        )
-                        processed += 1
-                    conn.commit()
-        logger.info("自動補齊 embedding 完成，共更新 %d 筆", processed)
-
-    def _compute_query_embedding_safe(self, text: str) -> Optional[List[float]]:
-        """嘗試用 OpenAI 產生查詢向量，失敗則回傳 None。"""
-        try:
-            api_key = os.getenv('OPENAI_API_KEY')
-            if not api_key:
-                return None
-            model = os.getenv('OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small')
-            from openai import OpenAI
-            client = OpenAI(api_key=api_key)
-            resp = client.embeddings.create(model=model, input=text or "")
-            vec = resp.data[0].embedding
-            if isinstance(vec, list) and vec:
-                return [float(x) for x in vec]
-            return None
+            return await aget_query_embedding(text)
         except Exception:
             return None
 
@@ -391,151 +270,376 @@ class ProgrammingKMSource(BaseKMSource):
         except Exception:
             return None
 
-    def _cosine_similarity(self, v1: List[float], v2: List[float]) -> float:
-        """計算餘弦相似度，長度不等時以最短長度對齊。"""
-        n = min(len(v1), len(v2))
-        if n == 0:
-            return 0.0
-        dot = 0.0
-        norm1 = 0.0
-        norm2 = 0.0
-        for i in range(n):
-            a = float(v1[i])
-            b = float(v2[i])
-            dot += a * b
-            norm1 += a * a
-            norm2 += b * b
-        if norm1 == 0.0 or norm2 == 0.0:
-            return 0.0
-        return dot / (math.sqrt(norm1) * math.sqrt(norm2))
+    def _paprika_vector_scores(self, articles: List[Dict[str, Any]],
+                               query_vec: List[float]) -> Dict[Any, float]:
+        """以程序內 NumPy 索引計算 Paprika 文章與查詢向量的相似度（文章列表更新時才重建索引）"""
+        if np is None or not articles:
+            return {}
+        if self._paprika_index_source is not articles:
+            self._paprika_index = NumpyVectorIndex.from_items(
+                (a.get('id'), self._parse_embedding(a.get('embedding')))
+                for a in articles if a.get('id') is not None
+            )
+            self._paprika_index_source = articles
+        return dict(self._paprika_index.search(query_vec, len(self._paprika_index)))
+
+    def _paprika_text_scores(self, articles: List[Dict[str, Any]], query_text: str) -> Dict[Any, float]:
+        """以 BM25 全文索引計算 Paprika 文章的關鍵詞分數（文章列表更新時才重建索引）"""
+        if np is None or not articles:
+            return {}
+        if self._paprika_text_index_source is not articles:
+            self._paprika_text_index = BM25Index.from_items(
+                (a.get('id'), f"{a.get('file_path') or ''}\n{a.get('content') or ''}")
+                for a in articles if a.get('id') is not None
+            )
+            self._paprika_text_index_source = articles
+        return dict(normalize_scores(self._paprika_text_index.search(query_text, len(self._paprika_text_index))))
 
     # ========== Database helpers ==========
-    def _search_db_by_embedding(self, query_vec: List[float], k: int = 5, threshold: float = 0.0) -> List[Dict[str, Any]]:
-        """用 PostgreSQL pgvector 做語義檢索。"""
-        conn_str = os.getenv('POSTGRES_CONNECTION_STRING') or os.getenv('DATABASE_URL')
-        if not conn_str:
-            # 允許以拆分的 DB_* 變數組裝連線字串
-            db_host = os.getenv('DB_HOST')
-            db_port = os.getenv('DB_PORT')
-            db_name = os.getenv('DB_DATABASE')
-            db_user = os.getenv('DB_USERNAME')
-            db_pass = os.getenv('DB_PASSWORD')
-            db_sslmode = os.getenv('DB_SSLMODE')
-            if all([db_host, db_port, db_name, db_user, db_pass]):
-                conn_str = f"postgres://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
-                if db_sslmode:
-                    conn_str = f"{conn_str}?sslmode={db_sslmode}"
-            else:
+    async def _asearch_db_hybrid(self, query_text: str, query_vec: Optional[List[float]],
+                          query_terms: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """以單一 SQL 完成 pgvector 與 pg_trgm 混合檢索，並在資料庫內做分數融合。
+
+        兩組候選各自以 CTE 取出（可各自使用 ANN / GIN 索引；距離只計算一次），
+        程序內 BM25 索引的候選以陣列帶入，三者以 FULL JOIN 融合：
+        - weighted: text_weight * similarity + vector_weight * (1 - cosine distance) + bm25_weight * 正規化 BM25
+        - rrf: 各自名次的 1 / (rrf_k + rank) 加權總和
+        只回傳融合後的 top_k 筆。向量查詢失敗（如未安裝 pgvector）時退回僅 trigram。
+        snippet 模式下只傳回開頭（供取標題）與命中附近的片段，不傳整篇內文。
+        """
+        if not km_db.is_configured():
+            return []
+        if not query_text and query_vec is None:
+            return []
+        terms = query_terms or []
+        local_index = get_vector_index() if query_vec is not None else None
+        if local_index is not None and self.vector_backend == 'local':
+            try:
+                return await self._arun_hybrid_query(query_text, query_vec, terms,
+                                                     local_index.search(query_vec, self.vector_candidates))
+            except Exception as e:
+                logger.error("DB 混合檢索（程序內向量索引）失敗: %s", str(e))
                 return []
-        embedding_str = '[' + ','.join(map(str, query_vec)) + ']'
-        rows: List[Dict[str, Any]] = []
         try:
-            with psycopg.connect(conn_str) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """
-                        SELECT
-                            id,
-                            file_path,
-                            content,
-                            file_date,
-                            1 - (embedding <=> %s::vector) AS similarity
-                        FROM articles
-                        WHERE 1 - (embedding <=> %s::vector) > %s
-                        AND file_path NOT LIKE 'test/%%'
-                        AND file_path NOT LIKE '%%test%%'
-                        ORDER BY embedding <=> %s::vector
-                        LIMIT %s
-                        """,
-                        (embedding_str, embedding_str, threshold, embedding_str, k)
-                    )
-                    for r in cur.fetchall():
-                        rows.append({
-                            'id': r[0],
-                            'file_path': r[1],
-                            'content': r[2],
-                            'file_date': r[3].isoformat() if r[3] else None,
-                            '_match_score': float(r[4] or 0.0),
-                            '_matched_terms': []
-                        })
+            return await self._arun_hybrid_query(query_text, query_vec, terms)
         except Exception as e:
-            logger.error("DB 向量檢索失敗: %s", str(e))
-            return []
-        return rows
-
-    def _search_db_by_trigram(self, query_text: str, k: int = 10, min_sim: float = 0.1) -> List[Dict[str, Any]]:
-        """用 pg_trgm 對 content 做全文近似檢索，利用 GIN(trgm) 索引。"""
-        if not query_text:
-            return []
-        conn_str = os.getenv('POSTGRES_CONNECTION_STRING') or os.getenv('DATABASE_URL')
-        if not conn_str:
-            db_host = os.getenv('DB_HOST')
-            db_port = os.getenv('DB_PORT')
-            db_name = os.getenv('DB_DATABASE')
-            db_user = os.getenv('DB_USERNAME')
-            db_pass = os.getenv('DB_PASSWORD')
-            db_sslmode = os.getenv('DB_SSLMODE')
-            if all([db_host, db_port, db_name, db_user, db_pass]):
-                conn_str = f"postgres://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
-                if db_sslmode:
-                    conn_str = f"{conn_str}?sslmode={db_sslmode}"
+            if query_vec is None:
+                logger.error("DB 混合檢索失敗: %s", str(e))
+                return []
+            if local_index is not None:
+                logger.warning("pgvector 檢索失敗，改用程序內向量索引: %s", str(e))
+                try:
+                    return await self._arun_hybrid_query(query_text, query_vec, terms,
+                                                         local_index.search(query_vec, self.vector_candidates))
+                except Exception as e2:
+                    logger.warning("程序內向量索引檢索失敗: %s", str(e2))
             else:
+                logger.warning("DB 混合檢索（含向量）失敗，改用 trigram: %s", str(e))
+            try:
+                return await self._arun_hybrid_query(query_text, None, terms)
+            except Exception as e2:
+                logger.error("DB trigram 檢索失敗: %s", str(e2))
                 return []
-        rows: List[Dict[str, Any]] = []
+
+    def build_hybrid_query(self, query_text: str, query_vec: Optional[List[float]], query_terms: List[str],
+                           vec_candidates: Optional[List[Tuple[Any, float]]] = None, table: str = 'articles',
+                           bm25: Optional[List[Tuple[Any, float]]] = None,
+                           use_chunks: bool = False) -> Tuple[str, Dict[str, Any]]:
+        """組出混合檢索 SQL 與參數（不含 qvec：需依連線的 adapter 綁定）
+
+        table 為文章表名稱（須為可信任的識別字；基準測試以同結構的暫存表量測同一份 SQL）；
+        bm25 未提供時取程序內 BM25 索引的候選。
+        """
+        params: Dict[str, Any] = {
+            'q': query_text,
+            'trgm_k': self.trigram_candidates,
+            'min_sim': self.min_text_similarity,
+            'w_text': self.text_weight,
+            'w_vec': self.vector_weight,
+            'rrf_k': self.rrf_k,
+            'k': self.top_k,
+            'terms': query_terms,
+            'head_chars': 400,
+            'snippet_chars': self.snippet_chars,
+            'snippet_lead': self.snippet_lead,
+            'w_bm25': self.bm25_weight,
+        }
+        # 查詢向量只綁定一次（query_vec CTE，型別為 vector），其餘位置引用 QVEC_SQL；
+        # 實際參數在借到連線後依 adapter 決定以二進位陣列或文字格式傳送
+        with_vec = query_vec is not None and vec_candidates is None
+        if bm25 is None:
+            text_index = get_text_index()
+            bm25 = normalize_scores(text_index.search(query_text, self.bm25_candidates)) if text_index is not None else []
+        params['bm25_ids'] = [int(i) for i, _ in bm25]
+        params['bm25_scores'] = [float(score) for _, score in bm25]
+        if vec_candidates is not None:
+            # 向量候選已由程序內索引算好，只需帶入 (id, 相似度)
+            params['vec_ids'] = [int(i) for i, _ in vec_candidates]
+            params['vec_scores'] = [float(score) for _, score in vec_candidates]
+            vec_candidates_sql = """
+                SELECT c.id, 1 - c.score AS dist
+                FROM unnest(%(vec_ids)s::bigint[], %(vec_scores)s::float8[]) AS c(id, score)
+            """
+        elif query_vec is not None:
+            params['vec_k'] = self.vector_candidates
+            rerank = self.pg_vector_type == 'halfvec' and self.vector_rerank > self.vector_candidates
+            params['vec_prefetch'] = self.vector_rerank if rerank else self.vector_candidates
+            distance_sql = (f"{pg_index.embedding_expr(self.pg_vector_type)} <=> "
+                            f"{self.QVEC_SQL}{pg_index.query_cast(self.pg_vector_type)}")
+            vec_candidates_sql = f"""
+                SELECT id, {'embedding, ' if rerank else ''}{distance_sql} AS dist
+                FROM {table}
+                WHERE embedding IS NOT NULL AND {pg_index.VISIBLE_SQL}
+                ORDER BY dist
+                LIMIT %(vec_prefetch)s
+            """
+            if rerank:
+                # halfvec ANN 取出較多候選，再以 float32 欄位精確重排
+                vec_candidates_sql = f"""
+                    SELECT id, embedding <=> {self.QVEC_SQL} AS dist
+                    FROM ({vec_candidates_sql}) approx
+                    ORDER BY dist
+                    LIMIT %(vec_k)s
+                """
+            if use_chunks:
+                # 段落向量的 ANN 候選以所屬文章計入，文章距離取整篇與段落中較近者；
+                # 段落表由切分任務延遲清理，測試 / 已刪除文章的段落須在這裡排除
+                params['chunk_k'] = self.chunk_candidates
+                vec_candidates_sql = f"""
+                    SELECT id, min(dist) AS dist
+                    FROM (
+                        SELECT id, dist FROM ({vec_candidates_sql}) article_vec
+                        UNION ALL
+                        SELECT article_id AS id, dist FROM (
+                            SELECT c.article_id, c.embedding <=> {self.QVEC_SQL} AS dist
+                            FROM article_chunks c
+                            JOIN {table} a ON a.id = c.article_id
+                            WHERE c.embedding IS NOT NULL AND {pg_index.VISIBLE_SQL} AND a.deleted_at IS NULL
+                            ORDER BY dist
+                            LIMIT %(chunk_k)s
+                        ) chunk_vec
+                    ) u
+                    GROUP BY id
+                """
+        else:
+            vec_candidates_sql = "SELECT NULL::bigint AS id, NULL::float8 AS dist WHERE false"
+
+        if self.fusion == 'rrf':
+            score_sql = ("%(w_text)s * COALESCE(1.0 / (%(rrf_k)s + t.text_rank), 0)"
+                         " + %(w_vec)s * COALESCE(1.0 / (%(rrf_k)s + v.emb_rank), 0)"
+                         " + %(w_bm25)s * COALESCE(1.0 / (%(rrf_k)s + b.bm25_rank), 0)")
+        else:
+            score_sql = ("%(w_text)s * COALESCE(t.text_score, 0) + %(w_vec)s * COALESCE(v.emb_score, 0)"
+                         " + %(w_bm25)s * COALESCE(b.bm25_score, 0)")
+
+        if self.retrieval_mode in ('snippet', 'passage'):
+            # 片段起點：任一查詢關鍵字在內文中最早出現的位置，往前保留 snippet_lead 字元
+            projection_sql = ("left(a.content, %(head_chars)s) AS head, "
+                              "substr(a.content, greatest(1, coalesce(m.pos, 1) - %(snippet_lead)s), %(snippet_chars)s) AS snippet")
+            snippet_join_sql = """
+            LEFT JOIN LATERAL (
+                SELECT min(p) AS pos
+                FROM (SELECT strpos(lower(a.content), t) AS p FROM unnest(%(terms)s::text[]) AS t) hits
+                WHERE p > 0
+            ) m ON true
+            """
+        else:
+            projection_sql = "a.content AS head, NULL::text AS snippet"
+            snippet_join_sql = ""
+        if use_chunks:
+            # 每篇文章取最相關的段落（與文章融合相同的向量 / trigram 權重）；尚未切分的文章 p 為 NULL
+            if with_vec:
+                passage_score_sql = (f"%(w_vec)s * COALESCE(1 - (c.embedding <=> {self.QVEC_SQL}), 0)"
+                                     " + %(w_text)s * similarity(c.content, %(q)s)")
+            else:
+                passage_score_sql = "similarity(c.content, %(q)s)"
+            projection_sql += ", p.id, p.chunk_index, p.heading, p.content"
+            snippet_join_sql += f"""
+            LEFT JOIN LATERAL (
+                SELECT c.id, c.chunk_index, c.heading, c.content
+                FROM article_chunks c
+                WHERE c.article_id = a.id
+                ORDER BY {passage_score_sql} DESC, c.chunk_index
+                LIMIT 1
+            ) p ON true
+            """
+
+        query_vec_sql = "query_vec AS (SELECT %(qvec)s::vector AS v)," if with_vec else ""
+        sql = f"""
+            WITH {query_vec_sql}
+            vec_candidates AS ({vec_candidates_sql}),
+            vec AS (
+                SELECT id, 1 - dist AS emb_score, row_number() OVER (ORDER BY dist) AS emb_rank
+                FROM vec_candidates
+            ),
+            trgm_candidates AS (
+                SELECT id, similarity(content, %(q)s) AS sim
+                FROM {table}
+                WHERE %(q)s <> '' AND content %% %(q)s AND {pg_index.VISIBLE_SQL}
+                ORDER BY sim DESC
+                LIMIT %(trgm_k)s
+            ),
+            trgm AS (
+                SELECT id, sim AS text_score, row_number() OVER (ORDER BY sim DESC) AS text_rank
+                FROM trgm_candidates
+                WHERE sim >= %(min_sim)s
+            ),
+            bm25 AS (
+                SELECT c.id, c.score AS bm25_score, row_number() OVER (ORDER BY c.score DESC) AS bm25_rank
+                FROM unnest(%(bm25_ids)s::bigint[], %(bm25_scores)s::float8[]) AS c(id, score)
+            ),
+            fused AS (
+                SELECT
+                    COALESCE(v.id, t.id, b.id) AS id,
+                    COALESCE(v.emb_score, 0) AS emb_score,
+                    COALESCE(t.text_score, 0) AS text_score,
+                    COALESCE(b.bm25_score, 0) AS bm25_score,
+                    {score_sql} AS score
+                FROM vec v
+                FULL OUTER JOIN trgm t ON v.id = t.id
+                FULL OUTER JOIN bm25 b ON b.id = COALESCE(v.id, t.id)
+                ORDER BY score DESC
+                LIMIT %(k)s
+            )
+            SELECT a.id, a.file_path, a.file_date, f.emb_score, f.text_score, f.bm25_score, f.score, {projection_sql}
+            FROM fused f
+            JOIN {table} a ON a.id = f.id
+            {snippet_join_sql}
+            ORDER BY f.score DESC
+        """
+        return sql, params
+
+    async def _arun_hybrid_query(self, query_text: str, query_vec: Optional[List[float]],
+                                 query_terms: List[str],
+                                 vec_candidates: Optional[List[Tuple[Any, float]]] = None) -> List[Dict[str, Any]]:
+        use_chunks = self._chunks_usable()
+        with_vec = query_vec is not None and vec_candidates is None
+        sql, params = self.build_hybrid_query(query_text, query_vec, query_terms, vec_candidates,
+                                              use_chunks=use_chunks)
+
         try:
-            # 使用獨立的連線避免 transaction 衝突
-            with psycopg.connect(conn_str, autocommit=True) as conn:
-                with conn.cursor() as cur:
-                    # 設定本連線的 trigram 門檻，讓 % 運算子使用指定 min_sim
-                    try:
-                        cur.execute("SELECT set_limit(%s)", (float(min_sim),))
-                    except Exception:
-                        pass
-                    cur.execute(
-                        """
-                        SELECT
-                            id,
-                            file_path,
-                            content,
-                            file_date,
-                            similarity(content, %s) AS sim
-                        FROM articles
-                        WHERE content %% %s
-                        AND file_path NOT LIKE 'test/%%'
-                        AND file_path NOT LIKE '%%test%%'
-                        ORDER BY sim DESC
-                        LIMIT %s
-                        """,
-                        (query_text, query_text, k)
+            async with km_db.aconnection() as conn:
+                async with conn.cursor() as cur:
+                    # 以交易範圍設定 trigram 門檻，讓 % 運算子使用指定 min_sim，
+                    # 且不會殘留在歸還連線池的連線上
+                    await cur.execute(
+                        "SELECT set_config('pg_trgm.similarity_threshold', %s, true)",
+                        (str(self.min_text_similarity),)
                     )
-                    for r in cur.fetchall():
-                        sim_val = float(r[4] or 0.0)
-                        if sim_val < min_sim:
-                            continue
-                        rows.append({
-                            'id': r[0],
-                            'file_path': r[1],
-                            'content': r[2],
-                            'file_date': r[3].isoformat() if r[3] else None,
-                            '_text_score': sim_val,
-                        })
+                    if with_vec:
+                        params['qvec'] = km_db.vector_param(conn, query_vec)
+                        await pg_index.aapply_search_settings(cur)
+                        if self.db_statement_timeout_ms > 0:
+                            # 過慢的 ANN 查詢直接中止，改走程序內索引
+                            await cur.execute("SELECT set_config('statement_timeout', %s, true)",
+                                              (str(self.db_statement_timeout_ms),))
+                    await cur.execute(sql, params)
+                    fetched = await cur.fetchall()
         except Exception as e:
-            logger.error("DB trigram 檢索失敗: %s", str(e))
-            return []
+            if use_chunks and getattr(e, 'sqlstate', None) == '42P01':
+                # article_chunks 尚未建立（未執行 migration 0005）：暫停段落檢索，改以片段回傳
+                logger.warning("段落表不可用，%d 秒內改用片段檢索: %s", self.CHUNKS_RETRY_SECONDS, str(e))
+                self._chunks_retry_at = time.monotonic() + self.CHUNKS_RETRY_SECONDS
+                return await self._arun_hybrid_query(query_text, query_vec, query_terms, vec_candidates)
+            raise
+
+        return self.parse_hybrid_rows(fetched, use_chunks)
+
+    def parse_hybrid_rows(self, fetched: List[Tuple], use_chunks: bool = False) -> List[Dict[str, Any]]:
+        """混合檢索 SQL 的結果列轉為文章 dict"""
+        rows: List[Dict[str, Any]] = []
+        for r in fetched:
+            row = {
+                'id': r[0],
+                'file_path': r[1],
+                'file_date': r[2].isoformat() if r[2] else None,
+                'emb_score': float(r[3] or 0.0),
+                'text_score': float(r[4] or 0.0),
+                'bm25_score': float(r[5] or 0.0),
+                '_hybrid_score': float(r[6] or 0.0),
+                '_matched_terms': [],
+            }
+            if self.retrieval_mode in ('snippet', 'passage'):
+                row['head'] = r[7] or ''
+                row['snippet'] = r[8] or ''
+            else:
+                row['content'] = r[7] or ''
+            if use_chunks and r[9] is not None:
+                row['passage'] = {'chunk_id': r[9], 'chunk_index': r[10], 'heading': r[11] or ''}
+                row['passage_content'] = r[12] or ''
+            rows.append(row)
         return rows
 
-    def _filter_test_articles(self, articles: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """過濾掉測試文章，只保留正式技術文檔"""
-        filtered = []
-        for article in articles:
-            file_path = article.get('file_path', '')
-            # 排除測試相關的路徑
-            if (not file_path.startswith('test/') and
-                'test' not in file_path.lower() and
-                not file_path.endswith('test.md') and
-                not file_path.endswith('test.txt')):
-                filtered.append(article)
-        return filtered
+    def _chunks_usable(self) -> bool:
+        """passage 模式且段落表可用（查無 article_chunks 表後暫停一段時間再重試）"""
+        return self.retrieval_mode == 'passage' and time.monotonic() >= self._chunks_retry_at
+
+    def fetch_full(self, article_id: Any) -> Optional[str]:
+        """延遲取得文章完整內文（snippet 模式下需要整篇時使用）"""
+        if article_id is None:
+            return None
+        if km_db.is_configured():
+            try:
+                with km_db.connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT content FROM articles WHERE id = %s", (article_id,))
+                        row = cur.fetchone()
+                        if row:
+                            return row[0]
+            except Exception as e:
+                logger.error("讀取文章內文失敗: %s", str(e))
+        # 不在資料庫中的文章（Paprika 回退結果）改查快取
+        for article in self._get_cached_articles():
+            if str(article.get('id')) == str(article_id):
+                return article.get('content')
+        return None
+
+    def _extract_query_terms(self, text: str) -> List[str]:
+        """萃取查詢關鍵字：英數詞（如 Java, .NET, C#）與 CJK bigram（中文句子不需空白分隔）"""
+        return list(dict.fromkeys(t for t in tokenize(text or '') if len(t) > 1 or t.isascii()))
+
+    def _make_snippet(self, content: str, query_terms: List[str]) -> str:
+        """在 Python 端擷取命中位置附近的片段（與 SQL 投影規則相同）"""
+        content_l = content.lower()
+        positions = [p for p in (content_l.find(t) for t in query_terms) if p >= 0]
+        start = max(0, min(positions) - self.snippet_lead) if positions else 0
+        return content[start:start + self.snippet_chars]
+
+    def _best_passage(self, content: str, query_terms: List[str]) -> Optional[str]:
+        """在 Python 端切分段落並取命中關鍵字最多者（Paprika 回退結果沒有 article_chunks）"""
+        chunks = chunk_markdown(content)
+        if len(chunks) < 2:
+            return None
+        best = max(chunks, key=lambda c: sum(c.content.lower().count(t) for t in query_terms))
+        return best.embedding_text()
+
+    def _result_content(self, article: Dict[str, Any], query_terms: List[str]) -> str:
+        """依檢索模式決定 KMResult.content：段落、片段或整篇"""
+        if self.retrieval_mode == 'full':
+            return article.get('content', '')
+        if self.retrieval_mode == 'passage':
+            passage = article.get('passage')
+            if passage is not None:
+                heading = passage.get('heading')
+                content = article.get('passage_content') or ''
+                return f"{heading}\n\n{content}" if heading else content
+            if article.get('snippet') is None and article.get('content'):
+                best = self._best_passage(article['content'], query_terms)
+                if best is not None:
+                    return best
+        if article.get('snippet') is not None:
+            return article['snippet']
+        return self._make_snippet(article.get('content') or '', query_terms)
+
+    def _visible_paprika_articles(self, articles: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """過濾掉 Paprika 測試文章，只保留正式技術文檔（文章列表更新時才重新過濾）
+
+        資料庫內的文章已由 articles.is_test 在 SQL 內排除，這裡只處理 Paprika API 的文章。
+        """
+        if self._paprika_visible_source is not articles:
+            self._paprika_visible = [a for a in articles if not is_test_path(a.get('file_path') or '')]
+            self._paprika_visible_source = articles
+        return self._paprika_visible
 
     def _extract_title_from_content(self, content: str) -> str:
         """從內容中提取標題"""
@@ -0,0 +1,79 @@
+"""
+知識庫源註冊表 - 程序內共用的 KMSourceManager
+
+每個 worker 只建立一次 KMSourceManager，各知識庫源的連線池與快取在 worker
+生命週期內沿用。源的組成由 settings.KM_SOURCES 決定（啟動時讀取）；修改後重新啟動
+worker，或在程序內呼叫 reload_km_manager() 重新建立並整批替換。
+"""
+
+import logging
+import threading
+from typing import Optional
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .manager import KMSourceManager
+
+logger = logging.getLogger(__name__)
+
+_manager: Optional[KMSourceManager] = None
+_lock = threading.Lock()
+
+
+def _build_manager() -> KMSourceManager:
+    return KMSourceManager(getattr(settings, 'KM_SOURCES', None))
+
+
+def get_km_manager() -> KMSourceManager:
+    """取得程序內共用的 KMSourceManager（延遲建立）"""
+    global _manager
+    manager = _manager
+    if manager is not None:
+        return manager
+    with _lock:
+        if _manager is None:
+            _manager = _build_manager()
+            logger.info("KM 註冊表已建立: %s", [s['name'] for s in _manager.list_sources()])
+        return _manager
+
+
+def reload_km_manager() -> KMSourceManager:
+    """立即依目前設定重建 KMSourceManager；進行中的查詢繼續使用舊實例"""
+    global _manager
+    manager = _build_manager()
+    with _lock:
+        _manager = manager
+    logger.info("KM 註冊表已重新載入: %s", [s['name'] for s in manager.list_sources()])
+    return manager
+
+
+def warm_km_manager(background: bool = False) -> None:
+    """worker 啟動時建立並預熱註冊表；background=True 時不阻塞啟動流程"""
+    def run():
+        try:
+            get_km_manager().warm()
+        except Exception as e:
+            logger.warning("KM 註冊表預熱失敗: %s", str(e))
+        # 啟用定期增量同步時，讓本 worker 的程序內索引跟上 articles 表
+        from .index_sync import sync_engine, sync_interval
+        from .text_index import enabled as text_index_enabled, get_text_index
+        if text_index_enabled() and get_text_index() is None:
+            # 全文索引沒有快照，啟動時先同步一次建立
+            try:
+                sync_engine.sync()
+            except Exception as e:
+                logger.warning("建立全文索引失敗: %s", str(e))
+        sync_engine.start_periodic(sync_interval())
+
+    if background:
+        threading.Thread(target=run, name='km-warmup', daemon=True).start()
+    else:
+        run()
+
+
+@receiver(setting_changed)
+def _reload_on_setting_changed(sender, setting, **kwargs):
+    if setting == 'KM_SOURCES':
+        reload_km_manager()
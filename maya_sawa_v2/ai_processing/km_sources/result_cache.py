@@ -0,0 +1,312 @@
+"""
+知識庫檢索結果快取 - 程序內 LRU/TTL + Redis 兩層快取
+
+鍵值由正規化查詢、參與檢索的源（名稱與檢索參數）與語料版本組成。
+文章變更（embedding 補齊、索引同步、匯入）時調高語料版本，舊條目不再被讀到，
+失效成本為 O(1)；舊條目依 LRU / TTL 自然淘汰。
+語料版本存在 Redis，所有 worker 共用（程序內快取 KM_SEARCH_CACHE_VERSION_TTL 秒，
+其他 worker 的版本更新最多延遲這段時間生效）；Redis 不可用時退回程序內版本。
+非同步路徑（aget / aset / amake_key）的 Redis 往返在執行緒中進行，不阻塞共用事件迴圈。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .base import BaseKMSource, KMResult
+from .embeddings import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class SearchResultCache:
+    """KMSourceManager 檢索結果的兩層快取，條目以語料版本標記"""
+
+    KEY_PREFIX = 'km:search'
+    VERSION_KEY = 'km:corpus:version'
+    STATS_KEY = 'km:search:stats'
+    STATS_FLUSH_SECONDS = 10
+
+    def __init__(self, max_size: Optional[int] = None, ttl_seconds: Optional[int] = None,
+                 redis_url: Optional[str] = None, enabled: Optional[bool] = None,
+                 version_ttl: Optional[float] = None):
+        self.max_size = max_size or int(os.getenv('KM_SEARCH_CACHE_SIZE', '512'))
+        self.ttl_seconds = ttl_seconds or int(os.getenv('KM_SEARCH_CACHE_TTL', '600'))
+        self.version_ttl = version_ttl if version_ttl is not None else float(
+            os.getenv('KM_SEARCH_CACHE_VERSION_TTL', '2'))
+        self.redis_url = redis_url if redis_url is not None else os.getenv('REDIS_URL', '')
+        self.enabled = enabled if enabled is not None else (
+            os.getenv('KM_SEARCH_CACHE', 'true').lower() in ('1', 'true', 'yes'))
+        self._local: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+        self._redis_retry_at = 0.0
+        self._local_version = 0
+        self._version: Optional[str] = None
+        self._version_expires = 0.0
+        self._pending: Counter = Counter()
+        self._flush_at = 0.0
+        self.hits_local = 0
+        self.hits_redis = 0
+        self.misses = 0
+        self.stores = 0
+        self.bumps = 0
+
+    def _get_redis(self):
+        """延遲建立 Redis 連線；失敗後 60 秒內不再嘗試，避免拖慢檢索"""
+        if not self.redis_url or time.monotonic() < self._redis_retry_at:
+            return None
+        if self._redis is None:
+            try:
+                import redis
+                self._redis = redis.Redis.from_url(self.redis_url, socket_timeout=0.2,
+                                                   socket_connect_timeout=0.2)
+            except Exception as e:
+                self._mark_redis_down(e)
+                return None
+        return self._redis
+
+    def _mark_redis_down(self, error: Exception) -> None:
+        logger.warning("檢索結果 Redis 快取不可用，暫停使用 60 秒: %s", str(error))
+        self._redis = None
+        self._redis_retry_at = time.monotonic() + 60
+
+    def _cached_version(self) -> Optional[str]:
+        if self._version is not None and time.monotonic() < self._version_expires:
+            return self._version
+        return None
+
+    def version(self) -> str:
+        """目前的語料版本（r = Redis 共用版本，l = 程序內版本）"""
+        cached = self._cached_version()
+        if cached is not None:
+            return cached
+        version = f"l{self._local_version}"
+        client = self._get_redis()
+        if client is not None:
+            try:
+                version = f"r{int(client.get(self.VERSION_KEY) or 0)}"
+            except Exception as e:
+                self._mark_redis_down(e)
+        self._version, self._version_expires = version, time.monotonic() + self.version_ttl
+        return version
+
+    async def aversion(self) -> str:
+        cached = self._cached_version()
+        if cached is not None:
+            return cached
+        if self._get_redis() is None:
+            return self.version()
+        return await asyncio.to_thread(self.version)
+
+    def bump_version(self, reason: str = '') -> None:
+        """文章變更後調高語料版本，之後的查詢不再讀到舊條目"""
+        with self._lock:
+            self._local_version += 1
+            self.bumps += 1
+            self._version = None
+            # 程序內條目已全部失效，直接釋放記憶體
+            self._local.clear()
+        client = self._get_redis()
+        if client is not None:
+            try:
+                client.incr(self.VERSION_KEY)
+            except Exception as e:
+                self._mark_redis_down(e)
+        self._version = None
+        logger.info("KM 語料版本已更新（%s）", reason or 'manual')
+
+    @staticmethod
+    def _digest(text: str, sources: Sequence[BaseKMSource]) -> str:
+        fingerprint = json.dumps(
+            [[source.name, source.get_source_type(), source.cache_params()] for source in sources],
+            sort_keys=True, default=str,
+        )
+        return hashlib.sha1(f"{normalize_query(text)}\0{fingerprint}".encode('utf-8')).hexdigest()
+
+    def make_key(self, text: str, sources: Sequence[BaseKMSource]) -> str:
+        return f"{self.KEY_PREFIX}:{self.version()}:{self._digest(text, sources)}"
+
+    async def amake_key(self, text: str, sources: Sequence[BaseKMSource]) -> str:
+        return f"{self.KEY_PREFIX}:{await self.aversion()}:{self._digest(text, sources)}"
+
+    @staticmethod
+    def encode_results(results: List[KMResult]) -> bytes:
+        return json.dumps([asdict(r) for r in results], default=str).encode('utf-8')
+
+    @staticmethod
+    def decode_results(raw: bytes) -> List[KMResult]:
+        return [KMResult(**item) for item in json.loads(raw)]
+
+    def _remember(self, key: str, raw: bytes) -> None:
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.ttl_seconds, raw)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def _count(self, client, field: str) -> Optional[Counter]:
+        """累計命中統計；每 STATS_FLUSH_SECONDS 回傳一批待寫入 Redis 的計數（由 _flush 寫入）"""
+        with self._lock:
+            self._pending[field] += 1
+            if client is None or time.monotonic() < self._flush_at:
+                return None
+            pending, self._pending = self._pending, Counter()
+            self._flush_at = time.monotonic() + self.STATS_FLUSH_SECONDS
+        return pending
+
+    def _flush(self, client, pending: Optional[Counter]) -> None:
+        """以一次 pipeline 把累計的命中統計寫入 Redis（所有 worker 共用）"""
+        if not pending:
+            return
+        try:
+            pipe = client.pipeline(transaction=False)
+            for name, count in pending.items():
+                pipe.hincrby(self.STATS_KEY, name, count)
+            pipe.execute()
+        except Exception as e:
+            self._mark_redis_down(e)
+
+    def _get_local(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._local[key]
+                entry = None
+            if entry is None:
+                return None
+            self._local.move_to_end(key)
+            self.hits_local += 1
+            return entry[1]
+
+    def _get_remote(self, client, key: str) -> Optional[bytes]:
+        """（阻塞）查詢 Redis；命中時一併寫入程序內快取"""
+        try:
+            raw = client.get(key)
+        except Exception as e:
+            self._mark_redis_down(e)
+            return None
+        if raw:
+            self._remember(key, raw)
+            with self._lock:
+                self.hits_redis += 1
+        return raw or None
+
+    def _lookup(self, key: str, client) -> Tuple[Optional[bytes], str]:
+        raw = self._get_local(key)
+        if raw is not None:
+            return raw, 'local'
+        if client is not None:
+            raw = self._get_remote(client, key)
+            if raw is not None:
+                return raw, 'redis'
+        with self._lock:
+            self.misses += 1
+        return None, 'miss'
+
+    def _result(self, raw: Optional[bytes], tier: str) -> Optional[List[KMResult]]:
+        return None if raw is None else self._mark(self.decode_results(raw), tier)
+
+    def get(self, key: str) -> Optional[List[KMResult]]:
+        """取得快取結果；每次命中都回傳新的 KMResult，呼叫端可自由修改 metadata"""
+        client = self._get_redis()
+        raw, tier = self._lookup(key, client)
+        self._flush(client, self._count(client, f'hits_{tier}' if raw is not None else 'misses'))
+        return self._result(raw, tier)
+
+    async def aget(self, key: str) -> Optional[List[KMResult]]:
+        """get 的非同步版本：程序內命中直接回傳，Redis 往返在執行緒中進行"""
+        raw = self._get_local(key)
+        tier = 'local'
+        client = self._get_redis()
+        if raw is None:
+            if client is None:
+                raw, tier = self._lookup(key, None)
+            else:
+                raw, tier = await asyncio.to_thread(self._lookup, key, client)
+        pending = self._count(client, f'hits_{tier}' if raw is not None else 'misses')
+        if pending:
+            await asyncio.to_thread(self._flush, client, pending)
+        return self._result(raw, tier)
+
+    @staticmethod
+    def _mark(results: List[KMResult], tier: str) -> List[KMResult]:
+        for result in results:
+            result.metadata['km_cache'] = tier
+        return results
+
+    def _store_local(self, key: str, results: List[KMResult]) -> bytes:
+        raw = self.encode_results(results)
+        self._remember(key, raw)
+        with self._lock:
+            self.stores += 1
+        return raw
+
+    def _store_remote(self, client, key: str, raw: bytes) -> None:
+        try:
+            client.set(key, raw, ex=self.ttl_seconds)
+        except Exception as e:
+            self._mark_redis_down(e)
+
+    def set(self, key: str, results: List[KMResult]) -> None:
+        raw = self._store_local(key, results)
+        client = self._get_redis()
+        if client is not None:
+            self._store_remote(client, key, raw)
+
+    async def aset(self, key: str, results: List[KMResult]) -> None:
+        """set 的非同步版本（Redis 寫入在執行緒中進行）"""
+        raw = self._store_local(key, results)
+        client = self._get_redis()
+        if client is not None:
+            await asyncio.to_thread(self._store_remote, client, key, raw)
+
+    def clear(self) -> None:
+        """清除程序內快取與計數（Redis 中的條目依 TTL 自然過期）"""
+        with self._lock:
+            self._local.clear()
+            self.hits_local = self.hits_redis = self.misses = self.stores = self.bumps = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits_local + self.hits_redis + self.misses
+        return {
+            'size': len(self._local),
+            'max_size': self.max_size,
+            'version': self.version(),
+            'hits_local': self.hits_local,
+            'hits_redis': self.hits_redis,
+            'misses': self.misses,
+            'stores': self.stores,
+            'bumps': self.bumps,
+            'hit_rate': (self.hits_local + self.hits_redis) / lookups if lookups else 0.0,
+        }
+
+    def shared_stats(self) -> Dict[str, Any]:
+        """所有 worker 累計的命中統計（需要 Redis）"""
+        client = self._get_redis()
+        if client is None:
+            return {}
+        try:
+            raw = client.hgetall(self.STATS_KEY)
+        except Exception as e:
+            self._mark_redis_down(e)
+            return {}
+        counts = {k.decode() if isinstance(k, bytes) else k: int(v) for k, v in raw.items()}
+        hits = counts.get('hits_local', 0) + counts.get('hits_redis', 0)
+        lookups = hits + counts.get('misses', 0)
+        return dict(counts, hit_rate=hits / lookups if lookups else 0.0)
+
+
+search_cache = SearchResultCache()
+
+
+def bump_corpus_version(reason: str = '') -> None:
+    """文章內容或 embedding 變更後呼叫，讓所有 worker 的檢索結果快取失效"""
+    search_cache.bump_version(reason)
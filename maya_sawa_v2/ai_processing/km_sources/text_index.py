@@ -0,0 +1,227 @@
+"""
+程序內全文索引 - CJK bigram + 英數詞切分的 BM25 倒排索引
+
+postings 以 CSR 形式存成連續陣列（offsets / doc_idx / tf），查詢只讀取命中詞的 postings，
+成本與命中 postings 數成正比，而非語料位元組數。索引由增量同步引擎從 articles 表建立，
+作為混合檢索的第三路訊號；Paprika 文章另建一份供關鍵詞回退使用。
+"""
+
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# CJK 統一表意文字（含擴充 A / 相容字）、日文假名與韓文音節
+_CJK = r"\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af"
+_TOKEN_RE = re.compile(rf"(?P<cjk>[{_CJK}]+)|(?P<word>[a-z0-9\+\#\.\-_]+)")
+_ALNUM_RE = re.compile(r"[a-z0-9]")
+
+
+def tokenize(text: str) -> List[str]:
+    """切分為英數詞（保留 c++ / c# / .net 這類寫法）與 CJK 連續字的 bigram（單字則保留單字）"""
+    tokens: List[str] = []
+    for m in _TOKEN_RE.finditer((text or '').lower()):
+        run = m.group('cjk')
+        if run:
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            continue
+        word = m.group('word').rstrip('.-_')
+        if _ALNUM_RE.search(word):
+            tokens.append(word)
+    return tokens
+
+
+class BM25Index:
+    """BM25 倒排索引：詞典 + CSR postings（每個詞的 doc_idx 依文件序排列）"""
+
+    def __init__(self, ids: "np.ndarray", vocab: Dict[str, int], offsets: "np.ndarray", doc_idx: "np.ndarray",
+                 tfs: "np.ndarray", doc_len: "np.ndarray", k1: float = 1.2, b: float = 0.75,
+                 meta: Optional[Dict[str, Any]] = None):
+        if np is None:
+            raise RuntimeError("numpy is required for BM25Index")
+        if len(offsets) != len(vocab) + 1 or len(ids) != len(doc_len):
+            raise ValueError("inconsistent postings arrays")
+        self.ids = ids
+        self.vocab = vocab
+        self.offsets = offsets
+        self.doc_idx = doc_idx
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        self.avgdl = float(doc_len.mean()) if len(doc_len) else 0.0
+        # 附帶資訊（如增量同步的 watermark）
+        self.meta: Dict[str, Any] = meta or {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.offsets.nbytes + self.doc_idx.nbytes + self.tfs.nbytes + self.doc_len.nbytes)
+
+    @staticmethod
+    def _ids_array(ids: List[Any]) -> "np.ndarray":
+        if all(isinstance(i, int) for i in ids):
+            return np.asarray(ids, dtype=np.int64)
+        return np.asarray(ids, dtype=object)
+
+    @staticmethod
+    def _postings(texts: Iterable[str], vocab: Dict[str, int], first_doc: int = 0
+                  ) -> Tuple[List[int], List[int], List[int], List[int]]:
+        """切詞並統計詞頻，回傳 (term_ids, doc_idx, tfs, doc_len)；新詞直接加入 vocab"""
+        term_ids: List[int] = []
+        doc_idx: List[int] = []
+        tfs: List[int] = []
+        doc_len: List[int] = []
+        for offset, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_len.append(sum(counts.values()))
+            for token, tf in counts.items():
+                term_ids.append(vocab.setdefault(token, len(vocab)))
+                doc_idx.append(first_doc + offset)
+                tfs.append(tf)
+        return term_ids, doc_idx, tfs, doc_len
+
+    @classmethod
+    def _from_postings(cls, ids: "np.ndarray", vocab: Dict[str, int], term_ids: "np.ndarray",
+                       doc_idx: "np.ndarray", tfs: "np.ndarray", doc_len: "np.ndarray", k1: float, b: float,
+                       meta: Optional[Dict[str, Any]] = None) -> "BM25Index":
+        order = np.lexsort((doc_idx, term_ids))
+        counts = np.bincount(term_ids, minlength=len(vocab)) if len(term_ids) else np.zeros(len(vocab), np.int64)
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(ids, vocab, offsets,
+                   np.ascontiguousarray(doc_idx[order], dtype=np.int32),
+                   np.ascontiguousarray(np.minimum(tfs[order], np.iinfo(np.uint16).max), dtype=np.uint16),
+                   np.asarray(doc_len, dtype=np.float32), k1, b, meta)
+
+    @classmethod
+    def from_items(cls, items: Iterable[Tuple[Any, str]], k1: float = 1.2, b: float = 0.75) -> "BM25Index":
+        """由 (id, text) 建立索引；沒有任何詞的文件不進入索引"""
+        ids: List[Any] = []
+        texts: List[str] = []
+        for item_id, text in items:
+            if item_id is None or not tokenize(text):
+                continue
+            ids.append(item_id)
+            texts.append(text)
+        vocab: Dict[str, int] = {}
+        term_ids, doc_idx, tfs, doc_len = cls._postings(texts, vocab)
+        return cls._from_postings(cls._ids_array(ids), vocab, np.asarray(term_ids, dtype=np.int64),
+                                  np.asarray(doc_idx, dtype=np.int64), np.asarray(tfs, dtype=np.int64),
+                                  np.asarray(doc_len, dtype=np.float32), k1, b)
+
+    def _query_terms(self, query: str) -> List[int]:
+        return list(dict.fromkeys(self.vocab[t] for t in tokenize(query) if t in self.vocab))
+
+    def search(self, query: str, k: int) -> List[Tuple[Any, float]]:
+        """回傳 [(id, BM25 分數), ...]，依分數由高到低；只計算命中詞的 postings"""
+        if len(self.ids) == 0 or k <= 0:
+            return []
+        n = len(self.ids)
+        doc_parts: List["np.ndarray"] = []
+        weight_parts: List["np.ndarray"] = []
+        for term in self._query_terms(query):
+            start, end = int(self.offsets[term]), int(self.offsets[term + 1])
+            df = end - start
+            if df == 0:
+                continue
+            docs = self.doc_idx[start:end]
+            tf = self.tfs[start:end].astype(np.float32)
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[docs] / (self.avgdl or 1.0))
+            doc_parts.append(docs)
+            weight_parts.append(idf * tf * (self.k1 + 1.0) / (tf + norm))
+        if not doc_parts:
+            return []
+        docs, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weight_parts))
+        k = min(k, len(docs))
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(docs) else np.arange(len(docs))
+        top = top[np.argsort(-scores[top])]
+        return list(zip(self.ids[docs[top]].tolist(), scores[top].tolist()))
+
+    def matched_terms(self, item_id: Any, query: str) -> List[str]:
+        """查詢詞中出現在指定文件的詞（供引用資訊顯示）"""
+        positions = np.flatnonzero(self.ids == item_id)
+        if not len(positions):
+            return []
+        doc = positions[0]
+        matched = []
+        for token in dict.fromkeys(tokenize(query)):
+            term = self.vocab.get(token)
+            if term is None:
+                continue
+            postings = self.doc_idx[self.offsets[term]:self.offsets[term + 1]]
+            i = np.searchsorted(postings, doc)
+            if i < len(postings) and postings[i] == doc:
+                matched.append(token)
+        return matched
+
+    def with_changes(self, upserts: Iterable[Tuple[Any, str]], deletes: Iterable[Any] = ()) -> "BM25Index":
+        """套用新增/更新與刪除，回傳新的索引（原索引不變）；既有 postings 以陣列運算過濾與重新編號"""
+        upserts = {item_id: text for item_id, text in upserts if item_id is not None}
+        drop = set(deletes) | set(upserts)
+        keep = np.ones(len(self.ids), dtype=bool)
+        if drop and len(self.ids):
+            keep = ~np.isin(self.ids, np.asarray(list(drop), dtype=self.ids.dtype))
+        term_of = np.repeat(np.arange(len(self.vocab), dtype=np.int64), np.diff(self.offsets))
+        kept_postings = keep[self.doc_idx]
+        renumber = np.cumsum(keep) - 1
+        ids = list(self.ids[keep].tolist())
+        vocab = dict(self.vocab)
+
+        added = [(item_id, text) for item_id, text in upserts.items() if tokenize(text)]
+        term_ids, doc_idx, tfs, doc_len = self._postings((text for _, text in added), vocab, first_doc=len(ids))
+        ids.extend(item_id for item_id, _ in added)
+        return self._from_postings(
+            self._ids_array(ids),
+            vocab,
+            np.concatenate([term_of[kept_postings], np.asarray(term_ids, dtype=np.int64)]),
+            np.concatenate([renumber[self.doc_idx[kept_postings]], np.asarray(doc_idx, dtype=np.int64)]),
+            np.concatenate([self.tfs[kept_postings].astype(np.int64), np.asarray(tfs, dtype=np.int64)]),
+            np.concatenate([self.doc_len[keep], np.asarray(doc_len, dtype=np.float32)]),
+            self.k1, self.b, dict(self.meta),
+        )
+
+
+def normalize_scores(results: List[Tuple[Any, float]]) -> List[Tuple[Any, float]]:
+    """BM25 分數除以最高分，轉為 0~1 以便與餘弦 / trigram 分數融合"""
+    if not results or results[0][1] <= 0:
+        return []
+    top = results[0][1]
+    return [(item_id, score / top) for item_id, score in results]
+
+
+_index: Optional[BM25Index] = None
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return os.getenv('KM_TEXT_INDEX', 'true').lower() in ('1', 'true', 'yes')
+
+
+def get_text_index() -> Optional[BM25Index]:
+    """取得程序內的 articles 全文索引（由增量同步引擎建立；尚未同步時為 None）"""
+    return _index
+
+
+def set_text_index(index: Optional[BM25Index]) -> None:
+    """替換程序內的全文索引（增量同步、測試替身）"""
+    global _index
+    with _lock:
+        _index = index
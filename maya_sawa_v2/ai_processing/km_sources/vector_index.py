@@ -0,0 +1,438 @@
+"""
+程序內向量索引 - 以 NumPy 連續 float32 矩陣保存文章 embedding（可選 float16 / int8 量化）
+
+列向量預先正規化，餘弦相似度即一次矩陣-向量乘積，top-k 以 argpartition 取得。
+快照存成 .npy 檔並以 mmap 載入，同一台機器上的多個 gunicorn/uvicorn worker
+共用作業系統的分頁快取。用於 pgvector 缺席或查詢過慢時的替代，以及測試中的本地替身。
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+class VectorIndex(ABC):
+    """向量索引介面"""
+
+    dim: int = 0
+
+    @abstractmethod
+    def search(self, query_vec: Sequence[float], k: int) -> List[Tuple[Any, float]]:
+        """回傳 [(id, cosine similarity), ...]，依相似度由高到低"""
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+
+QUANTIZATION_DTYPES = ('float32', 'float16', 'int8')
+
+# 量化矩陣分塊轉回 float32 計算內積，暫存記憶體只需一個區塊
+_SCAN_BLOCK_ROWS = 8192
+
+
+def quantize(matrix: "np.ndarray", dtype: str) -> Tuple["np.ndarray", Optional["np.ndarray"]]:
+    """量化正規化後的 float32 矩陣，回傳 (codes, scales)。
+
+    - float16: 直接轉為半精度（與 pgvector halfvec 相同精度），scales 為 None
+    - int8: 逐列對稱純量量化，每列一個 scale（列向量 ≈ codes * scale），可逐列增量更新
+    """
+    if dtype == 'float16':
+        return np.ascontiguousarray(matrix, dtype=np.float16), None
+    if dtype != 'int8':
+        raise ValueError(f"Unsupported vector index dtype: {dtype}")
+    if not len(matrix):
+        return np.empty(matrix.shape, dtype=np.int8), np.empty(0, dtype=np.float32)
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return np.ascontiguousarray(codes), scales.astype(np.float32)
+
+
+class NumpyVectorIndex(VectorIndex):
+    """NumPy 實作：ids 與 (n, dim) 正規化 float32 矩陣。
+
+    可改以量化碼（float16 / int8）掃描，記憶體與 I/O 降為 1/2～1/4；
+    保留 float32 矩陣（通常是 mmap 快照）時，可用 rerank_candidates 對前幾名以 float32 重新計分。
+    """
+
+    def __init__(self, ids: "np.ndarray", matrix: Optional["np.ndarray"], meta: Optional[Dict[str, Any]] = None,
+                 codes: Optional["np.ndarray"] = None, scales: Optional["np.ndarray"] = None,
+                 rerank_candidates: int = 0):
+        if np is None:
+            raise RuntimeError("numpy is required for NumpyVectorIndex")
+        if matrix is None and codes is None:
+            raise ValueError("either matrix or codes is required")
+        for array in (matrix, codes):
+            if array is not None and len(ids) != len(array):
+                raise ValueError("ids and matrix must have the same length")
+        self.ids = ids
+        self.matrix = matrix
+        self.codes = codes
+        self.scales = scales
+        self.rerank_candidates = int(rerank_candidates or 0)
+        scanned = codes if codes is not None else matrix
+        self.dim = int(scanned.shape[1]) if scanned.ndim == 2 and len(scanned) else 0
+        # 快照附帶資訊（如增量同步的 watermark）
+        self.meta: Dict[str, Any] = meta or {}
+
+    @property
+    def dtype(self) -> str:
+        """檢索時掃描的表示格式"""
+        return 'float32' if self.codes is None else str(self.codes.dtype)
+
+    @property
+    def nbytes(self) -> int:
+        """每次檢索需掃描的位元組數（重排只讀取候選列，不計入）"""
+        if self.codes is None:
+            return int(self.matrix.nbytes)
+        return int(self.codes.nbytes) + (int(self.scales.nbytes) if self.scales is not None else 0)
+
+    @staticmethod
+    def _normalize(matrix: "np.ndarray") -> "np.ndarray":
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+    @classmethod
+    def from_items(cls, items: Iterable[Tuple[Any, Sequence[float]]], dtype: str = 'float32',
+                   keep_float32: bool = True, rerank_candidates: int = 0) -> "NumpyVectorIndex":
+        """由 (id, vector) 建立索引；維度不一致的向量會被略過。
+
+        dtype 為 float16 / int8 時以量化碼檢索，keep_float32=False 時不保留 float32 矩陣。
+        """
+        ids: List[Any] = []
+        vectors: List[Sequence[float]] = []
+        dim = None
+        for item_id, vec in items:
+            if vec is None or len(vec) == 0:
+                continue
+            if dim is None:
+                dim = len(vec)
+            if len(vec) != dim:
+                continue
+            ids.append(item_id)
+            vectors.append(vec)
+        if not ids:
+            index = cls(np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32))
+        else:
+            id_dtype = np.int64 if all(isinstance(i, int) for i in ids) else None
+            index = cls(np.asarray(ids, dtype=id_dtype), cls._normalize(np.asarray(vectors, dtype=np.float32)))
+        if dtype == 'float32':
+            return index
+        return index.quantized(dtype, keep_float32=keep_float32, rerank_candidates=rerank_candidates)
+
+    def quantized(self, dtype: str, keep_float32: bool = False,
+                  rerank_candidates: Optional[int] = None) -> "NumpyVectorIndex":
+        """回傳以 dtype 掃描的新索引（需要 float32 矩陣作為量化來源）"""
+        rerank = self.rerank_candidates if rerank_candidates is None else rerank_candidates
+        if dtype == self.dtype:
+            matrix = self.matrix if keep_float32 or self.codes is None else None
+            return NumpyVectorIndex(self.ids, matrix, dict(self.meta), self.codes, self.scales, rerank)
+        if self.matrix is None:
+            raise ValueError(f"float32 vectors are required to build a {dtype} index")
+        if dtype == 'float32':
+            return NumpyVectorIndex(self.ids, self.matrix, dict(self.meta))
+        codes, scales = quantize(np.asarray(self.matrix, dtype=np.float32), dtype)
+        return NumpyVectorIndex(self.ids, self.matrix if keep_float32 else None, dict(self.meta),
+                                codes, scales, rerank)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _scores(self, q: "np.ndarray") -> "np.ndarray":
+        if self.codes is None:
+            return self.matrix @ q
+        n = len(self.codes)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, _SCAN_BLOCK_ROWS):
+            block = self.codes[start:start + _SCAN_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ q
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    @staticmethod
+    def _top(scores: "np.ndarray", k: int) -> "np.ndarray":
+        n = len(scores)
+        k = min(k, n)
+        if k < n:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(n)
+        return top[np.argsort(-scores[top])]
+
+    def search(self, query_vec: Sequence[float], k: int) -> List[Tuple[Any, float]]:
+        n = len(self.ids)
+        if n == 0 or k <= 0 or query_vec is None or len(query_vec) != self.dim:
+            return []
+        q = np.asarray(query_vec, dtype=np.float32)
+        norm = float(np.linalg.norm(q))
+        if norm == 0.0:
+            return []
+        q = q / norm
+        scores = self._scores(q)
+        if self.codes is None or self.matrix is None or self.rerank_candidates <= k:
+            top = self._top(scores, k)
+            return [(self.ids[i].item(), float(scores[i])) for i in top]
+        # 量化分數取前 rerank_candidates 名，再以 float32 精確重排（mmap 快照只會讀入這些列）
+        candidates = np.sort(self._top(scores, self.rerank_candidates))
+        exact = np.asarray(self.matrix[candidates], dtype=np.float32) @ q
+        order = np.argsort(-exact)[:k]
+        return [(self.ids[candidates[i]].item(), float(exact[i])) for i in order]
+
+    def with_changes(self, upserts: Iterable[Tuple[Any, Sequence[float]]],
+                     deletes: Iterable[Any] = ()) -> "NumpyVectorIndex":
+        """套用新增/更新與刪除，回傳新的索引（原索引不變，讀取端可持續使用舊版本）"""
+        upserts = {item_id: vec for item_id, vec in upserts if vec is not None and len(vec)}
+        drop = set(deletes) | set(upserts)
+        # 量化索引只在需要重排時保留 float32，避免把 mmap 快照整份讀進記憶體
+        keep_float32 = self.matrix is not None and (self.codes is None or self.rerank_candidates > 0)
+        ids = self.ids
+        parts = {'matrix': self.matrix if keep_float32 else None, 'codes': self.codes, 'scales': self.scales}
+        if drop and len(ids):
+            keep = ~np.isin(ids, np.asarray(list(drop), dtype=ids.dtype))
+            ids = ids[keep]
+            parts = {name: array[keep] if array is not None else None for name, array in parts.items()}
+        added = NumpyVectorIndex.from_items(
+            ((item_id, vec) for item_id, vec in upserts.items() if not self.dim or len(vec) == self.dim),
+            dtype=self.dtype, keep_float32=keep_float32,
+        )
+        if len(added):
+            if len(ids):
+                ids = np.concatenate([ids, added.ids.astype(ids.dtype)])
+                parts = {
+                    name: (np.concatenate([array, getattr(added, name)]) if array is not None else None)
+                    for name, array in parts.items()
+                }
+            else:
+                ids = added.ids
+                parts = {name: getattr(added, name) if parts[name] is not None else None for name in parts}
+        matrix = np.ascontiguousarray(parts['matrix'], dtype=np.float32) if parts['matrix'] is not None else None
+        codes = np.ascontiguousarray(parts['codes']) if parts['codes'] is not None else None
+        return NumpyVectorIndex(np.asarray(ids), matrix, dict(self.meta), codes, parts['scales'],
+                                self.rerank_candidates)
+
+    def _arrays(self) -> Dict[str, Optional["np.ndarray"]]:
+        """快照檔案後綴與對應陣列；float32 以外的格式各自存成 vectors.{dtype}.npy"""
+        arrays: Dict[str, Optional["np.ndarray"]] = {'ids': self.ids, 'vectors': self.matrix, 'scales': self.scales}
+        for dtype in QUANTIZATION_DTYPES[1:]:
+            arrays[f'vectors.{dtype}'] = self.codes if self.dtype == dtype else None
+        return arrays
+
+    def save(self, path: str) -> None:
+        """寫入快照（{path}.ids.npy / {path}.vectors[.dtype].npy / {path}.meta.json），以暫存檔 + rename 原子替換"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        for suffix, array in self._arrays().items():
+            target = f"{path}.{suffix}.npy"
+            if array is None:
+                # 移除舊快照留下、與目前索引不一致的檔案
+                if os.path.exists(target):
+                    os.remove(target)
+                continue
+            tmp = f"{target}.tmp"
+            with open(tmp, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp, target)
+        tmp = f"{path}.meta.json.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(dict(self.meta, dtype=self.dtype), f)
+        os.replace(tmp, f"{path}.meta.json")
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, dtype: Optional[str] = None,
+             rerank_candidates: int = 0) -> "NumpyVectorIndex":
+        """載入快照；mmap=True 時以唯讀記憶體映射開啟，worker 之間共用分頁。
+
+        dtype 預設為快照寫入時的格式；快照沒有該量化格式但有 float32 時於載入時量化。
+        量化索引的 float32 矩陣以 mmap 保留供重排，非 mmap 且不重排時不載入。
+        """
+        meta: Dict[str, Any] = {}
+        if os.path.exists(f"{path}.meta.json"):
+            with open(f"{path}.meta.json", encoding='utf-8') as f:
+                meta = json.load(f)
+        stored = meta.pop('dtype', 'float32')
+        dtype = dtype or stored
+        mode = 'r' if mmap else None
+        ids = np.load(f"{path}.ids.npy", mmap_mode=mode, allow_pickle=False)
+        codes_path = f"{path}.vectors.{dtype}.npy"
+        has_codes = dtype != 'float32' and os.path.exists(codes_path)
+        matrix = None
+        if os.path.exists(f"{path}.vectors.npy") and (mmap or not has_codes or rerank_candidates > 0):
+            matrix = np.load(f"{path}.vectors.npy", mmap_mode=mode, allow_pickle=False)
+        if dtype == 'float32':
+            if matrix is None:
+                raise ValueError(f"snapshot {path} has no float32 vectors")
+            return cls(ids, matrix, meta)
+        scales = None
+        if has_codes:
+            codes = np.load(codes_path, mmap_mode=mode, allow_pickle=False)
+            if dtype == 'int8':
+                scales = np.load(f"{path}.scales.npy", mmap_mode=mode, allow_pickle=False)
+        elif matrix is not None:
+            codes, scales = quantize(np.asarray(matrix, dtype=np.float32), dtype)
+            if not mmap and rerank_candidates <= 0:
+                matrix = None
+        else:
+            raise ValueError(f"snapshot {path} has neither float32 nor {dtype} vectors")
+        return cls(ids, matrix, meta, codes, scales, rerank_candidates)
+
+    @staticmethod
+    def snapshot_exists(path: str) -> bool:
+        return os.path.exists(f"{path}.ids.npy") and any(
+            os.path.exists(f"{path}.vectors.npy" if dtype == 'float32' else f"{path}.vectors.{dtype}.npy")
+            for dtype in QUANTIZATION_DTYPES
+        )
+
+
+def recall_report(index: NumpyVectorIndex, dtypes: Sequence[str] = QUANTIZATION_DTYPES, k: int = 10,
+                  samples: int = 200, rerank_candidates: int = 0, seed: int = 0) -> List[Dict[str, Any]]:
+    """以 float32 精確 top-k 為基準，量測各格式的 recall@k、掃描位元組與平均查詢時間。
+
+    查詢取自索引中的文章向量並加入少量雜訊；rerank_candidates > 0 時另列 float32 重排後的結果。
+    float16 的 recall 也可作為 pgvector halfvec 的參考（同為半精度）。
+    """
+    if index.matrix is None:
+        raise ValueError("float32 vectors are required for a recall report")
+    exact = NumpyVectorIndex(index.ids, np.asarray(index.matrix, dtype=np.float32))
+    n = len(exact)
+    if n == 0:
+        return []
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(n, size=min(samples, n), replace=False)
+    queries = exact.matrix[picks] + rng.normal(0.0, 0.01, (len(picks), exact.dim)).astype(np.float32)
+    truth = [{item_id for item_id, _ in exact.search(q, k)} for q in queries]
+
+    variants: List[Tuple[str, int]] = []
+    for dtype in dtypes:
+        variants.append((dtype, 0))
+        if dtype != 'float32' and rerank_candidates > k:
+            variants.append((dtype, rerank_candidates))
+
+    report: List[Dict[str, Any]] = []
+    for dtype, rerank in variants:
+        candidate = exact.quantized(dtype, keep_float32=rerank > 0, rerank_candidates=rerank)
+        hits = 0
+        started = time.perf_counter()
+        for q, expected in zip(queries, truth):
+            hits += len(expected & {item_id for item_id, _ in candidate.search(q, k)})
+        elapsed = time.perf_counter() - started
+        report.append({
+            'dtype': dtype,
+            'rerank': rerank,
+            'recall': hits / max(1, sum(len(t) for t in truth)),
+            'bytes': candidate.nbytes,
+            'bytes_per_vector': candidate.nbytes / n,
+            'compression': exact.nbytes / max(1, candidate.nbytes),
+            'query_ms': elapsed * 1000 / len(queries),
+        })
+    return report
+
+
+def parse_vector(value: Any) -> Optional[Sequence[float]]:
+    """解析 pgvector adapter 載入的 Vector / numpy 陣列、pgvector 文字格式或 JSON 陣列字串 / list"""
+    if value is None:
+        return None
+    if hasattr(value, 'to_numpy'):
+        value = value.to_numpy()
+    if np is not None and isinstance(value, np.ndarray):
+        return value.astype(np.float32, copy=False)
+    if isinstance(value, (list, tuple)):
+        return [float(x) for x in value]
+    if isinstance(value, str):
+        s = value.strip().strip('[]')
+        if not s:
+            return None
+        try:
+            return [float(x) for x in s.split(',')]
+        except ValueError:
+            return None
+    return None
+
+
+def save_snapshot(index: NumpyVectorIndex, path: str) -> None:
+    """寫入快照：保留 float32（重排與改用其他格式時使用），並附上 KM_VECTOR_INDEX_DTYPE 的量化碼"""
+    dtype = index_dtype()
+    if index.matrix is not None and dtype != index.dtype:
+        index = index.quantized(dtype, keep_float32=True)
+    index.save(path)
+
+
+def build_snapshot_from_db(path: str, batch_size: int = 1000) -> int:
+    """從 articles 表完整匯出 embedding 並寫入快照，回傳筆數（以伺服器端游標分批讀取）"""
+    from .index_sync import sync_engine
+
+    # 以 float32 重建，快照同時保存 float32 與量化碼
+    set_vector_index(NumpyVectorIndex.from_items([]))
+    sync_engine.sync(full=True, batch_size=batch_size)
+    index = get_vector_index()
+    save_snapshot(index, path)
+    logger.info("向量索引快照已寫入 %s（%d 筆，dim=%d，%s）", path, len(index), index.dim, index.dtype)
+    set_vector_index(NumpyVectorIndex.load(path, dtype=index_dtype(), rerank_candidates=rerank_candidates()))
+    return len(index)
+
+
+_index: Optional[VectorIndex] = None
+_loaded = False
+_lock = threading.Lock()
+
+
+def snapshot_path() -> str:
+    return os.getenv('KM_VECTOR_INDEX_PATH', '')
+
+
+def index_dtype() -> str:
+    """程序內索引掃描格式：float32 | float16 | int8"""
+    return os.getenv('KM_VECTOR_INDEX_DTYPE', 'float32')
+
+
+def rerank_candidates() -> int:
+    """量化檢索後以 float32 重排的候選數（0 表示不重排）"""
+    return int(os.getenv('KM_VECTOR_RERANK_CANDIDATES', '0'))
+
+
+def index_options() -> Dict[str, Any]:
+    """建立新索引時的量化設定；量化且不重排時不保留 float32 矩陣"""
+    dtype = index_dtype()
+    rerank = rerank_candidates()
+    return {'dtype': dtype, 'keep_float32': dtype == 'float32' or rerank > 0, 'rerank_candidates': rerank}
+
+
+def get_vector_index() -> Optional[VectorIndex]:
+    """取得程序內的向量索引；首次呼叫時由 KM_VECTOR_INDEX_PATH 快照以 mmap 載入"""
+    global _index, _loaded
+    if _loaded:
+        return _index
+    with _lock:
+        if not _loaded:
+            path = snapshot_path()
+            if np is not None and path and NumpyVectorIndex.snapshot_exists(path):
+                try:
+                    _index = NumpyVectorIndex.load(path, dtype=index_dtype(),
+                                                   rerank_candidates=rerank_candidates())
+                    logger.info("已載入向量索引快照 %s（%d 筆，%s）", path, len(_index), _index.dtype)
+                except Exception as e:
+                    logger.warning("載入向量索引快照失敗: %s", str(e))
+            _loaded = True
+    return _index
+
+
+def set_vector_index(index: Optional[VectorIndex]) -> None:
+    """替換程序內的向量索引（快照重建、測試替身）"""
+    global _index, _loaded
+    with _lock:
+        _index, _loaded = index, True
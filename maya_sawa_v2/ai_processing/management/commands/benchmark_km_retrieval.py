@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from maya_sawa_v2.ai_processing.km_sources import benchmark
+from maya_sawa_v2.ai_processing.km_sources import db as km_db
+
+
+class Command(BaseCommand):
+    help = "以固定語料與假 embedding 量測 ProgrammingKMSource 各階段延遲（p50/p95）與 recall@k / MRR，輸出可比較的 JSON"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--backend", choices=["auto", "postgres", "local"], default="auto",
+                            help="postgres：在 KM 資料庫建立暫存表；local：程序內索引（預設有資料庫設定就用 postgres）")
+        parser.add_argument("--corpus", default=None, help="語料 JSON 路徑（預設 km_sources/benchmark_corpus.json）")
+        parser.add_argument("--k", type=int, default=None, help="recall@k 的 k（預設 KM_HYBRID_TOP_K）")
+        parser.add_argument("--repeat", type=int, default=5, help="每個查詢計時的次數（另有一次不計時的暖身）")
+        parser.add_argument("--output", default=None, help="結果 JSON 寫入的路徑（預設輸出到 stdout）")
+        parser.add_argument("--baseline", default=None, help="先前的結果 JSON，列出品質與延遲的差值")
+
+    def handle(self, *args, **options):
+        if benchmark.np is None:
+            self.stderr.write(self.style.ERROR("未安裝 numpy，無法執行檢索基準測試。"))
+            return
+        if options["backend"] == "postgres" and not km_db.is_configured():
+            self.stderr.write(self.style.ERROR("找不到資料庫連線資訊（DATABASE_URL 或 DB_* 環境變數）。"))
+            return
+
+        try:
+            result = benchmark.run_benchmark(
+                corpus=benchmark.load_corpus(options["corpus"]),
+                backend=options["backend"],
+                k=options["k"],
+                repeat=max(1, options["repeat"]),
+            )
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"基準測試失敗：{e}"))
+            return
+
+        payload = json.dumps(result, ensure_ascii=False, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                f.write(payload + "\n")
+        else:
+            self.stdout.write(payload)
+
+        quality = result["quality"]
+        k = result["k"]
+        self.stderr.write(
+            f"{result['backend']}: {quality['queries']} 個查詢，recall@{k}={quality[f'recall@{k}']:.4f}，"
+            f"MRR={quality['mrr']:.4f}"
+        )
+        for stage, latency in result["latency_ms"].items():
+            self.stderr.write(f"  {stage:<8} p50={latency['p50']:.3f} ms  p95={latency['p95']:.3f} ms")
+
+        if options["baseline"]:
+            with open(options["baseline"], encoding="utf-8") as f:
+                diff = benchmark.compare(json.load(f), result)
+            if not diff["comparable"]:
+                self.stderr.write(self.style.WARNING("基準結果的語料或 k 不同，差值僅供參考。"))
+            self.stderr.write("與基準結果的差值：" + json.dumps(diff, ensure_ascii=False, sort_keys=True))
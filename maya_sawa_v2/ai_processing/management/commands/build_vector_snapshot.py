@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandParser
+
+from maya_sawa_v2.ai_processing.km_sources import db as km_db
+from maya_sawa_v2.ai_processing.km_sources import vector_index
+
+
+class Command(BaseCommand):
+    help = "從 articles 表匯出 embedding，寫入程序內向量索引的 NumPy 快照（供 worker 以 mmap 載入）"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--path", default=None, help="快照路徑前綴（預設 KM_VECTOR_INDEX_PATH）")
+        parser.add_argument("--batch-size", type=int, default=1000, help="伺服器端游標每批讀取筆數")
+
+    def handle(self, *args, **options):
+        if not km_db.is_configured():
+            self.stderr.write(self.style.ERROR("找不到資料庫連線資訊（DATABASE_URL 或 DB_* 環境變數）。"))
+            return
+        if vector_index.np is None:
+            self.stderr.write(self.style.ERROR("未安裝 numpy，無法建立向量索引快照。"))
+            return
+
+        path = options["path"] or vector_index.snapshot_path()
+        if not path:
+            self.stderr.write(self.style.ERROR("請以 --path 或 KM_VECTOR_INDEX_PATH 指定快照路徑。"))
+            return
+
+        try:
+            count = vector_index.build_snapshot_from_db(path, batch_size=options["batch_size"])
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"建立向量索引快照失敗：{e}"))
+            return
+
+        dtype = vector_index.index_dtype()
+        files = f"{path}.vectors.npy" + (f" / {path}.vectors.{dtype}.npy" if dtype != "float32" else "")
+        self.stdout.write(self.style.SUCCESS(f"已寫入 {count} 篇文章的向量至 {files} / {path}.ids.npy"))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandParser
+
+from maya_sawa_v2.ai_processing.km_sources import backfill, chunking
+from maya_sawa_v2.ai_processing.km_sources import db as km_db
+
+
+class Command(BaseCommand):
+    help = "將變更過的文章切成段落寫入 article_chunks，並可選擇補齊段落 embedding"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--limit", type=int, default=500, help="本次切分的最大文章數量")
+        parser.add_argument("--max-tokens", type=int, default=None, help="每個段落的 token 上限（預設 KM_CHUNK_MAX_TOKENS）")
+        parser.add_argument("--overlap", type=int, default=None, help="相鄰段落重疊的 token 數（預設 KM_CHUNK_OVERLAP_TOKENS）")
+        parser.add_argument("--embed", action="store_true", help="切分後補齊段落 embedding（需要 OPENAI_API_KEY）")
+        parser.add_argument("--batch-size", type=int, default=50, help="每批送入 OpenAI 的筆數")
+
+    def handle(self, *args, **options):
+        if not km_db.is_configured():
+            self.stderr.write(self.style.ERROR("找不到資料庫連線資訊（DATABASE_URL 或 DB_* 環境變數）。"))
+            return
+
+        stats = chunking.sync_article_chunks(
+            limit=options["limit"], max_tokens=options["max_tokens"], overlap_tokens=options["overlap"])
+        self.stdout.write(self.style.SUCCESS(
+            f"已切分 {stats['articles']} 篇文章：新增 {stats['inserted']} 段、保留 {stats['kept']} 段、刪除 {stats['deleted']} 段"
+        ))
+
+        if options["embed"]:
+            def report(processed, total):
+                self.stdout.write(f"段落 embedding {processed}/{total}")
+
+            processed = backfill.backfill_missing_embeddings(
+                limit=options["limit"] * 20, batch_size=options["batch_size"], progress=report, table="article_chunks")
+            self.stdout.write(self.style.SUCCESS(f"完成！共補齊 {processed} 段 embedding"))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandParser
+
+from maya_sawa_v2.ai_processing.km_sources.result_cache import bump_corpus_version, search_cache
+
+
+class Command(BaseCommand):
+    help = "檢視知識庫檢索結果快取的命中率，或在外部匯入文章後調高語料版本使快取失效"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--bump", action="store_true", help="調高語料版本（所有 worker 的快取條目立即失效）")
+
+    def handle(self, *args, **options):
+        if options["bump"]:
+            bump_corpus_version("manual")
+            self.stdout.write(self.style.SUCCESS(f"語料版本已更新為 {search_cache.version()}"))
+            return
+
+        shared = search_cache.shared_stats()
+        if not shared:
+            self.stdout.write(self.style.WARNING("Redis 不可用，無法取得各 worker 累計的命中統計。"))
+            return
+        lookups = shared.get("hits_local", 0) + shared.get("hits_redis", 0) + shared.get("misses", 0)
+        self.stdout.write(
+            f"語料版本 {search_cache.version()}：查詢 {lookups} 次，"
+            f"程序內命中 {shared.get('hits_local', 0)}，Redis 命中 {shared.get('hits_redis', 0)}，"
+            f"未命中 {shared.get('misses', 0)}，命中率 {shared['hit_rate']:.1%}"
+        )
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandParser
+
+from maya_sawa_v2.ai_processing.km_sources import db as km_db
+from maya_sawa_v2.ai_processing.km_sources import pg_index
+
+
+class Command(BaseCommand):
+    help = "建立、重建或檢視 articles.embedding 的 pgvector ANN 索引（HNSW / IVFFlat）"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--method", choices=sorted(pg_index.INDEX_NAMES), default="hnsw", help="索引方法")
+        parser.add_argument("--type", dest="vtype", choices=pg_index.VECTOR_TYPES, default=None,
+                            help="向量型別：vector（float32）或 halfvec（float16 運算式索引，預設 KM_PG_VECTOR_TYPE）")
+        parser.add_argument("--rebuild", action="store_true", help="即使索引已存在也重新建立（先建新索引再替換）")
+        parser.add_argument("--drop", action="store_true", help="移除指定方法的索引")
+        parser.add_argument("--status", action="store_true", help="僅列出目前的向量索引")
+        parser.add_argument("--m", type=int, default=16, help="HNSW 每層最大連結數")
+        parser.add_argument("--ef-construction", type=int, default=64, help="HNSW 建立時的候選數")
+        parser.add_argument("--lists", type=int, default=None, help="IVFFlat lists（預設依資料筆數推算）")
+
+    def handle(self, *args, **options):
+        if not km_db.is_configured():
+            self.stderr.write(self.style.ERROR("找不到資料庫連線資訊（DATABASE_URL 或 DB_* 環境變數）。"))
+            return
+
+        method: str = options["method"]
+        vtype: str = options["vtype"] or pg_index.vector_type()
+
+        try:
+            if options["status"]:
+                self._print_status()
+                return
+
+            if options["drop"]:
+                pg_index.drop_index(method, vtype)
+                self.stdout.write(self.style.SUCCESS(f"已移除 {pg_index.index_name(method, vtype)}"))
+                return
+
+            self.stdout.write(self.style.NOTICE(f"以 CONCURRENTLY 建立 {method}（{vtype}）索引，過程中不會阻塞檢索..."))
+            result = pg_index.build_index(
+                method=method,
+                rebuild=options["rebuild"],
+                m=options["m"],
+                ef_construction=options["ef_construction"],
+                lists=options["lists"],
+                vtype=vtype,
+            )
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"向量索引操作失敗：{e}"))
+            return
+
+        detail = f"（lists={result['lists']}）" if result.get("lists") else ""
+        self.stdout.write(self.style.SUCCESS(
+            f"{result['name']}: {result['action']}，含 embedding 的文章 {result['rows']} 篇{detail}"
+        ))
+        self._print_status()
+
+    def _print_status(self) -> None:
+        indexes = pg_index.list_indexes()
+        if not indexes:
+            self.stdout.write(self.style.WARNING("articles.embedding 尚無 ANN 索引，向量檢索將以循序掃描執行。"))
+            return
+        for idx in indexes:
+            state = "valid" if idx["valid"] else "INVALID"
+            self.stdout.write(f"{idx['name']} [{state}] {idx['size']}\n  {idx['definition']}")
+        settings_str = ", ".join(f"{k}={v}" for k, v in pg_index.search_settings().items())
+        settings_str += f", KM_PG_VECTOR_TYPE={pg_index.vector_type()}"
+        self.stdout.write(f"查詢參數: {settings_str}")
@@ -0,0 +1,49 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from maya_sawa_v2.ai_processing.km_sources import db as km_db
+from maya_sawa_v2.ai_processing.km_sources import vector_index
+from maya_sawa_v2.ai_processing.km_sources.index_sync import sync_engine
+
+
+class Command(BaseCommand):
+    help = "依 updated_at / deleted_at watermark 增量同步程序內文章索引，並更新向量索引快照"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--full", action="store_true", help="忽略 watermark，完整重建")
+        parser.add_argument("--batch-size", type=int, default=500, help="伺服器端游標每批讀取筆數")
+        parser.add_argument("--snapshot", default=None, help="向量索引快照路徑前綴（預設 KM_VECTOR_INDEX_PATH）")
+
+    def handle(self, *args, **options):
+        if not km_db.is_configured():
+            self.stderr.write(self.style.ERROR("找不到資料庫連線資訊（DATABASE_URL 或 DB_* 環境變數）。"))
+            return
+
+        path = options["snapshot"] or vector_index.snapshot_path()
+        if path and vector_index.np is not None and vector_index.NumpyVectorIndex.snapshot_exists(path):
+            # 從既有快照的 watermark 接續，只拉取之後的變更；有 float32 時以 float32 更新，快照兩者都保留
+            if os.path.exists(f"{path}.vectors.npy"):
+                snapshot = vector_index.NumpyVectorIndex.load(path, dtype="float32")
+            else:
+                snapshot = vector_index.NumpyVectorIndex.load(path)
+            vector_index.set_vector_index(snapshot)
+        elif path and vector_index.np is not None:
+            # 尚無快照：從空索引完整建立（pgvector 部署預設不同步向量索引）
+            vector_index.set_vector_index(vector_index.NumpyVectorIndex.from_items([]))
+
+        try:
+            stats = sync_engine.sync(full=options["full"], batch_size=options["batch_size"])
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"文章索引同步失敗：{e}"))
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats['status']} 同步完成：掃描 {stats['scanned']} 筆，更新 {stats['upserts']} 筆，"
+            f"刪除 {stats['deletes']} 筆（version={stats['version']}，{stats['elapsed_ms']} ms）"
+        ))
+
+        index = vector_index.get_vector_index()
+        if path and index is not None and (stats["upserts"] or stats["deletes"] or stats["status"] == "full"):
+            vector_index.save_snapshot(index, path)
+            self.stdout.write(f"向量索引快照已更新：{path}（{len(index)} 筆）")
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandParser
+
+from maya_sawa_v2.ai_processing.km_sources import vector_index
+
+
+class Command(BaseCommand):
+    help = "比較向量索引快照在 float32 / float16 / int8 下的 recall@k、記憶體用量與查詢時間"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--path", default=None, help="快照路徑前綴（預設 KM_VECTOR_INDEX_PATH）")
+        parser.add_argument("--k", type=int, default=10, help="recall@k 的 k")
+        parser.add_argument("--samples", type=int, default=200, help="抽樣查詢數")
+        parser.add_argument("--rerank", type=int, default=None,
+                            help="另列 float32 重排後的結果（候選數，預設 KM_VECTOR_RERANK_CANDIDATES）")
+        parser.add_argument("--dtype", action="append", choices=vector_index.QUANTIZATION_DTYPES, default=None,
+                            help="要比較的格式（可重複指定，預設全部）")
+
+    def handle(self, *args, **options):
+        if vector_index.np is None:
+            self.stderr.write(self.style.ERROR("未安裝 numpy，無法量測向量索引。"))
+            return
+
+        path = options["path"] or vector_index.snapshot_path()
+        if not path or not vector_index.NumpyVectorIndex.snapshot_exists(path):
+            self.stderr.write(self.style.ERROR("找不到向量索引快照，請先執行 build_vector_snapshot 或以 --path 指定。"))
+            return
+
+        rerank = options["rerank"] if options["rerank"] is not None else vector_index.rerank_candidates()
+        try:
+            index = vector_index.NumpyVectorIndex.load(path, dtype="float32")
+            report = vector_index.recall_report(
+                index,
+                dtypes=options["dtype"] or vector_index.QUANTIZATION_DTYPES,
+                k=options["k"],
+                samples=options["samples"],
+                rerank_candidates=rerank,
+            )
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"量測失敗：{e}"))
+            return
+
+        self.stdout.write(f"{path}: {len(index)} 篇文章，dim={index.dim}，recall@{options['k']}")
+        for row in report:
+            label = row["dtype"] + (f" + float32 rerank {row['rerank']}" if row["rerank"] else "")
+            self.stdout.write(
+                f"  {label:<28} recall={row['recall']:.4f}  "
+                f"{row['bytes'] / 1024 / 1024:8.2f} MiB（{row['bytes_per_vector']:.0f} B/篇，{row['compression']:.1f}x）  "
+                f"{row['query_ms']:.2f} ms/query"
+            )
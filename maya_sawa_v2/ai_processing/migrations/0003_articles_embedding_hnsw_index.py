@@ -0,0 +1,50 @@
+from django.db import migrations
+
+# articles 表由外部匯入流程維護（見 sql/db.sql），這裡只在 PostgreSQL 且表與
+# pgvector (>= 0.5.0，支援 HNSW) 都存在時補上 ANN 索引；其他環境（如測試用 SQLite）略過。
+
+INDEX_NAME = "articles_embedding_hnsw"
+
+
+def _can_index(cursor):
+    cursor.execute("SELECT to_regclass('articles') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return False
+    cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+    row = cursor.fetchone()
+    if not row:
+        return False
+    major, minor = (int(x) for x in row[0].split(".")[:2])
+    return (major, minor) >= (0, 5)
+
+
+def create_hnsw_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        if not _can_index(cursor):
+            return
+        cursor.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDEX_NAME} ON articles "
+            "USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)"
+        )
+
+
+def drop_hnsw_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}")
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY 不能在交易中執行
+    atomic = False
+
+    dependencies = [
+        ("maya_sawa_v2_ai_processing", "0002_processingtask_knowledge_citations_and_more"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_hnsw_index, drop_hnsw_index),
+    ]
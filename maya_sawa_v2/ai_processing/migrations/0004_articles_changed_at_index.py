@@ -0,0 +1,42 @@
+from django.db import migrations
+
+# 增量索引同步以 (changed_at, id) 做 keyset 分頁（見 km_sources/index_sync.py），
+# 這個運算式索引讓「watermark 之後的變更」只掃描變更列。articles 表不存在時略過。
+
+INDEX_NAME = "articles_changed_at_index"
+CHANGED_AT_SQL = (
+    "GREATEST(COALESCE(updated_at, created_at, file_date), "
+    "COALESCE(deleted_at, '-infinity'::timestamp))"
+)
+
+
+def create_changed_at_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('articles') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return
+        cursor.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDEX_NAME} ON articles (({CHANGED_AT_SQL}), id)"
+        )
+
+
+def drop_changed_at_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}")
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY 不能在交易中執行
+    atomic = False
+
+    dependencies = [
+        ("maya_sawa_v2_ai_processing", "0003_articles_embedding_hnsw_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_changed_at_index, drop_changed_at_index),
+    ]
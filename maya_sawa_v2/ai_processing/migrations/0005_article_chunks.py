@@ -0,0 +1,76 @@
+from django.db import migrations
+
+# 段落級檢索的 article_chunks 表（見 km_sources/chunking.py 與 sql/db.sql）。
+# 與 articles 相同由外部資料庫維護：只在 PostgreSQL、articles 表與 pgvector 都存在時建立；
+# trigram 索引需要 pg_trgm，HNSW 索引需要 pgvector >= 0.5.0，缺少時略過該索引。
+
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS article_chunks (
+  id BIGSERIAL PRIMARY KEY,
+  article_id BIGINT NOT NULL REFERENCES articles (id) ON DELETE CASCADE,
+  chunk_index INTEGER NOT NULL,
+  heading TEXT NOT NULL DEFAULT '',
+  content TEXT NOT NULL,
+  content_hash VARCHAR(40) NOT NULL,
+  start_offset INTEGER NOT NULL DEFAULT 0,
+  token_count INTEGER NOT NULL DEFAULT 0,
+  created_at TIMESTAMP NULL,
+  updated_at TIMESTAMP NULL,
+  embedding vector(1536)
+)
+"""
+
+
+def _extension_version(cursor, name):
+    cursor.execute("SELECT extversion FROM pg_extension WHERE extname = %s", [name])
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return tuple(int(x) for x in row[0].split(".")[:2])
+
+
+def create_article_chunks(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('articles') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return
+        vector_version = _extension_version(cursor, "vector")
+        if vector_version is None:
+            return
+        cursor.execute(CREATE_TABLE_SQL)
+        cursor.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS article_chunks_article_index "
+            "ON article_chunks (article_id, chunk_index)"
+        )
+        if _extension_version(cursor, "pg_trgm") is not None:
+            cursor.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_article_chunks_content_trgm "
+                "ON article_chunks USING GIN (content gin_trgm_ops)"
+            )
+        if vector_version >= (0, 5):
+            cursor.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS article_chunks_embedding_hnsw ON article_chunks "
+                "USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)"
+            )
+
+
+def drop_article_chunks(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS article_chunks")
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY 不能在交易中執行
+    atomic = False
+
+    dependencies = [
+        ("maya_sawa_v2_ai_processing", "0004_articles_changed_at_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_article_chunks, drop_article_chunks),
+    ]
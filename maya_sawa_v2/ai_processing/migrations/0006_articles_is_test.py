@@ -0,0 +1,77 @@
+from django.db import migrations
+
+# 測試文章改由 articles.is_test 產生欄位標記（與 km_sources.index_sync.is_test_path 相同規則），
+# 檢索以 NOT is_test 過濾，取代無法使用索引的 NOT LIKE '%test%'；既有的向量 / trigram 索引
+# 改建為只涵蓋正式文章的部分索引。articles 表不存在時略過。
+#
+# 注意：ADD COLUMN ... GENERATED ALWAYS AS ... STORED 會在 ACCESS EXCLUSIVE 鎖下重寫整張 articles 表，
+# 期間檢索與寫入全部等待（時間與表大小成正比），須在維護時段執行。之後的索引替換使用
+# CREATE / DROP INDEX CONCURRENTLY（先建新索引再替換），這一步才不阻塞檢索。
+
+ADD_COLUMN_SQL = (
+    "ALTER TABLE articles ADD COLUMN IF NOT EXISTS is_test BOOLEAN "
+    "GENERATED ALWAYS AS (lower(file_path) LIKE '%test%') STORED"
+)
+PREDICATE = "WHERE (NOT is_test)"
+
+
+def _search_indexes(cursor, partial):
+    """articles 上的 embedding ANN 與 content trigram 索引：[(name, definition)]"""
+    cursor.execute(
+        """
+        SELECT c.relname, pg_get_indexdef(c.oid)
+        FROM pg_index idx
+        JOIN pg_class c ON c.oid = idx.indexrelid
+        WHERE idx.indrelid = 'articles'::regclass
+          AND (pg_get_indexdef(c.oid) ILIKE '%%(embedding%%' OR pg_get_indexdef(c.oid) ILIKE '%%gin_trgm_ops%%')
+          AND (idx.indpred IS NOT NULL) = %s
+        """,
+        [partial],
+    )
+    return cursor.fetchall()
+
+
+def _swap_index(cursor, name, definition):
+    """以新定義建立暫存索引後替換同名索引"""
+    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}_swap")
+    cursor.execute(definition.replace(f"INDEX {name} ON", f"INDEX CONCURRENTLY {name}_swap ON", 1))
+    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cursor.execute(f"ALTER INDEX {name}_swap RENAME TO {name}")
+
+
+def add_is_test(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('articles') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return
+        cursor.execute(ADD_COLUMN_SQL)
+        for name, definition in _search_indexes(cursor, partial=False):
+            _swap_index(cursor, name, f"{definition} {PREDICATE}")
+
+
+def remove_is_test(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('articles') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return
+        for name, definition in _search_indexes(cursor, partial=True):
+            if definition.endswith(PREDICATE):
+                _swap_index(cursor, name, definition[: -len(PREDICATE)].rstrip())
+        cursor.execute("ALTER TABLE articles DROP COLUMN IF EXISTS is_test")
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY 不能在交易中執行
+    atomic = False
+
+    dependencies = [
+        ("maya_sawa_v2_ai_processing", "0005_article_chunks"),
+    ]
+
+    operations = [
+        migrations.RunPython(add_is_test, remove_is_test),
+    ]
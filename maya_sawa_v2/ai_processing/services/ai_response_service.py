@@ -2,8 +2,10 @@ from __future__ import annotations
 
 import time
 import logging
-from typing import Dict, Any, Optional, List
+from contextlib import aclosing
+from typing import Dict, Any, AsyncIterator, Iterator, Optional, List, Tuple
 
+from asgiref.sync import sync_to_async
 from django.utils import timezone
 
 from maya_sawa_v2.conversations.models import Conversation, Message
@@ -105,8 +107,8 @@ class AIResponseService:
 
         return response
 
-    def process_sync(self, user_message: Message, ai_model: AIModel, knowledge_context: Optional[str] = None) -> str:
-        start_time = time.time()
+    def _prepare_sync(self, user_message: Message, knowledge_context: Optional[str]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Classify the conversation and build the provider context for a direct (non-Celery) reply."""
         conversation = user_message.conversation
 
         classification_result = self.conversation_service.classify_and_update(
@@ -121,7 +123,11 @@ class AIResponseService:
         if knowledge_context:
             context_extra["knowledge_context"] = knowledge_context
 
-        context = self.build_context(conversation, context_extra)
+        return classification_result, self.build_context(conversation, context_extra)
+
+    def process_sync(self, user_message: Message, ai_model: AIModel, knowledge_context: Optional[str] = None) -> str:
+        start_time = time.time()
+        classification_result, context = self._prepare_sync(user_message, knowledge_context)
 
         provider = get_ai_provider(ai_model.provider, ai_model.config)
         response = provider.generate_response(user_message.content, context)
@@ -129,7 +135,31 @@ class AIResponseService:
         processing_time = time.time() - start_time
 
         Message.objects.create(
-            conversation=conversation,
+            conversation=user_message.conversation,
+            message_type="ai",
+            content=response,
+            metadata={
+                "ai_model": ai_model.name,
+                "provider": ai_model.provider,
+                "processing_time": processing_time,
+                "classification_result": classification_result,
+            },
+        )
+
+        return response
+
+    async def aprocess_sync(self, user_message: Message, ai_model: AIModel, knowledge_context: Optional[str] = None) -> str:
+        """Async counterpart of process_sync: ORM work runs through sync_to_async, the provider call is awaited."""
+        start_time = time.time()
+        classification_result, context = await sync_to_async(self._prepare_sync)(user_message, knowledge_context)
+
+        provider = get_ai_provider(ai_model.provider, ai_model.config)
+        response = await provider.agenerate_response(user_message.content, context)
+
+        processing_time = time.time() - start_time
+
+        await Message.objects.acreate(
+            conversation_id=user_message.conversation_id,
             message_type="ai",
             content=response,
             metadata={
@@ -142,4 +172,96 @@ class AIResponseService:
 
         return response
 
+    def process_stream(
+        self,
+        user_message: Message,
+        ai_model: AIModel,
+        knowledge_context: Optional[str] = None,
+    ) -> Iterator[Tuple[str, Any]]:
+        """Stream the reply as ("delta", text) events, then persist it and yield ("done", summary)."""
+        start_time = time.time()
+        classification_result, context = self._prepare_sync(user_message, knowledge_context)
 
+        provider = get_ai_provider(ai_model.provider, ai_model.config)
+        parts: List[str] = []
+        first_token_time: Optional[float] = None
+        for delta in provider.generate_stream(user_message.content, context):
+            if not delta:
+                continue
+            if first_token_time is None:
+                first_token_time = time.time() - start_time
+            parts.append(delta)
+            yield "delta", delta
+
+        response = "".join(parts)
+        processing_time = time.time() - start_time
+
+        message = Message.objects.create(
+            conversation=user_message.conversation,
+            message_type="ai",
+            content=response,
+            metadata=self._stream_metadata(ai_model, processing_time, first_token_time, classification_result),
+        )
+
+        yield "done", {
+            "message_id": message.id,
+            "response": response,
+            "processing_time": processing_time,
+            "first_token_time": first_token_time,
+        }
+
+    async def aprocess_stream(
+        self,
+        user_message: Message,
+        ai_model: AIModel,
+        knowledge_context: Optional[str] = None,
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """Async counterpart of process_stream: ORM work runs through sync_to_async, deltas come from agenerate_stream."""
+        start_time = time.time()
+        classification_result, context = await sync_to_async(self._prepare_sync)(user_message, knowledge_context)
+
+        provider = get_ai_provider(ai_model.provider, ai_model.config)
+        parts: List[str] = []
+        first_token_time: Optional[float] = None
+        async with aclosing(provider.agenerate_stream(user_message.content, context)) as stream:
+            async for delta in stream:
+                if not delta:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.time() - start_time
+                parts.append(delta)
+                yield "delta", delta
+
+        response = "".join(parts)
+        processing_time = time.time() - start_time
+
+        message = await Message.objects.acreate(
+            conversation_id=user_message.conversation_id,
+            message_type="ai",
+            content=response,
+            metadata=self._stream_metadata(ai_model, processing_time, first_token_time, classification_result),
+        )
+
+        yield "done", {
+            "message_id": message.id,
+            "response": response,
+            "processing_time": processing_time,
+            "first_token_time": first_token_time,
+        }
+
+    @staticmethod
+    def _stream_metadata(
+        ai_model: AIModel,
+        processing_time: float,
+        first_token_time: Optional[float],
+        classification_result: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        """Metadata stored on a streamed AI message."""
+        return {
+            "ai_model": ai_model.name,
+            "provider": ai_model.provider,
+            "processing_time": processing_time,
+            "first_token_time": first_token_time,
+            "streamed": True,
+            "classification_result": classification_result,
+        }
@@ -0,0 +1,35 @@
+"""
+AI 處理相關信號
+"""
+
+import logging
+
+from django.dispatch import Signal, receiver
+
+logger = logging.getLogger(__name__)
+
+# 程序內文章索引（向量索引等）套用增量同步並發布新版本時發送
+# 參數: version, upserts, deletes, full（完整重建）
+km_index_published = Signal()
+
+
+@receiver(km_index_published)
+def invalidate_km_results_on_sync(sender, upserts=0, deletes=0, full=False, **kwargs):
+    """增量同步發現文章變更時調高語料版本（啟動時的完整重建不代表文章有變更）"""
+    if not full and (upserts or deletes):
+        from maya_sawa_v2.ai_processing.km_sources.result_cache import bump_corpus_version
+        bump_corpus_version('index_sync')
+
+
+try:
+    from celery.signals import worker_process_init
+
+    @worker_process_init.connect
+    def warm_km_sources(**kwargs):
+        """Celery worker 子程序啟動時預熱知識庫註冊表"""
+        from django.conf import settings
+        if getattr(settings, 'KM_WARM_ON_START', True):
+            from maya_sawa_v2.ai_processing.km_sources.registry import warm_km_manager
+            warm_km_manager(background=True)
+except ImportError:
+    pass
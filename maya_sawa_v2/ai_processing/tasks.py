@@ -1,5 +1,7 @@
+import os
 import time
 import logging
+from contextlib import aclosing
 from celery import shared_task
 from .models import ProcessingTask
 from maya_sawa_v2.ai_processing.services.ai_response_service import AIResponseService
@@ -55,6 +57,36 @@ def process_ai_response(self, task_id):
         raise e
 
 
+@shared_task(bind=True, queue='maya_v2', ignore_result=False)
+def backfill_article_embeddings(self, limit=None, batch_size=None):
+    """補齊 articles 缺少的 embedding，並重新切分變更文章的段落、補齊段落 embedding
+    （由 beat 排程觸發；articles 由外部系統寫入，沒有可掛信號的寫入路徑）"""
+    from maya_sawa_v2.ai_processing.km_sources import backfill, chunking
+    from maya_sawa_v2.ai_processing.km_sources import db as km_db
+
+    if not km_db.is_configured():
+        return {'status': 'skipped', 'processed': 0}
+
+    limit = int(limit or os.getenv('EMBED_BACKFILL_LIMIT', '200'))
+    batch_size = int(batch_size or os.getenv('EMBED_BACKFILL_BATCH', '50'))
+
+    def report(processed, total):
+        self.update_state(state='PROGRESS', meta={'processed': processed, 'total': total})
+
+    with backfill.advisory_lock() as acquired:
+        if not acquired:
+            logger.info("embedding 補齊任務已在其他 worker 執行中，略過")
+            return {'status': 'skipped', 'processed': 0}
+        processed = backfill.backfill_missing_embeddings(limit=limit, batch_size=batch_size, progress=report)
+        chunks = {}
+        if chunking.enabled():
+            chunks = chunking.sync_article_chunks(limit=limit)
+            chunks['embedded'] = backfill.backfill_missing_embeddings(
+                limit=limit, batch_size=batch_size, progress=report, table='article_chunks')
+
+    return {'status': 'completed', 'processed': processed, 'chunks': chunks}
+
+
 def process_ai_response_sync(user_message, ai_model, knowledge_context: str | None = None):
     """同步處理AI回應，支援外部知識上下文"""
     try:
@@ -69,4 +101,36 @@ def process_ai_response_sync(user_message, ai_model, knowledge_context: str | No
         raise e
 
 
+async def aprocess_ai_response_sync(user_message, ai_model, knowledge_context: str | None = None):
+    """process_ai_response_sync 的非同步版本（ASGI 下等待模型回應時不佔用執行緒）"""
+    try:
+        service = AIResponseService()
+        return await service.aprocess_sync(user_message=user_message, ai_model=ai_model,
+                                           knowledge_context=knowledge_context)
+    except Exception as e:
+        logger.error(f"AI processing failed for message {user_message.id}: {str(e)}")
+        raise
 
+
+def process_ai_response_stream(user_message, ai_model, knowledge_context: str | None = None):
+    """串流處理AI回應：逐段產生 ("delta", 文字)，完成後保存訊息並產生 ("done", 摘要)"""
+    try:
+        service = AIResponseService()
+        yield from service.process_stream(user_message=user_message, ai_model=ai_model,
+                                          knowledge_context=knowledge_context)
+    except Exception as e:
+        logger.error(f"AI streaming failed for message {user_message.id}: {str(e)}")
+        raise
+
+
+async def aprocess_ai_response_stream(user_message, ai_model, knowledge_context: str | None = None):
+    """process_ai_response_stream 的非同步版本（ASGI / WebSocket 下等待模型串流時不佔用執行緒）"""
+    try:
+        service = AIResponseService()
+        async with aclosing(service.aprocess_stream(user_message=user_message, ai_model=ai_model,
+                                                    knowledge_context=knowledge_context)) as events:
+            async for event in events:
+                yield event
+    except Exception as e:
+        logger.error(f"AI streaming failed for message {user_message.id}: {str(e)}")
+        raise
@@ -0,0 +1,291 @@
+"""
+WebSocket 聊天協定（由 config/websocket.py 掛載）
+
+一條連線可同時進行多個問答，訊息皆為 JSON 文字訊框，以 id 區分各個問答：
+
+客戶端 → 伺服器
+- {"type": "auth", "token": "..."}：以 DRF Token 認證（交握時帶有效的 session cookie 則自動認證）
+- {"type": "ask", "id": "q1", "question": "...", "model_name": "gpt-4o-mini",
+   "session_id": "qa-...", "use_knowledge_base": true}：session_id 可省略（建立新會話）
+- {"type": "cancel", "id": "q1"}：取消進行中的問答（回答不保存）
+- {"type": "ping"}（舊版純文字 "ping" 仍回覆 "pong!"）
+
+伺服器 → 客戶端
+- ready / auth.ok / auth.error / pong / cancelled
+- 每個問答依序為 meta → citations → delta... → done（失敗時為 error），欄位同 ask-with-model/stream/
+
+每個問答是連線事件迴圈上的一個 asyncio task（astream_answer：等待檢索與模型串流時不佔用執行緒，
+ORM 呼叫在執行緒中進行）；取消問答即取消該 task。
+
+背壓：問答事件經過有上限的佇列；佇列滿時問答 task 會等待（連帶暫停讀取模型串流），
+超過 WS_SEND_TIMEOUT 秒仍無法送出則取消該問答。每條連線同時進行的問答數上限為 WS_MAX_INFLIGHT。
+控制 / 回覆訊框（ready、pong、cancelled、驗證錯誤等）走另一個有上限的佇列，由接收迴圈直接放入、
+不等待，並優先送出（cancelled 之後仍可能收到該問答已排入佇列的事件）；控制佇列也滿代表客戶端
+已不讀取訊息，直接關閉連線（1013），接收迴圈不會因送出而卡住。
+"""
+
+import asyncio
+import json
+import logging
+import os
+from contextlib import aclosing
+from http.cookies import SimpleCookie
+from importlib import import_module
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections
+
+from .services.qa_service import astream_answer, create_qa_session, find_ai_model
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = 1
+
+# 客戶端不讀取訊息時關閉連線（1013: try again later）
+SLOW_CLIENT_CLOSE_CODE = 1013
+
+
+class StreamCancelled(Exception):
+    """問答已取消（客戶端取消、連線中斷或送出逾時）"""
+
+
+class SlowClient(Exception):
+    """控制佇列已滿（客戶端未讀取訊息）"""
+
+
+class ChatSocket:
+    """單一 WebSocket 連線的聊天協定處理"""
+
+    def __init__(self, scope, receive, send, max_inflight: Optional[int] = None,
+                 queue_size: Optional[int] = None, send_timeout: Optional[float] = None):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.max_inflight = max_inflight or int(os.getenv('WS_MAX_INFLIGHT', '4'))
+        self.send_timeout = send_timeout if send_timeout is not None else float(os.getenv('WS_SEND_TIMEOUT', '30'))
+        queue_size = queue_size or int(os.getenv('WS_SEND_QUEUE', '256'))
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.control: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._pending = asyncio.Event()
+        self.asks: Dict[str, asyncio.Task] = {}
+        self.auth_required = getattr(settings, 'API_REQUIRE_AUTHENTICATION', False)
+        self.user = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def run(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        writer = None
+        slow_client = False
+        try:
+            while True:
+                event = await self.receive()
+
+                if event["type"] == "websocket.connect":
+                    await self.send({"type": "websocket.accept"})
+                    writer = asyncio.create_task(self._writer())
+                    self.user = await self._session_user()
+                    self.emit({'type': 'ready', 'protocol': PROTOCOL_VERSION,
+                               'authenticated': self.user is not None, 'auth_required': self.auth_required})
+
+                if event["type"] == "websocket.disconnect":
+                    break
+
+                if event["type"] == "websocket.receive":
+                    await self._dispatch(event.get("text"))
+        except SlowClient:
+            logger.warning("WebSocket 客戶端未讀取訊息（控制佇列已滿），關閉連線")
+            slow_client = True
+        finally:
+            for task in list(self.asks.values()):
+                task.cancel()
+            if writer is not None:
+                writer.cancel()
+        if slow_client:
+            try:
+                await asyncio.wait_for(self.send({"type": "websocket.close", "code": SLOW_CLIENT_CLOSE_CODE}),
+                                       self.send_timeout)
+            except Exception:
+                # 連線已無法寫入：結束 app 後由伺服器關閉
+                pass
+
+    async def _writer(self) -> None:
+        """依序送出訊框，控制訊框優先"""
+        while True:
+            if not self.control.empty():
+                text = self.control.get_nowait()
+            elif not self.outbox.empty():
+                text = self.outbox.get_nowait()
+            else:
+                await self._pending.wait()
+                self._pending.clear()
+                continue
+            await self.send({"type": "websocket.send", "text": text})
+
+    def _enqueue_control(self, text: str) -> None:
+        try:
+            self.control.put_nowait(text)
+        except asyncio.QueueFull:
+            raise SlowClient() from None
+        self._pending.set()
+
+    def emit(self, data: Dict[str, Any]) -> None:
+        """送出控制 / 回覆訊框（不等待）；控制佇列已滿時拋出 SlowClient"""
+        self._enqueue_control(json.dumps(data, ensure_ascii=False, default=str))
+
+    async def _dispatch(self, text: Optional[str]) -> None:
+        if text is None:
+            return
+        if text == "ping":
+            self._enqueue_control("pong!")
+            return
+        try:
+            message = json.loads(text)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            self.emit({'type': 'error', 'error': 'invalid message: expected a JSON object'})
+            return
+
+        kind = message.get('type')
+        if kind == 'ask':
+            await self._ask(message)
+        elif kind == 'cancel':
+            await self._cancel(message)
+        elif kind == 'auth':
+            await self._auth(message)
+        elif kind == 'ping':
+            self.emit({'type': 'pong'})
+        else:
+            self.emit({'type': 'error', 'id': message.get('id'), 'error': f'unknown message type: {kind}'})
+
+    # ========== 認證 ==========
+    async def _auth(self, message: Dict[str, Any]) -> None:
+        user = await sync_to_async(self._token_user)(str(message.get('token') or ''))
+        if user is None:
+            self.emit({'type': 'auth.error', 'error': 'invalid token'})
+            return
+        self.user = user
+        self.emit({'type': 'auth.ok', 'user_id': user.id})
+
+    @staticmethod
+    def _token_user(token: str):
+        if not token or not apps.is_installed('rest_framework.authtoken'):
+            return None
+        from rest_framework.authtoken.models import Token
+        found = Token.objects.select_related('user').filter(key=token).first()
+        return found.user if found and found.user.is_active else None
+
+    def _origin_allowed(self, headers: Dict[bytes, bytes]) -> bool:
+        """session cookie 只接受同源或 API_ALLOWED_ORIGINS 的連線（防止跨站 WebSocket 劫持）"""
+        origin = headers.get(b'origin', b'').decode('latin1')
+        if not origin:
+            return True
+        host = headers.get(b'host', b'').decode('latin1')
+        return origin in getattr(settings, 'API_ALLOWED_ORIGINS', []) or urlparse(origin).netloc == host
+
+    async def _session_user(self):
+        headers = dict(self.scope.get('headers') or [])
+        cookie = SimpleCookie()
+        cookie.load(headers.get(b'cookie', b'').decode('latin1'))
+        morsel = cookie.get(settings.SESSION_COOKIE_NAME)
+        if morsel is None or not self._origin_allowed(headers):
+            return None
+
+        def load():
+            from django.contrib.auth import get_user
+            session = import_module(settings.SESSION_ENGINE).SessionStore(morsel.value)
+            user = get_user(SimpleNamespace(session=session))
+            return user if user.is_authenticated else None
+
+        try:
+            return await sync_to_async(load)()
+        except Exception as e:
+            logger.warning("WebSocket session 認證失敗: %s", str(e))
+            return None
+
+    # ========== 問答 ==========
+    async def _ask(self, message: Dict[str, Any]) -> None:
+        ask_id = str(message.get('id') or '')
+        if not ask_id:
+            self.emit({'type': 'error', 'error': 'id is required'})
+            return
+        if ask_id in self.asks:
+            self.emit({'type': 'error', 'id': ask_id, 'error': 'duplicate id'})
+            return
+        if not message.get('question'):
+            self.emit({'type': 'error', 'id': ask_id, 'error': '問題內容不能為空'})
+            return
+        if self.auth_required and self.user is None:
+            self.emit({'type': 'error', 'id': ask_id, 'error': 'authentication required'})
+            return
+        if len(self.asks) >= self.max_inflight:
+            self.emit({'type': 'error', 'id': ask_id,
+                       'error': f'too many in-flight questions (max {self.max_inflight})'})
+            return
+
+        task = asyncio.create_task(self._run_ask(ask_id, message))
+        self.asks[ask_id] = task
+        task.add_done_callback(lambda _: self.asks.pop(ask_id, None))
+
+    async def _cancel(self, message: Dict[str, Any]) -> None:
+        ask_id = str(message.get('id') or '')
+        task = self.asks.get(ask_id)
+        if task is None:
+            self.emit({'type': 'error', 'id': ask_id, 'error': 'no such in-flight question'})
+            return
+        task.cancel()
+        self.emit({'type': 'cancelled', 'id': ask_id})
+
+    async def _push(self, data: Dict[str, Any]) -> None:
+        """送出問答事件；佇列滿時等待（背壓），超過 send_timeout 則中止問答"""
+        try:
+            await asyncio.wait_for(self.outbox.put(json.dumps(data, ensure_ascii=False, default=str)),
+                                   self.send_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("WebSocket 客戶端 %s 秒內未讀取訊息，取消問答 %s", self.send_timeout, data.get('id'))
+            raise StreamCancelled() from None
+        self._pending.set()
+
+    @staticmethod
+    def _open_session(model_name: str, message: Dict[str, Any], user):
+        """查找模型並建立問答會話（ORM，於執行緒中執行）；找不到模型時回傳 None"""
+        close_old_connections()
+        try:
+            ai_model = find_ai_model(model_name)
+            if ai_model is None:
+                return None
+            question = str(message['question'])
+            return ai_model, create_qa_session(question, user=user, session_id=message.get('session_id'))
+        finally:
+            close_old_connections()
+
+    async def _run_ask(self, ask_id: str, message: Dict[str, Any]) -> None:
+        try:
+            model_name = message.get('model_name') or 'gpt-4o-mini'
+            opened = await sync_to_async(self._open_session)(model_name, message, self.user)
+            if opened is None:
+                await self._push({'type': 'error', 'id': ask_id, 'error': f'找不到指定的模型: {model_name}'})
+                return
+            ai_model, (session_id, conversation, user_message) = opened
+            # 取消時關閉 generator，回答不保存
+            async with aclosing(astream_answer(str(message['question']), ai_model, session_id, conversation,
+                                               user_message,
+                                               use_knowledge_base=message.get('use_knowledge_base', True))) as events:
+                async for event, data in events:
+                    await self._push(dict(data, type=event, id=ask_id))
+        except StreamCancelled:
+            logger.info("WebSocket 問答 %s 已取消", ask_id)
+        except asyncio.CancelledError:
+            logger.info("WebSocket 問答 %s 已取消", ask_id)
+            raise
+        except Exception as e:
+            logger.error(f"WebSocket 問答 {ask_id} 失敗: {str(e)}")
+            try:
+                await self._push({'type': 'error', 'id': ask_id, 'error': f'服務器錯誤: {str(e)}'})
+            except Exception:
+                pass
@@ -0,0 +1,24 @@
+import json
+from typing import Any
+
+from rest_framework.renderers import BaseRenderer
+
+
+def sse_event(event: str, data: Any) -> str:
+    """格式化一個 Server-Sent Events 事件（data 以 JSON 單行送出）"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+class EventStreamRenderer(BaseRenderer):
+    """text/event-stream：讓 Accept: text/event-stream 的請求通過內容協商。
+
+    串流內容由 StreamingHttpResponse 直接輸出；只有在串流開始前回傳的 Response
+    （如參數錯誤）會經過此 renderer，以單一 error 事件送出。
+    """
+
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return sse_event('error', data).encode(self.charset)
@@ -0,0 +1,321 @@
+"""Question-answering flow shared by the HTTP (ask-with-model) and WebSocket chat endpoints."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import uuid
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+
+from maya_sawa_v2.ai_processing.models import AIModel
+from maya_sawa_v2.ai_processing.tasks import (aprocess_ai_response_stream, aprocess_ai_response_sync,
+                                              process_ai_response_stream)
+from maya_sawa_v2.conversations.models import Conversation, Message
+
+from .chat_history_service import ChatHistoryService
+
+logger = logging.getLogger(__name__)
+
+
+def find_ai_model(model_name: str) -> Optional[AIModel]:
+    """依名稱或 model_id 查找啟用中的 AI 模型，找不到時回傳 None"""
+    try:
+        # 先嘗試通過名稱查找
+        return AIModel.objects.get(name__icontains=model_name, is_active=True)
+    except AIModel.DoesNotExist:
+        try:
+            # 再嘗試通過 model_id 查找
+            return AIModel.objects.get(model_id__icontains=model_name, is_active=True)
+        except AIModel.DoesNotExist:
+            return None
+
+
+def _default_user():
+    # 準備會話用戶（若無預設用戶，建立一個輕量帳號）
+    UserModel = get_user_model()
+    user = UserModel.objects.filter(id=1).first()
+    if not user:
+        user = UserModel.objects.filter(username='api_default').first()
+    if not user:
+        # 建立不可登入的預設用戶
+        user = UserModel.objects.create_user(username=f"api_default")
+    return user
+
+
+def create_qa_session(question: str, user=None, session_id: Optional[str] = None) -> Tuple[str, Conversation, Message]:
+    """建立（或延續 session_id 的）問答會話與用戶訊息，並寫入 Redis 聊天歷史
+
+    回傳 (session_id, conversation, user_message)。session_id 找不到或屬於其他用戶時建立新會話。
+    """
+    user = user or _default_user()
+    conversation = None
+    if session_id:
+        conversation = Conversation.objects.filter(session_id=session_id, user=user).first()
+
+    # 創建會話和用戶訊息
+    with transaction.atomic():
+        if conversation is None:
+            # 生成唯一的 session_id
+            session_id = f"qa-{uuid.uuid4().hex[:8]}"
+
+            # 創建會話
+            conversation = Conversation.objects.create(
+                user=user,
+                session_id=session_id,
+                conversation_type='general',
+                title=f"QA-{session_id}"
+            )
+            created = True
+        else:
+            created = False
+
+        # 創建用戶訊息
+        user_message = Message.objects.create(
+            conversation=conversation,
+            message_type='user',
+            content=question
+        )
+
+    # 寫入 Redis 聊天歷史
+    try:
+        ch = ChatHistoryService()
+        if created:
+            ch.set_meta(session_id, {
+                'user_id': str(user.id),
+                'conversation_id': str(conversation.id),
+                'created_at': str(int(timezone.now().timestamp()))
+            })
+        ch.append_message(session_id, 'user', question)
+    except Exception as _:
+        pass
+
+    return session_id, conversation, user_message
+
+
+def _knowledge_query(question: str, conversation: Conversation):
+    from maya_sawa_v2.ai_processing.km_sources.base import KMQuery
+
+    # 創建查詢對象（需要 user_id 與 conversation_id）
+    return KMQuery(
+        query=question,
+        user_id=conversation.user_id,
+        conversation_id=str(conversation.id),
+        domain='programming',  # 可根據實際分類結果覆蓋
+        metadata={
+            'km_source': 'programming_km',
+            'session_id': conversation.session_id
+        }
+    )
+
+
+def _format_knowledge(km_results) -> Tuple[str, List[Dict[str, Any]], bool]:
+    """檢索結果整理為 (knowledge_context, knowledge_citations, knowledge_found)"""
+    logger.info(f"知識庫搜索完成，找到 {len(km_results)} 個結果")
+    knowledge_context = ""
+    knowledge_citations = []
+
+    # 僅展示 Paprika 文章做為引用，且來源連結固定為 work URL
+    paprika_results = [r for r in km_results if (r.metadata or {}).get('source_type') == 'paprika_api']
+    knowledge_found = False
+    if paprika_results:
+        knowledge_context = "\n\n相關知識庫內容：\n"
+        knowledge_found = True
+        for i, result in enumerate(paprika_results[:3]):  # 只取前3個結果
+            meta = (result.metadata or {})
+            title = meta.get('title') or '參考文章'
+            file_path = meta.get('file_path') or ''
+            work_url = f"https://peoplesystem.tatdvsonorth.com/work/{file_path}" if file_path else "https://peoplesystem.tatdvsonorth.com/work/"
+            # 段落結果已依 token 上限切好，直接注入；其餘仍截取開頭
+            excerpt = result.content if meta.get('passage') else f"{result.content[:200]}..."
+            knowledge_context += f"{i+1}. {title} ({file_path})\n{excerpt}\n"
+
+            # 準備引用資訊（寫死為 work URL）
+            knowledge_citations.append({
+                'article_id': meta.get('article_id'),
+                'title': title,
+                'file_path': file_path,
+                'file_date': meta.get('file_date'),
+                'section': (meta.get('passage') or {}).get('heading'),
+                'source': result.source,
+                'source_url': work_url,
+                'provider': meta.get('provider') or 'Paprika'
+            })
+
+        logger.info(f"找到 {len(km_results)} 個知識庫結果")
+    else:
+        logger.info("未找到相關的知識庫內容")
+        # 當沒有找到知識庫內容時，添加明確的說明
+        knowledge_context = "\n\n注意：無法從知識庫中找到相關的資訊來回答您的問題。以下回答基於我的訓練資料。"
+
+    return knowledge_context, knowledge_citations, knowledge_found
+
+
+def search_knowledge(question: str, conversation: Conversation) -> Tuple[str, List[Dict[str, Any]], bool]:
+    """搜索知識庫，回傳 (knowledge_context, knowledge_citations, knowledge_found)"""
+    try:
+        from maya_sawa_v2.ai_processing.km_sources.registry import get_km_manager
+
+        km_manager = get_km_manager()
+        logger.info(f"知識庫管理器可用源: {km_manager.list_sources()}")
+
+        return _format_knowledge(km_manager.search_all_suitable(_knowledge_query(question, conversation)))
+    except Exception as e:
+        logger.error(f"知識庫搜索失敗: {str(e)}")
+        return "", [], False
+
+
+async def asearch_knowledge(question: str, conversation: Conversation) -> Tuple[str, List[Dict[str, Any]], bool]:
+    """search_knowledge 的非同步版本：在目前的事件迴圈上並行檢索各知識源"""
+    try:
+        from maya_sawa_v2.ai_processing.km_sources.registry import get_km_manager
+
+        km_manager = get_km_manager()
+        logger.info(f"知識庫管理器可用源: {km_manager.list_sources()}")
+
+        return _format_knowledge(await km_manager.asearch_all_suitable(_knowledge_query(question, conversation)))
+    except Exception as e:
+        logger.error(f"知識庫搜索失敗: {str(e)}")
+        return "", [], False
+
+
+def _meta_event(question: str, ai_model: AIModel, session_id: str, conversation: Conversation) -> Dict[str, Any]:
+    return {
+        'session_id': session_id,
+        'conversation_id': str(conversation.id),
+        'question': question,
+        'ai_model': {
+            'id': ai_model.id,
+            'name': ai_model.name,
+            'provider': ai_model.provider
+        },
+    }
+
+
+def _record_answer(session_id: str, response: str, ai_model: AIModel) -> None:
+    # 寫入 Redis 聊天歷史（AI 回應）
+    try:
+        ch = ChatHistoryService()
+        ch.append_message(session_id, 'assistant', response, {'model': ai_model.name})
+    except Exception:
+        pass
+
+
+async def aanswer(user_message: Message, ai_model: AIModel, session_id: str, knowledge_context: str = "") -> str:
+    """ask-with-model 同步回答的非同步版本：等待模型回應（不佔用執行緒），附上知識庫內容並寫入聊天歷史"""
+    response = await aprocess_ai_response_sync(user_message, ai_model, knowledge_context=knowledge_context)
+    # 如果有知識庫內容或沒有找到知識庫內容的說明，將其添加到回應中
+    if knowledge_context:
+        response = f"{response}\n\n{knowledge_context}"
+    await asyncio.to_thread(_record_answer, session_id, response, ai_model)
+    return response
+
+
+def _done_event(session_id: str, conversation: Conversation, response: str,
+                summary: Dict[str, Any], knowledge_found: bool) -> Dict[str, Any]:
+    return {
+        'session_id': session_id,
+        'conversation_id': str(conversation.id),
+        'status': 'completed',
+        'ai_response': response,
+        'message_id': summary.get('message_id'),
+        'processing_time': summary.get('processing_time'),
+        'first_token_time': summary.get('first_token_time'),
+        'knowledge_used': knowledge_found,
+        'message': 'AI回答已完成'
+    }
+
+
+def stream_answer(
+    question: str,
+    ai_model: AIModel,
+    session_id: str,
+    conversation: Conversation,
+    user_message: Message,
+    use_knowledge_base: bool = True,
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """逐步產生問答事件 (event, data)：meta → citations → delta... → done（失敗時為 error）
+
+    回答在 done 之前已保存；提前關閉此 generator（取消）則不保存回答。
+    """
+    yield 'meta', _meta_event(question, ai_model, session_id, conversation)
+
+    knowledge_context = ""
+    knowledge_citations = []
+    knowledge_found = False
+    if use_knowledge_base:
+        knowledge_context, knowledge_citations, knowledge_found = search_knowledge(question, conversation)
+    yield 'citations', {
+        'knowledge_used': knowledge_found,
+        'knowledge_citations': knowledge_citations,
+    }
+
+    try:
+        summary: Dict[str, Any] = {}
+        for kind, payload in process_ai_response_stream(user_message, ai_model, knowledge_context=knowledge_context):
+            if kind == 'delta':
+                yield 'delta', {'text': payload}
+            else:
+                summary = payload
+
+        response = summary.get('response', '')
+        # 與同步版本相同：知識庫內容附在回答之後
+        if knowledge_context:
+            yield 'delta', {'text': f"\n\n{knowledge_context}"}
+            response = f"{response}\n\n{knowledge_context}"
+
+        _record_answer(session_id, response, ai_model)
+        yield 'done', _done_event(session_id, conversation, response, summary, knowledge_found)
+    except Exception as e:
+        logger.error(f"AI 串流處理失敗: {str(e)}")
+        yield 'error', {'error': f'AI 處理失敗: {str(e)}'}
+
+
+async def astream_answer(
+    question: str,
+    ai_model: AIModel,
+    session_id: str,
+    conversation: Conversation,
+    user_message: Message,
+    use_knowledge_base: bool = True,
+) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """stream_answer 的非同步版本（ASGI 串流與 WebSocket 使用），事件與保存規則相同
+
+    等待檢索與模型串流時不佔用執行緒；ORM 與 Redis 呼叫改在執行緒中進行。
+    """
+    yield 'meta', _meta_event(question, ai_model, session_id, conversation)
+
+    knowledge_context = ""
+    knowledge_citations = []
+    knowledge_found = False
+    if use_knowledge_base:
+        knowledge_context, knowledge_citations, knowledge_found = await asearch_knowledge(question, conversation)
+    yield 'citations', {
+        'knowledge_used': knowledge_found,
+        'knowledge_citations': knowledge_citations,
+    }
+
+    try:
+        summary: Dict[str, Any] = {}
+        async with aclosing(aprocess_ai_response_stream(
+                user_message, ai_model, knowledge_context=knowledge_context)) as events:
+            async for kind, payload in events:
+                if kind == 'delta':
+                    yield 'delta', {'text': payload}
+                else:
+                    summary = payload
+
+        response = summary.get('response', '')
+        if knowledge_context:
+            yield 'delta', {'text': f"\n\n{knowledge_context}"}
+            response = f"{response}\n\n{knowledge_context}"
+
+        await asyncio.to_thread(_record_answer, session_id, response, ai_model)
+        yield 'done', _done_event(session_id, conversation, response, summary, knowledge_found)
+    except Exception as e:
+        logger.error(f"AI 串流處理失敗: {str(e)}")
+        yield 'error', {'error': f'AI 處理失敗: {str(e)}'}
@@ -4,6 +4,7 @@ from .views import (
     ConversationViewSet,
     AIModelViewSet,
     ask_with_model,
+    ask_with_model_stream,
     available_models,
     add_model,
     chat_history,
@@ -21,6 +22,7 @@ urlpatterns = [
     path('maya-v2/', include(conversation_router.urls)),
     path('maya-v2/', include(ai_model_router.urls)),
     path('maya-v2/ask-with-model/', ask_with_model, name='ask_with_model'),
+    path('maya-v2/ask-with-model/stream/', ask_with_model_stream, name='ask_with_model_stream'),
     path('maya-v2/available-models/', available_models, name='available_models'),
     path('maya-v2/add-model/', add_model, name='add_model'),
     # Chat history endpoints (v1 primary)
@@ -1,20 +1,27 @@
 from rest_framework import viewsets, status
-from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.decorators import action, api_view, permission_classes, renderer_classes
+from rest_framework.exceptions import MethodNotAllowed
 from rest_framework.permissions import AllowAny
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.views import APIView
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.utils import timezone
-from django.db import transaction
-from django.contrib.auth import get_user_model
-from maya_sawa_v2.conversations.models import Conversation, Message
+from django.views.decorators.csrf import csrf_exempt
+from maya_sawa_v2.conversations.models import Conversation
 from maya_sawa_v2.ai_processing.models import AIModel
 from maya_sawa_v2.ai_processing.utils import AIProviderConfig, ModelNameMapper
 from maya_sawa_v2.ai_processing.tasks import process_ai_response_sync
 from maya_sawa_v2.ai_processing.km_sources.manager import KMSourceManager
 from .serializers import ConversationSerializer, MessageSerializer, CreateMessageSerializer, AIModelSerializer, AIProviderConfigSerializer
 from .services import ChatHistoryService
+from .services.qa_service import (aanswer, asearch_knowledge, astream_answer, create_qa_session, find_ai_model,
+                                  search_knowledge, stream_answer)
 from .permissions import AllowAnyPermission
-import uuid
+from .renderers import EventStreamRenderer, sse_event
+from contextlib import aclosing
 import logging
 
 logger = logging.getLogger(__name__)
@@ -199,18 +206,78 @@ class AIModelViewSet(viewsets.ReadOnlyModelViewSet):
             return AIModel.objects.filter(is_active=True)
 
 
+def _model_not_found(model_name: str) -> Response:
+    # 返回所有可用模型的信息
+    available_models = AIModel.objects.filter(is_active=True).values('name', 'model_id', 'provider')
+    return Response({
+        'error': f'找不到指定的模型: {model_name}',
+        'available_models': list(available_models)
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _answered(question, ai_model, session_id, conversation, response, knowledge_found, knowledge_citations) -> Response:
+    return Response({
+        'session_id': session_id,
+        'conversation_id': str(conversation.id),
+        'question': question,
+        'ai_model': {
+            'id': ai_model.id,
+            'name': ai_model.name,
+            'provider': ai_model.provider
+        },
+        'status': 'completed',
+        'ai_response': response,
+        'knowledge_used': knowledge_found,
+        'knowledge_citations': knowledge_citations,
+        'message': 'AI回答已完成'
+    })
+
+
+def _queue_answer(question, ai_model, conversation, user_message, knowledge_context, knowledge_citations,
+                  knowledge_found) -> Response:
+    # 異步處理 - 使用 Celery 任務
+    try:
+        from maya_sawa_v2.ai_processing.tasks import process_ai_response
+        from maya_sawa_v2.ai_processing.models import ProcessingTask
+
+        # 創建處理任務
+        processing_task = ProcessingTask.objects.create(
+            conversation=conversation,
+            message=user_message,
+            ai_model=ai_model,
+            status='queued',
+            knowledge_context=knowledge_context,
+            knowledge_citations=knowledge_citations,
+            knowledge_used=knowledge_found
+        )
+
+        # 發送 Celery 任務
+        celery_task = process_ai_response.delay(processing_task.id)
+
+        return Response({
+            'task_id': str(celery_task.id),
+            'status': 'queued',
+            'message': 'Task has been queued for processing',
+            'conversation_id': str(conversation.id),
+            'question': question,
+            'ai_model': {
+                'id': ai_model.id,
+                'name': ai_model.name,
+                'provider': ai_model.provider
+            }
+        })
+
+    except Exception as e:
+        logger.error(f"異步處理失敗: {str(e)}")
+        return Response({
+            'error': f'異步處理失敗: {str(e)}'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
-def ask_with_model(request):
-    """
-    使用指定語言模型進行對話，並整合知識庫
-
-    參數:
-    - question: 問題內容
-    - model_name: 語言模型名稱 (例如: gpt-4.1-nano, gpt-4o-mini)
-    - sync: 是否同步處理 (預設: true)
-    - use_knowledge_base: 是否使用知識庫 (預設: true)
-    """
+def _ask_with_model(request):
+    """ask-with-model 的同步版本（WSGI）：檢索與模型呼叫期間佔用一個執行緒"""
     try:
         question = request.data.get('question')
         model_name = request.data.get('model_name', 'gpt-4o-mini')
@@ -221,205 +288,189 @@ def ask_with_model(request):
             return Response({'error': '問題內容不能為空'}, status=status.HTTP_400_BAD_REQUEST)
 
         # 獲取指定的 AI 模型
+        ai_model = find_ai_model(model_name)
+        if ai_model is None:
+            return _model_not_found(model_name)
+
+        session_id, conversation, user_message = create_qa_session(question)
+
+        # 如果使用知識庫，先搜索相關知識
+        knowledge_context = ""
+        knowledge_citations = []
+        knowledge_found = False
+        if use_knowledge_base:
+            knowledge_context, knowledge_citations, knowledge_found = search_knowledge(question, conversation)
+
+        if not sync:
+            return _queue_answer(question, ai_model, conversation, user_message, knowledge_context,
+                                 knowledge_citations, knowledge_found)
+
         try:
-            # 先嘗試通過名稱查找
-            ai_model = AIModel.objects.get(name__icontains=model_name, is_active=True)
-        except AIModel.DoesNotExist:
+            # 同步處理
+            response = process_ai_response_sync(user_message, ai_model, knowledge_context=knowledge_context)
+
+            # 如果有知識庫內容或沒有找到知識庫內容的說明，將其添加到回應中
+            if knowledge_context:
+                response = f"{response}\n\n{knowledge_context}"
+
+            # 寫入 Redis 聊天歷史（AI 回應）
             try:
-                # 再嘗試通過 model_id 查找
-                ai_model = AIModel.objects.get(model_id__icontains=model_name, is_active=True)
-            except AIModel.DoesNotExist:
-                # 如果都找不到，返回所有可用模型的信息
-                available_models = AIModel.objects.filter(is_active=True).values('name', 'model_id', 'provider')
-                return Response({
-                    'error': f'找不到指定的模型: {model_name}',
-                    'available_models': list(available_models)
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-        # 準備會話用戶（若無預設用戶，建立一個輕量帳號）
-        UserModel = get_user_model()
-        user = UserModel.objects.filter(id=1).first()
-        if not user:
-            user = UserModel.objects.filter(username='api_default').first()
-        if not user:
-            # 建立不可登入的預設用戶
-            user = UserModel.objects.create_user(username=f"api_default")
-
-        # 創建會話和用戶訊息
-        with transaction.atomic():
-            # 生成唯一的 session_id
-            session_id = f"qa-{uuid.uuid4().hex[:8]}"
-
-            # 創建會話
-            conversation = Conversation.objects.create(
-                user=user,
-                session_id=session_id,
-                conversation_type='general',
-                title=f"QA-{session_id}"
-            )
-
-            # 創建用戶訊息
-            user_message = Message.objects.create(
-                conversation=conversation,
-                message_type='user',
-                content=question
-            )
-
-        # 寫入 Redis 聊天歷史
-        try:
-            ch = ChatHistoryService()
-            ch.set_meta(session_id, {
-                'user_id': str(user.id),
-                'conversation_id': str(conversation.id),
-                'created_at': str(int(timezone.now().timestamp()))
-            })
-            ch.append_message(session_id, 'user', question)
-        except Exception as _:
-            pass
+                ch = ChatHistoryService()
+                ch.append_message(session_id, 'assistant', response, {'model': ai_model.name})
+            except Exception:
+                pass
+
+            return _answered(question, ai_model, session_id, conversation, response, knowledge_found,
+                             knowledge_citations)
+
+        except Exception as e:
+            logger.error(f"AI 處理失敗: {str(e)}")
+            return Response({
+                'error': f'AI 處理失敗: {str(e)}'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    except Exception as e:
+        logger.error(f"API 錯誤: {str(e)}")
+        return Response({
+            'error': f'服務器錯誤: {str(e)}'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+async def _aask_with_model(request) -> Response:
+    """ask-with-model 的非同步版本（ASGI）：等待檢索與模型回應時不佔用執行緒，ORM 呼叫在執行緒中進行"""
+    try:
+        question = request.data.get('question')
+        model_name = request.data.get('model_name', 'gpt-4o-mini')
+        sync = request.data.get('sync', True)
+        use_knowledge_base = request.data.get('use_knowledge_base', True)
+
+        if not question:
+            return Response({'error': '問題內容不能為空'}, status=status.HTTP_400_BAD_REQUEST)
+
+        ai_model = await sync_to_async(find_ai_model)(model_name)
+        if ai_model is None:
+            return await sync_to_async(_model_not_found)(model_name)
+
+        session_id, conversation, user_message = await sync_to_async(create_qa_session)(question)
 
-                # 如果使用知識庫，先搜索相關知識
         knowledge_context = ""
         knowledge_citations = []
         knowledge_found = False
         if use_knowledge_base:
-            try:
-                from maya_sawa_v2.ai_processing.km_sources.manager import KMSourceManager
-                from maya_sawa_v2.ai_processing.km_sources.base import KMQuery
-
-                # 創建查詢對象（需要 user_id 與 conversation_id）
-                query = KMQuery(
-                    query=question,
-                    user_id=conversation.user_id,
-                    conversation_id=str(conversation.id),
-                    domain='programming',  # 可根據實際分類結果覆蓋
-                    metadata={
-                        'km_source': 'programming_km',
-                        'session_id': conversation.session_id
-                    }
-                )
+            knowledge_context, knowledge_citations, knowledge_found = await asearch_knowledge(question, conversation)
 
-                km_manager = KMSourceManager()
-                logger.info(f"知識庫管理器初始化完成，可用源: {km_manager.list_sources()}")
-
-                km_results = km_manager.search_all_suitable(query)
-                logger.info(f"知識庫搜索完成，找到 {len(km_results)} 個結果")
-
-                # 僅展示 Paprika 文章做為引用，且來源連結固定為 work URL
-                paprika_results = [r for r in km_results if (r.metadata or {}).get('source_type') == 'paprika_api']
-                knowledge_found = False
-                if paprika_results:
-                    knowledge_context = "\n\n相關知識庫內容：\n"
-                    knowledge_found = True
-                    for i, result in enumerate(paprika_results[:3]):  # 只取前3個結果
-                        meta = (result.metadata or {})
-                        title = meta.get('title') or '參考文章'
-                        file_path = meta.get('file_path') or ''
-                        work_url = f"https://peoplesystem.tatdvsonorth.com/work/{file_path}" if file_path else "https://peoplesystem.tatdvsonorth.com/work/"
-                        knowledge_context += f"{i+1}. {title} ({file_path})\n{result.content[:200]}...\n"
-
-                        # 準備引用資訊（寫死為 work URL）
-                        knowledge_citations.append({
-                            'article_id': meta.get('article_id'),
-                            'title': title,
-                            'file_path': file_path,
-                            'file_date': meta.get('file_date'),
-                            'source': result.source,
-                            'source_url': work_url,
-                            'provider': meta.get('provider') or 'Paprika'
-                        })
-
-                    logger.info(f"找到 {len(km_results)} 個知識庫結果")
-                else:
-                    logger.info("未找到相關的知識庫內容")
-                    # 當沒有找到知識庫內容時，添加明確的說明
-                    knowledge_context = "\n\n注意：無法從知識庫中找到相關的資訊來回答您的問題。以下回答基於我的訓練資料。"
+        if not sync:
+            return await sync_to_async(_queue_answer)(question, ai_model, conversation, user_message,
+                                                      knowledge_context, knowledge_citations, knowledge_found)
 
-            except Exception as e:
-                logger.error(f"知識庫搜索失敗: {str(e)}")
+        try:
+            response = await aanswer(user_message, ai_model, session_id, knowledge_context)
+            return _answered(question, ai_model, session_id, conversation, response, knowledge_found,
+                             knowledge_citations)
+        except Exception as e:
+            logger.error(f"AI 處理失敗: {str(e)}")
+            return Response({
+                'error': f'AI 處理失敗: {str(e)}'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # 處理 AI 回應
-        if sync:
-            try:
-                # 同步處理
-                response = process_ai_response_sync(user_message, ai_model, knowledge_context=knowledge_context)
-
-                # 如果有知識庫內容或沒有找到知識庫內容的說明，將其添加到回應中
-                if knowledge_context:
-                    response = f"{response}\n\n{knowledge_context}"
-
-                # 寫入 Redis 聊天歷史（AI 回應）
-                try:
-                    ch = ChatHistoryService()
-                    ch.append_message(session_id, 'assistant', response, {'model': ai_model.name})
-                except Exception:
-                    pass
-
-                return Response({
-                    'session_id': session_id,
-                    'conversation_id': str(conversation.id),
-                    'question': question,
-                    'ai_model': {
-                        'id': ai_model.id,
-                        'name': ai_model.name,
-                        'provider': ai_model.provider
-                    },
-                    'status': 'completed',
-                    'ai_response': response,
-                    'knowledge_used': knowledge_found,
-                    'knowledge_citations': knowledge_citations,
-                    'message': 'AI回答已完成'
-                })
+    except Exception as e:
+        logger.error(f"API 錯誤: {str(e)}")
+        return Response({
+            'error': f'服務器錯誤: {str(e)}'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            except Exception as e:
-                logger.error(f"AI 處理失敗: {str(e)}")
-                return Response({
-                    'error': f'AI 處理失敗: {str(e)}'
-                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        else:
-            # 異步處理 - 使用 Celery 任務
-            try:
-                from maya_sawa_v2.ai_processing.tasks import process_ai_response
-                from maya_sawa_v2.ai_processing.models import ProcessingTask
-
-                # 創建處理任務
-                processing_task = ProcessingTask.objects.create(
-                    conversation=conversation,
-                    message=user_message,
-                    ai_model=ai_model,
-                    status='queued',
-                    knowledge_context=knowledge_context,
-                    knowledge_citations=knowledge_citations,
-                    knowledge_used=knowledge_found
-                )
 
-                # 發送 Celery 任務
-                celery_task = process_ai_response.delay(processing_task.id)
-
-                return Response({
-                    'task_id': str(celery_task.id),
-                    'status': 'queued',
-                    'message': 'Task has been queued for processing',
-                    'conversation_id': str(conversation.id),
-                    'question': question,
-                    'ai_model': {
-                        'id': ai_model.id,
-                        'name': ai_model.name,
-                        'provider': ai_model.provider
-                    }
-                })
+class _AskWithModelAPI(APIView):
+    """ASGI 版本沿用的 DRF 設定（解析、認證、權限、節流與輸出格式與 _ask_with_model 相同）"""
+    permission_classes = [AllowAny]
 
-            except Exception as e:
-                logger.error(f"異步處理失敗: {str(e)}")
-                return Response({
-                    'error': f'異步處理失敗: {str(e)}'
-                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@csrf_exempt
+async def ask_with_model(request):
+    """
+    使用指定語言模型進行對話，並整合知識庫
+
+    參數:
+    - question: 問題內容
+    - model_name: 語言模型名稱 (例如: gpt-4.1-nano, gpt-4o-mini)
+    - sync: 是否同步處理 (預設: true)
+    - use_knowledge_base: 是否使用知識庫 (預設: true)
+
+    需要逐字顯示回答時改用 ask-with-model/stream/（Server-Sent Events）。
+    ASGI（uvicorn worker）下以 await 等待模型回應，同時處理的請求數不受執行緒數限制；
+    WSGI 下交給同步版本 _ask_with_model 處理。（@api_view 不支援 async view，因此以一般 Django view 分派）
+    """
+    if not isinstance(request, ASGIRequest):
+        return await sync_to_async(_ask_with_model)(request)
+
+    api = _AskWithModelAPI()
+    api.args, api.kwargs = (), {}
+    drf_request = api.initialize_request(request)
+    api.request = drf_request
+    api.headers = api.default_response_headers
+    try:
+        if request.method != 'POST':
+            raise MethodNotAllowed(request.method)
+        await sync_to_async(api.initial)(drf_request)
+        response = await _aask_with_model(drf_request)
+    except Exception as exc:
+        response = api.handle_exception(exc)
+    return api.finalize_response(drf_request, response)
+
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+def ask_with_model_stream(request):
+    """
+    ask-with-model 的 Server-Sent Events 版本：邊生成邊送出，縮短首字時間
+
+    參數同 ask-with-model（question、model_name、use_knowledge_base；一律同步生成）。
+    事件依序為：
+    - meta: session_id、conversation_id、question、ai_model
+    - citations: knowledge_used、knowledge_citations（知識庫檢索完成、開始生成前送出）
+    - delta: {"text": ...} 模型逐段輸出（最後附上知識庫內容，與 ask-with-model 的 ai_response 相同）
+    - done: 完整回答與 message_id、processing_time、first_token_time（回答已保存）
+    - error: 處理失敗
+    """
+    question = request.data.get('question')
+    model_name = request.data.get('model_name', 'gpt-4o-mini')
+    use_knowledge_base = request.data.get('use_knowledge_base', True)
+
+    if not question:
+        return Response({'error': '問題內容不能為空'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        ai_model = find_ai_model(model_name)
+        if ai_model is None:
+            return _model_not_found(model_name)
+        session_id, conversation, user_message = create_qa_session(question)
     except Exception as e:
         logger.error(f"API 錯誤: {str(e)}")
         return Response({
             'error': f'服務器錯誤: {str(e)}'
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def events():
+        for event, data in stream_answer(question, ai_model, session_id, conversation, user_message,
+                                         use_knowledge_base=use_knowledge_base):
+            yield sse_event(event, data)
+
+    async def aevents():
+        # 客戶端中斷時關閉 generator（回答不保存）
+        async with aclosing(astream_answer(question, ai_model, session_id, conversation, user_message,
+                                           use_knowledge_base=use_knowledge_base)) as answer:
+            async for event, data in answer:
+                yield sse_event(event, data)
+
+    # ASGI（uvicorn worker）會把同步迭代器整個讀完才送出，需改為非同步迭代器逐段送出
+    content = aevents() if isinstance(request._request, ASGIRequest) else events()
+    response = StreamingHttpResponse(content, content_type='text/event-stream; charset=utf-8')
+    # 關閉代理與瀏覽器的緩衝 / 快取，事件才會即時送達
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
@@ -1,4 +1,5 @@
 
+DROP TABLE IF EXISTS article_chunks;
 DROP TABLE IF EXISTS articles;
 
 CREATE TABLE articles (
@@ -9,15 +10,61 @@ CREATE TABLE articles (
   created_at TIMESTAMP NULL,
   updated_at TIMESTAMP NULL,
   deleted_at TIMESTAMP NULL,
-  embedding vector(1536)
+  embedding vector(1536),
+  -- 測試文章標記（與 km_sources.index_sync.is_test_path 同規則）；檢索以 NOT is_test 過濾並使用部分索引
+  is_test BOOLEAN GENERATED ALWAYS AS (lower(file_path) LIKE '%test%') STORED
 );
 
 -- 索引
 CREATE INDEX articles_file_date_index ON articles (file_date);
+-- 增量索引同步的 watermark（最後更新 / 刪除時間）
+CREATE INDEX articles_changed_at_index ON articles
+  ((GREATEST(COALESCE(updated_at, created_at, file_date), COALESCE(deleted_at, '-infinity'::timestamp))), id);
 
 -- 啟用擴充
 CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
--- 只對 content 建 trigram 索引（中文友好）
+-- 只對 content 建 trigram 索引（中文友好）；只涵蓋正式文章
 CREATE INDEX IF NOT EXISTS idx_articles_content_trgm
-  ON articles USING GIN (content gin_trgm_ops);
+  ON articles USING GIN (content gin_trgm_ops) WHERE NOT is_test;
+
+-- 向量 ANN 索引（pgvector >= 0.5.0）；重建或改用 IVFFlat 請用
+-- python manage.py manage_vector_index --method {hnsw,ivfflat} --rebuild
+-- 改用半精度索引（pgvector >= 0.7.0，索引約減半）請加上 --type halfvec 並設定 KM_PG_VECTOR_TYPE=halfvec
+CREATE EXTENSION IF NOT EXISTS vector;
+CREATE INDEX IF NOT EXISTS articles_embedding_hnsw
+  ON articles USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64) WHERE NOT is_test;
+
+-- 段落級檢索（km_sources/chunking.py）：依標題 / 段落切分、有 token 上限並前後重疊的段落，
+-- 各自有 embedding 與 trigram 索引；由 backfill_article_embeddings 排程切分並補齊 embedding
+CREATE TABLE IF NOT EXISTS article_chunks (
+  id BIGSERIAL PRIMARY KEY,
+  article_id BIGINT NOT NULL REFERENCES articles (id) ON DELETE CASCADE,
+  chunk_index INTEGER NOT NULL,
+  heading TEXT NOT NULL DEFAULT '',
+  content TEXT NOT NULL,
+  content_hash VARCHAR(40) NOT NULL,
+  start_offset INTEGER NOT NULL DEFAULT 0,
+  token_count INTEGER NOT NULL DEFAULT 0,
+  created_at TIMESTAMP NULL,
+  updated_at TIMESTAMP NULL,
+  embedding vector(1536)
+);
+CREATE INDEX IF NOT EXISTS article_chunks_article_index ON article_chunks (article_id, chunk_index);
+CREATE INDEX IF NOT EXISTS idx_article_chunks_content_trgm
+  ON article_chunks USING GIN (content gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS article_chunks_embedding_hnsw
+  ON article_chunks USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- embedding 重算的 checkpoint（km_sources/backfill.py 會自動建立）：
+-- python manage.py backfill_article_embeddings --force 中斷後從 last_id 繼續
+CREATE TABLE IF NOT EXISTS km_backfill_checkpoints (
+  job VARCHAR(200) PRIMARY KEY,
+  table_name VARCHAR(100) NOT NULL,
+  model VARCHAR(200) NOT NULL,
+  last_id BIGINT NOT NULL DEFAULT 0,
+  processed BIGINT NOT NULL DEFAULT 0,
+  started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  finished_at TIMESTAMP NULL
+);
@@ -3,18 +3,30 @@ AI 提供者單元測試
 測試不需要連資料庫的方法
 """
 
+import asyncio
+import json
+
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 from maya_sawa_v2.ai_processing.ai_providers import (
     AIProvider,
     OpenAIProvider,
     GeminiProvider,
     QwenProvider,
     MockProvider,
-    get_ai_provider
+    get_ai_provider,
+    provider_clients,
 )
 
 
+@pytest.fixture(autouse=True)
+def clear_provider_clients():
+    """每個測試使用全新的客戶端快取（避免沿用其他測試的 mock 客戶端）"""
+    provider_clients.clear()
+    yield
+    provider_clients.clear()
+
+
 class TestAIProvider:
     """AI 提供者抽象基類測試"""
 
@@ -136,6 +148,60 @@ class TestOpenAIProvider:
         assert any(msg['role'] == 'system' for msg in messages)
 
 
+class TestProviderClientRegistry:
+    """共用客戶端與連線池測試"""
+
+    @patch('openai.OpenAI')
+    def test_client_is_reused_across_providers_and_turns(self, mock_openai):
+        """測試相同設定的 provider 共用同一個客戶端，且只建立一次"""
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value.choices = [MagicMock()]
+        mock_openai.return_value = mock_client
+
+        for _ in range(3):
+            get_ai_provider('openai', {'api_key': 'test-key'}).generate_response("你好")
+
+        mock_openai.assert_called_once()
+        assert mock_client.chat.completions.create.call_count == 3
+        stats = provider_clients.stats()
+        assert stats['clients'] == {'openai': 1}
+        assert (stats['created'], stats['reused']) == (1, 2)
+
+    @patch('openai.OpenAI')
+    def test_clients_are_keyed_by_base_org_and_key(self, mock_openai):
+        """測試不同 api_base / organization / key 各自有客戶端，且共用同一個 HTTP 連線池"""
+        mock_openai.side_effect = lambda **kwargs: MagicMock(kwargs=kwargs)
+
+        a = provider_clients.openai('key-a')
+        b = provider_clients.openai('key-a', api_base='https://proxy.example.com/v1')
+        c = provider_clients.openai('key-a', organization='org-1')
+        d = provider_clients.openai('key-b')
+
+        assert len({id(a), id(b), id(c), id(d)}) == 4
+        assert provider_clients.openai('key-a', api_base='https://api.openai.com/v1') is a
+        assert b.kwargs['base_url'] == 'https://proxy.example.com/v1'
+        assert 'base_url' not in a.kwargs
+        assert a.kwargs['http_client'] is d.kwargs['http_client']
+
+    @patch('openai.OpenAI')
+    def test_proxy_env_is_not_mutated(self, mock_openai):
+        """測試建立客戶端時不修改 os.environ 的代理設定"""
+        import os
+        with patch.dict('os.environ', {'HTTPS_PROXY': 'http://proxy:3128'}):
+            provider_clients.openai('test-key')
+            assert os.environ['HTTPS_PROXY'] == 'http://proxy:3128'
+
+    def test_shared_http_pool_limits(self):
+        """測試共用連線池的 keep-alive 與上限設定"""
+        with patch.dict('os.environ', {'AI_HTTP_MAX_CONNECTIONS': '8', 'AI_HTTP_MAX_KEEPALIVE': '4'}):
+            provider_clients.openai('test-key')
+            stats = provider_clients.stats()
+
+        assert stats['http']['max_connections'] == 8
+        assert stats['http']['max_keepalive_connections'] == 4
+        assert stats['http']['connections'] == 0
+
+
 class TestGeminiProvider:
     """Gemini 提供者測試"""
 
@@ -177,6 +243,77 @@ class TestGeminiProvider:
         assert response == "AI 回應"
         mock_genai.configure.assert_called_once_with(api_key='test-key')
 
+    def test_gemini_history_is_built_in_one_call(self):
+        """測試多輪歷史以原生 history（user/model）與系統指令建立，每回合只呼叫一次 API"""
+        import sys
+        import types
+
+        calls = []
+
+        class StubChat:
+            def __init__(self, history):
+                self.history = history
+
+            def send_message(self, content, **kwargs):
+                calls.append(content)
+                return types.SimpleNamespace(text="AI 回應")
+
+        class StubModel:
+            def __init__(self, model_name, system_instruction=None):
+                self.model_name = model_name
+                self.system_instruction = system_instruction
+                self.chats = []
+
+            def start_chat(self, history=None):
+                self.chats.append(StubChat(history))
+                return self.chats[-1]
+
+        models = []
+        stub_genai = types.ModuleType('google.generativeai')
+        stub_genai.configure = lambda api_key=None: None
+
+        def generative_model(*args, **kwargs):
+            models.append(StubModel(*args, **kwargs))
+            return models[-1]
+
+        stub_genai.GenerativeModel = generative_model
+
+        history = []
+        for i in range(10):
+            history.append({'role': 'user', 'content': f'問題{i}'})
+            history.append({'role': 'assistant', 'content': f'回答{i}'})
+        context = {'conversation_history': history, 'system_prompt': '你是一個助手', 'knowledge_context': '文章內容'}
+
+        with patch.dict(sys.modules, {'google.generativeai': stub_genai}):
+            response = GeminiProvider(api_key='test-key', model='gemini-pro').generate_response("新問題", context)
+
+        assert response == "AI 回應"
+        assert calls == ["新問題"]
+        model = models[0]
+        assert model.model_name == 'gemini-pro'
+        assert model.system_instruction.startswith('你是一個助手')
+        assert '文章內容' in model.system_instruction
+        chat_history = model.chats[0].history
+        assert len(chat_history) == 20
+        assert chat_history[0] == {'role': 'user', 'parts': [{'text': '問題0'}]}
+        assert chat_history[1] == {'role': 'model', 'parts': [{'text': '回答0'}]}
+
+    def test_gemini_history_excludes_current_question(self):
+        """測試 conversation_history 已含本回合用戶訊息時不重複送出：history 結尾為上一回合的 model 回答"""
+        context = {'conversation_history': [
+            {'role': 'user', 'content': '問題0'},
+            {'role': 'assistant', 'content': '回答0'},
+            {'role': 'user', 'content': '新問題'},
+        ]}
+
+        history = GeminiProvider._build_history("新問題", context)
+
+        assert history[-1] == {'role': 'model', 'parts': [{'text': '回答0'}]}
+        assert [h['parts'][0]['text'] for h in history].count('新問題') == 0
+        assert OpenAIProvider._build_messages("新問題", context)[-2:] == [
+            {'role': 'assistant', 'content': '回答0'}, {'role': 'user', 'content': '新問題'}]
+        assert [m['content'] for m in QwenProvider._build_messages("新問題", context)].count('新問題') == 1
+
     def test_gemini_provider_no_api_key(self):
         """測試 GeminiProvider 沒有 API key"""
         provider = GeminiProvider(api_key=None)
@@ -232,6 +369,277 @@ class TestQwenProvider:
         assert "Qwen API key not found" in response
 
 
+class TestGenerateStream:
+    """串流生成測試"""
+
+    def test_mock_provider_stream_matches_response(self):
+        """測試 MockProvider 串流片段組合後等於完整回應"""
+        provider = MockProvider()
+        parts = list(provider.generate_stream("你好"))
+
+        assert len(parts) > 1
+        assert "".join(parts) == provider.generate_response("你好")
+
+    def test_default_stream_yields_full_response(self):
+        """測試未實作串流的提供者一次回傳完整回應"""
+        class EchoProvider(AIProvider):
+            def generate_response(self, message, context=None):
+                return f"echo:{message}"
+
+        assert list(EchoProvider().generate_stream("hi")) == ["echo:hi"]
+
+    @patch('openai.OpenAI')
+    def test_openai_stream_yields_deltas(self, mock_openai):
+        """測試 OpenAI 串流只回傳非空的 delta，並帶入 stream=True"""
+        def chunk(text):
+            c = MagicMock()
+            c.choices = [MagicMock()]
+            c.choices[0].delta.content = text
+            return c
+
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = iter([chunk("AI"), chunk(None), chunk(" 回應")])
+        mock_openai.return_value = mock_client
+
+        parts = list(OpenAIProvider(api_key='test-key').generate_stream("你好", {'system_prompt': '你是一個助手'}))
+
+        assert parts == ["AI", " 回應"]
+        kwargs = mock_client.chat.completions.create.call_args.kwargs
+        assert kwargs['stream'] is True
+        assert kwargs['messages'][0]['role'] == 'system'
+
+    def test_qwen_stream_yields_incremental_text(self):
+        """測試 Qwen 增量串流（內容可能是 [{'text': ...}] 列表）"""
+        import sys
+        mock_dashscope = MagicMock()
+
+        def response(content):
+            r = MagicMock(status_code=200)
+            r.output.choices = [MagicMock()]
+            r.output.choices[0].message.content = content
+            return r
+
+        mock_dashscope.MultiModalConversation.call.return_value = iter([response([{'text': 'AI'}]), response(' 回應')])
+        with patch.dict(sys.modules, {'dashscope': mock_dashscope}):
+            parts = list(QwenProvider(api_key='test-key').generate_stream("你好"))
+
+        assert parts == ["AI", " 回應"]
+        kwargs = mock_dashscope.MultiModalConversation.call.call_args.kwargs
+        assert kwargs['stream'] is True and kwargs['incremental_output'] is True
+
+    def test_stream_without_api_key(self):
+        """測試沒有 API key 時串流拋出例外（不把錯誤訊息當作回應內容）"""
+        with pytest.raises(ValueError, match="Google API key not found"):
+            list(GeminiProvider(api_key=None).generate_stream("你好"))
+        with pytest.raises(ValueError, match="Qwen API key not found"):
+            list(QwenProvider(api_key=None).generate_stream("你好"))
+
+    @patch('openai.OpenAI')
+    def test_stream_error_propagates_after_partial_output(self, mock_openai):
+        """測試串流中途失敗時拋出例外，已送出的片段保留"""
+        def chunks():
+            c = MagicMock()
+            c.choices = [MagicMock()]
+            c.choices[0].delta.content = "AI"
+            yield c
+            raise RuntimeError("connection reset")
+
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = chunks()
+        mock_openai.return_value = mock_client
+
+        stream = OpenAIProvider(api_key='test-key').generate_stream("你好")
+        assert next(stream) == "AI"
+        with pytest.raises(RuntimeError, match="connection reset"):
+            next(stream)
+
+
+class TestAsyncGenerate:
+    """非同步生成測試"""
+
+    def test_default_async_runs_sync_response(self):
+        """測試未實作非同步的提供者改在執行緒中呼叫 generate_response"""
+        class EchoProvider(AIProvider):
+            def generate_response(self, message, context=None):
+                return f"echo:{message}"
+
+        assert asyncio.run(EchoProvider().agenerate_response("hi")) == "echo:hi"
+
+    @patch('openai.AsyncOpenAI')
+    def test_openai_async_uses_shared_async_client(self, mock_async_openai):
+        """測試 OpenAI 非同步呼叫會 await AsyncOpenAI，同一 event loop 內共用客戶端"""
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = "AI 回應"
+        mock_client = MagicMock()
+        mock_client.chat.completions.create = AsyncMock(return_value=mock_response)
+        mock_async_openai.return_value = mock_client
+
+        async def main():
+            provider = OpenAIProvider(api_key='test-key')
+            responses = await asyncio.gather(*(provider.agenerate_response("你好") for _ in range(3)))
+            # event loop 結束後快取隨之釋放，需在 loop 內檢查
+            return responses, provider_clients.stats()['async_clients']
+
+        responses, async_clients = asyncio.run(main())
+        assert responses == ["AI 回應"] * 3
+        assert async_clients == {'openai': 1}
+        assert mock_async_openai.call_count == 1
+        assert 'http_client' in mock_async_openai.call_args.kwargs
+
+    def test_qwen_async_posts_to_dashscope(self):
+        """測試 Qwen 非同步呼叫以 httpx 直接送出 DashScope 請求"""
+        import httpx
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200, json={'output': {'choices': [
+                {'message': {'role': 'assistant', 'content': [{'text': 'AI 回應'}]}}]}})
+
+        async def main():
+            client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            with patch.object(provider_clients, 'async_http_client', return_value=client):
+                return await QwenProvider(api_key='test-key').agenerate_response("你好")
+
+        assert asyncio.run(main()) == "AI 回應"
+        body = json.loads(requests[0].content)
+        assert requests[0].url.path.endswith('/services/aigc/multimodal-generation/generation')
+        assert requests[0].headers['Authorization'] == 'Bearer test-key'
+        assert body['input']['messages'] == [{'role': 'user', 'content': [{'text': '你好'}]}]
+
+    def test_qwen_async_error_message(self):
+        """測試 DashScope 回傳錯誤時回覆錯誤字串"""
+        import httpx
+
+        async def main():
+            transport = httpx.MockTransport(lambda request: httpx.Response(401, json={'message': 'Invalid API-key'}))
+            client = httpx.AsyncClient(transport=transport)
+            with patch.object(provider_clients, 'async_http_client', return_value=client):
+                return await QwenProvider(api_key='bad-key').agenerate_response("你好")
+
+        assert "Invalid API-key" in asyncio.run(main())
+
+    def test_gemini_async_awaits_send_message_async(self):
+        """測試 Gemini 非同步呼叫使用 send_message_async"""
+        import sys
+        mock_genai = MagicMock()
+        mock_chat = MagicMock()
+        mock_chat.send_message_async = AsyncMock(return_value=MagicMock(text="AI 回應"))
+        mock_genai.GenerativeModel.return_value.start_chat.return_value = mock_chat
+
+        with patch.dict(sys.modules, {'google.generativeai': mock_genai}):
+            response = asyncio.run(GeminiProvider(api_key='test-key').agenerate_response("你好"))
+
+        assert response == "AI 回應"
+        mock_chat.send_message_async.assert_awaited_with("你好")
+        mock_chat.send_message.assert_not_called()
+
+    def test_async_without_api_key(self):
+        """測試沒有 API key 時非同步呼叫回傳固定錯誤字串"""
+        assert asyncio.run(GeminiProvider(api_key=None).agenerate_response("你好")) == "Google API key not found"
+        assert asyncio.run(QwenProvider(api_key=None).agenerate_response("你好")) == "Qwen API key not found"
+
+    def test_openai_async_stream(self):
+        """測試 OpenAI 非同步串流以 async for 逐段回傳"""
+        def chunk(text):
+            item = MagicMock()
+            item.choices = [MagicMock()]
+            item.choices[0].delta.content = text
+            return item
+
+        async def stream():
+            for text in ["你", None, "好"]:
+                yield chunk(text)
+
+        mock_client = MagicMock()
+        mock_client.chat.completions.create = AsyncMock(return_value=stream())
+
+        async def main():
+            with patch.object(provider_clients, 'async_openai', return_value=mock_client):
+                return [d async for d in OpenAIProvider(api_key='test-key').agenerate_stream("你好")]
+
+        assert asyncio.run(main()) == ["你", "好"]
+        assert mock_client.chat.completions.create.await_args.kwargs['stream'] is True
+
+    def test_qwen_async_stream_reads_sse(self):
+        """測試 Qwen 非同步串流讀取 DashScope SSE 增量輸出"""
+        import httpx
+        requests = []
+
+        def event(text):
+            return 'data:' + json.dumps({'output': {'choices': [
+                {'message': {'role': 'assistant', 'content': [{'text': text}]}}]}}, ensure_ascii=False)
+
+        def handler(request):
+            requests.append(request)
+            body = "\n\n".join(['id:1', event('你'), 'id:2', event('好')]) + "\n\n"
+            return httpx.Response(200, content=body.encode('utf-8'))
+
+        async def main():
+            client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            with patch.object(provider_clients, 'async_http_client', return_value=client):
+                return [d async for d in QwenProvider(api_key='test-key').agenerate_stream("你好")]
+
+        assert asyncio.run(main()) == ["你", "好"]
+        assert requests[0].headers['X-DashScope-SSE'] == 'enable'
+        assert json.loads(requests[0].content)['parameters']['incremental_output'] is True
+
+    def test_async_stream_without_api_key_raises(self):
+        """測試沒有 API key 時非同步串流拋出例外（不當作回應內容）"""
+        async def main(provider):
+            return [d async for d in provider.agenerate_stream("你好")]
+
+        with pytest.raises(ValueError):
+            asyncio.run(main(QwenProvider(api_key=None)))
+        with pytest.raises(ValueError):
+            asyncio.run(main(GeminiProvider(api_key=None)))
+
+    def test_aprocess_sync_awaits_provider(self):
+        """測試 AIResponseService.aprocess_sync 等待 agenerate_response 並保存回應"""
+        from maya_sawa_v2.ai_processing.services import ai_response_service as module
+
+        service = module.AIResponseService()
+        user_message = MagicMock(content="你好", conversation_id=3)
+        ai_model = MagicMock(provider='openai', config={})
+        ai_model.name = 'GPT'
+        provider = MagicMock()
+        provider.agenerate_response = AsyncMock(return_value='答案')
+
+        with patch.object(service, '_prepare_sync', return_value=({}, {'system_prompt': 's'})), \
+                patch.object(module, 'get_ai_provider', return_value=provider), \
+                patch.object(module.Message.objects, 'acreate', new_callable=AsyncMock) as acreate:
+            assert asyncio.run(service.aprocess_sync(user_message, ai_model)) == '答案'
+
+        provider.agenerate_response.assert_awaited_once_with("你好", {'system_prompt': 's'})
+        provider.generate_response.assert_not_called()
+        assert acreate.await_args.kwargs['conversation_id'] == 3
+        assert acreate.await_args.kwargs['content'] == '答案'
+
+    def test_aprocess_stream_awaits_provider(self):
+        """測試 AIResponseService.aprocess_stream 逐段產生非同步串流並保存回應"""
+        from maya_sawa_v2.ai_processing.services import ai_response_service as module
+
+        service = module.AIResponseService()
+        user_message = MagicMock(content="你好", conversation_id=3)
+        ai_model = MagicMock(provider='mock', config={})
+        ai_model.name = 'Mock'
+
+        async def main():
+            return [event async for event in service.aprocess_stream(user_message, ai_model)]
+
+        with patch.object(service, '_prepare_sync', return_value=({}, {})), \
+                patch.object(module.Message.objects, 'acreate', new_callable=AsyncMock) as acreate:
+            events = asyncio.run(main())
+
+        expected = MockProvider().generate_response("你好")
+        assert [payload for kind, payload in events if kind == 'delta'] == list(MockProvider().generate_stream("你好"))
+        assert events[-1][0] == 'done' and events[-1][1]['response'] == expected
+        assert acreate.await_args.kwargs['content'] == expected
+        assert acreate.await_args.kwargs['conversation_id'] == 3
+        assert acreate.await_args.kwargs['metadata']['streamed'] is True
+
+
 class TestGetAIProvider:
     """AI 提供者工廠函數測試"""
 
@@ -0,0 +1,188 @@
+"""
+API 視圖單元測試
+測試不需要連資料庫的方法
+"""
+
+import asyncio
+import json
+from types import SimpleNamespace
+from unittest.mock import patch, AsyncMock, MagicMock
+
+from django.test import AsyncRequestFactory
+from rest_framework.test import APIRequestFactory
+
+from maya_sawa_v2.api import views
+from maya_sawa_v2.api.services import qa_service
+
+
+def _parse_events(response):
+    """把 SSE 串流解析為 [(event, data), ...]"""
+    body = b"".join(response.streaming_content).decode('utf-8')
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+class TestAskWithModel:
+    """ask-with-model（非串流）測試"""
+
+    def test_asgi_awaits_provider_without_thread(self):
+        """測試 ASGI 下以 await 取得回答（不經由同步的 process_ai_response_sync）"""
+        ai_model = SimpleNamespace(id=1, name='GPT-4o Mini', provider='openai')
+        conversation = SimpleNamespace(id='c1')
+        answer = AsyncMock(return_value='Hello')
+        chat_history = MagicMock()
+        request = AsyncRequestFactory().post('/maya-v2/ask-with-model/',
+                                             {'question': 'hi', 'use_knowledge_base': True},
+                                             content_type='application/json')
+
+        with patch.object(views, 'find_ai_model', return_value=ai_model), \
+                patch.object(views, 'create_qa_session', return_value=('qa-1', conversation, MagicMock())), \
+                patch.object(views, 'asearch_knowledge', AsyncMock(return_value=('知識', [], True))), \
+                patch.object(qa_service, 'aprocess_ai_response_sync', answer), \
+                patch.object(views, 'process_ai_response_sync') as sync_answer, \
+                patch.object(qa_service, 'ChatHistoryService', return_value=chat_history):
+            response = asyncio.run(views.ask_with_model(request))
+            response.render()
+
+        body = json.loads(response.content)
+        assert response.status_code == 200
+        assert body['ai_response'] == 'Hello\n\n知識'
+        assert body['session_id'] == 'qa-1' and body['knowledge_used'] is True
+        answer.assert_awaited_once()
+        sync_answer.assert_not_called()
+        chat_history.append_message.assert_called_once_with('qa-1', 'assistant', 'Hello\n\n知識',
+                                                            {'model': 'GPT-4o Mini'})
+
+    def test_asgi_rejects_get_and_missing_question(self):
+        """測試 ASGI 下仍套用 DRF 的方法檢查與參數錯誤回應"""
+        factory = AsyncRequestFactory()
+        response = asyncio.run(views.ask_with_model(factory.get('/maya-v2/ask-with-model/')))
+        assert response.status_code == 405
+
+        response = asyncio.run(views.ask_with_model(
+            factory.post('/maya-v2/ask-with-model/', {}, content_type='application/json')))
+        response.render()
+        assert response.status_code == 400
+        assert json.loads(response.content) == {'error': '問題內容不能為空'}
+
+    def test_wsgi_uses_sync_path(self):
+        """測試 WSGI 下交給同步版本處理"""
+        ai_model = SimpleNamespace(id=1, name='GPT-4o Mini', provider='openai')
+        request = APIRequestFactory().post('/maya-v2/ask-with-model/',
+                                           {'question': 'hi', 'use_knowledge_base': False}, format='json')
+        with patch.object(views, 'find_ai_model', return_value=ai_model), \
+                patch.object(views, 'create_qa_session', return_value=('qa-1', SimpleNamespace(id='c1'), MagicMock())), \
+                patch.object(views, 'process_ai_response_sync', return_value='Hello') as sync_answer, \
+                patch.object(views, 'ChatHistoryService'):
+            response = asyncio.run(views.ask_with_model(request))
+            response.render()
+
+        assert json.loads(response.content)['ai_response'] == 'Hello'
+        sync_answer.assert_called_once()
+
+
+class TestAskWithModelStream:
+    """ask-with-model 串流（SSE）測試"""
+
+    def _request(self, data):
+        factory = APIRequestFactory()
+        return factory.post('/maya-v2/ask-with-model/stream/', data, format='json',
+                            HTTP_ACCEPT='text/event-stream')
+
+    def test_streams_meta_citations_deltas_and_done(self):
+        """測試事件順序：meta → citations → delta... → done，且回答附上知識庫內容"""
+        ai_model = SimpleNamespace(id=1, name='GPT-4o Mini', provider='openai')
+        conversation = SimpleNamespace(id='c1')
+        citations = [{'article_id': 16, 'title': '文章', 'section': '段落'}]
+
+        def fake_stream(user_message, model, knowledge_context=None):
+            yield 'delta', 'Hello'
+            yield 'delta', ' world'
+            yield 'done', {'message_id': 42, 'response': 'Hello world', 'processing_time': 0.5,
+                           'first_token_time': 0.1}
+
+        chat_history = MagicMock()
+        with patch.object(views, 'find_ai_model', return_value=ai_model), \
+                patch.object(views, 'create_qa_session', return_value=('qa-1', conversation, MagicMock())), \
+                patch.object(qa_service, 'search_knowledge', return_value=('\n\n相關知識庫內容：', citations, True)), \
+                patch.object(qa_service, 'process_ai_response_stream', side_effect=fake_stream), \
+                patch.object(qa_service, 'ChatHistoryService', return_value=chat_history):
+            response = views.ask_with_model_stream(self._request({'question': 'hi'}))
+            events = _parse_events(response)
+
+        assert response['Content-Type'].startswith('text/event-stream')
+        assert [e for e, _ in events] == ['meta', 'citations', 'delta', 'delta', 'delta', 'done']
+        assert events[0][1]['session_id'] == 'qa-1'
+        assert events[1][1] == {'knowledge_used': True, 'knowledge_citations': citations}
+        done = events[-1][1]
+        assert done['message_id'] == 42
+        assert done['ai_response'] == 'Hello world\n\n\n\n相關知識庫內容：'
+        chat_history.append_message.assert_called_once_with('qa-1', 'assistant', done['ai_response'],
+                                                            {'model': 'GPT-4o Mini'})
+
+    def test_asgi_streams_first_event_before_answer_finishes(self):
+        """測試 ASGI 下以非同步迭代器逐段送出：第一個事件在回答完成前就送達"""
+        ai_model = SimpleNamespace(id=1, name='GPT-4o Mini', provider='openai')
+        release = asyncio.Event()
+        finished = asyncio.Event()
+
+        async def slow_stream(user_message, model, knowledge_context=None):
+            yield 'delta', 'Hello'
+            await asyncio.wait_for(release.wait(), 5)
+            finished.set()
+            yield 'done', {'message_id': 1, 'response': 'Hello'}
+
+        request = AsyncRequestFactory().post('/maya-v2/ask-with-model/stream/',
+                                             {'question': 'hi', 'use_knowledge_base': False},
+                                             content_type='application/json',
+                                             headers={'accept': 'text/event-stream'})
+
+        async def consume(response):
+            chunks = []
+            async for chunk in response.__aiter__():
+                if not chunks:
+                    # 第一個事件送達時回答仍在生成
+                    assert not finished.is_set()
+                chunks.append(chunk)
+                if b'event: delta' in chunk:
+                    release.set()
+            return chunks
+
+        with patch.object(views, 'find_ai_model', return_value=ai_model), \
+                patch.object(views, 'create_qa_session', return_value=('qa-1', SimpleNamespace(id='c1'), MagicMock())), \
+                patch.object(qa_service, 'aprocess_ai_response_stream', side_effect=slow_stream), \
+                patch.object(qa_service, 'ChatHistoryService'):
+            response = views.ask_with_model_stream(request)
+            assert response.is_async
+            chunks = asyncio.run(consume(response))
+
+        assert [c.split(b'\n', 1)[0] for c in chunks] == [
+            b'event: meta', b'event: citations', b'event: delta', b'event: done']
+
+    def test_generation_failure_emits_error_event(self):
+        """測試生成失敗時送出 error 事件"""
+        ai_model = SimpleNamespace(id=1, name='GPT-4o Mini', provider='openai')
+
+        def failing_stream(*args, **kwargs):
+            raise RuntimeError('boom')
+            yield  # pragma: no cover
+
+        with patch.object(views, 'find_ai_model', return_value=ai_model), \
+                patch.object(views, 'create_qa_session', return_value=('qa-1', SimpleNamespace(id='c1'), MagicMock())), \
+                patch.object(qa_service, 'process_ai_response_stream', side_effect=failing_stream):
+            events = _parse_events(views.ask_with_model_stream(
+                self._request({'question': 'hi', 'use_knowledge_base': False})))
+
+        assert [e for e, _ in events] == ['meta', 'citations', 'error']
+        assert 'boom' in events[-1][1]['error']
+
+    def test_missing_question_is_rejected_as_event(self):
+        """測試參數錯誤在串流開始前以 400 回傳（SSE 客戶端收到 error 事件）"""
+        response = views.ask_with_model_stream(self._request({}))
+        response.render()
+
+        assert response.status_code == 400
+        assert response.content.decode('utf-8').startswith('event: error\n')
@@ -0,0 +1,272 @@
+"""
+WebSocket 聊天協定單元測試
+以假的 ASGI receive/send 驅動 ChatSocket，不需要連資料庫
+"""
+
+import asyncio
+import json
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+from maya_sawa_v2.api import chat_socket
+from maya_sawa_v2.api.chat_socket import ChatSocket
+
+
+class FakeClient:
+    """模擬 WebSocket 客戶端：inbox 給伺服器讀取，sent 收集伺服器送出的訊息"""
+
+    def __init__(self):
+        self.inbox = asyncio.Queue()
+        self.sent = []
+        self.arrived = asyncio.Event()
+
+    async def receive(self):
+        return await self.inbox.get()
+
+    async def send(self, message):
+        if message['type'] == 'websocket.send':
+            text = message['text']
+            self.sent.append(json.loads(text) if text.startswith('{') else text)
+            self.arrived.set()
+
+    def say(self, data):
+        text = data if isinstance(data, str) else json.dumps(data)
+        self.inbox.put_nowait({'type': 'websocket.receive', 'text': text})
+
+    async def wait_for(self, predicate, timeout=5):
+        async def poll():
+            while not any(predicate(m) for m in self.sent):
+                self.arrived.clear()
+                await self.arrived.wait()
+        await asyncio.wait_for(poll(), timeout)
+
+    def events(self, ask_id):
+        return [m['type'] for m in self.sent if isinstance(m, dict) and m.get('id') == ask_id]
+
+
+def _run(scenario, **socket_options):
+    """建立連線、執行 scenario(client, socket)，最後斷線"""
+    async def main():
+        client = FakeClient()
+        socket = ChatSocket({'type': 'websocket', 'headers': []}, client.receive, client.send, **socket_options)
+        client.inbox.put_nowait({'type': 'websocket.connect'})
+        task = asyncio.create_task(socket.run())
+        await client.wait_for(lambda m: isinstance(m, dict) and m['type'] == 'ready')
+        try:
+            await scenario(client, socket)
+        finally:
+            client.inbox.put_nowait({'type': 'websocket.disconnect'})
+            await asyncio.wait_for(task, 5)
+        return client
+    return asyncio.run(main())
+
+
+def _patched(astream_answer):
+    ai_model = SimpleNamespace(id=1, name='GPT-4o Mini', provider='openai')
+    return [
+        patch.object(chat_socket, 'find_ai_model', return_value=ai_model),
+        patch.object(chat_socket, 'create_qa_session',
+                     side_effect=lambda q, user=None, session_id=None: (session_id or 'qa-new', MagicMock(), MagicMock())),
+        patch.object(chat_socket, 'astream_answer', side_effect=astream_answer),
+        patch.object(chat_socket, 'close_old_connections'),
+    ]
+
+
+class TestChatSocket:
+    """WebSocket 聊天協定測試"""
+
+    def test_legacy_ping_and_ready(self):
+        """測試連線後送出 ready，純文字 ping 仍回覆 pong!"""
+        async def scenario(client, socket):
+            client.say('ping')
+            client.say({'type': 'ping'})
+            await client.wait_for(lambda m: m == {'type': 'pong'})
+
+        client = _run(scenario)
+        assert client.sent[0] == {'type': 'ready', 'protocol': 1, 'authenticated': False, 'auth_required': False}
+        assert client.sent[1:] == ['pong!', {'type': 'pong'}]
+
+    def test_multiplexes_concurrent_questions(self):
+        """測試同一連線同時進行兩個問答，事件以 id 區分且各自依序送出"""
+        started = []
+        both_started = asyncio.Event()
+
+        async def fake_stream(question, ai_model, session_id, conversation, user_message, use_knowledge_base=True):
+            yield 'meta', {'session_id': session_id}
+            yield 'citations', {'knowledge_used': False, 'knowledge_citations': []}
+            started.append(question)
+            if len(started) == 2:
+                both_started.set()
+            # 兩個問答都開始後才產生回答，確認是同時進行
+            await asyncio.wait_for(both_started.wait(), 5)
+            yield 'delta', {'text': question}
+            yield 'done', {'ai_response': question}
+
+        async def scenario(client, socket):
+            client.say({'type': 'ask', 'id': 'a', 'question': 'first'})
+            client.say({'type': 'ask', 'id': 'b', 'question': 'second', 'session_id': 'qa-old'})
+            await client.wait_for(lambda m: m.get('id') == 'a' and m['type'] == 'done')
+            await client.wait_for(lambda m: m.get('id') == 'b' and m['type'] == 'done')
+
+        patches = _patched(fake_stream)
+        with patches[0], patches[1], patches[2], patches[3]:
+            client = _run(scenario)
+
+        assert client.events('a') == ['meta', 'citations', 'delta', 'done']
+        assert client.events('b') == ['meta', 'citations', 'delta', 'done']
+        by_id = {m['id']: m for m in client.sent if isinstance(m, dict) and m['type'] == 'meta'}
+        assert by_id['b']['session_id'] == 'qa-old'
+        assert {m['text'] for m in client.sent if isinstance(m, dict) and m['type'] == 'delta'} == {'first', 'second'}
+
+    def test_cancel_stops_stream_and_closes_generator(self):
+        """測試取消後不再送出該問答的事件，並關閉回答 generator（不保存回答）"""
+        release = asyncio.Event()
+        closed = asyncio.Event()
+
+        async def fake_stream(question, ai_model, session_id, conversation, user_message, use_knowledge_base=True):
+            try:
+                yield 'meta', {'session_id': session_id}
+                await asyncio.wait_for(release.wait(), 5)
+                yield 'delta', {'text': 'late'}
+                yield 'done', {'ai_response': 'late'}
+            finally:
+                closed.set()
+
+        async def scenario(client, socket):
+            client.say({'type': 'ask', 'id': 'a', 'question': 'q'})
+            await client.wait_for(lambda m: m.get('id') == 'a' and m['type'] == 'meta')
+            client.say({'type': 'cancel', 'id': 'a'})
+            await client.wait_for(lambda m: m.get('id') == 'a' and m['type'] == 'cancelled')
+            release.set()
+            await asyncio.wait_for(closed.wait(), 5)
+            while socket.asks:
+                await asyncio.sleep(0.01)
+
+        patches = _patched(fake_stream)
+        with patches[0], patches[1], patches[2], patches[3]:
+            client = _run(scenario)
+
+        assert closed.is_set()
+        assert client.events('a') == ['meta', 'cancelled']
+
+    def test_rejects_unauthenticated_duplicate_and_excess_questions(self):
+        """測試需要認證時拒絕未認證的提問，以及重複 id 與超過同時問答上限"""
+        release = asyncio.Event()
+
+        async def fake_stream(question, ai_model, session_id, conversation, user_message, use_knowledge_base=True):
+            await asyncio.wait_for(release.wait(), 5)
+            yield 'done', {'ai_response': ''}
+
+        async def scenario(client, socket):
+            socket.auth_required = True
+            client.say({'type': 'ask', 'id': 'a', 'question': 'q'})
+            await client.wait_for(lambda m: m.get('id') == 'a')
+
+            socket.user = SimpleNamespace(id=7)
+            client.say({'type': 'ask', 'id': 'b', 'question': 'q'})
+            client.say({'type': 'ask', 'id': 'b', 'question': 'q'})
+            client.say({'type': 'ask', 'id': 'c', 'question': 'q'})
+            client.say({'type': 'ask', 'id': 'd', 'question': ''})
+            await client.wait_for(lambda m: m.get('id') == 'd')
+            release.set()
+            await client.wait_for(lambda m: m.get('id') == 'b' and m['type'] == 'done')
+
+        patches = _patched(fake_stream)
+        with patches[0], patches[1], patches[2], patches[3]:
+            client = _run(scenario, max_inflight=1)
+
+        errors = {m['id']: m['error'] for m in client.sent if isinstance(m, dict) and m['type'] == 'error'}
+        assert errors['a'] == 'authentication required'
+        assert errors['b'] == 'duplicate id'
+        assert errors['c'].startswith('too many in-flight questions')
+        assert errors['d'] == '問題內容不能為空'
+        assert client.events('b') == ['error', 'done']
+
+    def test_slow_client_cancels_question(self):
+        """測試送出佇列塞滿且超過 send_timeout 時取消該問答（背壓）"""
+        produced = []
+
+        async def fake_stream(question, ai_model, session_id, conversation, user_message, use_knowledge_base=True):
+            for i in range(100):
+                produced.append(i)
+                yield 'delta', {'text': str(i)}
+
+        async def scenario(client, socket):
+            stalled = asyncio.Event()
+
+            async def blocked_send(message):
+                await stalled.wait()
+
+            socket.send = blocked_send  # 客戶端不再讀取
+            client.say({'type': 'ask', 'id': 'a', 'question': 'q'})
+            await asyncio.sleep(0.05)
+            while socket.asks:
+                await asyncio.sleep(0.05)
+
+        patches = _patched(fake_stream)
+        with patches[0], patches[1], patches[2], patches[3]:
+            _run(scenario, queue_size=2, send_timeout=0.3)
+
+        assert len(produced) < 10
+
+    def test_receive_loop_not_blocked_by_full_outbox(self):
+        """測試問答事件塞滿送出佇列時，接收迴圈仍能處理取消，cancelled 優先送出"""
+        produced = []
+        release = asyncio.Event()
+
+        async def fake_stream(question, ai_model, session_id, conversation, user_message, use_knowledge_base=True):
+            for i in range(100):
+                produced.append(i)
+                yield 'delta', {'text': str(i)}
+
+        async def scenario(client, socket):
+            original_send = socket.send
+
+            async def gated_send(message):
+                await release.wait()
+                await original_send(message)
+
+            socket.send = gated_send  # 客戶端暫時不讀取
+            client.say({'type': 'ask', 'id': 'a', 'question': 'q'})
+            while not socket.outbox.full():
+                await asyncio.sleep(0.01)
+            client.say({'type': 'cancel', 'id': 'a'})
+            while socket.asks:
+                await asyncio.sleep(0.01)
+            release.set()
+            await client.wait_for(lambda m: m.get('type') == 'cancelled')
+
+        patches = _patched(fake_stream)
+        with patches[0], patches[1], patches[2], patches[3]:
+            client = _run(scenario, queue_size=2, send_timeout=5)
+
+        frames = [m for m in client.sent if isinstance(m, dict) and m.get('id') == 'a']
+        # 寫入端卡在第一個問答事件，之後先送出 cancelled
+        assert [m['type'] for m in frames[:2]] == ['delta', 'cancelled']
+        assert len(produced) < 10
+
+    def test_control_overflow_closes_connection(self):
+        """測試客戶端不讀取且控制佇列已滿時關閉連線（1013），不等待送出"""
+        closed = []
+
+        async def scenario(client, socket):
+            stalled = asyncio.Event()
+
+            async def blocked_send(message):
+                if message['type'] == 'websocket.close':
+                    closed.append(message)
+                    return
+                await stalled.wait()
+
+            socket.send = blocked_send
+            for _ in range(10):
+                client.say({'type': 'ping'})
+
+            async def wait_closed():
+                while not closed:
+                    await asyncio.sleep(0.01)
+            await asyncio.wait_for(wait_closed(), 5)
+
+        _run(scenario, queue_size=2, send_timeout=5)
+
+        assert closed == [{'type': 'websocket.close', 'code': chat_socket.SLOW_CLIENT_CLOSE_CODE}]
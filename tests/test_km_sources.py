@@ -0,0 +1,1686 @@
+"""
+知識庫源單元測試
+測試不需要連資料庫的方法
+"""
+
+import asyncio
+import json
+import time
+
+import pytest
+from unittest.mock import patch, MagicMock, AsyncMock
+from maya_sawa_v2.ai_processing.km_sources import db as km_db
+
+
+_DB_ENV_KEYS = [
+    'POSTGRES_CONNECTION_STRING', 'DATABASE_URL', 'DB_HOST', 'DB_PORT',
+    'DB_DATABASE', 'DB_USERNAME', 'DB_PASSWORD', 'DB_SSLMODE',
+]
+
+
+@pytest.fixture
+def clean_db_env(monkeypatch):
+    """清除所有資料庫相關環境變數"""
+    for key in _DB_ENV_KEYS:
+        monkeypatch.delenv(key, raising=False)
+    km_db.close_pools()
+    yield monkeypatch
+    km_db.close_pools()
+
+
+class TestKMDatabase:
+    """KM 資料庫連線池測試"""
+
+    def test_build_conn_str_prefers_database_url(self, clean_db_env):
+        """測試優先使用 DATABASE_URL"""
+        clean_db_env.setenv('DATABASE_URL', 'postgres://u:p@db:5432/app')
+        clean_db_env.setenv('DB_HOST', 'ignored')
+        assert km_db.build_conn_str() == 'postgres://u:p@db:5432/app'
+
+    def test_build_conn_str_from_split_env(self, clean_db_env):
+        """測試以 DB_* 變數組裝連線字串"""
+        clean_db_env.setenv('DB_HOST', 'db')
+        clean_db_env.setenv('DB_PORT', '5432')
+        clean_db_env.setenv('DB_DATABASE', 'app')
+        clean_db_env.setenv('DB_USERNAME', 'u')
+        clean_db_env.setenv('DB_PASSWORD', 'p')
+        clean_db_env.setenv('DB_SSLMODE', 'require')
+        assert km_db.build_conn_str() == 'postgres://u:p@db:5432/app?sslmode=require'
+
+    def test_unconfigured(self, clean_db_env):
+        """測試沒有連線資訊時不建立連線池"""
+        assert km_db.build_conn_str() == ''
+        assert km_db.is_configured() is False
+        assert km_db.get_pool() is None
+        with pytest.raises(RuntimeError):
+            with km_db.connection():
+                pass
+
+    def test_pool_is_shared(self, clean_db_env):
+        """測試連線池在程序內只建立一次"""
+        clean_db_env.setenv('DATABASE_URL', 'postgres://u:p@db:5432/app')
+        clean_db_env.setenv('KM_DB_POOL_MAX_SIZE', '7')
+        with patch.object(km_db, 'ConnectionPool') as mock_pool_cls:
+            mock_pool_cls.return_value = MagicMock()
+            first = km_db.get_pool()
+            second = km_db.get_pool()
+
+        assert first is second
+        mock_pool_cls.assert_called_once()
+        assert mock_pool_cls.call_args.kwargs['max_size'] == 7
+        assert km_db.pool_stats()['sync'] == first.get_stats.return_value
+
+    def test_close_pools_closes_async_pools_on_their_loop(self, clean_db_env):
+        """測試 close_pools 在建立非同步連線池的事件迴圈上關閉它"""
+        from maya_sawa_v2.ai_processing.km_sources import aio
+        clean_db_env.setenv('DATABASE_URL', 'postgres://u:p@db:5432/app')
+        closed_on = []
+
+        class FakeAsyncPool:
+            check_connection = None
+
+            def __init__(self, *args, **kwargs):
+                pass
+
+            async def open(self):
+                pass
+
+            async def close(self):
+                closed_on.append(asyncio.get_running_loop())
+
+        with patch.object(km_db, 'AsyncConnectionPool', FakeAsyncPool):
+            pool = aio.run_sync(km_db.get_async_pool())
+            km_db.close_pools()
+
+        assert isinstance(pool, FakeAsyncPool)
+        assert closed_on == [aio.get_background_loop()]
+        assert 'async' not in km_db.pool_stats()
+
+
+class TestEmbeddingBackfillTask:
+    """embedding 補齊排程任務測試"""
+
+    def test_skipped_without_database(self, clean_db_env):
+        """測試沒有資料庫時直接略過"""
+        from maya_sawa_v2.ai_processing.tasks import backfill_article_embeddings
+        result = backfill_article_embeddings.apply().get()
+        assert result == {'status': 'skipped', 'processed': 0}
+
+    def test_skipped_when_lock_held(self, clean_db_env):
+        """測試其他 worker 持有 advisory lock 時略過"""
+        from contextlib import contextmanager
+        from maya_sawa_v2.ai_processing.km_sources import backfill
+        from maya_sawa_v2.ai_processing.tasks import backfill_article_embeddings
+
+        @contextmanager
+        def lock_not_acquired():
+            yield False
+
+        clean_db_env.setenv('DATABASE_URL', 'postgres://u:p@db:5432/app')
+        with patch.object(backfill, 'advisory_lock', lock_not_acquired), \
+                patch.object(backfill, 'backfill_missing_embeddings') as mock_backfill:
+            result = backfill_article_embeddings.apply().get()
+
+        assert result['status'] == 'skipped'
+        mock_backfill.assert_not_called()
+
+    def test_advisory_lock_uses_session_lock_on_dedicated_connection(self, clean_db_env):
+        """測試 advisory lock 使用獨立 autocommit 連線的 session 鎖，區塊結束（含例外）時解鎖"""
+        from maya_sawa_v2.ai_processing.km_sources import backfill
+
+        clean_db_env.setenv('DATABASE_URL', 'postgres://u:p@db:5432/app')
+        conn = MagicMock()
+        conn.execute.return_value.fetchone.return_value = (True,)
+        with patch.object(backfill.psycopg, 'connect') as connect:
+            connect.return_value.__enter__.return_value = conn
+            with pytest.raises(RuntimeError):
+                with backfill.advisory_lock() as acquired:
+                    assert acquired
+                    raise RuntimeError('boom')
+
+        assert connect.call_args.kwargs == {'autocommit': True}
+        statements = [c.args[0] for c in conn.execute.call_args_list]
+        assert statements == ["SELECT pg_try_advisory_lock(%s)", "SELECT pg_advisory_unlock(%s)"]
+
+    def test_search_does_not_backfill(self, clean_db_env):
+        """測試檢索路徑不再觸發 embedding 補齊"""
+        from maya_sawa_v2.ai_processing.km_sources import backfill
+        from maya_sawa_v2.ai_processing.km_sources.base import KMQuery
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+
+        source = ProgrammingKMSource()
+        with patch.object(backfill, 'backfill_missing_embeddings') as mock_backfill, \
+                patch.object(source, '_acompute_query_embedding_safe', AsyncMock(return_value=None)), \
+                patch.object(source, '_aget_cached_articles', AsyncMock(return_value=[])):
+            source.search(KMQuery(query='Spring Boot', user_id=1, conversation_id='c1'))
+        mock_backfill.assert_not_called()
+
+
+class TestEmbeddingCache:
+    """查詢向量快取測試"""
+
+    def test_normalize_query(self):
+        """測試近似問題正規化為同一鍵"""
+        from maya_sawa_v2.ai_processing.km_sources.embeddings import normalize_query
+        assert normalize_query("什麼是 Spring Boot?") == normalize_query("  什麼是  spring boot？ ")
+
+    def test_vector_roundtrip(self):
+        """測試 float32 二進位編碼"""
+        from maya_sawa_v2.ai_processing.km_sources.embeddings import encode_vector, decode_vector
+        raw = encode_vector([0.5, -1.25, 2.0])
+        assert len(raw) == 12
+        assert decode_vector(raw) == [0.5, -1.25, 2.0]
+
+    def test_local_lru_hits_and_eviction(self):
+        """測試程序內 LRU 命中與淘汰"""
+        from maya_sawa_v2.ai_processing.km_sources.embeddings import EmbeddingCache
+        cache = EmbeddingCache(max_size=2, redis_url='')
+        cache.set('a', 'm', [1.0])
+        cache.set('b', 'm', [2.0])
+        assert cache.get('A', 'm') == [1.0]
+        cache.set('c', 'm', [3.0])  # 淘汰最久未使用的 b
+
+        assert cache.get('b', 'm') is None
+        assert cache.get('a', 'other-model') is None
+        stats = cache.stats()
+        assert stats['hits_local'] == 1
+        assert stats['misses'] == 2
+        assert stats['size'] == 2
+
+    def test_redis_tier(self):
+        """測試 Redis 層命中後回填程序內快取"""
+        from maya_sawa_v2.ai_processing.km_sources.embeddings import EmbeddingCache, encode_vector
+        cache = EmbeddingCache(redis_url='redis://cache:6379/0')
+        fake_redis = MagicMock()
+        fake_redis.get.return_value = encode_vector([0.25, 0.75])
+        cache._redis = fake_redis
+
+        assert cache.get('q', 'm') == [0.25, 0.75]
+        assert cache.get('q', 'm') == [0.25, 0.75]
+        fake_redis.get.assert_called_once()
+        assert cache.stats()['hits_redis'] == 1
+        assert cache.stats()['hits_local'] == 1
+
+    def test_get_query_embedding_uses_cache(self, monkeypatch):
+        """測試重複查詢只呼叫一次 embeddings API"""
+        from maya_sawa_v2.ai_processing.km_sources import embeddings
+        monkeypatch.setenv('OPENAI_API_KEY', 'test-key')
+        monkeypatch.setattr(embeddings, 'embedding_cache', embeddings.EmbeddingCache(redis_url=''))
+        client = MagicMock()
+        client.embeddings.create.return_value.data = [MagicMock(embedding=[0.1, 0.2])]
+        with patch.object(embeddings, 'get_openai_client', return_value=client):
+            first = embeddings.get_query_embedding('什麼是 Spring Boot?')
+            second = embeddings.get_query_embedding('什麼是 spring boot')
+
+        assert first == second == [0.1, 0.2]
+        # 送出的是正規化後的文字，快取鍵與向量一致
+        client.embeddings.create.assert_called_once()
+        assert client.embeddings.create.call_args.kwargs['input'] == '什麼是 spring boot'
+
+    def test_counters_thread_safe(self):
+        """測試多執行緒同時查詢時計數不遺失"""
+        import threading
+        from maya_sawa_v2.ai_processing.km_sources.embeddings import EmbeddingCache
+        cache = EmbeddingCache(redis_url='')
+        cache.set('hit', 'm', [1.0])
+
+        def lookup():
+            for _ in range(500):
+                cache.get('hit', 'm')
+                cache.get('miss', 'm')
+
+        threads = [threading.Thread(target=lookup) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert cache.stats()['hits_local'] == cache.stats()['misses'] == 4000
+
+
+class TestHybridRetrieval:
+    """混合檢索測試"""
+
+    def test_fusion_config(self):
+        """測試融合參數可由 config 覆寫"""
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource({'fusion': 'rrf', 'text_weight': 0.3, 'vector_weight': 0.7, 'top_k': 3})
+        assert source.fusion == 'rrf'
+        assert source.text_weight == 0.3
+        assert source.vector_weight == 0.7
+        assert source.top_k == 3
+
+    def test_falls_back_to_trigram_when_vector_query_fails(self, clean_db_env):
+        """測試向量查詢失敗時退回僅 trigram"""
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        clean_db_env.setenv('DATABASE_URL', 'postgres://u:p@db:5432/app')
+        source = ProgrammingKMSource()
+        rows = [{'id': 1, 'file_path': 'java/spring.md', '_hybrid_score': 0.3}]
+        mock_run = AsyncMock(side_effect=[Exception('no pgvector'), rows])
+        with patch.object(source, '_arun_hybrid_query', mock_run):
+            assert asyncio.run(source._asearch_db_hybrid('spring', [0.1, 0.2])) == rows
+
+        assert mock_run.call_args_list[1].args[:2] == ('spring', None)
+
+    def test_search_ranks_by_fused_score(self, clean_db_env):
+        """測試 search 直接採用資料庫融合分數排序"""
+        from maya_sawa_v2.ai_processing.km_sources.base import KMQuery
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource()
+        rows = [
+            {'id': i, 'file_path': f'docs/{i}.md', 'content': f'# Doc {i}', 'file_date': None,
+             '_hybrid_score': score, '_matched_terms': []}
+            for i, score in [(1, 0.2), (2, 0.9), (3, 0.5)]
+        ]
+        with patch.object(source, '_acompute_query_embedding_safe', AsyncMock(return_value=None)), \
+                patch.object(source, '_asearch_db_hybrid', AsyncMock(return_value=rows)):
+            results = source.search(KMQuery(query='doc', user_id=1, conversation_id='c1'))
+
+        assert [r.metadata['article_id'] for r in results] == [2, 3, 1]
+        assert results[0].relevance_score == 0.9
+
+
+class TestVectorIndex:
+    """pgvector 索引管理測試"""
+
+    def test_recommended_ivfflat_lists(self):
+        """測試 IVFFlat lists 依資料筆數推算"""
+        from maya_sawa_v2.ai_processing.km_sources.pg_index import recommended_ivfflat_lists
+        assert recommended_ivfflat_lists(0) == 1
+        assert recommended_ivfflat_lists(50_000) == 50
+        assert recommended_ivfflat_lists(4_000_000) == 2000
+
+    def test_search_settings_from_env(self, monkeypatch):
+        """測試每次查詢的 ef_search / probes 可由環境變數調整"""
+        from maya_sawa_v2.ai_processing.km_sources import pg_index
+        monkeypatch.setenv('KM_HNSW_EF_SEARCH', '100')
+        cur = MagicMock()
+        pg_index.apply_search_settings(cur)
+
+        calls = [c.args[1] for c in cur.execute.call_args_list]
+        assert ('hnsw.ef_search', '100') in calls
+        assert ('ivfflat.probes', '10') in calls
+
+    def test_command_requires_database(self, clean_db_env):
+        """測試沒有資料庫設定時命令直接報錯"""
+        from io import StringIO
+        from django.core.management import call_command
+        err = StringIO()
+        call_command('manage_vector_index', '--status', stderr=err)
+        assert '找不到資料庫連線資訊' in err.getvalue()
+
+
+class TestSnippetProjection:
+    """片段投影測試"""
+
+    def test_make_snippet_centers_on_first_match(self):
+        """測試片段從最早命中的關鍵字附近開始"""
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource({'snippet_chars': 20, 'snippet_lead': 4})
+        content = "x" * 100 + "Spring Boot 自動配置" + "y" * 100
+        snippet = source._make_snippet(content, ['boot', 'spring'])
+        assert snippet.startswith("xxxxSpring Boot")
+        assert len(snippet) == 20
+
+    def test_full_mode_returns_whole_content(self):
+        """測試 full 模式保留整篇內文"""
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource({'retrieval_mode': 'full'})
+        article = {'content': 'a' * 1000}
+        assert source._result_content(article, ['a']) == 'a' * 1000
+
+    def test_fetch_full_falls_back_to_paprika_cache(self, clean_db_env):
+        """測試資料庫無設定時由 Paprika 快取取得內文"""
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource()
+        with patch.object(source, '_get_cached_articles', return_value=[{'id': 7, 'content': '完整內文'}]):
+            assert source.fetch_full(7) == '完整內文'
+            assert source.fetch_full(8) is None
+
+
+class TestPaprikaCache:
+    """Paprika 共享快取測試"""
+
+    @staticmethod
+    def _response(status_code=200, articles=None, etag=None):
+        response = MagicMock(status_code=status_code, headers={'ETag': etag} if etag else {})
+        response.json.return_value = {'success': True, 'data': articles or []}
+        return response
+
+    def test_shared_between_sources(self):
+        """測試不同 ProgrammingKMSource 實例共用同一份快取"""
+        from maya_sawa_v2.ai_processing.km_sources import paprika
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        url = 'https://paprika.test/shared'
+        with patch.object(paprika.httpx, 'get', return_value=self._response(articles=[{'id': 1}])) as mock_get:
+            assert ProgrammingKMSource({'paprika_api_url': url})._get_cached_articles() == [{'id': 1}]
+            assert ProgrammingKMSource({'paprika_api_url': url})._get_cached_articles() == [{'id': 1}]
+        mock_get.assert_called_once()
+
+    def test_conditional_revalidation(self):
+        """測試過期後帶 ETag 重新驗證，304 時保留原資料"""
+        from maya_sawa_v2.ai_processing.km_sources.paprika import PaprikaCorpusCache, httpx
+        cache = PaprikaCorpusCache('https://paprika.test/etag', ttl_seconds=60, stale_seconds=0, redis_url='')
+        with patch.object(httpx, 'get', side_effect=[self._response(articles=[{'id': 1}], etag='"v1"'),
+                                                     self._response(status_code=304)]) as mock_get:
+            cache.get_articles()
+            cache.invalidate()
+            assert cache.get_articles() == [{'id': 1}]
+
+        assert mock_get.call_args_list[1].kwargs['headers'] == {'If-None-Match': '"v1"'}
+        assert cache.stats()['not_modified'] == 1
+
+    def test_stale_while_revalidate(self):
+        """測試過期資料立即回傳並只啟動一次背景更新"""
+        from maya_sawa_v2.ai_processing.km_sources.paprika import PaprikaCorpusCache
+        cache = PaprikaCorpusCache('https://paprika.test/swr', ttl_seconds=60, stale_seconds=600, redis_url='')
+        cache._articles = [{'id': 1}]
+        cache._fetched_at = 1.0
+        with patch('maya_sawa_v2.ai_processing.km_sources.paprika.time.time', return_value=100.0), \
+                patch('maya_sawa_v2.ai_processing.km_sources.paprika.threading.Thread') as mock_thread:
+            assert cache.get_articles() == [{'id': 1}]
+            assert cache.get_articles() == [{'id': 1}]
+
+        mock_thread.return_value.start.assert_called_once()
+        assert cache.stats()['stale_hits'] == 2
+
+    def test_single_flight_cold_start(self):
+        """測試冷啟動時並發請求只下載一次"""
+        import threading
+        import time
+        from maya_sawa_v2.ai_processing.km_sources.paprika import PaprikaCorpusCache, httpx
+        cache = PaprikaCorpusCache('https://paprika.test/cold', redis_url='')
+
+        def slow_get(*args, **kwargs):
+            time.sleep(0.05)
+            return self._response(articles=[{'id': 1}])
+
+        with patch.object(httpx, 'get', side_effect=slow_get) as mock_get:
+            threads = [threading.Thread(target=cache.get_articles) for _ in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        mock_get.assert_called_once()
+
+    def test_redis_lock_released_when_fetch_fails(self):
+        """測試下載失敗時仍釋放 Redis 更新鎖，損毀的 Redis 內容視為未命中"""
+        from maya_sawa_v2.ai_processing.km_sources.paprika import PaprikaCorpusCache, httpx
+        cache = PaprikaCorpusCache('https://paprika.test/lock', stale_seconds=0,
+                                   redis_url='redis://cache:6379/0')
+        cache._redis = MagicMock()
+        cache._redis.set.return_value = True
+        cache._redis.get.return_value = '{"articles": [tr'
+        with patch.object(httpx, 'get', side_effect=httpx.ConnectError('down')):
+            assert cache.get_articles() == []
+        cache._redis.delete.assert_called_once_with(f"{cache._redis_key}:lock")
+
+        # 冷啟動時其他 worker 持有鎖但 Redis 內容損毀：自行下載
+        cache._articles = None
+        cache._redis.set.return_value = False
+        cache._redis.delete.reset_mock()
+        with patch.object(httpx, 'get', return_value=self._response(articles=[{'id': 1}])):
+            assert cache.get_articles() == [{'id': 1}]
+        cache._redis.delete.assert_not_called()
+
+    def test_redis_lock_released_when_async_fetch_cancelled(self):
+        """測試非同步下載被取消（檢索逾時）時仍釋放 Redis 更新鎖"""
+        from maya_sawa_v2.ai_processing.km_sources import paprika
+        cache = paprika.PaprikaCorpusCache('https://paprika.test/lock-async', redis_url='redis://cache:6379/0')
+        cache._redis = MagicMock()
+        cache._redis.get.return_value = None
+        cache._redis.set.return_value = True
+        client = MagicMock()
+
+        async def hang(*args, **kwargs):
+            await asyncio.sleep(5)
+
+        client.get = hang
+
+        async def main():
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(cache.aget_articles(), 0.05)
+
+        with patch.object(paprika._async_clients, 'get', return_value=client):
+            asyncio.run(main())
+        cache._redis.delete.assert_called_once_with(f"{cache._redis_key}:lock")
+
+    def test_shared_cache_keyed_by_ttl(self):
+        """測試不同 TTL 取得各自的共享快取"""
+        from maya_sawa_v2.ai_processing.km_sources.paprika import get_paprika_cache
+        url = 'https://paprika.test/ttl'
+        assert get_paprika_cache(url, ttl_seconds=60).ttl_seconds == 60
+        assert get_paprika_cache(url, ttl_seconds=600).ttl_seconds == 600
+        assert get_paprika_cache(url, ttl_seconds=60) is get_paprika_cache(url, ttl_seconds=60)
+
+
+class TestAsyncRetrieval:
+    """非同步檢索介面測試"""
+
+    def test_run_sync_reuses_background_loop(self):
+        """測試同步呼叫共用同一個背景事件迴圈"""
+        from maya_sawa_v2.ai_processing.km_sources import aio
+
+        async def current_loop():
+            return asyncio.get_running_loop()
+
+        first = aio.run_sync(current_loop())
+        second = aio.run_sync(current_loop())
+        assert first is second is aio.get_background_loop()
+
+    def test_loop_local_values(self):
+        """測試 LoopLocal 在同一事件迴圈內共用、不同迴圈各自建立"""
+        from maya_sawa_v2.ai_processing.km_sources.aio import LoopLocal
+        local = LoopLocal(object)
+
+        async def get_twice():
+            return local.get(), local.get()
+
+        a1, a2 = asyncio.run(get_twice())
+        b1, _ = asyncio.run(get_twice())
+        assert a1 is a2
+        assert a1 is not b1
+
+    def test_default_asearch_wraps_sync_search(self):
+        """測試未覆寫 asearch 的源由管理器以非同步方式呼叫"""
+        from maya_sawa_v2.ai_processing.km_sources.base import KMQuery
+        from maya_sawa_v2.ai_processing.km_sources.manager import KMSourceManager
+        manager = KMSourceManager()
+        manager.remove_source('programming_km')
+        results = asyncio.run(manager.asearch_all_suitable(KMQuery(query='什麼是 Django', user_id=1, conversation_id='c1')))
+        assert results[0].source == 'general_km'
+
+    def test_paprika_async_fetch(self):
+        """測試非同步取得 Paprika 文章使用共用 AsyncClient"""
+        from maya_sawa_v2.ai_processing.km_sources import paprika
+        cache = paprika.PaprikaCorpusCache('https://paprika.test/async', redis_url='')
+        response = MagicMock(status_code=200, headers={'ETag': '"v1"'})
+        response.json.return_value = {'success': True, 'data': [{'id': 3}]}
+        client = MagicMock()
+        client.get = AsyncMock(return_value=response)
+        with patch.object(paprika._async_clients, 'get', return_value=client):
+            assert asyncio.run(cache.aget_articles()) == [{'id': 3}]
+            assert asyncio.run(cache.aget_articles()) == [{'id': 3}]
+        client.get.assert_awaited_once()
+        assert cache.stats()['etag'] == '"v1"'
+
+
+    def test_slow_redis_does_not_block_event_loop(self):
+        """測試查詢向量與 Paprika 的 Redis 往返在執行緒中進行，不阻塞共用事件迴圈"""
+        from maya_sawa_v2.ai_processing.km_sources import paprika
+        from maya_sawa_v2.ai_processing.km_sources.embeddings import EmbeddingCache, encode_vector
+
+        def slow(value):
+            def call(*args, **kwargs):
+                time.sleep(0.2)
+                return value
+            return call
+
+        embedding_cache = EmbeddingCache(redis_url='redis://cache:6379/0')
+        embedding_cache._redis = MagicMock()
+        embedding_cache._redis.get.side_effect = slow(encode_vector([0.5]))
+        corpus = paprika.PaprikaCorpusCache('https://paprika.test/slow-redis', redis_url='redis://cache:6379/0')
+        corpus._redis = MagicMock()
+        corpus._redis.get.side_effect = slow(json.dumps({'articles': [{'id': 1}], 'fetched_at': time.time()}))
+
+        async def main():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            task = asyncio.create_task(ticker())
+            results = await asyncio.gather(embedding_cache.aget('q', 'm'), corpus.aget_articles())
+            task.cancel()
+            return results, ticks
+
+        (vec, articles), ticks = asyncio.run(main())
+        assert vec == [0.5]
+        assert articles == [{'id': 1}]
+        assert ticks >= 5
+
+    def test_sync_search_times_out(self):
+        """測試同步 search 逾時回傳空結果，並取消背景迴圈上的查詢"""
+        from maya_sawa_v2.ai_processing.km_sources.base import KMQuery
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        cancelled = []
+
+        async def hung(query):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        source = ProgrammingKMSource({'timeout': 0.05})
+        with patch.object(source, 'asearch', side_effect=hung):
+            assert source.search(KMQuery(query='q', user_id=1, conversation_id='c1')) == []
+        for _ in range(50):
+            if cancelled:
+                break
+            time.sleep(0.01)
+        assert cancelled == [True]
+
+
+def _sleepy_source(name, delay, score=0.5, timeout=5):
+    """測試用知識庫源：等待指定秒數後回傳一筆結果"""
+    from maya_sawa_v2.ai_processing.km_sources.base import BaseKMSource, KMResult
+
+    class SleepySource(BaseKMSource):
+        @staticmethod
+        def _results():
+            return [KMResult(content=name, source=name, confidence=0.5, relevance_score=score)]
+
+        def search(self, query):
+            time.sleep(delay)
+            return self._results()
+
+        async def asearch(self, query):
+            await asyncio.sleep(delay)
+            return self._results()
+
+        def is_suitable_for(self, query):
+            return True
+
+        def get_source_type(self):
+            return name
+
+    return SleepySource(name, {'timeout': timeout})
+
+
+class TestConcurrentFanOut:
+    """知識庫源並行檢索測試"""
+
+    @staticmethod
+    def _manager(*sources, deadline=8.0):
+        from maya_sawa_v2.ai_processing.km_sources.manager import KMSourceManager
+        manager = KMSourceManager.__new__(KMSourceManager)
+        manager.sources, manager._sources_by_name, manager._sources_by_type = [], {}, {}
+        manager.deadline = deadline
+        for source in sources:
+            manager.add_source(source)
+        return manager
+
+    @staticmethod
+    def _query():
+        from maya_sawa_v2.ai_processing.km_sources.base import KMQuery
+        return KMQuery(query='q', user_id=1, conversation_id='c1')
+
+    def test_sources_run_concurrently(self):
+        """測試總耗時接近最慢的源而非各源相加"""
+        import time
+        manager = self._manager(_sleepy_source('a', 0.2, 0.9), _sleepy_source('b', 0.2, 0.1))
+        started = time.perf_counter()
+        results = manager.search_all_suitable(self._query())
+        assert time.perf_counter() - started < 0.35
+        assert [r.source for r in results] == ['a', 'b']
+        assert results[0].metadata['km_search']['partial'] is False
+
+    def test_overall_timeout_returns_empty_results(self):
+        """測試整體檢索超過 deadline 時記錄並回傳空結果，不拋出 TimeoutError"""
+        manager = self._manager(_sleepy_source('a', 0.0), deadline=0.0)
+
+        async def stuck(query):
+            await asyncio.sleep(5)
+
+        with patch.object(manager, 'asearch_all_suitable', side_effect=stuck):
+            started = time.perf_counter()
+            assert manager.search_all_suitable(self._query()) == []
+        assert time.perf_counter() - started < 2
+
+    def test_source_timeout_returns_partial_results(self):
+        """測試單一源逾時時回傳其餘源的結果並標示狀態"""
+        manager = self._manager(_sleepy_source('fast', 0.0), _sleepy_source('slow', 1.0, timeout=0.05))
+        results = manager.search_all_suitable(self._query())
+
+        assert [r.source for r in results] == ['fast']
+        report = results[0].metadata['km_search']
+        assert report['partial'] is True
+        assert report['sources']['slow']['status'] == 'timeout'
+        assert report['sources']['fast']['status'] == 'ok'
+        assert results[0].metadata['latency_ms'] == report['sources']['fast']['latency_ms']
+
+    def test_global_deadline(self):
+        """測試整體 deadline 限制所有源"""
+        import time
+        manager = self._manager(_sleepy_source('fast', 0.0), _sleepy_source('slow', 1.0), deadline=0.1)
+        started = time.perf_counter()
+        results = manager.search_all_suitable(self._query())
+        assert time.perf_counter() - started < 0.5
+        assert [r.source for r in results] == ['fast']
+
+
+class TestSearchResultCache:
+    """檢索結果快取測試"""
+
+    @pytest.fixture
+    def cache(self, monkeypatch):
+        from maya_sawa_v2.ai_processing.km_sources import manager, result_cache
+        cache = result_cache.SearchResultCache(redis_url='', enabled=True)
+        monkeypatch.setattr(manager, 'search_cache', cache)
+        monkeypatch.setattr(result_cache, 'search_cache', cache)
+        return cache
+
+    @staticmethod
+    def _counting_source(name='counted', delay=0.0, timeout=5):
+        source = _sleepy_source(name, delay, timeout=timeout)
+        source.calls = 0
+        original = source.asearch
+
+        async def asearch(query):
+            source.calls += 1
+            return await original(query)
+
+        source.asearch = asearch
+        return source
+
+    def test_repeated_query_hits_cache(self, cache):
+        """測試相同（正規化後）查詢第二次直接命中快取，且回傳的是獨立副本"""
+        from maya_sawa_v2.ai_processing.km_sources.base import KMQuery
+        source = self._counting_source()
+        manager = TestConcurrentFanOut._manager(source)
+        first = manager.search_all_suitable(KMQuery(query='Spring Boot?', user_id=1, conversation_id='c1'))
+        first[0].metadata['mutated'] = True
+        second = manager.search_all_suitable(KMQuery(query='spring  boot', user_id=2, conversation_id='c2'))
+
+        assert source.calls == 1
+        assert [r.content for r in second] == [r.content for r in first]
+        assert second[0].metadata['km_cache'] == 'local'
+        assert 'mutated' not in second[0].metadata
+        assert cache.stats()['hit_rate'] == 0.5
+
+    def test_cached_hit_is_retimed(self, cache):
+        """測試快取命中時 km_search 標示 cached 並使用本次查詢的耗時"""
+        source = self._counting_source(delay=0.05)
+        manager = TestConcurrentFanOut._manager(source)
+        first = manager.search_all_suitable(TestConcurrentFanOut._query())
+        second = manager.search_all_suitable(TestConcurrentFanOut._query())
+
+        assert first[0].metadata['km_search']['cached'] is False
+        summary = second[0].metadata['km_search']
+        assert summary['cached'] is True
+        assert summary['total_ms'] < first[0].metadata['km_search']['total_ms']
+        assert summary['sources']['counted']['latency_ms'] == summary['total_ms']
+        assert second[0].metadata['latency_ms'] == summary['total_ms']
+
+    def test_version_bump_invalidates(self, cache):
+        """測試語料版本更新後不再讀到舊結果"""
+        from maya_sawa_v2.ai_processing.km_sources.result_cache import bump_corpus_version
+        source = self._counting_source()
+        manager = TestConcurrentFanOut._manager(source)
+        manager.search_all_suitable(TestConcurrentFanOut._query())
+        bump_corpus_version('test')
+        manager.search_all_suitable(TestConcurrentFanOut._query())
+
+        assert source.calls == 2
+        assert cache.version() == 'l1'
+
+    def test_partial_results_are_not_cached(self, cache):
+        """測試有源逾時的部分結果不寫入快取"""
+        manager = TestConcurrentFanOut._manager(self._counting_source('fast'),
+                                                self._counting_source('slow', 1.0, timeout=0.05))
+        manager.search_all_suitable(TestConcurrentFanOut._query())
+        assert cache.stats()['stores'] == 0
+
+    def test_redis_tier_is_shared(self, monkeypatch):
+        """測試另一個 worker（另一個快取實例）可由 Redis 命中，且版本取自 Redis"""
+        from maya_sawa_v2.ai_processing.km_sources.base import KMResult
+        from maya_sawa_v2.ai_processing.km_sources.result_cache import SearchResultCache
+        store = {}
+        client = MagicMock()
+        client.get.side_effect = store.get
+        client.set.side_effect = lambda key, value, ex=None: store.__setitem__(key, value)
+        client.incr.side_effect = lambda key: store.__setitem__(key, int(store.get(key, 0)) + 1)
+        worker_a, worker_b = SearchResultCache(redis_url='redis://x'), SearchResultCache(redis_url='redis://x')
+        for cache in (worker_a, worker_b):
+            monkeypatch.setattr(cache, '_get_redis', lambda: client)
+        source = _sleepy_source('shared', 0.0)
+
+        key = worker_a.make_key('q', [source])
+        worker_a.set(key, [KMResult(content='x', source='shared', confidence=0.5, relevance_score=0.5)])
+        assert worker_b.get(worker_b.make_key('q', [source]))[0].metadata['km_cache'] == 'redis'
+
+        worker_b.bump_version('test')
+        assert worker_b.version() == 'r1'
+        # 其他 worker 的版本在程序內快取到期後才重新讀取
+        assert worker_a.make_key('q', [source]) == key
+        worker_a._version_expires = 0.0
+        assert worker_a.make_key('q', [source]) != key
+        assert worker_a.version() == 'r1'
+
+    def test_version_is_cached_locally(self):
+        """測試語料版本在 version_ttl 內只讀取一次 Redis"""
+        from maya_sawa_v2.ai_processing.km_sources.result_cache import SearchResultCache
+        client = MagicMock()
+        client.get.return_value = b'3'
+        cache = SearchResultCache(redis_url='redis://x', version_ttl=60)
+        cache._redis = client
+        source = _sleepy_source('versioned', 0.0)
+
+        keys = {cache.make_key('q', [source]), asyncio.run(cache.amake_key('q', [source]))}
+        assert len(keys) == 1
+        assert cache.version() == 'r3'
+        client.get.assert_called_once_with(SearchResultCache.VERSION_KEY)
+
+    def test_index_sync_bumps_only_on_incremental_changes(self, cache):
+        """測試增量同步有變更時才調高語料版本"""
+        from maya_sawa_v2.ai_processing.signals import km_index_published
+        km_index_published.send(sender=None, version=1, upserts=10, deletes=0, full=True)
+        km_index_published.send(sender=None, version=2, upserts=0, deletes=0, full=False)
+        assert cache.version() == 'l0'
+        km_index_published.send(sender=None, version=3, upserts=1, deletes=0, full=False)
+        assert cache.version() == 'l1'
+
+
+class TestKMRegistry:
+    """程序內知識庫註冊表測試"""
+
+    def test_manager_is_shared(self):
+        """測試多次取得為同一個 KMSourceManager"""
+        from maya_sawa_v2.ai_processing.km_sources.registry import get_km_manager
+        assert get_km_manager() is get_km_manager()
+        assert [s['name'] for s in get_km_manager().list_sources()] == ['programming_km', 'general_km']
+
+    def test_settings_change_rebuilds(self, settings):
+        """測試修改 KM_SOURCES 後重建並套用新設定"""
+        from maya_sawa_v2.ai_processing.km_sources.registry import get_km_manager
+        before = get_km_manager()
+        settings.KM_SOURCES = [
+            {'class': 'maya_sawa_v2.ai_processing.km_sources.general.GeneralKMSource', 'config': {'timeout': 2}},
+        ]
+        after = get_km_manager()
+
+        assert after is not before
+        assert [s['name'] for s in after.list_sources()] == ['general_km']
+        assert after.get_source_by_name('general_km').get_timeout() == 2.0
+
+    def test_reload_replaces_manager(self):
+        """測試 reload_km_manager 重建註冊表，之後取得的都是新實例"""
+        from maya_sawa_v2.ai_processing.km_sources.registry import get_km_manager, reload_km_manager
+        before = get_km_manager()
+        after = reload_km_manager()
+        assert after is not before
+        assert get_km_manager() is after
+
+    def test_invalid_source_is_skipped(self):
+        """測試無法匯入的源不影響其他源"""
+        from maya_sawa_v2.ai_processing.km_sources.manager import KMSourceManager
+        manager = KMSourceManager([
+            {'class': 'maya_sawa_v2.ai_processing.km_sources.missing.MissingSource'},
+            {'class': 'maya_sawa_v2.ai_processing.km_sources.general.GeneralKMSource'},
+        ])
+        assert [s['name'] for s in manager.list_sources()] == ['general_km']
+
+    def test_warm_calls_sources(self):
+        """測試預熱會呼叫每個源的 warm"""
+        from maya_sawa_v2.ai_processing.km_sources.manager import KMSourceManager
+        manager = KMSourceManager([{'class': 'maya_sawa_v2.ai_processing.km_sources.general.GeneralKMSource'}])
+        with patch.object(manager.sources[0], 'warm') as mock_warm:
+            manager.warm()
+        mock_warm.assert_called_once()
+
+
+class TestLocalVectorIndex:
+    """程序內 NumPy 向量索引測試"""
+
+    def test_top_k_matches_brute_force(self):
+        """測試 argpartition top-k 與逐一計算的餘弦相似度一致"""
+        import math
+        import random
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+        rng = random.Random(7)
+        items = [(i, [rng.uniform(-1, 1) for _ in range(16)]) for i in range(200)]
+        query = [rng.uniform(-1, 1) for _ in range(16)]
+
+        def cosine(a, b):
+            dot = sum(x * y for x, y in zip(a, b))
+            return dot / (math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b)))
+
+        expected = sorted(items, key=lambda it: cosine(it[1], query), reverse=True)[:5]
+        results = NumpyVectorIndex.from_items(items).search(query, 5)
+        assert [i for i, _ in results] == [i for i, _ in expected]
+        assert results[0][1] == pytest.approx(cosine(expected[0][1], query), rel=1e-5)
+
+    def test_snapshot_is_memory_mapped(self, tmp_path):
+        """測試快照以唯讀 mmap 載入且結果相同"""
+        import numpy as np
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+        index = NumpyVectorIndex.from_items([(1, [1.0, 0.0]), (2, [0.0, 1.0]), (3, [1.0, 1.0])])
+        path = str(tmp_path / 'articles')
+        index.save(path)
+        loaded = NumpyVectorIndex.load(path)
+
+        assert isinstance(loaded.matrix, np.memmap)
+        assert loaded.matrix.dtype == np.float32
+        assert loaded.search([1.0, 0.2], 2) == index.search([1.0, 0.2], 2)
+
+    def test_skips_mismatched_dimensions(self):
+        """測試維度不一致或空向量不進入索引"""
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+        index = NumpyVectorIndex.from_items([(1, [1.0, 0.0]), (2, [1.0]), (3, None)])
+        assert len(index) == 1
+        assert index.search([1.0], 3) == []
+
+    def test_pgvector_failure_uses_local_candidates(self, clean_db_env):
+        """測試 pgvector 查詢失敗時改以程序內索引提供向量候選"""
+        from maya_sawa_v2.ai_processing.km_sources import programming
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+        clean_db_env.setenv('DATABASE_URL', 'postgres://u:p@db:5432/app')
+        source = programming.ProgrammingKMSource()
+        index = NumpyVectorIndex.from_items([(1, [1.0, 0.0]), (2, [0.0, 1.0])])
+        rows = [{'id': 1, '_hybrid_score': 0.9}]
+        mock_run = AsyncMock(side_effect=[Exception('statement timeout'), rows])
+        with patch.object(programming, 'get_vector_index', return_value=index), \
+                patch.object(source, '_arun_hybrid_query', mock_run):
+            assert asyncio.run(source._asearch_db_hybrid('spring', [1.0, 0.0])) == rows
+
+        candidates = mock_run.call_args_list[1].args[3]
+        assert candidates[0][0] == 1
+        assert candidates[0][1] == pytest.approx(1.0)
+
+    def test_paprika_articles_ranked_by_vector(self):
+        """測試 Paprika 回退文章以向量相似度排序"""
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource()
+        articles = [
+            {'id': 1, 'embedding': '[0.0, 1.0]'},
+            {'id': 2, 'embedding': [1.0, 0.1]},
+            {'id': 3},
+        ]
+        scores = source._paprika_vector_scores(articles, [1.0, 0.0])
+        assert set(scores) == {1, 2}
+        assert scores[2] > scores[1]
+        assert source._paprika_vector_scores(articles, [1.0, 0.0]) == scores
+
+
+class TestQuantizedVectorIndex:
+    """量化向量索引（float16 / int8）測試"""
+
+    @staticmethod
+    def _items(n=300, dim=32, seed=3):
+        import numpy as np
+        rng = np.random.default_rng(seed)
+        return [(i, v.tolist()) for i, v in enumerate(rng.normal(size=(n, dim)))]
+
+    @pytest.mark.parametrize('dtype, ratio', [('float16', 2), ('int8', 3.5)])
+    def test_quantized_scan_is_smaller_with_high_recall(self, dtype, ratio):
+        """測試量化後掃描位元組下降且 top-k 與 float32 幾乎一致"""
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+        items = self._items()
+        exact = NumpyVectorIndex.from_items(items)
+        index = NumpyVectorIndex.from_items(items, dtype=dtype, keep_float32=False)
+
+        assert index.dtype == dtype and index.matrix is None
+        assert exact.nbytes / index.nbytes >= ratio
+        query = items[0][1]
+        expected = {i for i, _ in exact.search(query, 10)}
+        assert len(expected & {i for i, _ in index.search(query, 10)}) >= 9
+
+    def test_rerank_uses_float32_scores(self):
+        """測試重排以 float32 重新計分"""
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+        items = self._items()
+        exact = NumpyVectorIndex.from_items(items)
+        index = NumpyVectorIndex.from_items(items, dtype='int8', rerank_candidates=40)
+        query = items[5][1]
+
+        assert index.search(query, 5) == pytest.approx(exact.search(query, 5))
+
+    def test_snapshot_round_trip(self, tmp_path):
+        """測試量化快照的儲存與載入，以及由 float32 快照於載入時量化"""
+        import numpy as np
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+        items = self._items(n=50, dim=8)
+        path = str(tmp_path / 'articles')
+        NumpyVectorIndex.from_items(items, dtype='int8', keep_float32=False).save(path)
+        loaded = NumpyVectorIndex.load(path)
+        assert loaded.dtype == 'int8' and loaded.matrix is None
+        assert isinstance(loaded.codes, np.memmap)
+        assert not (tmp_path / 'articles.vectors.npy').exists()
+
+        NumpyVectorIndex.from_items(items).save(path)
+        requantized = NumpyVectorIndex.load(path, dtype='float16', mmap=False)
+        assert requantized.dtype == 'float16' and requantized.matrix is None
+        assert requantized.search(items[0][1], 1)[0][0] == 0
+
+    def test_with_changes_keeps_format(self):
+        """測試增量更新沿用量化格式"""
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+        index = NumpyVectorIndex.from_items([(1, [1.0, 0.0]), (2, [0.0, 1.0])], dtype='int8', keep_float32=False)
+        new = index.with_changes([(3, [0.6, 0.8])], deletes=[1])
+        assert new.dtype == 'int8' and new.matrix is None
+        assert sorted(new.ids.tolist()) == [2, 3]
+        assert new.search([0.6, 0.8], 1)[0] == (3, pytest.approx(1.0, abs=0.02))
+
+    def test_recall_report(self):
+        """測試 recall 報告包含各格式與重排結果"""
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex, recall_report
+        report = recall_report(NumpyVectorIndex.from_items(self._items()), k=5, samples=20, rerank_candidates=20)
+        rows = {(r['dtype'], r['rerank']): r for r in report}
+
+        assert set(rows) == {('float32', 0), ('float16', 0), ('float16', 20), ('int8', 0), ('int8', 20)}
+        assert rows[('float32', 0)]['recall'] == 1.0
+        assert rows[('int8', 20)]['recall'] >= rows[('int8', 0)]['recall']
+        assert rows[('int8', 0)]['compression'] > 3.5
+
+    def test_halfvec_index_and_query_expressions(self, monkeypatch):
+        """測試 halfvec 索引與查詢使用相同運算式"""
+        from maya_sawa_v2.ai_processing.km_sources import pg_index
+        monkeypatch.setenv('KM_EMBEDDING_DIM', '1536')
+        sql = pg_index._index_sql('hnsw', pg_index.index_name('hnsw', 'halfvec'), 16, 64, 1, 'halfvec')
+
+        assert pg_index.index_name('hnsw', 'halfvec') == 'articles_embedding_hnsw_halfvec'
+        assert '(embedding::halfvec(1536)) halfvec_cosine_ops' in sql
+        assert pg_index.embedding_expr('halfvec') in sql
+        assert pg_index.query_cast('halfvec') == '::halfvec(1536)'
+
+    def test_halfvec_query_reranks_with_float32(self, clean_db_env):
+        """測試 halfvec 檢索先取較多候選再以 float32 欄位重排"""
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource({'pg_vector_type': 'halfvec', 'vector_rerank': 40})
+        cur = AsyncMock()
+        cur.fetchall.return_value = []
+        conn = MagicMock()
+        conn.cursor.return_value.__aenter__.return_value = cur
+        aconnection = MagicMock()
+        aconnection.return_value.__aenter__.return_value = conn
+        with patch.object(km_db, 'aconnection', aconnection):
+            asyncio.run(source._arun_hybrid_query('spring', [0.1, 0.2], []))
+
+        sql, params = cur.execute.call_args.args
+        assert '(embedding::halfvec(1536)) <=> (SELECT v FROM query_vec)::halfvec(1536)' in sql
+        assert 'embedding <=> (SELECT v FROM query_vec) AS dist' in sql
+        assert sql.count('%(qvec)s') == 1
+        assert params['vec_prefetch'] == 40 and params['vec_k'] == source.vector_candidates
+
+
+class TestBM25Index:
+    """BM25 全文索引測試"""
+
+    def test_tokenize_cjk_bigrams_and_words(self):
+        """測試中文以 bigram 切分，英數詞保留 c++ / .net 寫法"""
+        from maya_sawa_v2.ai_processing.km_sources.text_index import tokenize
+        assert tokenize('Spring Boot 自動配置') == ['spring', 'boot', '自動', '動配', '配置']
+        assert tokenize('C++ 與 .NET、C#。') == ['c++', '與', '.net', 'c#']
+
+    def test_search_ranks_by_bm25(self):
+        """測試無空白的中文查詢也能命中，且詞頻較高的文件排前"""
+        from maya_sawa_v2.ai_processing.km_sources.text_index import BM25Index
+        index = BM25Index.from_items([
+            (1, 'Spring Boot 自動配置原理'),
+            (2, '自動配置 自動配置 詳解'),
+            (3, 'Python 教學'),
+            (4, ''),
+        ])
+        results = index.search('自動配置怎麼用', 5)
+
+        assert len(index) == 3
+        assert [i for i, _ in results] == [2, 1]
+        assert index.matched_terms(1, '自動配置') == ['自動', '動配', '配置']
+        assert index.search('rust', 5) == []
+
+    def test_with_changes_renumbers_postings(self):
+        """測試增量更新不修改舊索引，且刪除的文件不再命中"""
+        from maya_sawa_v2.ai_processing.km_sources.text_index import BM25Index
+        old = BM25Index.from_items([(1, 'java spring'), (2, 'java 集合'), (3, 'python')])
+        new = old.with_changes([(2, 'golang 並發'), (5, 'java stream')], deletes=[1])
+
+        assert {i for i, _ in old.search('java', 5)} == {1, 2}
+        assert [i for i, _ in new.search('java', 5)] == [5]
+        assert [i for i, _ in new.search('並發', 5)] == [2]
+        assert sorted(new.ids.tolist()) == [2, 3, 5]
+
+    def test_sync_builds_text_index(self, monkeypatch):
+        """測試增量同步同時建立全文索引"""
+        from datetime import datetime
+        from maya_sawa_v2.ai_processing.km_sources import index_sync, text_index
+
+        monkeypatch.setattr(text_index, '_index', None)
+        engine, _ = TestIndexSync._engine([
+            (1, 'java/spring.md', 'Spring Boot 自動配置', None, False, datetime(2025, 1, 1)),
+        ], monkeypatch)
+        engine.register(index_sync.TextIndexTarget())
+        engine.sync()
+
+        index = text_index.get_text_index()
+        assert index.search('自動配置', 1)[0][0] == 1
+        assert index.meta['watermark'] == [datetime(2025, 1, 1).isoformat(), 1]
+
+    def test_hybrid_query_passes_bm25_candidates(self, clean_db_env, monkeypatch):
+        """測試 BM25 候選以陣列帶入融合 SQL"""
+        from maya_sawa_v2.ai_processing.km_sources import text_index
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        from maya_sawa_v2.ai_processing.km_sources.text_index import BM25Index
+        monkeypatch.setattr(text_index, '_index', BM25Index.from_items([(7, '自動配置'), (8, '配置檔')]))
+        source = ProgrammingKMSource({'retrieval_mode': 'snippet'})
+        cur = AsyncMock()
+        cur.fetchall.return_value = [(7, 'a.md', None, 0.0, 0.0, 1.0, 0.3, 'head', 'snippet')]
+        conn = MagicMock()
+        conn.cursor.return_value.__aenter__.return_value = cur
+        aconnection = MagicMock()
+        aconnection.return_value.__aenter__.return_value = conn
+        with patch.object(km_db, 'aconnection', aconnection):
+            rows = asyncio.run(source._arun_hybrid_query('自動配置', None, []))
+
+        sql, params = cur.execute.call_args.args
+        assert 'bm25_rank' in sql
+        assert params['bm25_ids'][0] == 7 and params['bm25_scores'][0] == 1.0
+        assert rows[0]['bm25_score'] == 1.0 and rows[0]['_hybrid_score'] == 0.3
+
+    def test_fallback_scores_paprika_with_bm25(self):
+        """測試資料庫無結果時以 BM25 為 Paprika 文章排序"""
+        from maya_sawa_v2.ai_processing.km_sources.base import KMQuery
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource()
+        articles = [
+            {'id': 1, 'file_path': 'python/intro.md', 'content': 'Python 入門'},
+            {'id': 2, 'file_path': 'java/spring.md', 'content': 'Spring 自動配置原理'},
+        ]
+        with patch.object(source, '_acompute_query_embedding_safe', AsyncMock(return_value=None)), \
+                patch.object(source, '_asearch_db_hybrid', AsyncMock(return_value=[])), \
+                patch.object(source, '_aget_cached_articles', AsyncMock(return_value=articles)):
+            results = source.search(KMQuery(query='自動配置是什麼', user_id=1, conversation_id='c1'))
+
+        assert [r.metadata['article_id'] for r in results] == [2]
+        assert results[0].relevance_score == 1.0
+        assert results[0].metadata['matched_terms'] == ['自動', '動配', '配置']
+
+
+class TestIndexSync:
+    """文章索引增量同步測試"""
+
+    @staticmethod
+    def _engine(rows, monkeypatch):
+        """建立使用假資料庫連線的同步引擎"""
+        from contextlib import contextmanager
+        from maya_sawa_v2.ai_processing.km_sources import index_sync
+
+        cursor = MagicMock()
+        cursor.fetchmany.side_effect = [rows, []]
+
+        @contextmanager
+        def fake_connection():
+            conn = MagicMock()
+            conn.cursor.return_value.__enter__.return_value = cursor
+            yield conn
+
+        monkeypatch.setenv('DATABASE_URL', 'postgres://u:p@db:5432/app')
+        monkeypatch.setenv('KM_VECTOR_BACKEND', 'local')
+        monkeypatch.setattr(index_sync.km_db, 'connection', fake_connection)
+        engine = index_sync.IndexSyncEngine()
+        engine.register(index_sync.VectorIndexTarget())
+        return engine, cursor
+
+    def test_incremental_sync_applies_upserts_and_tombstones(self, monkeypatch):
+        """測試增量同步套用更新與刪除並推進 watermark"""
+        from datetime import datetime
+        from maya_sawa_v2.ai_processing.km_sources import vector_index
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+
+        monkeypatch.setattr(vector_index, '_index', NumpyVectorIndex.from_items([(1, [1.0, 0.0]), (2, [0.0, 1.0])]))
+        monkeypatch.setattr(vector_index, '_loaded', True)
+        t1, t2 = datetime(2025, 1, 1), datetime(2025, 1, 2)
+        engine, cursor = self._engine([
+            (2, 'docs/b.md', 'b', None, True, t1),
+            (3, 'docs/c.md', 'c', '[1,1]', False, t2),
+            (4, 'test/d.md', 'd', '[1,0]', True, t2),
+        ], monkeypatch)
+        engine.watermark = (datetime(2024, 12, 31), 9)
+
+        stats = engine.sync()
+
+        assert cursor.execute.call_args.args[1] == {'changed_at': datetime(2024, 12, 31), 'id': 9}
+        assert (stats['upserts'], stats['deletes'], stats['version']) == (1, 2, 1)
+        assert engine.watermark == (t2, 4)
+        index = vector_index.get_vector_index()
+        assert sorted(index.ids.tolist()) == [1, 3]
+        assert index.meta['watermark'] == [t2.isoformat(), 4]
+
+    def test_unknown_watermark_triggers_full_sync(self, monkeypatch):
+        """測試沒有 watermark 時完整重建（不帶 WHERE 條件）"""
+        from datetime import datetime
+        from maya_sawa_v2.ai_processing.km_sources import vector_index
+
+        monkeypatch.setattr(vector_index, '_index', None)
+        monkeypatch.setattr(vector_index, '_loaded', True)
+        engine, cursor = self._engine([(1, 'docs/a.md', 'a', '[1,0]', False, datetime(2025, 1, 1))], monkeypatch)
+
+        assert engine.sync()['status'] == 'full'
+        assert 'WHERE' not in cursor.execute.call_args.args[0]
+        assert vector_index.get_vector_index().search([1.0, 0.0], 1)[0][0] == 1
+
+    def test_vector_target_disabled_for_pgvector_backend(self, monkeypatch):
+        """測試 pgvector 部署且未載入快照時不同步程序內向量索引，載入快照後才同步"""
+        from maya_sawa_v2.ai_processing.km_sources import index_sync, vector_index
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+
+        monkeypatch.setenv('KM_VECTOR_BACKEND', 'pgvector')
+        monkeypatch.setattr(vector_index, '_index', None)
+        monkeypatch.setattr(vector_index, '_loaded', True)
+        target = index_sync.VectorIndexTarget()
+        assert not target.enabled()
+
+        monkeypatch.setattr(vector_index, '_index', NumpyVectorIndex.from_items([(1, [1.0, 0.0])]))
+        assert target.enabled()
+
+    def test_full_sync_text_only_skips_embedding_and_applies_per_batch(self, monkeypatch):
+        """測試只有全文索引啟用時不讀取 embedding，完整重建逐批累積、最後一次發布"""
+        from datetime import datetime
+        from maya_sawa_v2.ai_processing.km_sources import index_sync, text_index, vector_index
+
+        monkeypatch.setattr(text_index, '_index', None)
+        monkeypatch.setattr(vector_index, '_index', None)
+        monkeypatch.setattr(vector_index, '_loaded', True)
+        t = datetime(2025, 1, 1)
+        batches = [
+            [(1, 'java/spring.md', 'Spring Boot 自動配置', None, False, t)],
+            [(2, 'python/intro.md', 'Python 入門', None, False, t), (3, 'test/x.md', 'x', None, True, t)],
+        ]
+        engine, cursor = self._engine([], monkeypatch)
+        monkeypatch.setenv('KM_VECTOR_BACKEND', 'pgvector')
+        cursor.fetchmany.side_effect = batches + [[]]
+        text_target = index_sync.TextIndexTarget()
+        engine.register(text_target)
+        seen = []
+        original = text_target.add_batch
+        monkeypatch.setattr(text_target, 'add_batch',
+                            lambda state, rows: seen.append([r['id'] for r in rows]) or original(state, rows))
+
+        stats = engine.sync()
+
+        select = cursor.execute.call_args.args[0]
+        assert 'SELECT id, file_path, content, NULL,' in select
+        assert seen == [[1], [2]]
+        assert (stats['status'], stats['upserts'], stats['scanned']) == ('full', 2, 3)
+        index = text_index.get_text_index()
+        assert sorted(index.ids.tolist()) == [1, 2]
+        assert index.search('自動配置', 1)[0][0] == 1
+        assert vector_index.get_vector_index() is None
+
+    def test_full_sync_builds_vector_index_across_batches(self, monkeypatch):
+        """測試完整重建跨批累積向量並讀取 embedding 欄位"""
+        from datetime import datetime
+        from maya_sawa_v2.ai_processing.km_sources import vector_index
+
+        monkeypatch.setattr(vector_index, '_index', None)
+        monkeypatch.setattr(vector_index, '_loaded', True)
+        t = datetime(2025, 1, 1)
+        engine, cursor = self._engine([], monkeypatch)
+        cursor.fetchmany.side_effect = [[(1, 'a.md', 'a', '[1,0]', False, t)],
+                                        [(2, 'b.md', 'b', '[0,1]', False, t), (3, 'c.md', 'c', None, False, t)],
+                                        []]
+
+        assert engine.sync()['status'] == 'full'
+        assert 'content, embedding,' in cursor.execute.call_args.args[0]
+        index = vector_index.get_vector_index()
+        assert sorted(index.ids.tolist()) == [1, 2]
+        assert index.search([0.0, 1.0], 1)[0][0] == 2
+        assert index.meta['watermark'] == [t.isoformat(), 3]
+
+    def test_failed_target_keeps_watermark_and_redelivers(self, monkeypatch):
+        """測試任一索引套用失敗時不推進 watermark，下次同步重新送出同一批變更"""
+        from datetime import datetime
+        from maya_sawa_v2.ai_processing.km_sources import index_sync
+
+        class FlakyTarget(index_sync.IndexTarget):
+            name = 'flaky'
+
+            def __init__(self):
+                self.calls = []
+
+            def watermark(self):
+                return None
+
+            def apply(self, upserts, deletes, full, watermark):
+                self.calls.append([row['id'] for row in upserts])
+                if len(self.calls) == 1:
+                    raise RuntimeError('boom')
+
+        start = (datetime(2024, 12, 31), 9)
+        rows = [(3, 'docs/c.md', 'c', '[1,1]', False, datetime(2025, 1, 2))]
+        engine, cursor = self._engine(rows, monkeypatch)
+        cursor.fetchmany.side_effect = [rows, [], rows, []]
+        engine.targets = {}
+        target = FlakyTarget()
+        engine.register(target)
+        engine.watermark = start
+
+        assert engine.sync()['failed'] == ['flaky']
+        assert engine.watermark == start
+
+        stats = engine.sync()
+        assert cursor.execute.call_args.args[1] == {'changed_at': start[0], 'id': start[1]}
+        assert stats['failed'] == []
+        assert target.calls == [[3], [3]]
+        assert engine.watermark == (datetime(2025, 1, 2), 3)
+
+    def test_no_changes_keeps_version(self, monkeypatch):
+        """測試沒有變更時不發布新版本"""
+        from datetime import datetime
+        engine, _ = self._engine([], monkeypatch)
+        engine.watermark = (datetime(2025, 1, 1), 1)
+        with patch('maya_sawa_v2.ai_processing.signals.km_index_published.send') as mock_send:
+            assert engine.sync()['version'] == 0
+        mock_send.assert_not_called()
+
+    def test_with_changes_does_not_mutate_published_index(self):
+        """測試套用變更產生新索引，舊版本保持不變"""
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import NumpyVectorIndex
+        old = NumpyVectorIndex.from_items([(1, [1.0, 0.0]), (2, [0.0, 1.0])])
+        new = old.with_changes([(2, [1.0, 0.0]), (5, [0.6, 0.8])], deletes=[1])
+        assert old.ids.tolist() == [1, 2]
+        assert sorted(new.ids.tolist()) == [2, 5]
+        assert new.search([1.0, 0.0], 1)[0][0] == 2
+
+
+class TestArticleChunks:
+    """段落切分與段落檢索測試"""
+
+    DOC = (
+        "# Spring Boot\n\nSpring Boot 簡化了 Spring 應用的建立。\n\n## 自動配置\n\n"
+        + "自動配置會依據 classpath 決定要建立哪些 bean。" * 30
+        + "\n\n```java\n@SpringBootApplication\n\npublic class App {}\n```\n\n## 結語\n\n短結語。\n"
+    )
+
+    def test_chunks_follow_headings_and_token_limit(self):
+        """測試段落不跨越標題、不超過 token 上限，且保留標題路徑"""
+        from maya_sawa_v2.ai_processing.km_sources.chunking import chunk_markdown, estimate_tokens
+        chunks = chunk_markdown(self.DOC, max_tokens=120, overlap_tokens=30)
+
+        assert chunks[0].heading == 'Spring Boot'
+        assert chunks[-1].heading == 'Spring Boot > 結語' and chunks[-1].content == '短結語。'
+        assert all(c.token_count <= 120 for c in chunks)
+        assert all(self.DOC[c.start:c.end] == c.content for c in chunks)
+        assert [c.index for c in chunks] == list(range(len(chunks)))
+        assert estimate_tokens('Spring 自動配置') == 4 + 2
+
+    def test_adjacent_chunks_overlap(self):
+        """測試同一標題下相鄰段落前後重疊，程式碼區塊不被空行切開"""
+        from maya_sawa_v2.ai_processing.km_sources.chunking import chunk_markdown
+        chunks = [c for c in chunk_markdown(self.DOC, max_tokens=120, overlap_tokens=30)
+                  if c.heading == 'Spring Boot > 自動配置']
+
+        assert len(chunks) > 2
+        assert all(b.start < a.end for a, b in zip(chunks, chunks[1:]))
+        assert '@SpringBootApplication\n\npublic class App {}' in chunks[-1].content
+
+    def test_apply_chunks_keeps_unchanged_embeddings(self):
+        """測試重新切分時內容未變的段落只更新位置（保留 embedding），其餘新增或刪除"""
+        from maya_sawa_v2.ai_processing.km_sources.chunking import Chunk, _apply_chunks
+        kept = Chunk(0, 'A', '不變的段落', 0, 5, 5)
+        added = Chunk(1, 'A', '新段落', 6, 9, 3)
+        cur = MagicMock()
+        cur.fetchall.return_value = [(10, kept.content_hash), (11, 'stale-hash')]
+
+        assert _apply_chunks(cur, 1, [kept, added]) == (1, 1, 1)
+        statements = [c.args[0] for c in cur.execute.call_args_list + cur.executemany.call_args_list]
+        assert any(s.startswith('DELETE') for s in statements)
+        update = next(c for c in cur.executemany.call_args_list if c.args[0].startswith('UPDATE'))
+        assert update.args[1] == [(0, 0, 5, 10)]
+
+    def test_sync_skipped_without_table(self, clean_db_env):
+        """測試 article_chunks 表不存在時不切分"""
+        from maya_sawa_v2.ai_processing.km_sources import chunking
+        clean_db_env.setenv('DATABASE_URL', 'postgres://u:p@db:5432/app')
+        cur = MagicMock()
+        cur.fetchone.return_value = (False,)
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        connection = MagicMock()
+        connection.return_value.__enter__.return_value = conn
+        with patch.object(km_db, 'connection', connection):
+            assert chunking.sync_article_chunks()['articles'] == 0
+        assert cur.execute.call_count == 1
+
+    def test_sync_excludes_test_articles(self, clean_db_env):
+        """測試段落切分的 SQL 以 articles.is_test 排除測試文章"""
+        from maya_sawa_v2.ai_processing.km_sources import chunking
+        clean_db_env.setenv('DATABASE_URL', 'postgres://u:p@db:5432/app')
+        cur = MagicMock()
+        cur.fetchone.return_value = (True,)
+        cur.fetchall.return_value = []
+        cur.rowcount = 0
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        connection = MagicMock()
+        connection.return_value.__enter__.return_value = conn
+        with patch.object(km_db, 'connection', connection):
+            assert chunking.sync_article_chunks()['articles'] == 0
+
+        select = next(c.args[0] for c in cur.execute.call_args_list if 'SELECT a.id, a.content' in c.args[0])
+        assert 'AND NOT a.is_test' in select
+        assert 'a.NOT' not in select
+
+    def _hybrid_cursor(self, rows):
+        cur = AsyncMock()
+        cur.fetchall.return_value = rows
+        conn = MagicMock()
+        conn.cursor.return_value.__aenter__.return_value = cur
+        aconnection = MagicMock()
+        aconnection.return_value.__aenter__.return_value = conn
+        return cur, aconnection
+
+    def test_hybrid_query_returns_best_passage(self, clean_db_env):
+        """測試 passage 模式以段落向量擴充召回，並回傳最相關段落與所屬文章"""
+        from maya_sawa_v2.ai_processing.km_sources import pg_index
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource({'retrieval_mode': 'passage'})
+        cur, aconnection = self._hybrid_cursor(
+            [(7, 'java/spring.md', None, 0.8, 0.2, 0.0, 0.6, '# Spring', 'snippet', 70, 3, 'Spring > 自動配置', '段落內容')])
+        with patch.object(km_db, 'aconnection', aconnection):
+            rows = asyncio.run(source._arun_hybrid_query('自動配置', [0.1, 0.2], ['自動']))
+
+        sql, params = cur.execute.call_args.args
+        assert 'FROM article_chunks' in sql and params['chunk_k'] == source.chunk_candidates
+        # 段落 ANN 候選與文章候選相同，排除測試與已刪除文章
+        chunk_vec = sql[sql.index('FROM article_chunks c'):sql.index(') chunk_vec')]
+        assert 'JOIN articles a ON a.id = c.article_id' in chunk_vec
+        assert pg_index.VISIBLE_SQL in chunk_vec and 'a.deleted_at IS NULL' in chunk_vec
+        assert rows[0]['passage'] == {'chunk_id': 70, 'chunk_index': 3, 'heading': 'Spring > 自動配置'}
+        assert source._result_content(rows[0], ['自動']) == 'Spring > 自動配置\n\n段落內容'
+
+    def test_missing_chunk_table_falls_back_to_snippet(self, clean_db_env):
+        """測試 article_chunks 表不存在時改用片段檢索，並暫停段落檢索"""
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+
+        class UndefinedTable(Exception):
+            sqlstate = '42P01'
+
+        source = ProgrammingKMSource({'retrieval_mode': 'passage'})
+        cur, aconnection = self._hybrid_cursor([(7, 'a.md', None, 0.0, 0.5, 0.0, 0.3, 'head', 'snippet')])
+        cur.execute.side_effect = [None, UndefinedTable('relation "article_chunks" does not exist'), None, None]
+        with patch.object(km_db, 'aconnection', aconnection):
+            rows = asyncio.run(source._arun_hybrid_query('spring', None, ['spring']))
+
+        assert 'article_chunks' not in cur.execute.call_args.args[0]
+        assert rows[0]['snippet'] == 'snippet' and 'passage' not in rows[0]
+        assert not source._chunks_usable()
+
+
+
+class TestEmbeddingBackfillEngine:
+    """並行 embedding 補齊引擎測試"""
+
+    class FakeClient:
+        """依輸入長度產生 embedding；第一批刻意較慢，讓批次完成順序與送出順序不同"""
+
+        def __init__(self, fail_on=None):
+            import threading
+            self.fail_on = fail_on
+            self.calls = []
+            self.lock = threading.Lock()
+            self.embeddings = self
+
+        def create(self, model, input):
+            import time
+            from types import SimpleNamespace
+            with self.lock:
+                self.calls.append(list(input))
+                first = len(self.calls) == 1
+            if first:
+                time.sleep(0.05)
+            if self.fail_on and self.fail_on in input:
+                raise RuntimeError('rate limited')
+            return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(t))]) for t in input])
+
+    def _run(self, pages, client, reembed=False, checkpoint=None, **kwargs):
+        from maya_sawa_v2.ai_processing.km_sources import backfill
+        cur = MagicMock()
+        cur.fetchall.side_effect = pages + [[]]
+        cur.fetchone.return_value = checkpoint
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        connection = MagicMock()
+        connection.return_value.__enter__.return_value = conn
+        engine = backfill.EmbeddingBackfill(client=client, batch_size=2, concurrency=3, flush_rows=2,
+                                            limiter=backfill.TokenRateLimiter(10_000), **kwargs)
+        with patch.object(km_db, 'connection', connection), \
+                patch('maya_sawa_v2.ai_processing.km_sources.result_cache.bump_corpus_version'):
+            processed = engine.run(reembed=reembed)
+        written = [c.args[0] for c in cur.copy.return_value.__enter__.return_value.write_row.call_args_list]
+        statements = [c.args[0] for c in cur.execute.call_args_list]
+        return processed, written, statements, cur
+
+    def test_rate_limiter_waits_for_refill(self):
+        """測試超過每分鐘配額時等待補充"""
+        from maya_sawa_v2.ai_processing.km_sources.backfill import TokenRateLimiter
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        limiter = TokenRateLimiter(600, clock=lambda: now[0], sleep=sleep)
+        assert limiter.acquire(600) == 0.0
+        assert limiter.acquire(100) == pytest.approx(10.0)
+        assert sleeps == [pytest.approx(10.0)]
+
+    def test_concurrent_batches_written_in_id_order(self):
+        """測試並行批次依 id 順序以 COPY + UPDATE ... FROM 寫回"""
+        rows = [(i, 'x' * i) for i in range(1, 8)]
+        client = self.FakeClient()
+        processed, written, statements, _ = self._run([rows], client)
+
+        assert processed == 7
+        assert [row_id for row_id, _ in written] == list(range(1, 8))
+        assert written[2] == (3, '[3.0]')
+        assert sum(s.startswith('UPDATE articles t') for s in statements) == 2
+        assert len(client.calls) == 4
+
+    def test_failure_keeps_written_prefix_and_checkpoint(self):
+        """測試批次失敗時只寫回之前依序完成的批次，checkpoint 停在最後寫回的 id"""
+        rows = [(i, f'text-{i}') for i in range(1, 9)]
+        client = self.FakeClient(fail_on='text-5')
+        processed, written, statements, cur = self._run([rows], client, reembed=True, checkpoint=None)
+
+        assert processed == 4
+        assert [row_id for row_id, _ in written] == [1, 2, 3, 4]
+        checkpoint = [c.args[1] for c in cur.execute.call_args_list if 'INSERT INTO km_backfill_checkpoints' in c.args[0]]
+        assert [c[3:] for c in checkpoint] == [(2, 2, False), (4, 2, False)]
+
+    def test_reembed_resumes_after_checkpoint(self):
+        """測試重算從 checkpoint 的 last_id 之後繼續，完成後標記結束"""
+        client = self.FakeClient()
+        processed, written, statements, cur = self._run([[(11, 'a'), (12, 'b')]], client, reembed=True,
+                                                        checkpoint=(10, False))
+
+        page_query = next(c for c in cur.execute.call_args_list if c.args[0].startswith('SELECT id, content'))
+        assert 'embedding IS NULL' not in page_query.args[0] and page_query.args[1][0] == 10
+        assert processed == 2
+        finished = [c.args[1] for c in cur.execute.call_args_list if 'INSERT INTO km_backfill_checkpoints' in c.args[0]]
+        assert finished[-1][3:] == (12, 0, True)
+
+    def test_pending_count_runs_no_ddl(self):
+        """測試 dry run 統計待處理筆數時不建立 checkpoint 表（表不存在時從頭起算）"""
+        from maya_sawa_v2.ai_processing.km_sources import backfill
+        cur = MagicMock()
+        cur.fetchone.side_effect = [(False,), (7,)]
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        connection = MagicMock()
+        connection.return_value.__enter__.return_value = conn
+        with patch.object(km_db, 'connection', connection):
+            assert backfill.EmbeddingBackfill().pending_count(reembed=True) == 7
+
+        statements = [c.args[0] for c in cur.execute.call_args_list]
+        assert not any('CREATE TABLE' in sql for sql in statements)
+        assert cur.execute.call_args.args[1] == (0,)
+
+    def test_finished_job_is_skipped(self):
+        """測試已完成的重算不再執行"""
+        client = self.FakeClient()
+        processed, _, _, _ = self._run([[(1, 'a')]], client, reembed=True, checkpoint=(1, True))
+        assert processed == 0 and client.calls == []
+
+
+class TestBinaryVectorTransport:
+    """pgvector 二進位傳輸測試"""
+
+    @pytest.fixture
+    def vector_conn(self):
+        """註冊了 pgvector adapter 的連線替身（只有 adapters，不連資料庫）"""
+        from types import SimpleNamespace
+        import psycopg
+        from psycopg.adapt import AdaptersMap
+        from psycopg.types import TypeInfo
+        from pgvector.psycopg.vector import register_vector_info
+        conn = SimpleNamespace(adapters=AdaptersMap(psycopg.adapters), connection=None)
+        register_vector_info(conn, TypeInfo('vector', 90001, 90002))
+        return conn
+
+    def test_query_vector_is_dumped_as_binary(self, vector_conn):
+        """測試已註冊 adapter 的連線以 float32 二進位傳送查詢向量"""
+        import numpy as np
+        from psycopg.adapt import PyFormat, Transformer
+        from psycopg.pq import Format
+        param = km_db.vector_param(vector_conn, [0.5, -1.0, 2.0])
+
+        assert isinstance(param, np.ndarray) and param.dtype == np.float32
+        dumper = Transformer(vector_conn).get_dumper(param, PyFormat.AUTO)
+        assert dumper.format == Format.BINARY and dumper.oid == 90001
+        assert len(dumper.dump(param)) == 4 + 3 * 4
+
+    def test_falls_back_to_text_without_adapter(self):
+        """測試未註冊 adapter（如未安裝 pgvector 擴充）時退回文字格式"""
+        assert km_db.vector_param(MagicMock(), [0.5, 1.0]) == '[0.5,1.0]'
+
+    def test_parse_vector_accepts_loaded_vectors(self):
+        """測試索引同步可直接使用 adapter 載入的 Vector / numpy 陣列"""
+        import numpy as np
+        from pgvector import Vector
+        from maya_sawa_v2.ai_processing.km_sources.vector_index import parse_vector
+        assert parse_vector(Vector([1.0, 2.0])).tolist() == [1.0, 2.0]
+        assert parse_vector(np.array([1.0, 2.0])).dtype == np.float32
+        assert parse_vector('[1,2]') == [1.0, 2.0]
+
+    def test_backfill_copies_binary_vectors(self, vector_conn):
+        """測試補齊以二進位 COPY 寫入暫存表"""
+        import numpy as np
+        from maya_sawa_v2.ai_processing.km_sources import backfill
+        cur = MagicMock()
+        engine = backfill.EmbeddingBackfill(client=MagicMock())
+        engine._flush(MagicMock(adapters=vector_conn.adapters), cur, [(1, [0.1, 0.2])], reembed=False)
+
+        copy = cur.copy.return_value.__enter__.return_value
+        assert 'FORMAT BINARY' in cur.copy.call_args.args[0]
+        copy.set_types.assert_called_once_with(['int8', 'vector'])
+        row = copy.write_row.call_args.args[0]
+        assert row[0] == 1 and isinstance(row[1], np.ndarray)
+        assert any('SET embedding = s.embedding,' in c.args[0] for c in cur.execute.call_args_list)
+
+
+class TestTestArticleExclusion:
+    """測試文章排除（articles.is_test 產生欄位 + 部分索引）測試"""
+
+    def test_hybrid_query_filters_with_indexed_column(self, clean_db_env):
+        """測試混合檢索以 NOT is_test 過濾，不再使用 NOT LIKE 掃描"""
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource({'retrieval_mode': 'snippet'})
+        cur = AsyncMock()
+        cur.fetchall.return_value = []
+        conn = MagicMock()
+        conn.cursor.return_value.__aenter__.return_value = cur
+        aconnection = MagicMock()
+        aconnection.return_value.__aenter__.return_value = conn
+        with patch.object(km_db, 'aconnection', aconnection):
+            asyncio.run(source._arun_hybrid_query('spring', [0.1, 0.2], ['spring']))
+
+        sql = cur.execute.call_args.args[0]
+        assert 'NOT LIKE' not in sql
+        assert sql.count('NOT is_test') == 2
+
+    def test_ann_index_is_partial(self):
+        """測試 ANN 索引只涵蓋正式文章（與檢索條件相同才會被使用）"""
+        from maya_sawa_v2.ai_processing.km_sources import pg_index
+        for method in ('hnsw', 'ivfflat'):
+            sql = pg_index._index_sql(method, pg_index.index_name(method, 'vector'), 16, 64, 100, 'vector')
+            assert sql.endswith(f"WHERE {pg_index.VISIBLE_SQL}")
+
+    def test_paprika_filter_is_memoized_per_list(self):
+        """測試 Paprika 測試文章過濾只在文章列表更新時重算"""
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource()
+        articles = [{'id': 1, 'file_path': 'java/spring.md'}, {'id': 2, 'file_path': 'docs/Test-plan.md'}]
+
+        visible = source._visible_paprika_articles(articles)
+        assert [a['id'] for a in visible] == [1]
+        assert source._visible_paprika_articles(articles) is visible
+        assert source._visible_paprika_articles(list(articles)) is not visible
+
+
+class TestRetrievalBenchmark:
+    """離線檢索基準測試"""
+
+    def test_hash_embedder_is_deterministic(self):
+        """測試假 embedding 固定且已正規化，詞彙重疊的文字較相似"""
+        from maya_sawa_v2.ai_processing.km_sources.benchmark import HashEmbedder
+        embedder = HashEmbedder(dim=64)
+        a = embedder.embed('Spring 交易回滾')
+        assert a == HashEmbedder(dim=64).embed('Spring 交易回滾')
+        assert abs(sum(v * v for v in a) - 1.0) < 1e-9
+        similar = sum(x * y for x, y in zip(a, embedder.embed('Spring 交易')))
+        other = sum(x * y for x, y in zip(a, embedder.embed('React hooks')))
+        assert similar > other
+
+    def test_metrics_and_trigram_similarity(self):
+        """測試 recall@k、reciprocal rank、百分位數與 pg_trgm 相同的 similarity"""
+        from maya_sawa_v2.ai_processing.km_sources import benchmark
+        assert benchmark.recall_at_k(['a', 'b', 'c'], ['c', 'd'], 2) == 0.0
+        assert benchmark.recall_at_k(['a', 'b', 'c'], ['c', 'd'], 3) == 0.5
+        assert benchmark.reciprocal_rank(['a', 'b', 'c'], ['b']) == 0.5
+        assert benchmark.percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.5
+        assert benchmark.trigrams('cat') == {'  c', ' ca', 'cat', 'at '}
+        assert benchmark.trigram_similarity(benchmark.trigrams('cat'), benchmark.trigrams('cat')) == 1.0
+
+    def test_local_benchmark_reports_stages_and_quality(self, clean_db_env):
+        """測試沒有資料庫時以程序內後端執行，輸出各階段延遲與品質，且不回傳測試文章"""
+        from maya_sawa_v2.ai_processing.km_sources import benchmark
+        result = benchmark.run_benchmark(repeat=1)
+
+        assert result['backend'] == 'local'
+        assert set(result['latency_ms']) == set(benchmark.STAGES + benchmark.LocalBackend.stages)
+        assert all(set(v) == {'p50', 'p95', 'mean'} for v in result['latency_ms'].values())
+        assert set(result['quality']['by_lang']) == {'en', 'mixed', 'zh'}
+        assert result['quality'][f"recall@{result['k']}"] >= 0.8
+        assert not any(path.startswith('test/') for q in result['per_query'] for path in q['ranked'])
+
+    def test_postgres_backend_times_production_query(self, clean_db_env):
+        """測試資料庫後端執行 ProgrammingKMSource 的正式檢索 SQL，只把表名換成暫存表"""
+        from maya_sawa_v2.ai_processing.km_sources import benchmark
+        from maya_sawa_v2.ai_processing.km_sources.programming import ProgrammingKMSource
+        source = ProgrammingKMSource({'retrieval_mode': 'snippet'})
+        conn = MagicMock()
+        cur = conn.cursor.return_value.__enter__.return_value
+        backend = benchmark.PostgresBackend(conn, [{'id': 1, 'file_path': 'a.md', 'content': 'spring'}],
+                                            {1: [0.1, 0.2]}, dim=2)
+        cur.fetchall.return_value = [(1, 'a.md', None, 0.9, 0.5, 0.0, 0.7, 'spring', 'spring')]
+
+        with patch.object(km_db, 'vector_param', side_effect=lambda conn, vec: vec):
+            ids = backend.retrieve(source, 'spring', [0.1, 0.2], [(1, 1.0)], 5, lambda stage, fn: fn())
+
+        sql, params = cur.execute.call_args.args
+        expected_sql, _ = source.build_hybrid_query('spring', [0.1, 0.2], ['spring'],
+                                                    table=benchmark.BENCH_TABLE, bm25=[(1, 1.0)])
+        assert ids == [1]
+        assert sql == expected_sql
+        assert f'FROM {benchmark.BENCH_TABLE}' in sql and 'FROM articles' not in sql and 'JOIN articles' not in sql
+        assert params['bm25_ids'] == [1] and params['qvec'] == [0.1, 0.2]
+
+    def test_compare_reports_deltas_and_changed_queries(self):
+        """測試與基準結果比較的差值"""
+        from maya_sawa_v2.ai_processing.km_sources import benchmark
+        base = {'k': 5, 'corpus': {'sha1': 'x'}, 'quality': {'mrr': 0.5, 'recall@5': 0.6, 'queries': 2},
+                'latency_ms': {'vector': {'p50': 1.0, 'p95': 2.0}},
+                'per_query': [{'id': 'q1', 'ranked': ['a']}, {'id': 'q2', 'ranked': ['b']}]}
+        current = {'k': 5, 'corpus': {'sha1': 'x'}, 'quality': {'mrr': 0.75, 'recall@5': 0.6, 'queries': 2},
+                   'latency_ms': {'vector': {'p50': 0.5, 'p95': 2.5}},
+                   'per_query': [{'id': 'q1', 'ranked': ['a']}, {'id': 'q2', 'ranked': ['c']}]}
+
+        diff = benchmark.compare(base, current)
+        assert diff['comparable']
+        assert diff['quality'] == {'mrr': 0.25, 'recall@5': 0.0}
+        assert diff['latency_ms'] == {'vector': {'p50': -0.5, 'p95': 0.5}}
+        assert diff['changed_queries'] == ['q2']